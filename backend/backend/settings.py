@@ -38,7 +38,7 @@ INSTALLED_APPS = [
     'django.contrib.messages',
     'django.contrib.staticfiles',
     'rest_framework',
-    'tourint',
+    'tourint.apps.TourintConfig',
     'corsheaders',
 ]
 
@@ -91,6 +91,10 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        'OPTIONS': {
+            # Download processes write progress concurrently with the web process
+            'timeout': 20,
+        },
     }
 }
 
@@ -132,3 +136,48 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/3.0/howto/static-files/
 
 STATIC_URL = '/static/'
+
+
+# Live progress streaming (/torrents/events/)
+
+# Minimum time between batches of updates pushed to a client
+TOURINT_PROGRESS_STREAM_INTERVAL_S = 0.5
+
+
+# Adding torrents (POST /torrents/)
+
+# Threads fetching and parsing .torrent files in the background
+TOURINT_FETCH_WORKERS = 4
+
+# Start the download worker forkserver when the server starts, instead of on the first download
+TOURINT_PREWARM_WORKERS = True
+
+
+# Engine metrics (/metrics)
+
+# Have downloads record counters and latency histograms. Turned off, recording is a no-op.
+TOURINT_METRICS_ENABLED = True
+
+
+# DHT (trackerless peer discovery)
+
+# Look torrents up in the mainline DHT as well as asking their tracker, so a download survives
+# its tracker being down and magnet links without trackers work
+TOURINT_DHT_ENABLED = True
+
+# Routing table saved between runs, so the DHT doesn't bootstrap from scratch every time
+TOURINT_DHT_STATE_FILE = os.path.join(BASE_DIR, 'dht_state.json')
+
+
+# Peer transport
+
+# 'tcp', or 'utp' (BEP 29) to connect to peers over uTP, whose congestion control gets out of the
+# way of other traffic on the uplink. Peers have to accept uTP, most modern clients do.
+TOURINT_PEER_TRANSPORT = 'tcp'
+
+
+# Streaming
+
+# Download pieces roughly in order, ahead of whatever /torrents/<file_hash>/data/ last read, so
+# media can be played while it downloads
+TOURINT_STREAMING = False
@@ -15,8 +15,10 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, include, re_path
+from tourint import views as tourint_views
 
 urlpatterns = [
     path('admin/', admin.site.urls),
-    path('torrents/', include('tourint.urls'))
+    path('torrents/', include('tourint.urls')),
+    path('metrics', tourint_views.handle_metrics, name='metrics'),
 ]
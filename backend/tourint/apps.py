@@ -1,5 +1,32 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.db.backends.signals import connection_created
+import multiprocessing
+import sys
+import threading
+
+
+def enable_sqlite_wal(sender, connection, **kwargs):
+    # WAL lets the web process keep reading while download processes write progress, instead of
+    # every progress UPDATE locking readers out
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode=WAL;')
+            cursor.execute('PRAGMA synchronous=NORMAL;')
 
 
 class TourintConfig(AppConfig):
     name = 'tourint'
+
+    def ready(self):
+        connection_created.connect(enable_sqlite_wal)
+
+        # Start the download worker forkserver in the background while the server comes up.
+        # Other management commands never start downloads, so they skip it, and so do child
+        # processes that happen to import Django.
+        is_other_command = sys.argv[0].endswith('manage.py') and sys.argv[1:2] != ['runserver']
+        is_child = multiprocessing.parent_process() is not None
+        if getattr(settings, 'TOURINT_PREWARM_WORKERS', True) and not is_other_command\
+                and not is_child:
+            from .torrent_protocol import worker
+            threading.Thread(target=worker.prewarm, name='PrewarmWorkers', daemon=True).start()
@@ -0,0 +1,138 @@
+"""
+Registry of the download processes started by this web process.
+
+Each download worker (see torrent_protocol/worker.py) is kept with the parent end of its control
+pipe, keyed by info hash, so views can send it commands (see torrent_protocol/control.py).
+Processes that have exited are reaped whenever the registry is used.
+"""
+from typing import Dict, Optional
+import threading
+import time
+import uuid
+
+from .torrent_protocol import control
+from .torrent_protocol import disk_io
+from .torrent_protocol import tracker
+from .torrent_protocol import worker
+from .torrent_protocol.torrent_download import default_output_directory
+
+# How long resuming waits for a paused download to finish writing its state and exit
+STOP_TIMEOUT_S: float = 30.0
+
+class EngineHandle:
+    def __init__(self, process, connection, reply_connection, layout, run_id):
+        self.process = process
+        self.connection = connection
+        # Where the download answers READs, see control.ReadReplies
+        self.replies = control.ReadReplies(reply_connection)
+        # The download's files, which READ ranges are read from once they're on disk
+        self.layout = layout
+        # Tags the progress this process reports, see events.track_progress
+        self.run_id = run_id
+        # Connection.send isn't safe to call from several request threads at once
+        self.lock = threading.Lock()
+        # Held from sending a READ until its answer is in, so readers don't take each other's
+        # replies
+        self.read_lock = threading.Lock()
+        # Set once the process has been told to pause or cancel, i.e. it is on its way out
+        self.stopping = False
+
+    def send(self, command, **arguments):
+        with self.lock:
+            control.send_command(self.connection, command, **arguments)
+            if command in (control.Command.PAUSE, control.Command.CANCEL):
+                self.stopping = True
+
+    def read(self, offset, length, timeout_s=control.DEFAULT_READ_TIMEOUT_S) -> bytes:
+        """Reads a byte range of the torrent, waiting for the download to fetch it if needed.
+        Raises TimeoutError and ValueError, see control.ReadReplies.wait."""
+        with self.read_lock:
+            request_id = uuid.uuid4().hex
+            deadline = time.time() + timeout_s
+            self.send(control.Command.READ, request_id=request_id, offset=offset,
+                    length=length, deadline=deadline)
+            self.replies.wait(request_id, deadline)
+        return disk_io.read_range(self.layout, offset, length)
+
+    def close(self):
+        self.process.join()
+        self.connection.close()
+        self.replies.connection.close()
+
+engines: Dict[str, EngineHandle] = {}
+engines_lock = threading.Lock()
+
+def reap():
+    """Forgets about engines whose process has exited. Call with engines_lock held."""
+    for file_hash, handle in list(engines.items()):
+        if not handle.process.is_alive():
+            handle.close()
+            del engines[file_hash]
+
+def start(file_hash, torrent_file_path, options, telemetry_queue, on_start=None) -> EngineHandle:
+    """Starts a download worker with a control pipe, unless one is already running.
+
+    options are TorrentDownload keyword arguments as plain data, see worker.run_worker. on_start
+    is called with the new run's id just before its process starts, e.g. to track its progress.
+    It isn't called if the download was already running.
+    """
+    handle = get(file_hash)
+    if handle is not None and handle.stopping:
+        # Resumed right after a pause. The new process has to wait for the old one's resume
+        # state, and they can't both have the files open.
+        handle.process.join(STOP_TIMEOUT_S)
+
+    with engines_lock:
+        reap()
+        if file_hash in engines:
+            return engines[file_hash]
+
+        run_id = uuid.uuid4().hex
+        if on_start is not None:
+            on_start(run_id)
+        metainfo = tracker.decode_torrent_file(torrent_file_path)
+        layout = disk_io.FileLayout(metainfo['info'],
+                options.get('output_directory') or default_output_directory(file_hash))
+        parent_connection, child_connection = worker.get_context().Pipe()
+        reply_reader, reply_writer = worker.get_context().Pipe(duplex=False)
+        process = worker.start_worker(torrent_file_path, dict(options, run_id=run_id),
+                child_connection,
+                telemetry_queue, name='TorrentDownload-{}'.format(file_hash[:8]),
+                reply_connection=reply_writer)
+        # Only the child uses its ends now. Closing ours means the child sees EOF if we go away.
+        child_connection.close()
+        reply_writer.close()
+
+        handle = EngineHandle(process, parent_connection, reply_reader, layout, run_id)
+        engines[file_hash] = handle
+        return handle
+
+def get(file_hash) -> Optional[EngineHandle]:
+    with engines_lock:
+        reap()
+        return engines.get(file_hash)
+
+def send(file_hash, command, **arguments) -> bool:
+    """Sends a command to a running download. Returns False if there isn't one."""
+    handle = get(file_hash)
+    if handle is None:
+        return False
+    try:
+        handle.send(command, **arguments)
+    except (BrokenPipeError, EOFError, OSError):
+        # Exited between get() and send()
+        return False
+    return True
+
+def read(file_hash, offset, length, timeout_s=control.DEFAULT_READ_TIMEOUT_S) -> Optional[bytes]:
+    """Reads from a running download. Returns None if there isn't one."""
+    handle = get(file_hash)
+    if handle is None:
+        return None
+    try:
+        return handle.read(offset, length, timeout_s)
+    except TimeoutError:
+        # An OSError too, but the download is still there
+        raise
+    except (BrokenPipeError, EOFError, OSError):
+        return None
@@ -0,0 +1,186 @@
+"""
+In-process pub/sub for live download progress.
+
+Download processes push (kind, file_hash, payload) tuples onto a multiprocessing queue. A
+listener thread drains it. The latest engine snapshot, engine metrics and profiling summary are
+kept per torrent, for detail requests, /metrics and profiling results. Progress updates are
+written to the database from here, through a throttled ProgressReporter per run, so download
+processes never need Django. They also go into the ProgressBroker, which merges them into every
+subscriber's pending batch. Subscribers (the server-sent events view) pick up one coalesced batch
+per interval, so a client sees at most one message per torrent per interval however often the
+engines report.
+"""
+from typing import Dict, Optional
+import threading
+import time
+
+from .torrent_protocol import metrics
+from .torrent_protocol import profiling
+from .torrent_protocol import progress
+from .torrent_protocol import snapshot
+from .torrent_protocol import worker
+
+
+class Subscription:
+    """One client's pending updates. Read from the thread serving that client's stream."""
+
+    def __init__(self, file_hash=None):
+        # Only receive updates for this torrent, or every torrent if None
+        self.file_hash = file_hash
+        # file_hash -> merged changed fields not yet delivered
+        self.pending: Dict[str, Dict] = {}
+        self.condition = threading.Condition()
+
+    def push(self, file_hash, changed):
+        if self.file_hash is not None and file_hash != self.file_hash:
+            return
+        with self.condition:
+            self.pending.setdefault(file_hash, {}).update(changed)
+            self.condition.notify()
+
+    def next_batch(self, timeout=None) -> Dict[str, Dict]:
+        """Waits for updates and returns everything merged since the last batch.
+
+        Returns an empty dict if nothing arrived within timeout.
+        """
+        with self.condition:
+            if not self.pending:
+                self.condition.wait(timeout)
+            batch = self.pending
+            self.pending = {}
+        return batch
+
+
+class ProgressBroker:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = set()
+
+    def subscribe(self, file_hash=None) -> Subscription:
+        subscription = Subscription(file_hash)
+        with self.lock:
+            self.subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscribers.discard(subscription)
+
+    def publish(self, file_hash, changed):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscription in subscribers:
+            subscription.push(file_hash, changed)
+
+
+broker = ProgressBroker()
+
+# file_hash -> (monotonic time received, latest engine snapshot)
+snapshots: Dict[str, tuple] = {}
+snapshots_lock = threading.Lock()
+
+# file_hash -> latest Registry.collect() from that torrent's download
+engine_metrics: Dict[str, Dict] = {}
+engine_metrics_lock = threading.Lock()
+
+# file_hash -> phase timings and file paths of the torrent's last profiling window
+profiles: Dict[str, Dict] = {}
+profiles_lock = threading.Lock()
+
+# run id -> (file_hash, reporter writing that run's progress to the database). Keyed by run, not
+# torrent: a download resumed right after a pause starts a new run before the old one has sent
+# its final update.
+progress_reporters: Dict[str, tuple] = {}
+progress_lock = threading.Lock()
+# Progress fields reported once, when a download stops. They're written straight away.
+FINAL_FIELDS = ('completed', 'cancelled', 'paused')
+
+telemetry_queue = None
+telemetry_lock = threading.Lock()
+
+
+def track_progress(file_hash, run_id, sink):
+    """Sends the progress one run of a download reports to sink, throttled, until it stops.
+
+    Earlier runs of the same torrent are forgotten, so whatever they still report (say, the
+    'paused' of the run a quick resume replaced) doesn't overwrite the new run's progress.
+    """
+    with progress_lock:
+        replaced = [r for r, (h, _) in progress_reporters.items() if h == file_hash and r != run_id]
+        old_reporters = [progress_reporters.pop(r)[1] for r in replaced]
+        if run_id not in progress_reporters:
+            reporter = progress.ProgressReporter(sink)
+            reporter.start()
+            progress_reporters[run_id] = (file_hash, reporter)
+    for old_reporter in old_reporters:
+        # Writes what it has so far, nothing after this
+        old_reporter.close()
+
+
+def record_progress(run_id, changed):
+    with progress_lock:
+        if run_id not in progress_reporters:
+            return
+        _, reporter = progress_reporters[run_id]
+        reporter.update(**changed)
+        if any(name in changed for name in FINAL_FIELDS):
+            del progress_reporters[run_id]
+        else:
+            return
+    # The download has stopped, so there's nothing to wait for
+    reporter.close()
+
+
+def get_snapshot(file_hash) -> Optional[Dict]:
+    """Returns the latest snapshot of a download with its age in seconds added, or None"""
+    with snapshots_lock:
+        if file_hash not in snapshots:
+            return None
+        received, latest = snapshots[file_hash]
+    return dict(latest, age_s=time.monotonic() - received)
+
+
+def get_engine_metrics() -> Dict[str, Dict]:
+    with engine_metrics_lock:
+        return dict(engine_metrics)
+
+
+def get_profile(file_hash) -> Optional[Dict]:
+    with profiles_lock:
+        return profiles.get(file_hash)
+
+
+def listen_for_telemetry(queue):
+    while True:
+        try:
+            kind, file_hash, payload = queue.get()
+        except (EOFError, OSError):
+            # The queue is torn down when the interpreter exits
+            return
+        if kind == snapshot.MESSAGE_KIND:
+            with snapshots_lock:
+                snapshots[file_hash] = (time.monotonic(), payload)
+        elif kind == metrics.MESSAGE_KIND:
+            with engine_metrics_lock:
+                engine_metrics[file_hash] = payload
+        elif kind == profiling.MESSAGE_KIND:
+            with profiles_lock:
+                profiles[file_hash] = payload
+        elif kind == progress.QueueSink.KIND:
+            run_id = payload.pop(progress.QueueSink.RUN_ID_FIELD, None)
+            try:
+                record_progress(run_id, payload)
+            except Exception as e:
+                print('Recording progress for {} failed: {}'.format(file_hash, e))
+            broker.publish(file_hash, payload)
+
+
+def get_telemetry_queue():
+    """Returns the queue download processes report to, starting its listener on first use"""
+    global telemetry_queue
+    with telemetry_lock:
+        if telemetry_queue is None:
+            telemetry_queue = worker.get_context().Queue()
+            threading.Thread(target=listen_for_telemetry, args=(telemetry_queue,),
+                    name='TelemetryListener', daemon=True).start()
+        return telemetry_queue
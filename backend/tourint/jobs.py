@@ -0,0 +1,207 @@
+"""
+Background pipeline for adding torrents.
+
+POST /torrents/ only queues an AddTorrentJob and returns its id. A small thread pool fetches the
+.torrent file, parses it, writes it to the download folder, creates the Torrents row and starts
+the download, so slow URLs never hold up a request thread. Torrents are deduplicated on info hash:
+adding one that's already known finishes the job with the existing row instead of starting a
+second download.
+
+Magnet links are accepted in place of URLs. The info dict is fetched from the peers the magnet's
+trackers hand out, or the DHT finds for magnets without trackers (see torrent_protocol/metadata.py
+and dht.py), and written out as a .torrent file, so from there on a magnet is added like any other
+torrent.
+"""
+from typing import Dict, Optional
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import enum
+import os
+import threading
+import urllib.request
+import uuid
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from .models import Torrents
+from .torrent_protocol import bencode
+from .torrent_protocol import disk_io
+from .torrent_protocol import dht
+from .torrent_protocol import magnet
+from .torrent_protocol import metadata
+from .torrent_protocol import tracker
+
+TORRENT_FILE_ENDING: str = '.torrent'
+DEFAULT_FETCH_WORKERS: int = 4
+FETCH_TIMEOUT_S: float = 30.0
+# Nothing legitimate comes close; stops a bad URL from filling memory
+MAX_TORRENT_FILE_BYTES: int = 16 * 1024 * 1024
+# Finished jobs are kept this long (by count) so clients can still look them up
+MAX_FINISHED_JOBS: int = 1000
+
+class AddTorrentJob:
+    class Status(str, enum.Enum):
+        PENDING = 'pending'
+        FETCHING = 'fetching'
+        DONE = 'done'
+        FAILED = 'failed'
+
+    def __init__(self, url):
+        self.id = uuid.uuid4().hex
+        self.url = url
+        self.status = AddTorrentJob.Status.PENDING
+        self.error: Optional[str] = None
+        self.file_hash: Optional[str] = None
+        # True if the torrent was already known and no new download was started
+        self.duplicate = False
+
+    def as_dict(self) -> Dict:
+        return {
+            'id': self.id,
+            'url': self.url,
+            'status': self.status.value,
+            'error': self.error,
+            'file_hash': self.file_hash,
+            'duplicate': self.duplicate,
+        }
+
+class AddTorrentPipeline:
+    def __init__(self, start_download, download_folder, max_workers=DEFAULT_FETCH_WORKERS):
+        # Called with the new Torrents row once its .torrent file is on disk
+        self.start_download = start_download
+        self.download_folder = download_folder
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                thread_name_prefix='AddTorrent')
+
+        self.lock = threading.Lock()
+        self.jobs: Dict[str, AddTorrentJob] = OrderedDict()
+        # URL -> job that hasn't finished yet, so the same URL isn't fetched twice at once
+        self.in_flight: Dict[str, AddTorrentJob] = {}
+        # info hash -> Torrents pk of everything added through this pipeline
+        self.known_hashes: Dict[str, int] = {}
+
+    def submit(self, url) -> AddTorrentJob:
+        with self.lock:
+            if url in self.in_flight:
+                return self.in_flight[url]
+            job = AddTorrentJob(url)
+            self.jobs[job.id] = job
+            self.in_flight[url] = job
+        self.executor.submit(self.run_job, job)
+        return job
+
+    def get(self, job_id) -> Optional[AddTorrentJob]:
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def finish(self, job, status, error=None):
+        with self.lock:
+            job.status = status
+            job.error = error
+            self.in_flight.pop(job.url, None)
+
+            finished = [j for j in self.jobs.values()
+                    if j.status in (AddTorrentJob.Status.DONE, AddTorrentJob.Status.FAILED)]
+            for old_job in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+                del self.jobs[old_job.id]
+
+    def fetch(self, url) -> bytes:
+        with urllib.request.urlopen(url, timeout=FETCH_TIMEOUT_S) as f:
+            data = f.read(MAX_TORRENT_FILE_BYTES + 1)
+        if len(data) > MAX_TORRENT_FILE_BYTES:
+            raise ValueError('Torrent file is larger than {} bytes'.format(MAX_TORRENT_FILE_BYTES))
+        return data
+
+    def fetch_magnet(self, job) -> Optional[bytes]:
+        """Returns .torrent file bytes for a magnet link, or None if the torrent is known already"""
+        link = magnet.parse(job.url)
+        job.file_hash = link.info_hash.hex()
+        use_dht = not link.trackers and not link.peers
+        if use_dht and not getattr(settings, 'TOURINT_DHT_ENABLED', True):
+            raise ValueError('Magnet link has no trackers or peers to get the metadata from')
+
+        # Checked before asking peers for anything, the metadata is the slow part
+        close_old_connections()
+        with self.lock:
+            if self.find_existing(job.file_hash) is not None:
+                return None
+
+        if use_dht:
+            addresses = dht.lookup_peers(link.info_hash,
+                    state_file=getattr(settings, 'TOURINT_DHT_STATE_FILE', None))
+            link.peers.extend({'ip': ip, 'port': port} for ip, port in addresses)
+        info_bytes = metadata.fetch_metadata(link)
+        return magnet.torrent_file_bytes(info_bytes, link.trackers)
+
+    def find_existing(self, file_hash) -> Optional[int]:
+        if file_hash in self.known_hashes:
+            return self.known_hashes[file_hash]
+        existing = Torrents.objects.filter(file_hash=file_hash).values_list('pk', flat=True)
+        return existing[0] if existing else None
+
+    def run_job(self, job):
+        job.status = AddTorrentJob.Status.FETCHING
+        try:
+            if magnet.is_magnet(job.url):
+                data = self.fetch_magnet(job)
+                if data is None:
+                    job.duplicate = True
+                    self.finish(job, AddTorrentJob.Status.DONE)
+                    return
+            else:
+                data = self.fetch(job.url)
+            metainfo = bencode.decode(data)
+            file_hash = tracker.get_info_hash(metainfo).hex()
+            job.file_hash = file_hash
+
+            close_old_connections()
+            # Held across the check and the insert so two URLs for the same torrent can't race
+            with self.lock:
+                if self.find_existing(file_hash) is not None:
+                    job.duplicate = True
+                    torrent = None
+                else:
+                    torrent = self.create_torrent(metainfo, file_hash, data)
+                    self.known_hashes[file_hash] = torrent.pk
+
+            if torrent is not None:
+                self.start_download(torrent)
+        except Exception as e:
+            print('Adding torrent from {} failed: {}'.format(job.url, e))
+            self.finish(job, AddTorrentJob.Status.FAILED, str(e))
+        else:
+            self.finish(job, AddTorrentJob.Status.DONE)
+        finally:
+            close_old_connections()
+
+    def create_torrent(self, metainfo, file_hash, data) -> Torrents:
+        # Comes from whoever made the torrent, so it mustn't be able to climb out of the folder
+        name = disk_io.sanitize_path_component(metainfo['info']['name'])
+        os.makedirs(self.download_folder, exist_ok=True)
+        torrent_file_path = os.path.join(self.download_folder,
+                name + '_' + file_hash + TORRENT_FILE_ENDING)
+        with open(torrent_file_path, 'wb') as torrent_file:
+            torrent_file.write(data)
+
+        return Torrents.objects.create(name=name,
+                file_hash=file_hash,
+                torrent_file_path=torrent_file_path,
+                total_size_bytes=tracker.get_total_length(metainfo['info']),
+                downloaded_bytes=0,
+                download_status=Torrents.DownloadStatus.IN_PROGRESS,
+                number_of_seeders=0,
+                number_of_peers_connected=0,
+                download_directory=self.download_folder)
+
+pipeline: Optional[AddTorrentPipeline] = None
+pipeline_lock = threading.Lock()
+
+def get_pipeline(start_download, download_folder) -> AddTorrentPipeline:
+    """Returns the process-wide pipeline, creating it on first use"""
+    global pipeline
+    with pipeline_lock:
+        if pipeline is None:
+            pipeline = AddTorrentPipeline(start_download, download_folder,
+                    getattr(settings, 'TOURINT_FETCH_WORKERS', DEFAULT_FETCH_WORKERS))
+        return pipeline
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 17:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tourint', '0004_torrents_torrent_file_path'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='torrents',
+            name='file_priorities',
+            field=models.JSONField(blank=True, default=list),
+        ),
+    ]
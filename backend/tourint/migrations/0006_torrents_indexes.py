@@ -0,0 +1,46 @@
+# Generated by Django 5.2.18 on 2026-10-19 18:08
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def make_file_hashes_unique(apps, schema_editor):
+    # Older rows could share a hash (the field defaulted to "default" and duplicate adds weren't
+    # rejected). Keep the oldest row's hash and suffix the others with their id so none are lost.
+    Torrents = apps.get_model('tourint', 'Torrents')
+    seen = set()
+    for torrent in Torrents.objects.order_by('id').only('id', 'file_hash'):
+        if torrent.file_hash in seen:
+            torrent.file_hash = '{}-duplicate-{}'.format(torrent.file_hash, torrent.id)
+            torrent.save(update_fields=['file_hash'])
+        seen.add(torrent.file_hash)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tourint', '0005_torrents_file_priorities'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='torrents',
+            name='updated_at',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+        migrations.AlterField(
+            model_name='torrents',
+            name='download_status',
+            field=models.CharField(choices=[('Completed', 'Completed'), ('In Progress', 'In Progress'), ('Paused', 'Paused'), ('Cancelled', 'Cancelled')], db_index=True, default='In Progress', max_length=15),
+        ),
+        migrations.RunPython(make_file_hashes_unique, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='torrents',
+            name='file_hash',
+            field=models.CharField(max_length=255, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='torrents',
+            index=models.Index(fields=['download_status', '-id'], name='torrents_status_id_idx'),
+        ),
+    ]
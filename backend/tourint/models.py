@@ -1,4 +1,5 @@
 from django.db import models
+from django.utils import timezone
 
 # Create your models here.
 class Torrents(models.Model):
@@ -13,7 +14,7 @@ class Torrents(models.Model):
     name = models.CharField(max_length=255, default="name")
 
     # Hash of the torrent as a hex string
-    file_hash = models.CharField(max_length=255, default="default")
+    file_hash = models.CharField(max_length=255, unique=True)
 
     torrent_file_path = models.TextField(default="torrentfilepath")
 
@@ -23,7 +24,8 @@ class Torrents(models.Model):
     download_status = models.CharField(
         max_length=15,
         choices=DownloadStatus.choices,
-        default=DownloadStatus.IN_PROGRESS
+        default=DownloadStatus.IN_PROGRESS,
+        db_index=True
     )
 
     number_of_seeders = models.PositiveIntegerField(default=0)
@@ -31,6 +33,27 @@ class Torrents(models.Model):
 
     download_directory = models.CharField(max_length=255, default="./downloads/")
 
+    # Priority name ('skip', 'low', 'normal', 'high') of each file in the torrent, in the order
+    # the files appear in the metainfo. Empty means every file is 'normal'.
+    file_priorities = models.JSONField(default=list, blank=True)
+
+    # Bumped on every change, including the queryset .update() calls that progress reporting
+    # uses (those have to set it explicitly). List ETags are derived from it.
+    updated_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        indexes = [
+            # Listing one status in cursor order
+            models.Index(fields=['download_status', '-id'], name='torrents_status_id_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.updated_at = timezone.now()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'updated_at' not in update_fields:
+            kwargs['update_fields'] = list(update_fields) + ['updated_at']
+        super().save(*args, **kwargs)
+
     def __str__(self):
         return "Torrent {}, hash = {}, status = {}, total size = {} bytes, downloaded = {} bytes".format(
                     self.name, self.file_hash, self.download_status, self.total_size_bytes,
@@ -0,0 +1,9 @@
+from rest_framework.pagination import CursorPagination
+
+class TorrentsCursorPagination(CursorPagination):
+    """Newest first. Cursors seek on the primary key, so every page costs the same however many
+    torrents there are, unlike offset pagination."""
+    ordering = '-id'
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 500
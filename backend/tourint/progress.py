@@ -0,0 +1,32 @@
+from django.db import close_old_connections
+from django.utils import timezone
+from .models import Torrents
+
+class TorrentProgressSink:
+    """Writes progress reported by a download to its Torrents row.
+
+    Called from the download's ProgressReporter thread with only the fields that changed, which
+    are written with a single UPDATE instead of re-saving the whole row.
+    """
+
+    def __init__(self, torrent_id):
+        self.torrent_id = torrent_id
+
+    def __call__(self, changed):
+        fields = dict(changed)
+        if fields.pop('completed', False):
+            fields['download_status'] = Torrents.DownloadStatus.COMPLETED
+        elif fields.pop('cancelled', False):
+            fields['download_status'] = Torrents.DownloadStatus.CANCELLED
+        elif 'paused' in fields:
+            fields['download_status'] = Torrents.DownloadStatus.PAUSED if fields.pop('paused')\
+                    else Torrents.DownloadStatus.IN_PROGRESS
+
+        model_fields = set(f.name for f in Torrents._meta.get_fields())
+        fields = {k: v for k, v in fields.items() if k in model_fields}
+        if not fields:
+            return
+
+        fields['updated_at'] = timezone.now()
+        close_old_connections()
+        Torrents.objects.filter(pk=self.torrent_id).update(**fields)
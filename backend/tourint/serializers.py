@@ -13,4 +13,12 @@ class TorrentsSerializer(serializers.ModelSerializer):
             'download_status',
             'number_of_seeders',
             'number_of_peers_connected',
+            'file_priorities',
         )
+
+    def __init__(self, *args, fields=None, **kwargs):
+        """fields restricts the output to a subset of Meta.fields"""
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
@@ -1,3 +1,301 @@
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from unittest import mock
+import json
+import os
+import pathlib
+import tempfile
+import time
 
-# Create your tests here.
+from .models import Torrents
+from .pagination import TorrentsCursorPagination
+from . import events
+from . import jobs
+from .torrent_protocol.control import Command
+from .torrent_protocol import bencode
+
+def make_torrent_file(directory, name, filename='test.torrent', lengths=(10,)) -> str:
+    """Writes a minimal .torrent with a file of each of lengths and returns its file:// URL"""
+    info = {'name': name, 'piece length': 16384, 'pieces': bytes(20)}
+    if len(lengths) == 1:
+        info['length'] = lengths[0]
+    else:
+        info['files'] = [{'length': length, 'path': ['file{}'.format(i)]}
+                for i, length in enumerate(lengths)]
+    path = os.path.join(directory, filename)
+    with open(path, 'wb') as f:
+        f.write(bencode.encode({'announce': 'http://127.0.0.1:1/announce', 'info': info}))
+    return pathlib.Path(path).as_uri()
+
+# The pipeline's threads use their own database connections, so the rows they create have to be
+# committed for the test to see them
+class AddTorrentPipelineTests(TransactionTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.download_folder = os.path.join(self.directory.name, 'downloads')
+        self.started = []
+        self.pipeline = jobs.AddTorrentPipeline(self.started.append, self.download_folder,
+                max_workers=2)
+
+    def tearDown(self):
+        self.pipeline.executor.shutdown(wait=True)
+        self.directory.cleanup()
+
+    def wait_for_job(self, job, timeout_s=10) -> jobs.AddTorrentJob:
+        deadline = time.monotonic() + timeout_s
+        while job.status not in (jobs.AddTorrentJob.Status.DONE, jobs.AddTorrentJob.Status.FAILED):
+            if time.monotonic() > deadline:
+                self.fail('Job {} still {} after {}s'.format(job.id, job.status, timeout_s))
+            time.sleep(0.01)
+        return job
+
+    def test_adds_and_starts_torrent(self):
+        job = self.wait_for_job(self.pipeline.submit(make_torrent_file(self.directory.name,
+            'movie.mkv')))
+        self.assertEqual(job.status, jobs.AddTorrentJob.Status.DONE, job.error)
+        self.assertFalse(job.duplicate)
+        torrent = Torrents.objects.get(file_hash=job.file_hash)
+        self.assertEqual(torrent.name, 'movie.mkv')
+        self.assertEqual(torrent.total_size_bytes, 10)
+        self.assertTrue(os.path.isfile(torrent.torrent_file_path))
+        self.assertEqual([t.pk for t in self.started], [torrent.pk])
+
+    def test_torrent_name_cannot_escape_download_folder(self):
+        job = self.wait_for_job(self.pipeline.submit(make_torrent_file(self.directory.name,
+            '../../escaped')))
+        self.assertEqual(job.status, jobs.AddTorrentJob.Status.DONE, job.error)
+        torrent = Torrents.objects.get(file_hash=job.file_hash)
+        self.assertEqual(os.path.dirname(torrent.torrent_file_path), self.download_folder)
+        self.assertNotIn('/', os.path.basename(torrent.torrent_file_path)[:-len('.torrent')])
+        self.assertFalse(os.path.exists(os.path.join(os.path.dirname(self.directory.name),
+            'escaped_' + job.file_hash + jobs.TORRENT_FILE_ENDING)))
+
+    def test_same_torrent_from_another_url_is_a_duplicate(self):
+        first = self.wait_for_job(self.pipeline.submit(make_torrent_file(self.directory.name,
+            'movie.mkv', 'a.torrent')))
+        second = self.wait_for_job(self.pipeline.submit(make_torrent_file(self.directory.name,
+            'movie.mkv', 'b.torrent')))
+        self.assertEqual(second.status, jobs.AddTorrentJob.Status.DONE, second.error)
+        self.assertTrue(second.duplicate)
+        self.assertEqual(second.file_hash, first.file_hash)
+        self.assertEqual(Torrents.objects.count(), 1)
+        self.assertEqual(len(self.started), 1)
+
+    def test_known_torrent_is_a_duplicate_for_a_new_pipeline(self):
+        url = make_torrent_file(self.directory.name, 'movie.mkv')
+        self.wait_for_job(self.pipeline.submit(url))
+        pipeline = jobs.AddTorrentPipeline(self.started.append, self.download_folder)
+        try:
+            job = self.wait_for_job(pipeline.submit(url))
+        finally:
+            pipeline.executor.shutdown(wait=True)
+        self.assertTrue(job.duplicate)
+        self.assertEqual(len(self.started), 1)
+
+    def test_bad_torrent_file_fails_the_job(self):
+        path = os.path.join(self.directory.name, 'bad.torrent')
+        with open(path, 'wb') as f:
+            f.write(b'not bencode')
+        job = self.wait_for_job(self.pipeline.submit(pathlib.Path(path).as_uri()))
+        self.assertEqual(job.status, jobs.AddTorrentJob.Status.FAILED)
+        self.assertTrue(job.error)
+        self.assertEqual(Torrents.objects.count(), 0)
+        self.assertEqual(self.started, [])
+
+    def test_unreachable_url_fails_the_job(self):
+        job = self.wait_for_job(self.pipeline.submit(
+            pathlib.Path(self.directory.name, 'missing.torrent').as_uri()))
+        self.assertEqual(job.status, jobs.AddTorrentJob.Status.FAILED)
+        self.assertFalse(self.pipeline.in_flight)
+
+    def test_failing_start_download_fails_the_job(self):
+        def start_download(torrent):
+            raise RuntimeError('no engine')
+        self.pipeline.start_download = start_download
+        job = self.wait_for_job(self.pipeline.submit(make_torrent_file(self.directory.name,
+            'movie.mkv')))
+        self.assertEqual(job.status, jobs.AddTorrentJob.Status.FAILED)
+        self.assertIn('no engine', job.error)
+
+def create_torrent(name, status=Torrents.DownloadStatus.IN_PROGRESS, **fields) -> Torrents:
+    return Torrents.objects.create(name=name, file_hash='{:040x}'.format(Torrents.objects.count()
+        + 1), download_status=status, **fields)
+
+class ListTorrentsViewTests(TestCase):
+    def setUp(self):
+        self.movie = create_torrent('Movie.mkv')
+        self.album = create_torrent('album', Torrents.DownloadStatus.PAUSED)
+        self.distro = create_torrent('distro.iso', Torrents.DownloadStatus.COMPLETED)
+
+    def names(self, response):
+        return [t['name'] for t in response.json()['results']]
+
+    def test_newest_first(self):
+        response = self.client.get('/torrents/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.names(response), ['distro.iso', 'album', 'Movie.mkv'])
+
+    def test_cursor_pages(self):
+        response = self.client.get('/torrents/', {'page_size': 2})
+        self.assertEqual(self.names(response), ['distro.iso', 'album'])
+        self.assertIsNone(response.json()['previous'])
+        response = self.client.get(response.json()['next'])
+        self.assertEqual(self.names(response), ['Movie.mkv'])
+        self.assertIsNone(response.json()['next'])
+
+    def test_page_size_is_capped(self):
+        for i in range(TorrentsCursorPagination.max_page_size):
+            create_torrent('extra {}'.format(i))
+        response = self.client.get('/torrents/', {'page_size': 10000})
+        self.assertEqual(len(response.json()['results']), TorrentsCursorPagination.max_page_size)
+        self.assertIsNotNone(response.json()['next'])
+
+    def test_status_filter(self):
+        response = self.client.get('/torrents/', {'status': 'Paused,Completed'})
+        self.assertEqual(self.names(response), ['distro.iso', 'album'])
+
+    def test_name_filter_ignores_case(self):
+        response = self.client.get('/torrents/', {'name': 'movie'})
+        self.assertEqual(self.names(response), ['Movie.mkv'])
+
+    def test_file_hash_filter_ignores_case(self):
+        response = self.client.get('/torrents/', {'file_hash': self.album.file_hash.upper()})
+        self.assertEqual(self.names(response), ['album'])
+
+    def test_fields(self):
+        response = self.client.get('/torrents/', {'fields': 'name,download_status'})
+        self.assertEqual(response.json()['results'][0],
+                {'name': 'distro.iso', 'download_status': 'Completed'})
+
+    def test_unknown_field_is_rejected(self):
+        response = self.client.get('/torrents/', {'fields': 'name,password'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('password', response.json()['fields'])
+
+    def test_unchanged_list_is_not_modified(self):
+        etag = self.client.get('/torrents/')['ETag']
+        response = self.client.get('/torrents/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_etag_changes_with_the_rows(self):
+        etag = self.client.get('/torrents/')['ETag']
+        Torrents.objects.filter(pk=self.movie.pk).update(downloaded_bytes=5,
+                updated_at=timezone.now())
+        response = self.client.get('/torrents/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+        etag = response['ETag']
+        create_torrent('new')
+        self.assertEqual(self.client.get('/torrents/', HTTP_IF_NONE_MATCH=etag).status_code,
+                200)
+
+    def test_etag_depends_on_the_query(self):
+        self.assertNotEqual(self.client.get('/torrents/')['ETag'],
+                self.client.get('/torrents/', {'status': 'Paused'})['ETag'])
+
+class FilePrioritiesViewTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        make_torrent_file(self.directory.name, 'album', 'album.torrent', lengths=(10, 20, 30))
+        self.torrent = create_torrent('album',
+                torrent_file_path=os.path.join(self.directory.name, 'album.torrent'))
+        self.url = '/torrents/{}/priorities/'.format(self.torrent.file_hash.upper())
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def post(self, priorities):
+        return self.client.post(self.url, {'priorities': priorities},
+                content_type='application/json')
+
+    def test_defaults_to_normal(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        files = response.json()['files']
+        self.assertEqual([(f['path'], f['length'], f['priority']) for f in files],
+                [('album/file0', 10, 'normal'), ('album/file1', 20, 'normal'),
+                 ('album/file2', 30, 'normal')])
+
+    @mock.patch('tourint.engines.send', return_value=True)
+    def test_saved_and_sent_to_the_running_download(self, send):
+        response = self.post({'1': 'skip', '2': 'HIGH'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([f['priority'] for f in response.json()['files']],
+                ['normal', 'skip', 'high'])
+        self.torrent.refresh_from_db()
+        self.assertEqual(self.torrent.file_priorities, ['normal', 'skip', 'high'])
+        send.assert_called_once_with(self.torrent.file_hash, Command.SET_FILE_PRIORITIES,
+                priorities=['normal', 'skip', 'high'])
+
+    @mock.patch('tourint.engines.send', return_value=False)
+    def test_saved_without_a_running_download(self, send):
+        self.assertEqual(self.post(['low', 'low', 'skip']).status_code, 200)
+        self.torrent.refresh_from_db()
+        self.assertEqual(self.torrent.file_priorities, ['low', 'low', 'skip'])
+
+    @mock.patch('tourint.engines.send')
+    def test_bad_priorities_are_rejected(self, send):
+        self.assertEqual(self.post(['low']).status_code, 400)
+        self.assertEqual(self.post({'3': 'low'}).status_code, 400)
+        self.assertEqual(self.post(['low', 'urgent', 'low']).status_code, 400)
+        self.assertEqual(self.post('low').status_code, 400)
+        send.assert_not_called()
+        self.torrent.refresh_from_db()
+        self.assertEqual(self.torrent.file_priorities, [])
+
+    def test_unknown_torrent(self):
+        self.assertEqual(self.client.get('/torrents/{}/priorities/'.format('f' * 40)).status_code,
+                404)
+
+class ProgressTrackingTests(TestCase):
+    def setUp(self):
+        self.flushes = {'old': [], 'new': []}
+
+    def tearDown(self):
+        for run_id in ('old', 'new'):
+            events.record_progress(run_id, {'cancelled': True})
+
+    def test_final_update_closes_the_run(self):
+        events.track_progress('abc', 'old', self.flushes['old'].append)
+        events.record_progress('old', {'downloaded_bytes': 10, 'paused': True})
+        self.assertEqual(self.flushes['old'], [{'downloaded_bytes': 10, 'paused': True}])
+        self.assertNotIn('old', events.progress_reporters)
+
+    def test_late_update_from_a_replaced_run_is_ignored(self):
+        events.track_progress('abc', 'old', self.flushes['old'].append)
+        events.record_progress('old', {'downloaded_bytes': 10})
+        # Resumed before the paused run's last update came in
+        events.track_progress('abc', 'new', self.flushes['new'].append)
+        events.record_progress('old', {'downloaded_bytes': 20, 'paused': True})
+        events.record_progress('new', {'downloaded_bytes': 30, 'completed': True})
+
+        self.assertEqual(self.flushes['old'], [{'downloaded_bytes': 10}])
+        self.assertEqual(self.flushes['new'], [{'downloaded_bytes': 30, 'completed': True}])
+
+    def test_runs_of_other_torrents_are_kept(self):
+        events.track_progress('abc', 'old', self.flushes['old'].append)
+        events.track_progress('def', 'new', self.flushes['new'].append)
+        self.assertIn('old', events.progress_reporters)
+        self.assertIn('new', events.progress_reporters)
+
+class ProgressStreamViewTests(TestCase):
+    @override_settings(TOURINT_PROGRESS_STREAM_INTERVAL_S=0)
+    def test_streams_published_progress(self):
+        response = self.client.get('/torrents/events/', {'file_hash': 'abc'})
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        # A plain iterator, which WSGI servers send chunk by chunk
+        self.assertFalse(response.is_async)
+        stream = iter(response.streaming_content)
+        try:
+            self.assertEqual(next(stream), b'retry: 2000\n\n')
+            events.broker.publish('def', {'downloaded_bytes': 1})
+            events.broker.publish('abc', {'downloaded_bytes': 2})
+            event, data = next(stream).decode('utf-8').strip().split('\n')
+            self.assertEqual(event, 'event: progress')
+            self.assertEqual(json.loads(data[len('data: '):]),
+                    {'downloaded_bytes': 2, 'file_hash': 'abc'})
+        finally:
+            response.close()
+        self.assertFalse(events.broker.subscribers)
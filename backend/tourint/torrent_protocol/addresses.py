@@ -0,0 +1,53 @@
+"""
+Peer addresses, IPv4 or IPv6.
+
+Peers are (ip, port) pairs everywhere in the engine, with the ip as text. This decides which
+address family a peer is reached over, how it's printed, and the compact forms trackers and PEX
+send peers in: 4 address bytes and 2 port bytes each for IPv4 ('peers', 'added'), 16 and 2 for
+IPv6 ('peers6', 'added6', BEP 7).
+"""
+from typing import Dict, List, Tuple
+import socket
+
+COMPACT_SIZES: Dict[int, int] = {socket.AF_INET: 6, socket.AF_INET6: 18}
+FAMILY_LABELS: Dict[int, str] = {socket.AF_INET: 'ipv4', socket.AF_INET6: 'ipv6'}
+
+def family_of(ip) -> int:
+    """AF_INET6 for IPv6 literals, AF_INET for everything else, host names included"""
+    return socket.AF_INET6 if ':' in ip else socket.AF_INET
+
+def family_label(ip) -> str:
+    return FAMILY_LABELS[family_of(ip)]
+
+def format_address(ip, port) -> str:
+    if family_of(ip) == socket.AF_INET6:
+        return '[{}]:{}'.format(ip, port)
+    return '{}:{}'.format(ip, port)
+
+def encode_compact(addresses, family=socket.AF_INET) -> bytes:
+    """Compact form of the (ip, port) pairs of one family"""
+    return b''.join(socket.inet_pton(family, ip) + port.to_bytes(2, byteorder='big')
+            for ip, port in addresses)
+
+def decode_compact(data, family=socket.AF_INET) -> List[Tuple[str, int]]:
+    if not isinstance(data, (bytes, str)):
+        return []
+    if isinstance(data, str):
+        # bencode.decode turns byte strings that happen to be ascii into str
+        data = data.encode('latin-1')
+    size = COMPACT_SIZES[family]
+    addresses = []
+    for start in range(0, len(data) - size + 1, size):
+        ip = socket.inet_ntop(family, data[start:start + size - 2])
+        port = int.from_bytes(data[start + size - 2:start + size], byteorder='big')
+        if port != 0:
+            addresses.append((ip, port))
+    return addresses
+
+def split_by_family(addresses) -> Tuple[List[Tuple[str, int]], List[Tuple[str, int]]]:
+    """(IPv4 addresses, IPv6 addresses)"""
+    ipv4, ipv6 = [], []
+    for address in addresses:
+        (ipv6 if family_of(address[0]) == socket.AF_INET6 else ipv4).append(address)
+    return ipv4, ipv6
+
@@ -0,0 +1,412 @@
+"""
+Throughput benchmarks for the peer wire protocol hot path.
+
+Run from the torrent_protocol directory, like the tests:
+
+    python -m benchmarks.bench_protocol [--output results.json] [--baseline benchmarks/baseline.json]
+
+Every benchmark runs on synthetic PIECE/HAVE/BITFIELD streams generated from a fixed seed, and
+feeds the stream to the parser in randomly sized chunks the way socket reads would. Results are
+reported as messages/s (or ops/s) and MB/s, saved as JSON, and compared against a stored
+baseline. A benchmark more than --tolerance slower than its baseline is a regression, and makes
+the script exit non-zero. Baselines are machine specific: regenerate one with --save-baseline on
+the machine you compare on before tuning anything.
+"""
+from typing import Callable, Dict, List
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import sys
+import time
+
+import bencode
+import peer
+import piece_picker
+import ring_buffer
+
+DEFAULT_SEED: int = 1234
+DEFAULT_BASELINE: str = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+# Allowed slowdown relative to the baseline before a result counts as a regression
+DEFAULT_TOLERANCE: float = 0.2
+
+BLOCK_SIZE: int = peer.PieceDownload.BLOCK_SIZE_BYTES
+NUM_PIECES: int = 2048
+
+def make_piece_message(rng, piece_index, begin, length) -> bytes:
+    payload = bytearray()
+    payload.extend(piece_index.to_bytes(4, byteorder='big'))
+    payload.extend(begin.to_bytes(4, byteorder='big'))
+    payload.extend(rng.getrandbits(8 * length).to_bytes(length, byteorder='big'))
+    return peer.PeerMessage(peer.PeerMessage.Id.PIECE, payload).serialize()
+
+def make_have_message(piece_index) -> bytes:
+    return peer.PeerMessage(peer.PeerMessage.Id.HAVE, piece_index.to_bytes(4, byteorder='big'))\
+            .serialize()
+
+def make_bitfield_message(rng, num_pieces) -> bytes:
+    num_bytes = (num_pieces + 7) // 8
+    payload = rng.getrandbits(8 * num_bytes).to_bytes(num_bytes, byteorder='big')
+    return peer.PeerMessage(peer.PeerMessage.Id.BITFIELD, payload).serialize()
+
+def make_stream(rng, kind, num_messages) -> List[bytes]:
+    """Returns a list of serialized messages of the given kind ('piece', 'have', 'bitfield' or
+    'mixed')
+    """
+    messages = []
+    for i in range(num_messages):
+        k = kind
+        if kind == 'mixed':
+            # Roughly what a busy connection looks like: mostly blocks, a lot of HAVEs
+            k = rng.choices(['piece', 'have', 'state', 'keep_alive'], weights=[6, 3, 1, 1])[0]
+
+        if k == 'piece':
+            messages.append(make_piece_message(rng, i % NUM_PIECES, 0, BLOCK_SIZE))
+        elif k == 'have':
+            messages.append(make_have_message(rng.randrange(NUM_PIECES)))
+        elif k == 'bitfield':
+            messages.append(make_bitfield_message(rng, NUM_PIECES))
+        elif k == 'keep_alive':
+            messages.append(peer.PeerMessage(peer.PeerMessage.Id.KEEP_ALIVE).serialize())
+        else:
+            messages.append(peer.PeerMessage(peer.PeerMessage.Id.UNCHOKE).serialize())
+    return messages
+
+def fragment(rng, data, max_chunk) -> List[bytes]:
+    """Splits data into randomly sized chunks, like the reads off a socket"""
+    chunks = []
+    i = 0
+    while i < len(data):
+        size = rng.randint(1, max_chunk)
+        chunks.append(data[i:i+size])
+        i += size
+    return chunks
+
+def parse_stream(chunks) -> int:
+    """Feeds chunks through a RingBuffer the way PeerConnection does, returns messages parsed"""
+    buf = ring_buffer.RingBuffer(BLOCK_SIZE + peer.PeerConnection.BUFFER_PADDING)
+    num_messages = 0
+    for chunk in chunks:
+        chunk = memoryview(chunk)
+        while len(chunk):
+            space = buf.empty_space()
+            buf.write(chunk[:space])
+            chunk = chunk[space:]
+            while peer.PeerMessage.from_ring_buffer(buf) is not None:
+                num_messages += 1
+    assert(len(buf) == 0)
+    return num_messages
+
+def decode_stream(chunks) -> int:
+    """parse_stream with the batch decoder PeerConnection uses"""
+    buf = ring_buffer.RingBuffer(BLOCK_SIZE + peer.PeerConnection.BUFFER_PADDING)
+    num_messages = 0
+    for chunk in chunks:
+        chunk = memoryview(chunk)
+        while len(chunk):
+            space = buf.empty_space()
+            buf.write(chunk[:space])
+            chunk = chunk[space:]
+            num_messages += len(peer.decode_frames(buf))
+    assert(len(buf) == 0)
+    return num_messages
+
+def make_idle_connection(num_pieces) -> peer.PeerConnection:
+    """A connection past the bitfield, for feeding messages to without a socket"""
+    connection = peer.PeerConnection({'ip': '127.0.0.1', 'port': 1}, bytes(20),
+            piece_picker.PiecePicker(num_pieces))
+    connection.socket.close()
+    connection.state = peer.PeerConnection.State.IDLE
+    connection.available_pieces = peer.Bitfield.empty(num_pieces)
+    return connection
+
+class Benchmark:
+    def __init__(self, name, setup: Callable, run: Callable, unit='msgs'):
+        """setup(rng) returns a state object, run(state) does one iteration and returns
+        (operations, bytes) processed
+        """
+        self.name = name
+        self.setup = setup
+        self.run = run
+        self.unit = unit
+
+def bench_parse(kind, num_messages, max_chunk) -> Benchmark:
+    def setup(rng):
+        messages = make_stream(rng, kind, num_messages)
+        chunks = fragment(rng, b''.join(messages), max_chunk)
+        return (chunks, len(messages), sum(len(m) for m in messages))
+
+    def run(state):
+        chunks, expected, total_bytes = state
+        parsed = parse_stream(chunks)
+        assert(parsed == expected)
+        return parsed, total_bytes
+
+    return Benchmark('from_ring_buffer.{}'.format(kind), setup, run)
+
+def bench_decode(kind, num_messages, max_chunk) -> Benchmark:
+    def setup(rng):
+        messages = make_stream(rng, kind, num_messages)
+        chunks = fragment(rng, b''.join(messages), max_chunk)
+        return (chunks, len(messages), sum(len(m) for m in messages))
+
+    def run(state):
+        chunks, expected, total_bytes = state
+        parsed = decode_stream(chunks)
+        assert(parsed == expected)
+        return parsed, total_bytes
+
+    return Benchmark('decode_frames.{}'.format(kind), setup, run)
+
+def bench_handle_messages(kind, num_messages, max_chunk) -> Benchmark:
+    """Decoding plus dispatch, HAVEs ending up in the bitfield and the piece picker"""
+    def setup(rng):
+        messages = make_stream(rng, kind, num_messages)
+        chunks = fragment(rng, b''.join(messages), max_chunk)
+        return (chunks, len(messages), sum(len(m) for m in messages))
+
+    def run(state):
+        chunks, num_messages, total_bytes = state
+        connection = make_idle_connection(NUM_PIECES)
+        for chunk in chunks:
+            chunk = memoryview(chunk)
+            while len(chunk):
+                space = connection.buffer.empty_space()
+                connection.append_to_buffer(chunk[:space])
+                chunk = chunk[space:]
+                connection.handle_messages_from_buffer(False)
+        assert(len(connection.buffer) == 0)
+        return num_messages, total_bytes
+
+    return Benchmark('handle_messages.{}'.format(kind), setup, run)
+
+def bench_serialize(num_messages) -> Benchmark:
+    def setup(rng):
+        payload = bytes(BLOCK_SIZE + 8)
+        return [peer.PeerMessage.new_request(rng.randrange(NUM_PIECES), 0, BLOCK_SIZE)
+                for _ in range(num_messages)] +\
+               [peer.PeerMessage(peer.PeerMessage.Id.PIECE, payload)
+                for _ in range(num_messages // 10)]
+
+    def run(messages):
+        total_bytes = 0
+        for m in messages:
+            total_bytes += len(m.serialize())
+        return len(messages), total_bytes
+
+    return Benchmark('serialize', setup, run)
+
+def bench_ring_buffer(num_ops, max_chunk) -> Benchmark:
+    def setup(rng):
+        return [rng.randbytes(rng.randint(1, max_chunk)) for _ in range(num_ops)]
+
+    def run(chunks):
+        buf = ring_buffer.RingBuffer(BLOCK_SIZE + peer.PeerConnection.BUFFER_PADDING)
+        total_bytes = 0
+        for chunk in chunks:
+            buf.write(chunk)
+            total_bytes += len(buf.read(len(chunk)))
+        return len(chunks), total_bytes
+
+    return Benchmark('ring_buffer.write_read', setup, run, unit='ops')
+
+def bench_block_response(num_pieces, piece_length) -> Benchmark:
+    def setup(rng):
+        blocks = []
+        for begin in range(0, piece_length, BLOCK_SIZE):
+            payload = bytearray((0).to_bytes(4, byteorder='big'))
+            payload.extend(begin.to_bytes(4, byteorder='big'))
+            payload.extend(rng.randbytes(min(BLOCK_SIZE, piece_length - begin)))
+            blocks.append(payload)
+        rng.shuffle(blocks)
+        return blocks
+
+    def run(blocks):
+        total_bytes = 0
+        for _ in range(num_pieces):
+            download = peer.PieceDownload(0, piece_length)
+            for payload in blocks:
+                download.handle_block_response(payload)
+                total_bytes += len(payload) - 8
+            assert(download.all_blocks_received())
+            download.digest()
+        return num_pieces * len(blocks), total_bytes
+
+    # Blocks are hashed as they arrive, so this includes the piece's SHA-1 to be comparable
+    # with hashing the whole piece once it's complete
+    return Benchmark('PieceDownload.receive_and_hash', setup, run, unit='blocks')
+
+def bench_bitfield(num_ops) -> Benchmark:
+    def setup(rng):
+        return [rng.randrange(NUM_PIECES) for _ in range(num_ops)]
+
+    def run(indices):
+        bitfield = peer.Bitfield(bytearray((NUM_PIECES + 7) // 8))
+        for i in indices:
+            bitfield.set(i)
+        for i in range(NUM_PIECES):
+            bitfield.contains(i)
+        for i in indices:
+            bitfield.clear(i)
+        return 2 * len(indices) + NUM_PIECES, 0
+
+    return Benchmark('Bitfield.set_contains_clear', setup, run, unit='ops')
+
+def make_metainfo(rng, num_pieces):
+    return {
+        'announce': 'http://127.0.0.1:6969/announce',
+        'info': {
+            'name': 'benchmark.bin',
+            'piece length': 262144,
+            'length': 262144 * num_pieces,
+            'pieces': rng.randbytes(20 * num_pieces),
+        },
+        'comment': 'synthetic',
+        'url-list': ['http://127.0.0.1/{}'.format(i) for i in range(16)],
+    }
+
+def bench_bencode_encode(num_docs, num_pieces) -> Benchmark:
+    def setup(rng):
+        return [make_metainfo(rng, num_pieces) for _ in range(num_docs)]
+
+    def run(docs):
+        total_bytes = 0
+        for metainfo in docs:
+            total_bytes += len(bencode.encode(metainfo))
+        return len(docs), total_bytes
+
+    return Benchmark('bencode.encode', setup, run, unit='docs')
+
+def bench_bencode_decode(num_docs, num_pieces) -> Benchmark:
+    def setup(rng):
+        return [bencode.encode(make_metainfo(rng, num_pieces)) for _ in range(num_docs)]
+
+    def run(docs):
+        total_bytes = 0
+        for encoded in docs:
+            bencode.decode(encoded)
+            total_bytes += len(encoded)
+        return len(docs), total_bytes
+
+    return Benchmark('bencode.decode', setup, run, unit='docs')
+
+def all_benchmarks(scale=1) -> List[Benchmark]:
+    return [
+        bench_parse('piece', 2000 * scale, 65536),
+        bench_parse('have', 50000 * scale, 4096),
+        bench_parse('bitfield', 10000 * scale, 4096),
+        bench_parse('mixed', 5000 * scale, 16384),
+        bench_decode('piece', 2000 * scale, 65536),
+        bench_decode('have', 50000 * scale, 4096),
+        bench_decode('bitfield', 10000 * scale, 4096),
+        bench_decode('mixed', 5000 * scale, 16384),
+        bench_handle_messages('have', 50000 * scale, 4096),
+        bench_handle_messages('mixed', 5000 * scale, 16384),
+        bench_serialize(50000 * scale),
+        bench_ring_buffer(50000 * scale, 4096),
+        bench_block_response(100 * scale, 16 * BLOCK_SIZE),
+        bench_bitfield(100000 * scale),
+        bench_bencode_encode(200 * scale, 100),
+        bench_bencode_decode(200 * scale, 100),
+    ]
+
+def run_benchmark(benchmark, seed, repeat) -> Dict:
+    state = benchmark.setup(random.Random(seed))
+    # Best of `repeat` runs, which is the least noisy estimate of what the code can do. The
+    # collector is off while timing, same as timeit, so allocation-heavy code isn't penalized
+    # by whenever a collection happens to land.
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            operations, num_bytes = benchmark.run(state)
+            elapsed = time.perf_counter() - start
+        finally:
+            gc.enable()
+        if best is None or elapsed < best[0]:
+            best = (elapsed, operations, num_bytes)
+
+    elapsed, operations, num_bytes = best
+    return {
+        'unit': benchmark.unit,
+        'seconds': elapsed,
+        'ops_per_s': operations / elapsed,
+        'mb_per_s': num_bytes / elapsed / 1e6,
+    }
+
+def compare(results, baseline, tolerance) -> List[str]:
+    """Returns a description of every benchmark that got slower than tolerance allows"""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]['ops_per_s']
+        change = result['ops_per_s'] / before - 1
+        print('{:40s} {:+7.1%} vs baseline'.format(name, change))
+        if change < -tolerance:
+            regressions.append('{}: {:.0f} -> {:.0f} {}/s'.format(name, before,
+                result['ops_per_s'], result['unit']))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    parser.add_argument('--repeat', type=int, default=7)
+    parser.add_argument('--scale', type=int, default=1, help='multiplies the work per iteration')
+    parser.add_argument('--filter', default='', help='only run benchmarks containing this')
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true',
+            help='overwrite the baseline with these results instead of comparing')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args(argv)
+
+    results = {}
+    for benchmark in all_benchmarks(args.scale):
+        if args.filter not in benchmark.name:
+            continue
+        result = run_benchmark(benchmark, args.seed, args.repeat)
+        results[benchmark.name] = result
+        print('{:40s} {:14,.0f} {}/s {:10.1f} MB/s'.format(benchmark.name, result['ops_per_s'],
+            result['unit'], result['mb_per_s']))
+
+    document = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'seed': args.seed,
+        'scale': args.scale,
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(document, f, indent=2, sort_keys=True)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(document, f, indent=2, sort_keys=True)
+        print('Saved baseline to {}'.format(args.baseline))
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print('No baseline at {}, skipping comparison'.format(args.baseline))
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get('scale') != args.scale:
+        print('Baseline was recorded with scale {}, not comparing'.format(baseline.get('scale')))
+        return 0
+
+    regressions = compare(results, baseline['results'], args.tolerance)
+    for r in regressions:
+        print('REGRESSION {}'.format(r))
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,143 @@
+"""
+Startup benchmarks for download worker processes.
+
+Run from the torrent_protocol directory, like the tests:
+
+    python -m benchmarks.bench_startup [--output results.json]
+
+Two things are measured:
+
+- Import time of the engine (torrent_download) in a fresh interpreter, from python -X importtime,
+  and which heavyweight modules (requests, Django, DRF) the import pulls in.
+- Time from Process.start() until a worker is ready to run a download, and that worker's memory
+  (PSS, so shared pages are split between the processes sharing them, and RSS), for each start
+  method. The parent first imports what the web app would have loaded (--parent-imports), since
+  that's what fork copies into every worker. forkserver is measured warm, i.e. after its server is
+  running (what worker.prewarm does), and its cold first start is reported separately.
+"""
+from typing import Dict, List
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+ENGINE_MODULE: str = 'torrent_download'
+HEAVY_MODULES = ('requests', 'urllib3', 'django', 'rest_framework')
+PROTOCOL_DIRECTORY: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def import_time_us(module) -> int:
+    """Cumulative import time of module in a fresh interpreter, in microseconds"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+            cwd=PROTOCOL_DIRECTORY, capture_output=True, text=True, check=True)
+    for line in result.stderr.splitlines():
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2].strip() == module:
+            return int(fields[1])
+    raise ValueError('{} not found in -X importtime output'.format(module))
+
+def heavy_modules_after_import(module) -> List[str]:
+    code = 'import sys, {}; print(",".join(m for m in {!r} if m in sys.modules))'\
+            .format(module, HEAVY_MODULES)
+    result = subprocess.run([sys.executable, '-c', code], cwd=PROTOCOL_DIRECTORY,
+            capture_output=True, text=True, check=True)
+    return [m for m in result.stdout.strip().split(',') if m]
+
+def memory_kb() -> Dict[str, int]:
+    memory = {}
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            for line in f:
+                name, _, value = line.partition(':')
+                if name in ('Rss', 'Pss'):
+                    memory[name.lower() + '_kb'] = int(value.split()[0])
+    except OSError:
+        memory['rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return memory
+
+def probe(connection):
+    """Worker stand-in: gets to the point where a download could start, then reports"""
+    import torrent_download
+    connection.send((time.monotonic(), memory_kb(), [m for m in HEAVY_MODULES if m in sys.modules]))
+    connection.close()
+
+def start_probe(context) -> Dict:
+    receiver, sender = context.Pipe(duplex=False)
+    start = time.monotonic()
+    process = context.Process(target=probe, args=(sender,))
+    process.start()
+    sender.close()
+    ready, memory, heavy = receiver.recv()
+    process.join()
+    return dict(memory, start_ms=(ready - start) * 1000, heavy_modules=heavy)
+
+def bench_start_method(method, repeat) -> Dict:
+    context = multiprocessing.get_context(method)
+    result = {}
+    if method == 'forkserver':
+        context.set_forkserver_preload([ENGINE_MODULE])
+        result['cold_start_ms'] = start_probe(context)['start_ms']
+
+    runs = [start_probe(context) for _ in range(repeat)]
+    result.update({
+        'start_ms': statistics.median(r['start_ms'] for r in runs),
+        'heavy_modules': runs[-1]['heavy_modules'],
+    })
+    for name in ('pss_kb', 'rss_kb'):
+        if name in runs[-1]:
+            result[name] = statistics.median(r[name] for r in runs)
+    return result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=7)
+    parser.add_argument('--methods', default=','.join(multiprocessing.get_all_start_methods()))
+    parser.add_argument('--parent-imports', default='django,rest_framework,requests',
+            help='modules to import in the parent first, skipped if not installed')
+    parser.add_argument('--output', help='write results to this JSON file')
+    args = parser.parse_args(argv)
+
+    imported = []
+    for module in filter(None, args.parent_imports.split(',')):
+        try:
+            __import__(module)
+            imported.append(module)
+        except ImportError:
+            pass
+
+    imports = [import_time_us(ENGINE_MODULE) for _ in range(args.repeat)]
+    results = {
+        'python': sys.version.split()[0],
+        'parent_imports': imported,
+        'import': {
+            'module': ENGINE_MODULE,
+            'import_ms': statistics.median(imports) / 1000,
+            'heavy_modules': heavy_modules_after_import(ENGINE_MODULE),
+        },
+        'start_methods': {},
+    }
+    print('import {:30s} {:8.1f} ms  pulls in: {}'.format(ENGINE_MODULE,
+        results['import']['import_ms'], ', '.join(results['import']['heavy_modules']) or '-'))
+
+    for method in args.methods.split(','):
+        result = bench_start_method(method, args.repeat)
+        results['start_methods'][method] = result
+        print('start {:11s} {:8.1f} ms  pss {:>8} kB  rss {:>8} kB  inherited: {}'.format(method,
+            result['start_ms'], result.get('pss_kb', '?'), result.get('rss_kb', '?'),
+            ', '.join(result['heavy_modules']) or '-'))
+        if 'cold_start_ms' in result:
+            print('      {:11s} {:8.1f} ms  (cold, starting the server)'.format('',
+                result['cold_start_ms']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -162,9 +162,13 @@ def encode_dict(d: Dict) -> bytes:
     ret_tokens.append(DICT_DELIMITER)
 
     for key, val in d.items():
-        if not isinstance(key, str):
-            raise TypeError('bencode.encode_dict: key must be an ascii string')
-        ret_tokens.extend(encode_ascii_string(key))
+        if isinstance(key, str):
+            ret_tokens.extend(encode_ascii_string(key))
+        elif isinstance(key, bytes):
+            # Binary keys, like the pieces roots in a v2 torrent's 'piece layers'
+            ret_tokens.extend(encode_bytes_string(key))
+        else:
+            raise TypeError('bencode.encode_dict: key must be a string')
         ret_tokens.extend(encode(val))
 
     ret_tokens.append(END_DELIMITER)
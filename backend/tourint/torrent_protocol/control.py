@@ -0,0 +1,139 @@
+"""
+Control channel between the web app and a running TorrentDownload.
+
+The parent keeps one end of a multiprocessing Pipe and sends (command, arguments) tuples. The
+download registers the other end in the same poll loop as its peer sockets, so a command is acted
+on as soon as it arrives instead of on the next database poll. Results come back the usual way,
+as progress updates and snapshots on the telemetry queue, except for READs, which are answered on
+a reply pipe of their own (see ReadReplies).
+"""
+import enum
+import json
+import os
+import select
+import time
+
+class Command(str, enum.Enum):
+    # Flush, save resume state and exit. Resuming means starting a new TorrentDownload, which
+    # picks up from the resume state.
+    PAUSE = 'pause'
+    # Like PAUSE, but reports the torrent as cancelled. Arguments: delete_data, to also remove
+    # everything downloaded so far.
+    CANCEL = 'cancel'
+    # Arguments: bytes_per_second, 0 for unlimited
+    SET_RATE_LIMIT = 'set_rate_limit'
+    # Send a snapshot on the telemetry queue right away
+    SNAPSHOT = 'snapshot'
+    # Time each phase of the download, and run cProfile unless cprofile is false, for
+    # duration_s seconds (see profiling.py). The summary comes back on the telemetry queue.
+    PROFILE = 'profile'
+    # Wait for a byte range of the torrent to be verified and on disk, so the reader can read it
+    # from the files itself. Arguments: request_id, offset, length, deadline (the time.time()
+    # after which the reader has given up). Answered on the reply pipe, or not at all if the
+    # pieces aren't in by the deadline.
+    READ = 'read'
+    # Argument: priorities, the piece_picker.Priority name of every file in the torrent
+    SET_FILE_PRIORITIES = 'set_file_priorities'
+
+# Profiling window when PROFILE doesn't give one
+DEFAULT_PROFILE_S: float = 30.0
+DEFAULT_READ_TIMEOUT_S: float = 30.0
+# Largest range one READ may ask for, the reader holds it in memory
+MAX_READ_BYTES: int = 16 * 1024 * 1024
+# Keeps every READ reply well under PIPE_BUF, see send_read_reply
+MAX_REQUEST_ID_CHARS: int = 64
+MAX_ERROR_CHARS: int = 200
+
+def send_command(connection, command: Command, **arguments):
+    connection.send((Command(command).value, arguments))
+
+def receive_command(connection):
+    """Returns the next (Command, arguments) on the connection, which must be readable"""
+    command, arguments = connection.recv()
+    return Command(command), arguments
+
+def send_read_reply(connection, request_id, error=None) -> bool:
+    """Answers a READ on the download's end of the reply pipe, which must be non-blocking.
+
+    A reply is one line of JSON, [request_id, error]. Lines shorter than PIPE_BUF are written
+    whole or not at all, so if the reader has stopped draining the pipe the reply is dropped
+    (and False returned) instead of the download loop stalling on it.
+    """
+    if error is not None:
+        error = str(error)[:MAX_ERROR_CHARS]
+    line = json.dumps([request_id, error]).encode('utf-8') + b'\n'
+    assert(len(line) <= select.PIPE_BUF)
+    try:
+        os.write(connection.fileno(), line)
+    except OSError:
+        # BlockingIOError if the pipe is full, BrokenPipeError if the reader went away
+        return False
+    return True
+
+class ReadReplies:
+    """The reader's end of a download's READ reply pipe"""
+
+    def __init__(self, connection):
+        self.connection = connection
+        # Bytes received after the last complete reply line
+        self.buffer = b''
+
+    def wait(self, request_id, deadline):
+        """Waits until deadline (a time.time()) for the download to say the range READ with
+        request_id is on disk. Replies to earlier READs that timed out are skipped. Raises
+        TimeoutError if none comes in time, ValueError if the download refused the read, and
+        EOFError if it exited."""
+        while True:
+            while b'\n' in self.buffer:
+                line, self.buffer = self.buffer.split(b'\n', 1)
+                reply_id, error = json.loads(line)
+                if reply_id != request_id:
+                    continue
+                if error is not None:
+                    raise ValueError(error)
+                return
+            remaining = deadline - time.time()
+            if remaining <= 0 or not self.connection.poll(remaining):
+                raise TimeoutError('Read not answered in time')
+            data = os.read(self.connection.fileno(), select.PIPE_BUF)
+            if not data:
+                raise EOFError('The download exited')
+            self.buffer += data
+
+class TokenBucket:
+    """Download rate limit. Bytes are charged after they've been read, so the bucket can go
+    into debt; wait_s() then says how long to stop reading for it to pay the debt back."""
+
+    # Burst allowance in seconds' worth of the rate
+    BURST_S: float = 0.25
+
+    def __init__(self, rate_bps=0):
+        self.rate_bps = 0
+        self.tokens = 0.0
+        self.last_refill = time.monotonic()
+        self.set_rate(rate_bps)
+
+    def set_rate(self, rate_bps):
+        """0 turns the limit off"""
+        self.rate_bps = max(0, rate_bps)
+        self.tokens = min(self.tokens, self.capacity())
+        self.last_refill = time.monotonic()
+
+    def capacity(self) -> float:
+        return self.rate_bps * self.BURST_S
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity(), self.tokens + (now - self.last_refill) * self.rate_bps)
+        self.last_refill = now
+
+    def consume(self, num_bytes):
+        if self.rate_bps:
+            self.refill()
+            self.tokens -= num_bytes
+
+    def wait_s(self) -> float:
+        if not self.rate_bps:
+            return 0.0
+        self.refill()
+        return -self.tokens / self.rate_bps if self.tokens < 0 else 0.0
@@ -0,0 +1,673 @@
+"""
+Mainline DHT (BEP 5): finding peers for a torrent without a tracker.
+
+DhtNode is an asyncio KRPC node over UDP. It keeps a Kademlia routing table of k-buckets, answers
+ping, find_node, get_peers and announce_peer, and runs iterative lookups that keep ALPHA queries
+in flight, closest nodes first, until the K closest nodes it has heard of have all been asked.
+announce_peer tokens are derived from the asker's IP and a secret that rotates every
+TOKEN_ROTATE_S, and tokens made with the previous secret are still accepted. The routing table
+can be saved to a JSON file and loaded on the next start, so bootstrapping doesn't begin from
+scratch. Lookup latency and message counts go to the EngineMetrics passed in.
+
+TorrentDownload isn't asyncio, so DhtService runs a node on an event loop in a thread of its own
+and hands the peers its lookups find back through a queue.
+"""
+from typing import Dict, List, Optional, Sequence, Tuple
+from collections import OrderedDict
+import asyncio
+import hashlib
+import json
+import os
+import queue
+import socket
+import threading
+import time
+
+if __package__ is None or __package__ == '':
+    import bencode
+    import metrics
+    import pex
+else:
+    from . import bencode
+    from . import metrics
+    from . import pex
+
+NODE_ID_SIZE: int = 20
+ID_BITS: int = NODE_ID_SIZE * 8
+COMPACT_NODE_SIZE: int = NODE_ID_SIZE + pex.COMPACT_PEER_SIZE
+# Bucket size and lookup parallelism, as in the Kademlia paper and BEP 5
+K: int = 8
+ALPHA: int = 3
+QUERY_TIMEOUT_S: float = 2.0
+# Nodes that failed to answer this many queries in a row get replaced by new ones
+BAD_NODE_FAILURES: int = 2
+TOKEN_ROTATE_S: float = 300.0
+TOKEN_SIZE: int = 8
+PEER_TTL_S: float = 30 * 60
+# Buckets nobody was added to for this long get a lookup of a random id in their range
+BUCKET_REFRESH_S: float = 15 * 60
+MAX_PEERS_PER_INFO_HASH: int = 1000
+# Keeps get_peers responses well inside one UDP datagram
+MAX_VALUES_PER_RESPONSE: int = 50
+
+DEFAULT_BOOTSTRAP: List[Tuple[str, int]] = [
+    ('router.bittorrent.com', 6881),
+    ('dht.transmissionbt.com', 6881),
+    ('router.utorrent.com', 6881),
+]
+
+class ErrorCode:
+    GENERIC = 201
+    SERVER = 202
+    PROTOCOL = 203
+    METHOD_UNKNOWN = 204
+
+class KrpcError(Exception):
+    def __init__(self, code, message):
+        Exception.__init__(self, '{} {}'.format(code, message))
+        self.code = code
+
+def as_bytes(value) -> bytes:
+    """bencode.decode returns byte strings that happen to be ascii as str. Undoes that."""
+    if isinstance(value, str):
+        return value.encode('latin-1')
+    if isinstance(value, bytes):
+        return value
+    raise ValueError('Expected a byte string, got {}'.format(type(value).__name__))
+
+def canonical(value):
+    """value with every dict's keys in sorted order, which bencode requires"""
+    if isinstance(value, dict):
+        return {key: canonical(value[key]) for key in sorted(value)}
+    if isinstance(value, list):
+        return [canonical(v) for v in value]
+    return value
+
+def distance(a: bytes, b: bytes) -> int:
+    return int.from_bytes(a, byteorder='big') ^ int.from_bytes(b, byteorder='big')
+
+def random_node_id() -> bytes:
+    return os.urandom(NODE_ID_SIZE)
+
+class Node:
+    """A contact in the routing table"""
+
+    def __init__(self, node_id: bytes, ip: str, port: int):
+        self.node_id = node_id
+        self.ip = ip
+        self.port = port
+        self.last_seen = time.monotonic()
+        self.failures = 0
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        return (self.ip, self.port)
+
+    def is_bad(self) -> bool:
+        return self.failures >= BAD_NODE_FAILURES
+
+    def __repr__(self):
+        return 'Node({}, {}:{})'.format(self.node_id.hex()[:8], self.ip, self.port)
+
+def encode_nodes(nodes) -> bytes:
+    return b''.join(node.node_id + pex.encode_peers([node.address]) for node in nodes)
+
+def decode_nodes(data) -> List[Node]:
+    data = as_bytes(data)
+    nodes = []
+    for start in range(0, len(data) - COMPACT_NODE_SIZE + 1, COMPACT_NODE_SIZE):
+        addresses = pex.decode_peers(data[start+NODE_ID_SIZE:start+COMPACT_NODE_SIZE])
+        if addresses:
+            nodes.append(Node(data[start:start+NODE_ID_SIZE], *addresses[0]))
+    return nodes
+
+class RoutingTable:
+    """Contacts in ID_BITS k-buckets, bucket i holding nodes whose distance from us has its
+    highest set bit at i. Most recently seen last in each bucket."""
+
+    def __init__(self, own_id: bytes, bucket_size=K):
+        self.own_id = own_id
+        self.bucket_size = bucket_size
+        self.buckets: List[Dict[bytes, Node]] = [OrderedDict() for _ in range(ID_BITS)]
+        self.last_changed = [time.monotonic()] * ID_BITS
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self.buckets)
+
+    def bucket_index(self, node_id) -> int:
+        return distance(self.own_id, node_id).bit_length() - 1
+
+    def bucket_for(self, node_id) -> Dict[bytes, Node]:
+        return self.buckets[self.bucket_index(node_id)]
+
+    def random_id_in_bucket(self, index) -> bytes:
+        offset = (1 << index) | (int.from_bytes(os.urandom(NODE_ID_SIZE), byteorder='big') &
+                ((1 << index) - 1))
+        return (int.from_bytes(self.own_id, byteorder='big') ^ offset).to_bytes(NODE_ID_SIZE,
+                byteorder='big')
+
+    def stale_buckets(self, max_age_s=BUCKET_REFRESH_S) -> List[int]:
+        """Indices of buckets to refresh: those not changed within max_age_s, down to one past
+        the closest non-empty bucket. Closer ones would almost certainly stay empty."""
+        non_empty = [i for i, bucket in enumerate(self.buckets) if bucket]
+        if not non_empty:
+            return []
+        now = time.monotonic()
+        return [i for i in range(ID_BITS - 1, max(non_empty[0] - 2, -1), -1)
+                if now - self.last_changed[i] >= max_age_s]
+
+    def nodes(self) -> List[Node]:
+        return [node for bucket in self.buckets for node in bucket.values()]
+
+    def get(self, node_id) -> Optional[Node]:
+        if node_id == self.own_id:
+            return None
+        return self.bucket_for(node_id).get(node_id)
+
+    def add(self, node: Node) -> bool:
+        """Adds or refreshes a node that was just heard from. Returns False if its bucket was
+        full of good nodes."""
+        if node.node_id == self.own_id or len(node.node_id) != NODE_ID_SIZE:
+            return False
+        index = self.bucket_index(node.node_id)
+        bucket = self.buckets[index]
+        existing = bucket.get(node.node_id)
+        if existing is not None:
+            existing.ip, existing.port = node.address
+            existing.last_seen = time.monotonic()
+            existing.failures = 0
+            bucket.move_to_end(node.node_id)
+            return True
+        if len(bucket) >= self.bucket_size:
+            bad = next((n for n in bucket.values() if n.is_bad()), None)
+            if bad is None:
+                return False
+            del bucket[bad.node_id]
+        bucket[node.node_id] = node
+        self.last_changed[index] = time.monotonic()
+        return True
+
+    def mark_failed(self, node_id):
+        node = self.get(node_id)
+        if node is not None:
+            node.failures += 1
+
+    def closest(self, target: bytes, count=K) -> List[Node]:
+        good = [node for node in self.nodes() if not node.is_bad()]
+        return sorted(good, key=lambda node: distance(node.node_id, target))[:count]
+
+def save_state(path, node_id: bytes, table: RoutingTable):
+    """Writes the node id and routing table to path, replacing it atomically"""
+    state = {
+        'node_id': node_id.hex(),
+        'nodes': [[node.node_id.hex(), node.ip, node.port] for node in table.nodes()
+            if not node.is_bad()],
+    }
+    temporary_path = '{}.tmp'.format(path)
+    with open(temporary_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(temporary_path, path)
+
+def load_state(path) -> Tuple[Optional[bytes], List[Node]]:
+    """(node id, nodes) from a file save_state wrote, or (None, []) if there's no usable one"""
+    try:
+        with open(path) as f:
+            state = json.load(f)
+        node_id = bytes.fromhex(state['node_id'])
+        nodes = [Node(bytes.fromhex(i), ip, int(port)) for i, ip, port in state['nodes']]
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        if os.path.exists(path):
+            print('Ignoring DHT state in {}: {}'.format(path, e))
+        return None, []
+    if len(node_id) != NODE_ID_SIZE:
+        return None, []
+    return node_id, nodes
+
+class LookupResult:
+    def __init__(self, target: bytes):
+        self.target = target
+        # (ip, port) pairs from get_peers 'values', in the order they were found
+        self.peers: List[Tuple[str, int]] = []
+        # The closest nodes that answered, with the announce_peer token each gave us
+        self.nodes: List[Tuple[Node, Optional[bytes]]] = []
+        self.queries = 0
+        self.responses = 0
+        self.timeouts = 0
+        self.seconds = 0.0
+
+class DhtProtocol(asyncio.DatagramProtocol):
+    def __init__(self, node):
+        self.node = node
+
+    def datagram_received(self, data, address):
+        self.node.datagram_received(data, address)
+
+    def error_received(self, error):
+        # ICMP port unreachable and the like. The query just times out.
+        pass
+
+class DhtNode:
+    def __init__(self, node_id: Optional[bytes] = None, engine_metrics=None):
+        self.node_id = node_id or random_node_id()
+        self.table = RoutingTable(self.node_id)
+        self.engine_metrics = engine_metrics or metrics.DISABLED_ENGINE_METRICS
+        self.transport = None
+        self.port = None
+
+        # transaction id -> (future, address the response has to come from, node id if known)
+        self.pending: Dict[bytes, Tuple[asyncio.Future, Tuple[str, int], Optional[bytes]]] = {}
+        self.next_transaction = int.from_bytes(os.urandom(2), byteorder='big')
+
+        # info hash -> {(ip, port): time announced}
+        self.peer_store: Dict[bytes, Dict[Tuple[str, int], float]] = {}
+        # Current secret first
+        self.secrets = [os.urandom(16), os.urandom(16)]
+        self.secret_rotated = time.monotonic()
+
+    async def start(self, host='0.0.0.0', port=0):
+        loop = asyncio.get_running_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(lambda: DhtProtocol(self),
+                local_addr=(host, port), family=socket.AF_INET)
+        self.port = self.transport.get_extra_info('sockname')[1]
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+        for future, _, _ in self.pending.values():
+            if not future.done():
+                future.cancel()
+        self.pending.clear()
+
+    def count_message(self, direction, kind):
+        self.engine_metrics.dht_messages.inc(1, (direction, kind))
+
+    def send(self, message, address, kind):
+        if self.transport is None:
+            return
+        self.transport.sendto(bencode.encode(canonical(message)), address)
+        self.count_message('sent', kind)
+
+    # Client side
+
+    async def query(self, address, method, arguments, node_id=None) -> Dict:
+        """Sends a query and returns the response's 'r' dict. Raises asyncio.TimeoutError if
+        there's no answer within QUERY_TIMEOUT_S, or KrpcError if the node answers with one."""
+        transaction_id = self.next_transaction.to_bytes(2, byteorder='big')
+        self.next_transaction = (self.next_transaction + 1) % 65536
+        future = asyncio.get_running_loop().create_future()
+        self.pending[transaction_id] = (future, address, node_id)
+
+        arguments = dict(arguments, id=self.node_id)
+        self.send({'t': transaction_id, 'y': 'q', 'q': method, 'a': arguments}, address, method)
+        try:
+            response = await asyncio.wait_for(future, QUERY_TIMEOUT_S)
+        except asyncio.TimeoutError:
+            self.count_message('timeout', method)
+            if node_id is not None:
+                self.table.mark_failed(node_id)
+            raise
+        finally:
+            self.pending.pop(transaction_id, None)
+
+        responder_id = as_bytes(response.get('id', b''))
+        if len(responder_id) != NODE_ID_SIZE:
+            raise KrpcError(ErrorCode.PROTOCOL, 'Response without a node id')
+        self.table.add(Node(responder_id, *address))
+        return response
+
+    async def ping(self, address) -> bytes:
+        return as_bytes((await self.query(address, 'ping', {}))['id'])
+
+    async def lookup(self, target: bytes, method='get_peers', start_nodes=()) -> LookupResult:
+        """Iterative lookup of the nodes closest to target, collecting peers on the way for
+        get_peers. Also refreshes the routing table with every node that answers."""
+        result = LookupResult(target)
+        start = time.perf_counter()
+        argument = 'info_hash' if method == 'get_peers' else 'target'
+
+        shortlist: Dict[bytes, Node] = {}
+        for node in list(self.table.closest(target, K)) + list(start_nodes):
+            shortlist.setdefault(node.node_id, node)
+        queried = set()
+        failed = set()
+        tokens: Dict[bytes, Optional[bytes]] = {}
+        seen_peers = set()
+        in_flight: Dict[asyncio.Task, Node] = {}
+
+        def by_distance(node):
+            return distance(node.node_id, target)
+
+        while True:
+            closest = sorted((n for n in shortlist.values() if n.node_id not in failed),
+                    key=by_distance)[:K]
+            for node in closest:
+                if len(in_flight) >= ALPHA:
+                    break
+                if node.node_id in queried:
+                    continue
+                queried.add(node.node_id)
+                result.queries += 1
+                task = asyncio.ensure_future(self.query(node.address, method,
+                    {argument: target}, node.node_id))
+                in_flight[task] = node
+            if not in_flight:
+                # Every one of the K closest has been asked
+                break
+
+            done, _ = await asyncio.wait(list(in_flight), return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                node = in_flight.pop(task)
+                try:
+                    response = task.result()
+                except (asyncio.TimeoutError, KrpcError, ValueError) as e:
+                    failed.add(node.node_id)
+                    if isinstance(e, asyncio.TimeoutError):
+                        result.timeouts += 1
+                    continue
+                result.responses += 1
+                token = response.get('token')
+                tokens[node.node_id] = as_bytes(token) if token is not None else None
+                try:
+                    found = decode_nodes(response.get('nodes', b''))
+                    values = response.get('values', [])
+                    if not isinstance(values, list):
+                        values = []
+                    for value in values:
+                        for address in pex.decode_peers(as_bytes(value)):
+                            if address not in seen_peers:
+                                seen_peers.add(address)
+                                result.peers.append(address)
+                except ValueError:
+                    continue
+                for found_node in found:
+                    if found_node.node_id != self.node_id:
+                        shortlist.setdefault(found_node.node_id, found_node)
+
+        responded = sorted((n for n in shortlist.values() if n.node_id in tokens),
+                key=by_distance)[:K]
+        result.nodes = [(node, tokens[node.node_id]) for node in responded]
+        result.seconds = time.perf_counter() - start
+        self.engine_metrics.dht_lookup_seconds.observe(result.seconds, (method,))
+        self.engine_metrics.dht_lookup_queries.observe(result.queries, (method,))
+        return result
+
+    async def get_peers(self, info_hash: bytes) -> LookupResult:
+        return await self.lookup(info_hash, 'get_peers')
+
+    async def announce_peer(self, info_hash: bytes, port: int,
+                            lookup_result: Optional[LookupResult] = None) -> int:
+        """Announces that we have info_hash on port to the closest nodes that gave us a token.
+        Returns how many accepted."""
+        if lookup_result is None:
+            lookup_result = await self.get_peers(info_hash)
+        announces = [self.query(node.address, 'announce_peer',
+            {'info_hash': info_hash, 'port': port, 'token': token, 'implied_port': 0},
+            node.node_id) for node, token in lookup_result.nodes if token is not None]
+        results = await asyncio.gather(*announces, return_exceptions=True)
+        return sum(1 for r in results if not isinstance(r, BaseException))
+
+    async def bootstrap(self, addresses: Sequence[Tuple[str, int]] = DEFAULT_BOOTSTRAP):
+        """Fills the routing table by looking up our own id. The bootstrap addresses are only
+        needed if the table (e.g. as loaded by load_state) doesn't have enough nodes."""
+        start_nodes = []
+        if len(self.table) < K:
+            loop = asyncio.get_running_loop()
+            for host, port in addresses:
+                try:
+                    infos = await loop.getaddrinfo(host, port, family=socket.AF_INET,
+                            type=socket.SOCK_DGRAM)
+                except OSError as e:
+                    print('DHT: could not resolve {}: {}'.format(host, e))
+                    continue
+                ip = infos[0][4][0]
+                try:
+                    node_id = await self.ping((ip, port))
+                except (asyncio.TimeoutError, KrpcError, ValueError):
+                    continue
+                start_nodes.append(Node(node_id, ip, port))
+        await self.lookup(self.node_id, 'find_node', start_nodes)
+
+    async def refresh(self, max_age_s=BUCKET_REFRESH_S):
+        """Looks up a random id in each stale bucket's range, as BEP 5 asks every 15 minutes"""
+        for index in self.table.stale_buckets(max_age_s):
+            await self.lookup(self.table.random_id_in_bucket(index), 'find_node')
+
+    # Server side
+
+    def datagram_received(self, data, address):
+        try:
+            message = bencode.decode(data)
+            if not isinstance(message, dict):
+                raise ValueError('not a dict')
+            transaction_id = as_bytes(message.get('t', b''))
+            message_type = message.get('y')
+        except Exception:
+            self.count_message('received', 'malformed')
+            return
+
+        if message_type == 'q':
+            self.count_message('received', str(message.get('q')))
+            self.handle_query(message, transaction_id, address)
+        elif message_type in ('r', 'e'):
+            self.count_message('received', 'response' if message_type == 'r' else 'error')
+            pending = self.pending.get(transaction_id)
+            # Only the node we asked gets to answer
+            if pending is None or pending[1] != address or pending[0].done():
+                return
+            future = pending[0]
+            if message_type == 'r' and isinstance(message.get('r'), dict):
+                future.set_result(message['r'])
+            elif message_type == 'e' and isinstance(message.get('e'), list) and\
+                    len(message['e']) == 2:
+                future.set_exception(KrpcError(*message['e']))
+            else:
+                future.set_exception(KrpcError(ErrorCode.PROTOCOL, 'Malformed response'))
+
+    def respond(self, transaction_id, address, response):
+        self.send({'t': transaction_id, 'y': 'r', 'r': dict(response, id=self.node_id)},
+                address, 'response')
+
+    def respond_error(self, transaction_id, address, code, message):
+        self.send({'t': transaction_id, 'y': 'e', 'e': [code, message]}, address, 'error')
+
+    def handle_query(self, message, transaction_id, address):
+        arguments = message.get('a')
+        method = message.get('q')
+        try:
+            if not isinstance(arguments, dict):
+                raise ValueError('missing arguments')
+            sender_id = as_bytes(arguments.get('id', b''))
+            if len(sender_id) != NODE_ID_SIZE:
+                raise ValueError('bad node id')
+
+            if method == 'ping':
+                response = {}
+            elif method == 'find_node':
+                response = {'nodes': encode_nodes(self.table.closest(
+                    self.id_argument(arguments, 'target')))}
+            elif method == 'get_peers':
+                response = self.handle_get_peers(self.id_argument(arguments, 'info_hash'),
+                        address)
+            elif method == 'announce_peer':
+                self.handle_announce_peer(arguments, address)
+                response = {}
+            else:
+                self.respond_error(transaction_id, address, ErrorCode.METHOD_UNKNOWN,
+                        'Method Unknown')
+                return
+        except ValueError as e:
+            self.respond_error(transaction_id, address, ErrorCode.PROTOCOL,
+                    'Protocol Error: {}'.format(e))
+            return
+
+        self.respond(transaction_id, address, response)
+        # Nodes that query us are as alive as nodes that answer
+        self.table.add(Node(sender_id, *address))
+
+    def id_argument(self, arguments, name) -> bytes:
+        value = as_bytes(arguments.get(name, b''))
+        if len(value) != NODE_ID_SIZE:
+            raise ValueError('bad {}'.format(name))
+        return value
+
+    def rotate_secrets(self):
+        if time.monotonic() - self.secret_rotated >= TOKEN_ROTATE_S:
+            self.secrets = [os.urandom(16), self.secrets[0]]
+            self.secret_rotated = time.monotonic()
+
+    def make_token(self, ip, secret) -> bytes:
+        return hashlib.sha1(secret + socket.inet_aton(ip)).digest()[:TOKEN_SIZE]
+
+    def is_valid_token(self, token, ip) -> bool:
+        return any(token == self.make_token(ip, secret) for secret in self.secrets)
+
+    def stored_peers(self, info_hash) -> Dict[Tuple[str, int], float]:
+        peers = self.peer_store.get(info_hash, {})
+        now = time.monotonic()
+        for address in [a for a, announced in peers.items() if now - announced > PEER_TTL_S]:
+            del peers[address]
+        return peers
+
+    def handle_get_peers(self, info_hash, address) -> Dict:
+        self.rotate_secrets()
+        response = {
+            'token': self.make_token(address[0], self.secrets[0]),
+            'nodes': encode_nodes(self.table.closest(info_hash)),
+        }
+        peers = list(self.stored_peers(info_hash))[-MAX_VALUES_PER_RESPONSE:]
+        if peers:
+            response['values'] = [pex.encode_peers([peer]) for peer in peers]
+        return response
+
+    def handle_announce_peer(self, arguments, address):
+        info_hash = self.id_argument(arguments, 'info_hash')
+        self.rotate_secrets()
+        if not self.is_valid_token(as_bytes(arguments.get('token', b'')), address[0]):
+            raise ValueError('bad token')
+        port = address[1] if arguments.get('implied_port') else arguments.get('port')
+        if not isinstance(port, int) or not 0 < port < 65536:
+            raise ValueError('bad port')
+
+        peers = self.stored_peers(info_hash)
+        if info_hash not in self.peer_store:
+            self.peer_store[info_hash] = peers
+        peers.pop((address[0], port), None)
+        peers[(address[0], port)] = time.monotonic()
+        while len(peers) > MAX_PEERS_PER_INFO_HASH:
+            del peers[next(iter(peers))]
+
+class DhtService:
+    """A DhtNode running on its own event loop thread, for callers that aren't asyncio"""
+
+    START_TIMEOUT_S: float = 5.0
+    STOP_TIMEOUT_S: float = 5.0
+    # How often to check for buckets due a refresh
+    REFRESH_CHECK_S: float = 60.0
+
+    def __init__(self, bootstrap=DEFAULT_BOOTSTRAP, state_file=None, port=0,
+                 engine_metrics=None):
+        self.bootstrap_addresses = [tuple(address) for address in bootstrap]
+        self.state_file = state_file
+        self.port = port
+        self.engine_metrics = engine_metrics
+        self.node: Optional[DhtNode] = None
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='DHT', daemon=True)
+        self.bootstrapped = None
+        self.refresher = None
+        # (ip, port) pairs found by lookups, for the caller to take
+        self.found_peers = queue.Queue()
+
+    def start(self):
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.start_node(), self.loop)\
+                .result(self.START_TIMEOUT_S)
+
+    async def start_node(self):
+        node_id, nodes = (None, []) if self.state_file is None else load_state(self.state_file)
+        self.node = DhtNode(node_id, self.engine_metrics)
+        for node in nodes:
+            self.node.table.add(node)
+        await self.node.start(port=self.port)
+        self.bootstrapped = asyncio.ensure_future(self.node.bootstrap(self.bootstrap_addresses))
+        self.refresher = asyncio.ensure_future(self.refresh_loop())
+
+    async def refresh_loop(self):
+        try:
+            await asyncio.shield(self.bootstrapped)
+        except Exception:
+            pass
+        while True:
+            await asyncio.sleep(self.REFRESH_CHECK_S)
+            try:
+                await self.node.refresh()
+            except Exception as e:
+                print('DHT refresh failed: {}'.format(e))
+
+    def find_peers(self, info_hash: bytes, announce_port: Optional[int] = None):
+        """Starts a get_peers lookup in the background. Peers it finds show up in take_peers.
+        With announce_port, we're then announced as a peer on that port."""
+        asyncio.run_coroutine_threadsafe(self.run_lookup(info_hash, announce_port), self.loop)
+
+    async def run_lookup(self, info_hash, announce_port):
+        try:
+            await asyncio.shield(self.bootstrapped)
+            result = await self.node.get_peers(info_hash)
+            print('DHT: found {} peers for {} in {:.2f}s ({} queries)'.format(len(result.peers),
+                info_hash.hex(), result.seconds, result.queries))
+            for address in result.peers:
+                self.found_peers.put(address)
+            if announce_port is not None:
+                await self.node.announce_peer(info_hash, announce_port, result)
+        except Exception as e:
+            print('DHT lookup failed: {}'.format(e))
+
+    def take_peers(self) -> List[Tuple[str, int]]:
+        peers = []
+        while True:
+            try:
+                peers.append(self.found_peers.get_nowait())
+            except queue.Empty:
+                return peers
+
+    def stop(self):
+        if not self.thread.is_alive():
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self.stop_node(), self.loop)\
+                    .result(self.STOP_TIMEOUT_S)
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join(self.STOP_TIMEOUT_S)
+
+    async def stop_node(self):
+        for task in (self.bootstrapped, self.refresher):
+            if task is not None:
+                task.cancel()
+        if self.node is None:
+            return
+        if self.state_file is not None:
+            try:
+                save_state(self.state_file, self.node.node_id, self.node.table)
+            except OSError as e:
+                print('Could not save DHT state to {}: {}'.format(self.state_file, e))
+        self.node.close()
+
+def lookup_peers(info_hash: bytes, bootstrap=DEFAULT_BOOTSTRAP, state_file=None,
+                 timeout_s=30.0) -> List[Tuple[str, int]]:
+    """One-off get_peers lookup with a temporary node, for code without a DhtService"""
+    async def run():
+        node_id, nodes = (None, []) if state_file is None else load_state(state_file)
+        node = DhtNode(node_id)
+        for contact in nodes:
+            node.table.add(contact)
+        await node.start()
+        try:
+            await node.bootstrap(bootstrap)
+            return (await node.get_peers(info_hash)).peers
+        finally:
+            if state_file is not None:
+                save_state(state_file, node.node_id, node.table)
+            node.close()
+    return asyncio.run(asyncio.wait_for(run(), timeout_s))
@@ -0,0 +1,429 @@
+"""
+Disk I/O for downloaded torrent data.
+
+Verified pieces are handed to a DiskWriter, which keeps them in a bounded write-back cache and
+writes them out from its own thread so the network loop never blocks on the disk. Adjacent pieces
+are coalesced into a single sequential os.pwritev() per file.
+"""
+from typing import Dict, List, Tuple, Set
+import os
+import enum
+import threading
+import time
+
+if __package__ is None or __package__ == '':
+    import metrics
+    import profiling
+else:
+    from . import metrics
+    from . import profiling
+
+# Resume state is a bitfield of pieces that are known to be on disk. Pieces are only recorded in
+# it once their data has been fsynced, so they aren't hashed again when a download resumes.
+RESUME_FILE_NAME: str = '.resume'
+
+# os.pwritev rejects more buffers than this in one call
+MAX_IOV_COUNT: int = 1024
+
+class FsyncPolicy(enum.Enum):
+    # Leave it to the OS. Nothing is known to be on disk, so no resume state is saved either.
+    NEVER = 0
+    # fsync every file touched by a batch before the batch counts as written
+    EVERY_BATCH = 1
+    # fsync everything once when the writer is closed, and every RESUME_INTERVAL_S before
+    # saving resume state
+    ON_CLOSE = 2
+
+def sanitize_path_component(component) -> str:
+    if isinstance(component, bytes):
+        component = component.decode('utf-8', errors='replace')
+    component = str(component).replace('/', '_').replace('\\', '_')
+    if component in ('', '.', '..'):
+        return '_'
+    return component
+
+class FileLayout:
+    """Maps the torrent's flat byte space onto the files described by the info dict"""
+
+    def __init__(self, info: Dict, base_directory):
+        self.base_directory = str(base_directory)
+        # list of (path, length, offset into the torrent)
+        self.files: List[Tuple[str, int, int]] = []
+
+        name = sanitize_path_component(info['name'])
+        offset = 0
+        if 'files' in info:
+            for f in info['files']:
+                components = [sanitize_path_component(c) for c in f['path']]
+                path = os.path.join(self.base_directory, name, *components)
+                self.files.append((path, f['length'], offset))
+                offset += f['length']
+        else:
+            self.files.append((os.path.join(self.base_directory, name), info['length'], 0))
+            offset = info['length']
+
+        self.total_length = offset
+
+    def __len__(self):
+        return len(self.files)
+
+    def file_pieces(self, file_index, piece_length) -> range:
+        """The pieces that overlap a file"""
+        _, file_length, file_offset = self.files[file_index]
+        if file_length == 0:
+            return range(0)
+        first_piece = file_offset // piece_length
+        last_piece = (file_offset + file_length - 1) // piece_length
+        return range(first_piece, last_piece + 1)
+
+    def piece_priorities(self, file_priorities, piece_length, num_pieces) -> List:
+        """Maps per-file priorities onto pieces.
+
+        A piece shared by several files gets the highest priority among them, so a skipped file
+        never keeps a wanted neighbour from being downloaded.
+        """
+        assert(len(file_priorities) == len(self.files))
+        ret = [min(file_priorities)] * num_pieces
+        for file_index, priority in enumerate(file_priorities):
+            for piece_index in self.file_pieces(file_index, piece_length):
+                ret[piece_index] = max(ret[piece_index], priority)
+        return ret
+
+    def segments(self, offset, length) -> List[Tuple[int, int, int]]:
+        """Splits the byte range [offset, offset + length) at file boundaries.
+
+        Returns a list of (file index, offset within the file, length).
+        """
+        if offset < 0 or offset + length > self.total_length:
+            raise ValueError('FileLayout.segments: range {}+{} outside of torrent of size {}'
+                    .format(offset, length, self.total_length))
+
+        ret = []
+        for file_index, (_, file_length, file_offset) in enumerate(self.files):
+            if length == 0:
+                break
+            file_end = file_offset + file_length
+            if file_end <= offset:
+                continue
+            segment_length = min(length, file_end - offset)
+            if segment_length > 0:
+                ret.append((file_index, offset - file_offset, segment_length))
+            offset += segment_length
+            length -= segment_length
+        return ret
+
+def read_range(layout, offset, length) -> bytes:
+    """Reads a byte range of the torrent from its files"""
+    ret = bytearray()
+    for file_index, file_offset, segment_length in layout.segments(offset, length):
+        with open(layout.files[file_index][0], 'rb') as f:
+            ret.extend(os.pread(f.fileno(), segment_length, file_offset))
+    return bytes(ret)
+
+def load_resume_state(output_directory, num_pieces) -> Set[int]:
+    """Returns the set of piece indices recorded as written in the resume file"""
+    path = os.path.join(str(output_directory), RESUME_FILE_NAME)
+    try:
+        with open(path, 'rb') as f:
+            bitfield = f.read()
+    except FileNotFoundError:
+        return set()
+
+    if len(bitfield) != (num_pieces + 7) // 8:
+        print('Ignoring resume file {} with unexpected size {}'.format(path, len(bitfield)))
+        return set()
+
+    return set(i for i in range(num_pieces) if (bitfield[i // 8] >> (7 - (i % 8))) & 1)
+
+def save_resume_state(output_directory, num_pieces, pieces):
+    bitfield = bytearray((num_pieces + 7) // 8)
+    for i in pieces:
+        bitfield[i // 8] |= 1 << (7 - (i % 8))
+
+    path = os.path.join(str(output_directory), RESUME_FILE_NAME)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(bitfield)
+    os.replace(tmp_path, path)
+
+def delete_download(layout, output_directory):
+    """Removes a download's files and resume state, then any directories left empty"""
+    for path, _, _ in layout.files:
+        if os.path.exists(path):
+            os.remove(path)
+    resume_path = os.path.join(str(output_directory), RESUME_FILE_NAME)
+    for path in (resume_path, resume_path + '.tmp'):
+        if os.path.exists(path):
+            os.remove(path)
+
+    if not os.path.isdir(str(output_directory)):
+        return
+    for directory, _, _ in sorted(os.walk(str(output_directory)), key=lambda w: -len(w[0])):
+        if not os.listdir(directory):
+            os.rmdir(directory)
+
+def write_buffers(fd, buffers, offset):
+    """Writes all of buffers to fd starting at offset, retrying short writes"""
+    buffers = [memoryview(b) for b in buffers if len(b)]
+    while buffers:
+        batch = buffers[:MAX_IOV_COUNT]
+        if hasattr(os, 'pwritev'):
+            written = os.pwritev(fd, batch, offset)
+        else:
+            written = os.pwrite(fd, batch[0], offset)
+        offset += written
+
+        # Drop whatever was written, keeping the unwritten tail of a partially written buffer
+        while written and buffers:
+            if written >= len(buffers[0]):
+                written -= len(buffers[0])
+                buffers.pop(0)
+            else:
+                buffers[0] = buffers[0][written:]
+                written = 0
+
+class DiskWriter(threading.Thread):
+    """Write-back cache for verified pieces, drained by a dedicated writer thread.
+
+    submit() blocks once max_cache_bytes are waiting to be written, which throttles the downloader
+    to the speed of the disk. Callers that can't afford to block should check is_full() first.
+    """
+
+    DEFAULT_MAX_CACHE_BYTES: int = 64 * 1024 * 1024
+    # Upper bound on how much a single coalesced write may cover
+    MAX_BATCH_BYTES: int = 16 * 1024 * 1024
+    # With FsyncPolicy.ON_CLOSE, how often written pieces are synced and saved as resume state.
+    # A crash loses at most this much progress.
+    RESUME_INTERVAL_S: float = 10.0
+
+    def __init__(self, layout: FileLayout, piece_length: int, num_pieces: int, output_directory,
+                 written_pieces=None, max_cache_bytes=DEFAULT_MAX_CACHE_BYTES,
+                 fsync_policy=FsyncPolicy.ON_CLOSE, engine_metrics=None, phase_timer=None):
+        threading.Thread.__init__(self, name='DiskWriter', daemon=True)
+        self.layout = layout
+        self.piece_length = piece_length
+        self.num_pieces = num_pieces
+        self.output_directory = output_directory
+        self.max_cache_bytes = max_cache_bytes
+        self.fsync_policy = fsync_policy
+        self.engine_metrics = engine_metrics or metrics.DISABLED_ENGINE_METRICS
+        # Times write_batch as the 'write' phase while profiling, see profiling.py
+        self.phase_timer = phase_timer or profiling.PhaseTimer()
+
+        # Pieces waiting to be written, and pieces currently being written by the writer thread.
+        # Both still count against the cache size.
+        self.pending: Dict[int, bytes] = {}
+        self.in_flight: Dict[int, bytes] = {}
+        self.cached_bytes = 0
+
+        self.written_pieces: Set[int] = set(written_pieces or ())
+        # Files that are never opened or allocated. Pieces that straddle one are written only
+        # partially, and are recorded in partial_pieces instead of written_pieces.
+        self.skipped_files: Set[int] = set()
+        self.partial_pieces: Set[int] = set()
+        self.file_descriptors: Dict[int, int] = {}
+        self.dirty_files: Set[int] = set()
+        self.last_resume_save = time.monotonic()
+
+        self.error = None
+        self.closing = False
+        self.condition = threading.Condition()
+
+    def is_full(self) -> bool:
+        return self.cached_bytes >= self.max_cache_bytes
+
+    def on_disk(self, pieces) -> bool:
+        """Whether every one of pieces has been written to its files, so other processes can
+        read it from there"""
+        with self.condition:
+            return all(p in self.written_pieces or p in self.partial_pieces for p in pieces)
+
+    def queue_depth(self) -> int:
+        with self.condition:
+            return len(self.pending) + len(self.in_flight)
+
+    def set_skipped_files(self, skipped_files):
+        with self.condition:
+            self.skipped_files = set(skipped_files)
+
+    def check_error(self):
+        if self.error is not None:
+            raise IOError('DiskWriter failed: {}'.format(self.error))
+
+    def submit(self, piece_index, piece_bytes):
+        """Queues a verified piece to be written. Blocks while the cache is full."""
+        with self.condition:
+            while self.is_full() and self.error is None:
+                self.condition.wait()
+            self.check_error()
+
+            if piece_index in self.pending or piece_index in self.in_flight:
+                return
+            self.pending[piece_index] = piece_bytes
+            self.cached_bytes += len(piece_bytes)
+            self.condition.notify_all()
+
+    def flush(self):
+        """Blocks until everything submitted so far has been written"""
+        with self.condition:
+            while (self.pending or self.in_flight) and self.error is None:
+                self.condition.wait()
+            self.check_error()
+
+    def close(self):
+        with self.condition:
+            self.closing = True
+            self.condition.notify_all()
+        if self.is_alive():
+            self.join()
+        self.check_error()
+
+    def get_fd(self, file_index) -> int:
+        fd = self.file_descriptors.get(file_index)
+        if fd is None:
+            path = self.layout.files[file_index][0]
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            self.file_descriptors[file_index] = fd
+        return fd
+
+    def take_batch(self) -> Dict[int, bytes]:
+        """Moves all pending pieces to in_flight. Must hold the condition."""
+        batch = self.pending
+        self.pending = {}
+        self.in_flight.update(batch)
+        return batch
+
+    @staticmethod
+    def coalesce(piece_indices) -> List[List[int]]:
+        """Groups sorted piece indices into runs of consecutive pieces"""
+        runs = []
+        for index in sorted(piece_indices):
+            if runs and runs[-1][-1] == index - 1:
+                runs[-1].append(index)
+            else:
+                runs.append([index])
+        return runs
+
+    def write_run(self, run, batch, skipped_files) -> Set[int]:
+        """Writes a run of consecutive pieces. Returns the pieces that were only partially written
+        because they overlap a skipped file.
+        """
+        offset = run[0] * self.piece_length
+        buffers = [memoryview(batch[i]) for i in run]
+        partial = set()
+
+        for file_index, file_offset, length in self.layout.segments(offset,
+                sum(len(b) for b in buffers)):
+            if file_index in skipped_files:
+                partial.update(range(offset // self.piece_length,
+                        (offset + length - 1) // self.piece_length + 1))
+            offset += length
+
+            # Peel off exactly `length` bytes worth of buffers for this file
+            segment = []
+            while length:
+                if len(buffers[0]) <= length:
+                    length -= len(buffers[0])
+                    segment.append(buffers.pop(0))
+                else:
+                    segment.append(buffers[0][:length])
+                    buffers[0] = buffers[0][length:]
+                    length = 0
+
+            if file_index in skipped_files:
+                continue
+            write_buffers(self.get_fd(file_index), segment, file_offset)
+            self.dirty_files.add(file_index)
+
+        return partial
+
+    def write_batch(self, batch):
+        with self.condition:
+            skipped_files = set(self.skipped_files)
+
+        partial = set()
+        for run in self.coalesce(batch.keys()):
+            # Split overly long runs so a huge batch doesn't hold everything in one syscall
+            max_pieces = max(1, self.MAX_BATCH_BYTES // self.piece_length)
+            for i in range(0, len(run), max_pieces):
+                partial.update(self.write_run(run[i:i+max_pieces], batch, skipped_files))
+
+        complete = set(batch.keys()) - partial
+        with self.condition:
+            # A piece written whole once its files are no longer skipped isn't partial anymore
+            self.partial_pieces -= complete
+            self.partial_pieces.update(partial)
+            self.written_pieces.update(complete)
+        if self.fsync_policy == FsyncPolicy.EVERY_BATCH or\
+                (self.fsync_policy == FsyncPolicy.ON_CLOSE and
+                 time.monotonic() - self.last_resume_save >= self.RESUME_INTERVAL_S):
+            self.save_resume_state()
+
+    def save_resume_state(self):
+        """Syncs every written file, then records the written pieces. The other way round, a
+        crash could leave the resume file listing pieces whose data never reached the disk."""
+        self.sync_files()
+        save_resume_state(self.output_directory, self.num_pieces, self.written_pieces)
+        self.last_resume_save = time.monotonic()
+
+    def sync_files(self):
+        for file_index in self.dirty_files:
+            os.fsync(self.file_descriptors[file_index])
+        self.dirty_files.clear()
+
+    def read(self, offset, length) -> bytes:
+        """Reads a byte range of the torrent, serving it from the cache where possible"""
+        ret = bytearray(length)
+        with self.condition:
+            cached = dict(self.in_flight)
+            cached.update(self.pending)
+
+        position = offset
+        while position < offset + length:
+            piece_index = position // self.piece_length
+            piece_start = piece_index * self.piece_length
+            chunk_length = min(offset + length, piece_start + self.piece_length) - position
+
+            if piece_index in cached:
+                start = position - piece_start
+                chunk = cached[piece_index][start:start+chunk_length]
+            else:
+                chunk = read_range(self.layout, position, chunk_length)
+
+            ret[position-offset:position-offset+len(chunk)] = chunk
+            position += chunk_length
+
+        return bytes(ret)
+
+    def run(self):
+        try:
+            while True:
+                with self.condition:
+                    while not self.pending and not self.closing:
+                        self.condition.wait()
+                    if not self.pending and self.closing:
+                        break
+                    batch = self.take_batch()
+
+                start = time.perf_counter()
+                with self.phase_timer.phase('write'):
+                    self.write_batch(batch)
+                self.engine_metrics.disk_write_seconds.observe(time.perf_counter() - start)
+
+                with self.condition:
+                    for piece_index, piece_bytes in batch.items():
+                        del self.in_flight[piece_index]
+                        self.cached_bytes -= len(piece_bytes)
+                    self.condition.notify_all()
+
+            if self.fsync_policy != FsyncPolicy.NEVER:
+                self.save_resume_state()
+        except Exception as e:
+            with self.condition:
+                self.error = e
+                self.condition.notify_all()
+        finally:
+            for fd in self.file_descriptors.values():
+                os.close(fd)
+            self.file_descriptors = {}
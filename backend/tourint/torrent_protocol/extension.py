@@ -0,0 +1,54 @@
+"""
+The extension protocol (BEP 10).
+
+Peers that both set PeerHandshake.EXTENSION_PROTOCOL_BIT exchange EXTENDED messages. The first
+byte of the payload is an extension message id and the rest is up to the extension. Id 0 is the
+extended handshake, a bencoded dict whose 'm' maps each extension name the sender supports to the
+id it wants to receive that extension's messages under. So ids differ per direction: we send with
+the peer's ids and receive with ours (LOCAL_IDS).
+"""
+from typing import Dict, Tuple
+
+if __package__ is None or __package__ == '':
+    import bencode
+    import peer
+else:
+    from . import bencode
+    from . import peer
+
+HANDSHAKE_ID: int = 0
+
+# Extension name -> id we receive it under
+LOCAL_IDS: Dict[str, int] = {
+    # BEP 9, see metadata.py
+    'ut_metadata': 1,
+    # BEP 11, see pex.py
+    'ut_pex': 2,
+}
+
+def message(extension_id, body: bytes) -> 'peer.PeerMessage':
+    return peer.PeerMessage(peer.PeerMessage.Id.EXTENDED, bytes([extension_id]) + body)
+
+def handshake_message(extensions, **fields) -> 'peer.PeerMessage':
+    """Our extended handshake, offering the named extensions. fields are added to the dict,
+    e.g. metadata_size."""
+    handshake = {'m': {name: LOCAL_IDS[name] for name in sorted(extensions)}}
+    handshake.update(fields)
+    return message(HANDSHAKE_ID, bencode.encode(dict(sorted(handshake.items()))))
+
+def parse(payload) -> Tuple[int, bytes]:
+    """Splits an EXTENDED message payload into (extension id, body)"""
+    if len(payload) < 1:
+        raise ValueError('Empty extended message')
+    return payload[0], bytes(payload[1:])
+
+def decode_handshake(body) -> Dict:
+    handshake = bencode.decode(body)
+    if not isinstance(handshake, dict) or not isinstance(handshake.get('m', {}), dict):
+        raise ValueError('Malformed extended handshake')
+    return handshake
+
+def peer_ids(handshake) -> Dict[str, int]:
+    """Extension name -> id the peer wants to receive it under. Id 0 means disabled."""
+    return {name: extension_id for name, extension_id in handshake.get('m', {}).items()
+            if isinstance(extension_id, int) and extension_id > 0}
@@ -0,0 +1,81 @@
+"""
+Magnet links.
+
+A magnet link names a torrent by info hash (xt=urn:btih:..., hex or base32) and may add a display
+name (dn), trackers (tr) and peer addresses (x.pe). The info dictionary itself comes from peers,
+see metadata.py; torrent_file_bytes() then turns it into a .torrent file so the rest of the app
+can treat the torrent like any other.
+"""
+from typing import Dict, List, Optional
+import base64
+import binascii
+import urllib.parse
+
+if __package__ is None or __package__ == '':
+    import bencode
+else:
+    from . import bencode
+
+SCHEME: str = 'magnet:'
+INFO_HASH_PREFIX: str = 'urn:btih:'
+
+class Magnet:
+    def __init__(self, info_hash: bytes, name: Optional[str] = None, trackers=(), peers=()):
+        self.info_hash = info_hash
+        self.name = name
+        self.trackers: List[str] = list(trackers)
+        # Peer dicts in the format tracker responses use, {'ip': ..., 'port': ...}
+        self.peers: List[Dict] = list(peers)
+
+def is_magnet(uri) -> bool:
+    return isinstance(uri, str) and uri[:len(SCHEME)].lower() == SCHEME
+
+def parse_info_hash(value) -> bytes:
+    if len(value) == 40:
+        try:
+            return bytes.fromhex(value)
+        except ValueError:
+            pass
+    elif len(value) == 32:
+        try:
+            return base64.b32decode(value.upper())
+        except binascii.Error:
+            pass
+    raise ValueError('Bad info hash in magnet link: {}'.format(value))
+
+def parse_peer(value) -> Dict:
+    host, _, port = value.rpartition(':')
+    if not host or not port.isdigit():
+        raise ValueError('Bad peer address in magnet link: {}'.format(value))
+    return {'ip': host.strip('[]'), 'port': int(port)}
+
+def parse(uri) -> Magnet:
+    """Parses a magnet link. Raises a ValueError unless it names a BitTorrent info hash."""
+    if not is_magnet(uri):
+        raise ValueError('Not a magnet link: {}'.format(uri))
+    query = urllib.parse.parse_qs(uri[len(SCHEME):].lstrip('?'))
+
+    info_hash = None
+    for topic in query.get('xt', []):
+        if topic.lower().startswith(INFO_HASH_PREFIX):
+            info_hash = parse_info_hash(topic[len(INFO_HASH_PREFIX):])
+            break
+    if info_hash is None:
+        raise ValueError('Magnet link has no {} topic'.format(INFO_HASH_PREFIX))
+
+    names = query.get('dn')
+    return Magnet(info_hash, names[0] if names else None, query.get('tr', []),
+            [parse_peer(p) for p in query.get('x.pe', [])])
+
+def torrent_file_bytes(info_bytes: bytes, trackers) -> bytes:
+    """A .torrent file for info_bytes, the info dict exactly as fetched.
+
+    The info dict is spliced in as is rather than decoded and encoded again, so the info hash
+    can't change.
+    """
+    metainfo = {}
+    if trackers:
+        metainfo['announce'] = trackers[0]
+        metainfo['announce-list'] = [[t] for t in trackers]
+    # Keys in sorted order, and 'info' sorts after both of the others
+    return bencode.encode(metainfo)[:-1] + bencode.encode('info') + info_bytes + b'e'
@@ -0,0 +1,225 @@
+"""
+SHA-256 Merkle trees for BitTorrent v2 and hybrid torrents (BEP 52).
+
+Each file gets its own tree. The leaves are the SHA-256 of every 16 KiB block of the file,
+padded with zero hashes to a power of two, and every node above is the SHA-256 of its two
+children. The root is the file's 'pieces root' in the info dict's 'file tree'. For files
+bigger than a piece, the metainfo's 'piece layers' has the layer where each node covers one
+piece.
+
+PieceTrees maps the v1 pieces of a hybrid torrent onto those trees. A finished piece is checked
+against its node in the piece layer. If it doesn't match, a peer sends the leaf hashes under
+that node (HASH_REQUEST / HASHES in peer.py), and those tell exactly which blocks were bad.
+"""
+from functools import lru_cache
+from typing import Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+import hashlib
+import struct
+
+BLOCK_SIZE: int = 16384
+HASH_LENGTH: int = 32
+ZERO_HASH: bytes = bytes(HASH_LENGTH)
+# Peers don't have to answer requests for more hashes than this at once
+MAX_HASHES_PER_REQUEST: int = 512
+META_VERSION: int = 2
+
+# Payload of HASH_REQUEST and HASH_REJECT, and the start of HASHES: pieces root, base layer,
+# index, length, proof layers
+HASH_REQUEST = struct.Struct('>32sIIII')
+
+def block_hash(data) -> bytes:
+    return hashlib.sha256(data).digest()
+
+def parent(left, right) -> bytes:
+    return hashlib.sha256(left + right).digest()
+
+@lru_cache(maxsize=None)
+def pad_hash(height) -> bytes:
+    """Root of a subtree of 2**height zero leaves"""
+    if height == 0:
+        return ZERO_HASH
+    below = pad_hash(height - 1)
+    return parent(below, below)
+
+def next_power_of_two(n) -> int:
+    return 1 << max(n - 1, 0).bit_length()
+
+def root(hashes: Sequence[bytes], width=None, height=0) -> bytes:
+    """Root of the tree over a layer of hashes, padded to width (a power of two). height is how
+    far above the leaves the layer is, which decides what the padding hashes are."""
+    if width is None:
+        width = next_power_of_two(len(hashes))
+    assert(len(hashes) <= width and width & (width - 1) == 0)
+    layer = list(hashes)
+    pad = pad_hash(height)
+    while width > 1:
+        if len(layer) % 2:
+            layer.append(pad)
+        layer = [parent(layer[i], layer[i + 1]) for i in range(0, len(layer), 2)]
+        pad = parent(pad, pad)
+        width //= 2
+    return layer[0] if layer else pad
+
+def root_from_proof(node, index, uncles: Sequence[bytes]) -> bytes:
+    """Climbs from node, the index'th node of its layer, through its uncles bottom up"""
+    for uncle in uncles:
+        node = parent(node, uncle) if index % 2 == 0 else parent(uncle, node)
+        index //= 2
+    return node
+
+def as_bytes(value) -> bytes:
+    # bencode.decode hands back binary strings that happen to be ascii as str
+    return value.encode('ascii') if isinstance(value, str) else bytes(value)
+
+def is_hybrid(info: Dict) -> bool:
+    return info.get('meta version') == META_VERSION and 'pieces' in info
+
+def file_tree_files(file_tree: Dict, path=()) -> Iterator[Tuple[Tuple[str, ...], Dict]]:
+    """The (path, {'length', 'pieces root'}) of every file in a 'file tree', in order"""
+    for name in sorted(file_tree, key=as_bytes):
+        node = file_tree[name]
+        if name == '':
+            yield path, node
+        else:
+            yield from file_tree_files(node, path + (name,))
+
+class MerkleTree:
+    """Every layer of one file's tree, for answering hash requests"""
+
+    def __init__(self, leaf_hashes: Sequence[bytes]):
+        width = next_power_of_two(len(leaf_hashes))
+        self.layers: List[List[bytes]] = [list(leaf_hashes) +
+                [ZERO_HASH] * (width - len(leaf_hashes))]
+        while len(self.layers[-1]) > 1:
+            below = self.layers[-1]
+            self.layers.append([parent(below[i], below[i + 1]) for i in range(0, len(below), 2)])
+
+    @classmethod
+    def from_data(cls, data):
+        return cls([block_hash(data[i:i + BLOCK_SIZE]) for i in range(0, len(data), BLOCK_SIZE)])
+
+    def root(self) -> bytes:
+        return self.layers[-1][0]
+
+    def piece_layer(self, piece_length, file_length) -> bytes:
+        """The file's entry in 'piece layers': one hash per piece, without padding"""
+        height = (piece_length // BLOCK_SIZE).bit_length() - 1
+        num_pieces = (file_length + piece_length - 1) // piece_length
+        return b''.join(self.layers[height][:num_pieces])
+
+    def hashes(self, base_layer, index, length, proof_layers) -> List[bytes]:
+        """length hashes of base_layer from index on, then proof_layers uncles of the subtree
+        they make up. Raises ValueError for a request outside the tree."""
+        if length < 1 or length & (length - 1) or index % length or\
+                base_layer >= len(self.layers) or index + length > len(self.layers[base_layer]):
+            raise ValueError('no hashes {}+{} in layer {}'.format(index, length, base_layer))
+        ret = self.layers[base_layer][index:index + length]
+        height = base_layer + length.bit_length() - 1
+        node = index // length
+        for _ in range(proof_layers):
+            if height >= len(self.layers) - 1:
+                raise ValueError('proof of {} layers goes past the root'.format(proof_layers))
+            ret.append(self.layers[height][node ^ 1])
+            node //= 2
+            height += 1
+        return ret
+
+class PieceTree(NamedTuple):
+    """Where a v1 piece sits in its file's tree"""
+    pieces_root: bytes
+    # The piece's node in the piece layer, or the file's root if the file fits in one piece
+    root: bytes
+    # Leaves under root, and the file's index of the first one
+    width: int
+    first_leaf: int
+    # Bytes of the piece that belong to the file. The rest is padding, which must be zeros.
+    data_length: int
+
+    def num_blocks(self) -> int:
+        return (self.data_length + BLOCK_SIZE - 1) // BLOCK_SIZE
+
+    def hash_requests(self) -> List[Tuple[int, int, int]]:
+        """(index, length, proof layers) of the HASH_REQUESTs that cover every leaf under root"""
+        length = min(self.width, MAX_HASHES_PER_REQUEST)
+        proof_layers = (self.width // length).bit_length() - 1
+        return [(self.first_leaf + offset, length, proof_layers)
+                for offset in range(0, self.width, length)]
+
+    def check(self, leaf_hashes: Sequence[bytes]) -> bool:
+        """Whether the piece's leaf hashes make up root"""
+        return root(leaf_hashes, self.width) == self.root
+
+class PieceTrees:
+    """The PieceTree of every piece of a hybrid torrent, from its 'file tree' and 'piece layers'.
+
+    In a hybrid torrent every file starts on a piece boundary (the v1 file list pads them), so
+    the v1 pieces are the v2 pieces of each file in turn. Raises ValueError if the trees don't
+    fit the v1 pieces or a piece layer doesn't hash up to its file's root.
+    """
+
+    def __init__(self, info: Dict, piece_layers: Dict, num_pieces: int):
+        piece_length = info['piece length']
+        if piece_length < BLOCK_SIZE or piece_length & (piece_length - 1):
+            raise ValueError('piece length {} is not a power of two of at least {}'.format(
+                piece_length, BLOCK_SIZE))
+        layers = {as_bytes(k): as_bytes(v) for k, v in piece_layers.items()}
+        piece_width = piece_length // BLOCK_SIZE
+        piece_height = piece_width.bit_length() - 1
+
+        self.trees: Dict[int, PieceTree] = {}
+        piece_index = 0
+        for path, node in file_tree_files(info['file tree']):
+            length = node['length']
+            if length == 0:
+                continue
+            pieces_root = as_bytes(node['pieces root'])
+            if length <= piece_length:
+                width = next_power_of_two((length + BLOCK_SIZE - 1) // BLOCK_SIZE)
+                self.trees[piece_index] = PieceTree(pieces_root, pieces_root, width, 0, length)
+                piece_index += 1
+                continue
+
+            num_file_pieces = (length + piece_length - 1) // piece_length
+            layer = layers.get(pieces_root)
+            if layer is None or len(layer) != num_file_pieces * HASH_LENGTH:
+                raise ValueError('missing or short piece layer for {}'.format('/'.join(path)))
+            hashes = [layer[i:i + HASH_LENGTH] for i in range(0, len(layer), HASH_LENGTH)]
+            if root(hashes, height=piece_height) != pieces_root:
+                raise ValueError('piece layer for {} does not match its pieces root'.format(
+                    '/'.join(path)))
+            for i, piece_hash in enumerate(hashes):
+                data_length = min(piece_length, length - i * piece_length)
+                self.trees[piece_index] = PieceTree(pieces_root, piece_hash, piece_width,
+                        i * piece_width, data_length)
+                piece_index += 1
+
+        if piece_index != num_pieces:
+            raise ValueError('file tree has {} pieces, the v1 pieces are {}'.format(piece_index,
+                num_pieces))
+
+    def __len__(self):
+        return len(self.trees)
+
+    def get(self, piece_index) -> Optional[PieceTree]:
+        return self.trees.get(piece_index)
+
+def hash_request_payload(pieces_root, index, length, proof_layers, base_layer=0) -> bytes:
+    return HASH_REQUEST.pack(pieces_root, base_layer, index, length, proof_layers)
+
+def parse_hash_request(payload) -> Tuple[bytes, int, int, int, int]:
+    """(pieces root, base layer, index, length, proof layers) of a HASH_REQUEST or HASH_REJECT"""
+    if len(payload) != HASH_REQUEST.size:
+        raise ValueError('hash request of {} bytes'.format(len(payload)))
+    return HASH_REQUEST.unpack(bytes(payload))
+
+def parse_hashes(payload) -> Tuple[bytes, int, int, int, int, List[bytes]]:
+    """The hash request a HASHES message answers, followed by the hashes in it"""
+    if len(payload) < HASH_REQUEST.size or (len(payload) - HASH_REQUEST.size) % HASH_LENGTH:
+        raise ValueError('hashes message of {} bytes'.format(len(payload)))
+    request = parse_hash_request(payload[:HASH_REQUEST.size])
+    hashes = bytes(payload[HASH_REQUEST.size:])
+    _, _, _, length, proof_layers = request
+    if len(hashes) != (length + proof_layers) * HASH_LENGTH:
+        raise ValueError('expected {} hashes, got {}'.format(length + proof_layers,
+            len(hashes) // HASH_LENGTH))
+    return request + ([hashes[i:i + HASH_LENGTH] for i in range(0, len(hashes), HASH_LENGTH)],)
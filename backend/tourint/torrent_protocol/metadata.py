@@ -0,0 +1,384 @@
+"""
+Fetching a torrent's info dictionary from peers (ut_metadata, BEP 9), for magnet links.
+
+MetadataFetcher connects to several peers at once over non-blocking sockets in one poll loop.
+Once a peer's extended handshake (see extension.py) gives the size of the metadata, its 16 KiB
+pieces are spread over every peer that offers ut_metadata, a few outstanding requests each, and a
+piece a peer rejects is asked of another. When every piece is in, the whole info dict is checked
+against the info hash. On a mismatch it's fetched again, without the peer if only one sent it.
+"""
+from typing import Dict, List, Optional, Set
+from collections import deque
+import enum
+import errno
+import hashlib
+import select
+import socket
+import time
+
+if __package__ is None or __package__ == '':
+    import addresses
+    import bencode
+    import consts
+    import extension
+    import peer
+    import tracker
+else:
+    from . import addresses
+    from . import bencode
+    from . import consts
+    from . import extension
+    from . import peer
+    from . import tracker
+
+EXTENSION_NAME: str = 'ut_metadata'
+METADATA_PIECE_SIZE: int = 16384
+# A 16 MiB info dict would list about 800k pieces. Anything bigger is a bad peer.
+MAX_METADATA_SIZE: int = 16 * 1024 * 1024
+DEFAULT_TIMEOUT_S: float = 60.0
+# 'left' to announce while the size is unknown. Not 0, which would make us look like a seeder.
+UNKNOWN_LEFT: int = 1
+
+class MessageType(enum.IntEnum):
+    REQUEST = 0
+    DATA = 1
+    REJECT = 2
+
+def request_message(peer_extension_id, piece) -> peer.PeerMessage:
+    return extension.message(peer_extension_id,
+            bencode.encode({'msg_type': MessageType.REQUEST.value, 'piece': piece}))
+
+def data_message(peer_extension_id, piece, total_size, data) -> peer.PeerMessage:
+    header = {'msg_type': MessageType.DATA.value, 'piece': piece, 'total_size': total_size}
+    return extension.message(peer_extension_id, bencode.encode(header) + data)
+
+def reject_message(peer_extension_id, piece) -> peer.PeerMessage:
+    return extension.message(peer_extension_id,
+            bencode.encode({'msg_type': MessageType.REJECT.value, 'piece': piece}))
+
+def parse_message(body):
+    """Returns (MessageType, piece, total size or None, data) for a ut_metadata message"""
+    header, end = bencode.decode_any(body, 0)
+    if not isinstance(header, dict) or not isinstance(header.get('piece'), int):
+        raise ValueError('Malformed ut_metadata message')
+    return (MessageType(header.get('msg_type')), header['piece'], header.get('total_size'),
+            bytes(body[end:]))
+
+def num_pieces(metadata_size) -> int:
+    return (metadata_size + METADATA_PIECE_SIZE - 1) // METADATA_PIECE_SIZE
+
+def piece_size(metadata_size, piece) -> int:
+    return min(METADATA_PIECE_SIZE, metadata_size - piece * METADATA_PIECE_SIZE)
+
+class MetadataPeer:
+    """A connection that speaks just enough of the protocol to fetch metadata"""
+
+    # Bigger than any message a peer needs to send us before or while serving metadata
+    MAX_MESSAGE_SIZE: int = 2 * 1024 * 1024
+
+    class State(enum.Enum):
+        CONNECTING = 0
+        HANDSHAKE = 1
+        CONNECTED = 2
+
+    def __init__(self, peer_info: Dict, info_hash: bytes):
+        self.peer_info = peer_info
+        self.info_hash = info_hash
+        self.socket = socket.socket(addresses.family_of(peer_info['ip']), socket.SOCK_STREAM)
+        self.socket.setblocking(False)
+        self.state = self.State.CONNECTING
+        self.buffer = bytearray()
+        # Bytes the socket didn't take yet
+        self.outbox = bytearray()
+
+        # From the peer's extended handshake
+        self.extension_id: Optional[int] = None
+        self.metadata_size: Optional[int] = None
+
+        self.requested: Set[int] = set()
+        self.rejected: Set[int] = set()
+        self.last_progress = time.monotonic()
+
+    def __str__(self):
+        return addresses.format_address(self.peer_info['ip'], self.peer_info['port'])
+
+    def fileno(self) -> int:
+        return self.socket.fileno()
+
+    def connect(self):
+        error = self.socket.connect_ex((self.peer_info['ip'], self.peer_info['port']))
+        if error not in (0, errno.EINPROGRESS):
+            raise OSError(error, 'Could not connect to {}'.format(self))
+
+    def finish_connect(self):
+        error = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            raise OSError(error, 'Could not connect to {}'.format(self))
+        self.state = self.State.HANDSHAKE
+        reserved = peer.PeerHandshake.reserved_with(peer.PeerHandshake.EXTENSION_PROTOCOL_BIT)
+        self.send(peer.PeerHandshake(consts.PEER_ID, self.info_hash, reserved).serialize())
+        self.send(extension.handshake_message([EXTENSION_NAME]).serialize())
+
+    def is_ready(self) -> bool:
+        return self.extension_id is not None and self.metadata_size is not None
+
+    def send(self, data):
+        self.outbox.extend(data)
+        self.flush()
+
+    def flush(self):
+        try:
+            sent = self.socket.send(self.outbox)
+        except BlockingIOError:
+            return
+        del self.outbox[:sent]
+
+    def request(self, piece):
+        self.requested.add(piece)
+        self.send(request_message(self.extension_id, piece).serialize())
+
+    def receive(self) -> List:
+        """Reads what's available and returns the ut_metadata messages it completed, parsed.
+
+        Raises on a closed connection or a protocol error.
+        """
+        data = self.socket.recv(65536)
+        if not data:
+            raise ConnectionError('{} closed the connection'.format(self))
+        self.buffer.extend(data)
+
+        if self.state == self.State.HANDSHAKE:
+            if len(self.buffer) < peer.PeerHandshake.HANDSHAKE_SIZE:
+                return []
+            handshake = peer.PeerHandshake.deserialize(
+                    bytes(self.buffer[:peer.PeerHandshake.HANDSHAKE_SIZE]))
+            del self.buffer[:peer.PeerHandshake.HANDSHAKE_SIZE]
+            if handshake.info_hash != self.info_hash:
+                raise ValueError('{} sent the wrong info hash'.format(self))
+            if not handshake.has_reserved_bit(peer.PeerHandshake.EXTENSION_PROTOCOL_BIT):
+                raise ValueError('{} does not support the extension protocol'.format(self))
+            self.state = self.State.CONNECTED
+
+        messages = []
+        while len(self.buffer) >= peer.PeerMessage.MESSAGE_LENGTH_SIZE:
+            length = int.from_bytes(self.buffer[:peer.PeerMessage.MESSAGE_LENGTH_SIZE],
+                    byteorder='big')
+            if length > self.MAX_MESSAGE_SIZE:
+                raise ValueError('{} sent a {} byte message'.format(self, length))
+            end = peer.PeerMessage.MESSAGE_LENGTH_SIZE + length
+            if len(self.buffer) < end:
+                break
+            payload = bytes(self.buffer[peer.PeerMessage.MESSAGE_LENGTH_SIZE:end])
+            del self.buffer[:end]
+
+            # Everything but extended messages (bitfields, haves, chokes) is irrelevant here
+            if length == 0 or payload[0] != peer.PeerMessage.Id.EXTENDED.value:
+                continue
+            extension_id, body = extension.parse(payload[1:])
+            if extension_id == extension.HANDSHAKE_ID:
+                self.handle_extended_handshake(extension.decode_handshake(body))
+            elif extension_id == extension.LOCAL_IDS[EXTENSION_NAME]:
+                messages.append(parse_message(body))
+        return messages
+
+    def handle_extended_handshake(self, handshake):
+        self.extension_id = extension.peer_ids(handshake).get(EXTENSION_NAME)
+        size = handshake.get('metadata_size')
+        if isinstance(size, int) and 0 < size <= MAX_METADATA_SIZE:
+            self.metadata_size = size
+
+    def close(self):
+        self.socket.close()
+
+class MetadataFetcher:
+    MAX_PEERS: int = 8
+    # Outstanding requests per peer
+    MAX_REQUESTS_PER_PEER: int = 2
+    # A peer with requests outstanding that sends nothing for this long is dropped
+    REQUEST_TIMEOUT_S: float = 10.0
+    MAX_HASH_FAILURES: int = 3
+    POLL_TIMEOUT_MS: int = 200
+
+    def __init__(self, info_hash: bytes, peers: List[Dict], max_peers=MAX_PEERS,
+                 timeout_s=DEFAULT_TIMEOUT_S):
+        self.info_hash = info_hash
+        self.max_peers = max_peers
+        self.timeout_s = timeout_s
+
+        self.candidates = deque()
+        seen = set()
+        for peer_info in peers:
+            address = (peer_info['ip'], peer_info['port'])
+            if address not in seen:
+                seen.add(address)
+                self.candidates.append(peer_info)
+
+        # fd -> connection
+        self.connections: Dict[int, MetadataPeer] = {}
+        self.poll_object = select.poll()
+
+        self.metadata_size: Optional[int] = None
+        self.pieces: Dict[int, bytes] = {}
+        # piece -> connection it came from
+        self.piece_sources: Dict[int, MetadataPeer] = {}
+        self.hash_failures = 0
+
+    def fetch(self) -> bytes:
+        """Returns the info dict as the peers sent it, checked against the info hash.
+
+        Raises TimeoutError if that takes longer than timeout_s, or a ValueError if the peers run
+        out or keep sending metadata that doesn't match.
+        """
+        deadline = time.monotonic() + self.timeout_s
+        try:
+            while True:
+                self.connect_more()
+                if not self.connections:
+                    raise ValueError('No peer could provide the metadata')
+                if time.monotonic() > deadline:
+                    raise TimeoutError('No metadata within {}s'.format(self.timeout_s))
+
+                for fd, event in self.poll_object.poll(self.POLL_TIMEOUT_MS):
+                    if fd in self.connections:
+                        self.handle_event(self.connections[fd], event)
+
+                self.drop_stalled()
+                self.assign_requests()
+                if self.metadata_size is not None and\
+                        len(self.pieces) == num_pieces(self.metadata_size):
+                    metadata = self.assemble()
+                    if metadata is not None:
+                        return metadata
+        finally:
+            for connection in list(self.connections.values()):
+                self.drop(connection)
+
+    def connect_more(self):
+        while self.candidates and len(self.connections) < self.max_peers:
+            connection = MetadataPeer(self.candidates.popleft(), self.info_hash)
+            try:
+                connection.connect()
+            except OSError as e:
+                print('Metadata: {}'.format(e))
+                connection.close()
+                continue
+            self.connections[connection.fileno()] = connection
+            self.poll_object.register(connection.fileno(), select.POLLOUT)
+
+    def drop(self, connection):
+        fd = connection.fileno()
+        if self.connections.get(fd) is connection:
+            del self.connections[fd]
+            self.poll_object.unregister(fd)
+        connection.close()
+
+    def handle_event(self, connection, event):
+        try:
+            if connection.state == MetadataPeer.State.CONNECTING:
+                connection.finish_connect()
+            elif event & select.POLLIN:
+                for message in connection.receive():
+                    self.handle_message(connection, *message)
+                self.check_metadata_size(connection)
+            elif event & (select.POLLHUP | select.POLLERR):
+                raise ConnectionError('{} hung up'.format(connection))
+            if event & select.POLLOUT:
+                connection.flush()
+        except (OSError, ValueError) as e:
+            print('Metadata: dropping {}: {}'.format(connection, e))
+            self.drop(connection)
+            return
+
+        mask = select.POLLIN | (select.POLLOUT if connection.outbox else 0)
+        self.poll_object.modify(connection.fileno(), mask)
+
+    def check_metadata_size(self, connection):
+        if connection.metadata_size is None:
+            return
+        if self.metadata_size is None:
+            self.metadata_size = connection.metadata_size
+        elif connection.metadata_size != self.metadata_size:
+            raise ValueError('metadata size {} disagrees with {}'.format(
+                connection.metadata_size, self.metadata_size))
+
+    def handle_message(self, connection, message_type, piece, total_size, data):
+        if piece not in connection.requested:
+            return
+        connection.requested.discard(piece)
+        connection.last_progress = time.monotonic()
+        if message_type == MessageType.REJECT:
+            connection.rejected.add(piece)
+        elif message_type == MessageType.DATA:
+            if total_size != self.metadata_size or\
+                    len(data) != piece_size(self.metadata_size, piece):
+                raise ValueError('bad metadata piece {}'.format(piece))
+            if piece not in self.pieces:
+                self.pieces[piece] = data
+                self.piece_sources[piece] = connection
+
+    def drop_stalled(self):
+        now = time.monotonic()
+        for connection in list(self.connections.values()):
+            if connection.requested and now - connection.last_progress > self.REQUEST_TIMEOUT_S:
+                print('Metadata: dropping {}: requests timed out'.format(connection))
+                self.drop(connection)
+
+    def assign_requests(self):
+        """Spreads the missing pieces over the ready peers, one request per peer per round"""
+        if self.metadata_size is None:
+            return
+        ready = [c for c in self.connections.values() if c.is_ready()]
+        outstanding = set()
+        for connection in ready:
+            outstanding |= connection.requested
+        missing = [i for i in range(num_pieces(self.metadata_size))
+                if i not in self.pieces and i not in outstanding]
+
+        for _ in range(self.MAX_REQUESTS_PER_PEER):
+            for connection in ready:
+                if not missing:
+                    return
+                if len(connection.requested) >= self.MAX_REQUESTS_PER_PEER:
+                    continue
+                piece = next((i for i in missing if i not in connection.rejected), None)
+                if piece is None:
+                    continue
+                missing.remove(piece)
+                connection.last_progress = time.monotonic()
+                connection.request(piece)
+                self.poll_object.modify(connection.fileno(),
+                        select.POLLIN | (select.POLLOUT if connection.outbox else 0))
+
+    def assemble(self) -> Optional[bytes]:
+        metadata = b''.join(self.pieces[i] for i in range(num_pieces(self.metadata_size)))
+        if hashlib.sha1(metadata).digest() == self.info_hash:
+            return metadata
+
+        self.hash_failures += 1
+        print('Metadata: hash check failed ({} / {})'.format(self.hash_failures,
+            self.MAX_HASH_FAILURES))
+        if self.hash_failures >= self.MAX_HASH_FAILURES:
+            raise ValueError('Metadata from peers failed the hash check {} times'
+                    .format(self.hash_failures))
+        sources = set(self.piece_sources.values())
+        if len(sources) == 1:
+            self.drop(sources.pop())
+        self.pieces = {}
+        self.piece_sources = {}
+        return None
+
+def find_peers(magnet) -> List[Dict]:
+    """The magnet link's own peers plus whatever its trackers return"""
+    peers = list(magnet.peers)
+    for announce_url in magnet.trackers:
+        try:
+            response = tracker.send_ths_request(announce_url, magnet.info_hash, UNKNOWN_LEFT)
+        except Exception as e:
+            print('Announce to {} failed: {}'.format(announce_url, e))
+            continue
+        peers.extend({'ip': ip, 'port': port} for ip, port in tracker.response_peers(response))
+    return peers
+
+def fetch_metadata(magnet, timeout_s=DEFAULT_TIMEOUT_S) -> bytes:
+    """Fetches the info dict for a magnet.Magnet, see MetadataFetcher.fetch"""
+    return MetadataFetcher(magnet.info_hash, find_peers(magnet), timeout_s=timeout_s).fetch()
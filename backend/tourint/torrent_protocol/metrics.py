@@ -0,0 +1,219 @@
+"""
+Counters, gauges and histograms for the download engine, rendered in the Prometheus text format.
+
+A TorrentDownload with metrics enabled records into a Registry and sends Registry.collect() over
+its telemetry queue; the web app merges what every download sent and serves it at /metrics. With
+metrics disabled, the engine gets DISABLED instead, whose metrics are shared no-op objects, so
+instrumented code costs one empty method call per event and never has to check a flag.
+"""
+from typing import Dict, List, Sequence, Tuple
+import bisect
+import math
+
+# Telemetry queue messages are (kind, info hash hex, payload)
+MESSAGE_KIND: str = 'metrics'
+
+# Seconds, from 50us to 10s
+DEFAULT_TIME_BUCKETS: Tuple[float, ...] = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025,
+        0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Queries per DHT lookup
+DHT_QUERY_BUCKETS: Tuple[float, ...] = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+class Counter:
+    TYPE: str = 'counter'
+
+    def __init__(self, name, help, label_names: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        # label values tuple -> value
+        self.values: Dict[Tuple, float] = {}
+
+    def inc(self, amount=1, labels: Tuple = ()):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def collect(self) -> Dict:
+        return {'type': self.TYPE, 'help': self.help, 'labels': self.label_names,
+                'samples': [(labels, value) for labels, value in list(self.values.items())]}
+
+class Gauge(Counter):
+    TYPE: str = 'gauge'
+
+    def set(self, value, labels: Tuple = ()):
+        self.values[labels] = value
+
+class Histogram:
+    TYPE: str = 'histogram'
+
+    def __init__(self, name, help, label_names: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_TIME_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        # label values tuple -> [count per bucket (non-cumulative, last one is +Inf), sum]
+        self.values: Dict[Tuple, List] = {}
+
+    def observe(self, value, labels: Tuple = ()):
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def collect(self) -> Dict:
+        return {'type': self.TYPE, 'help': self.help, 'labels': self.label_names,
+                'buckets': self.buckets,
+                'samples': [(labels, list(counts), total)
+                    for labels, (counts, total) in list(self.values.items())]}
+
+class Registry:
+    enabled: bool = True
+
+    def __init__(self):
+        self.metrics: Dict[str, object] = {}
+
+    def register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError('Metric {} already registered'.format(metric.name))
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, label_names=()) -> Counter:
+        return self.register(Counter(name, help, label_names))
+
+    def gauge(self, name, help, label_names=()) -> Gauge:
+        return self.register(Gauge(name, help, label_names))
+
+    def histogram(self, name, help, label_names=(), buckets=DEFAULT_TIME_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, label_names, buckets))
+
+    def collect(self) -> Dict[str, Dict]:
+        """Returns every metric as plain data that can be pickled and rendered elsewhere"""
+        return {name: metric.collect() for name, metric in self.metrics.items()}
+
+class NullMetric:
+    def inc(self, amount=1, labels=()):
+        pass
+
+    def set(self, value, labels=()):
+        pass
+
+    def observe(self, value, labels=()):
+        pass
+
+class NullRegistry:
+    enabled: bool = False
+    NULL_METRIC = NullMetric()
+
+    def counter(self, name, help, label_names=()):
+        return self.NULL_METRIC
+
+    def gauge(self, name, help, label_names=()):
+        return self.NULL_METRIC
+
+    def histogram(self, name, help, label_names=(), buckets=DEFAULT_TIME_BUCKETS):
+        return self.NULL_METRIC
+
+    def collect(self) -> Dict[str, Dict]:
+        return {}
+
+DISABLED = NullRegistry()
+
+def format_labels(names, values) -> str:
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        escaped = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append('{}="{}"'.format(name, escaped))
+    return '{' + ','.join(pairs) + '}'
+
+def format_value(value) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def render(collections: Sequence[Tuple[Dict[str, str], Dict[str, Dict]]]) -> str:
+    """Renders collected metrics in the Prometheus text exposition format.
+
+    collections is a list of (extra labels, Registry.collect() result), e.g. one per torrent
+    labelled with its info hash. Metrics with the same name are merged under one header.
+    """
+    merged: Dict[str, Tuple[Dict, List]] = {}
+    for extra_labels, collected in collections:
+        for name, metric in collected.items():
+            merged.setdefault(name, (metric, []))[1].append((extra_labels, metric))
+
+    lines = []
+    for name in sorted(merged):
+        first, parts = merged[name]
+        lines.append('# HELP {} {}'.format(name, first['help']))
+        lines.append('# TYPE {} {}'.format(name, first['type']))
+        for extra_labels, metric in parts:
+            names = tuple(extra_labels) + tuple(metric['labels'])
+            if metric['type'] == Histogram.TYPE:
+                for labels, counts, total in metric['samples']:
+                    values = tuple(extra_labels.values()) + tuple(labels)
+                    cumulative = 0
+                    for bound, count in zip(tuple(metric['buckets']) + (math.inf,), counts):
+                        cumulative += count
+                        lines.append('{}_bucket{} {}'.format(name,
+                            format_labels(names + ('le',), values + (format_value(bound),)),
+                            cumulative))
+                    lines.append('{}_sum{} {}'.format(name, format_labels(names, values),
+                        format_value(total)))
+                    lines.append('{}_count{} {}'.format(name, format_labels(names, values),
+                        cumulative))
+            else:
+                for labels, value in metric['samples']:
+                    values = tuple(extra_labels.values()) + tuple(labels)
+                    lines.append('{}{} {}'.format(name, format_labels(names, values),
+                        format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+class EngineMetrics:
+    """Every metric a TorrentDownload and its peers record"""
+
+    def __init__(self, registry):
+        self.registry = registry
+        self.bytes_received = registry.counter('tourint_bytes_received_total',
+                'Bytes read from peers')
+        self.bytes_sent = registry.counter('tourint_bytes_sent_total', 'Bytes sent to peers')
+        self.socket_sends = registry.counter('tourint_socket_sends_total',
+                'send() calls made to write to peers')
+        self.messages_received = registry.counter('tourint_messages_received_total',
+                'Peer wire messages parsed, by type', ('type',))
+        self.pieces_verified = registry.counter('tourint_pieces_verified_total',
+                'Pieces that passed their hash check')
+        self.hash_failures = registry.counter('tourint_hash_failures_total',
+                'Pieces that failed their hash check and were requeued')
+        self.connect_failures = registry.counter('tourint_peer_connect_failures_total',
+                'Peers that could not be connected to, by address family', ('family',))
+        self.connect_races_lost = registry.counter('tourint_peer_connect_races_lost_total',
+                'Connections dropped after their handshake because a connection to the same '
+                'peer, or enough other ones, finished theirs first')
+        self.peers_active = registry.gauge('tourint_peers_active', 'Connected peers')
+        self.disk_queue_depth = registry.gauge('tourint_disk_queue_depth',
+                'Verified pieces waiting to be written')
+        self.poll_loop_seconds = registry.histogram('tourint_poll_loop_seconds',
+                'Time spent handling one batch of poll events, not counting the wait')
+        self.bad_blocks = registry.counter('tourint_bad_blocks_total',
+                'Blocks of hybrid torrents that failed their Merkle hash and were fetched again')
+        self.piece_hash_seconds = registry.histogram('tourint_piece_hash_seconds',
+                'Time to finish hashing a completed piece before it is accepted')
+        self.disk_write_seconds = registry.histogram('tourint_disk_write_seconds',
+                'Time to write one batch of pieces')
+        self.peer_connect_seconds = registry.histogram('tourint_peer_connect_seconds',
+                'Time to open a connection and send the handshake, by address family',
+                ('family',))
+        self.dht_messages = registry.counter('tourint_dht_messages_total',
+                'DHT messages sent and received, and queries that timed out',
+                ('direction', 'type'))
+        self.dht_lookup_seconds = registry.histogram('tourint_dht_lookup_seconds',
+                'Time for one iterative DHT lookup', ('method',))
+        self.dht_lookup_queries = registry.histogram('tourint_dht_lookup_queries',
+                'Queries sent by one iterative DHT lookup', ('method',),
+                buckets=DHT_QUERY_BUCKETS)
+
+DISABLED_ENGINE_METRICS = EngineMetrics(DISABLED)
@@ -1,20 +1,37 @@
-from typing import Dict, Tuple
+from typing import Dict, List, Tuple
 from queue import Queue
+from collections import Counter, deque
+from operator import itemgetter
+import errno
+import os
 import socket
 import sys
 import random
 import enum
 import time
 import hashlib
+import struct
 
 if __package__ is None or __package__ == '':
+    import addresses
     import consts
     import tracker
     import ring_buffer
+    import metrics
+    import extension
+    import pex
+    import transport
+    import merkle
 else:
+    from . import addresses
     from . import consts
     from . import tracker
     from . import ring_buffer
+    from . import metrics
+    from . import extension
+    from . import pex
+    from . import transport
+    from . import merkle
 
 def read_from_socket_checked(s: socket.socket, size_bytes: int) -> bytes:
     ret = bytearray()
@@ -35,12 +52,33 @@ class PeerHandshake:
     PROTOCOL_NAME: str = 'BitTorrent protocol'
     RESERVED_SIZE: int = 8
 
-    def __init__(self, peer_id: bytearray, info_hash: bytearray):
+    # Reserved bits, as (byte index, mask)
+    # BEP 6
+    FAST_EXTENSION_BIT: Tuple[int, int] = (7, 0x04)
+    # BEP 10
+    EXTENSION_PROTOCOL_BIT: Tuple[int, int] = (5, 0x10)
+    # BEP 52
+    V2_BIT: Tuple[int, int] = (7, 0x10)
+
+    def __init__(self, peer_id: bytearray, info_hash: bytearray, reserved=bytes(RESERVED_SIZE)):
         assert(len(peer_id) == self.PEER_ID_LEN)
         assert(len(info_hash) == self.INFO_HASH_LEN)
+        assert(len(reserved) == self.RESERVED_SIZE)
 
         self.peer_id = peer_id
         self.info_hash = info_hash
+        self.reserved = bytes(reserved)
+
+    @classmethod
+    def reserved_with(cls, *bits) -> bytes:
+        reserved = bytearray(cls.RESERVED_SIZE)
+        for index, mask in bits:
+            reserved[index] |= mask
+        return bytes(reserved)
+
+    def has_reserved_bit(self, bit) -> bool:
+        index, mask = bit
+        return (self.reserved[index] & mask) != 0
 
     def __str__(self):
         return 'PeerHandshake: id = {}, hash = {}'.format(self.peer_id, self.info_hash)
@@ -48,7 +86,7 @@ class PeerHandshake:
     def serialize(self) -> bytes:
         b: bytearray = bytearray([self.NAME_LENGTH])
         b.extend(self.PROTOCOL_NAME.encode('ascii'))
-        b.extend(bytearray(self.RESERVED_SIZE))
+        b.extend(self.reserved)
         b.extend(self.info_hash)
 
         if isinstance(self.peer_id, bytes):
@@ -87,7 +125,7 @@ class PeerHandshake:
                     {}'.format(cls.PROTOCOL_NAME, protocol_name))
 
         idx += cls.NAME_LENGTH 
-        # skipping reserved bytes
+        reserved = handshake_bytes[idx:idx+cls.RESERVED_SIZE]
         idx += cls.RESERVED_SIZE
 
         info_hash = handshake_bytes[idx:idx+cls.INFO_HASH_LEN]
@@ -95,7 +133,7 @@ class PeerHandshake:
 
         peer_id = handshake_bytes[idx:idx+cls.PEER_ID_LEN]
 
-        return cls(peer_id, info_hash)
+        return cls(peer_id, info_hash, reserved)
 
 
 class PeerMessage:
@@ -119,6 +157,21 @@ class PeerMessage:
         # len == 0
         KEEP_ALIVE = 10
 
+        # Fast extension (BEP 6), only sent to peers that set FAST_EXTENSION_BIT
+        SUGGEST = 13
+        HAVE_ALL = 14
+        HAVE_NONE = 15
+        REJECT = 16
+        ALLOWED_FAST = 17
+
+        # Extension protocol (BEP 10), see extension.py
+        EXTENDED = 20
+
+        # Merkle hashes of v2 torrents (BEP 52), only sent to peers that set V2_BIT. See
+        # merkle.py for the payloads.
+        HASH_REQUEST = 21
+        HASHES = 22
+        HASH_REJECT = 23
 
     def __init__(self, message_id, payload=None):
         self.id = message_id
@@ -129,16 +182,15 @@ class PeerMessage:
 
     @classmethod
     def is_state_message(cls, message_id):
-        return message_id in [cls.Id.CHOKE, cls.Id.UNCHOKE, cls.Id.INTERESTED, cls.Id.NOT_INTERESTED]
+        return message_id in STATE_MESSAGE_IDS
 
     @classmethod
     def is_valid_message_id(cls, message_id):
-        valid_values = [t.value for t in cls.Id]
-        return message_id in valid_values
+        return message_id in VALID_MESSAGE_IDS
 
     def serialize(self) -> bytes:
         if self.id == self.Id.KEEP_ALIVE:
-            return bytearray(MESSAGE_LENGTH_SIZE)
+            return bytes(self.MESSAGE_LENGTH_SIZE)
 
         ret = bytearray()
 
@@ -161,45 +213,109 @@ class PeerMessage:
     def from_ring_buffer(cls, buf):
         """Parses a PeerMessage from a ring_buffer
 
-        A full message including the payload must be in buf.
+        A full message including the payload must be in buf. Messages with ids we don't know are
+        skipped.
 
         Returns None if there isn't enough data in the buffer
         """
-        if len(buf) < cls.MESSAGE_LENGTH_SIZE:
-            return None
-        
-        message_length_bytes = buf.peek(cls.MESSAGE_LENGTH_SIZE)
-        message_length = int.from_bytes(message_length_bytes, byteorder='big')
+        while len(buf) >= cls.MESSAGE_LENGTH_SIZE:
+            message_length_bytes = buf.peek(cls.MESSAGE_LENGTH_SIZE)
+            message_length = int.from_bytes(message_length_bytes, byteorder='big')
 
-        if message_length == 0:
-            buf.remove(cls.MESSAGE_LENGTH_SIZE)
-            return cls(cls.Id.KEEP_ALIVE, 0)
-        
-        #print('message length {}'.format(message_length))
-        if len(buf) < message_length + cls.MESSAGE_LENGTH_SIZE:
-            # Incomplete header
-            # Don't remove anything from the buffer, wait for next byte to get a full header
-            #print('incomplete header: buffer needs {} bytes but only has {}'.format(message_length + 4,
-            #    len(buf)))
-            return None
+            if message_length == 0:
+                buf.remove(cls.MESSAGE_LENGTH_SIZE)
+                return cls(cls.Id.KEEP_ALIVE, 0)
 
+            if len(buf) < message_length + cls.MESSAGE_LENGTH_SIZE:
+                # Incomplete message, wait for the rest of it
+                return None
 
-        # Have a full header (length + message id)
-        buf.remove(cls.MESSAGE_LENGTH_SIZE)
-        message_id = cls.Id(buf.read(1)[0])
+            # Have a full header (length + message id)
+            buf.remove(cls.MESSAGE_LENGTH_SIZE)
+            message_id = buf.read(1)[0]
+
+            payload_length = message_length - 1
+            assert(len(buf) >= payload_length)
+
+            payload = buf.read(payload_length)
+            if message_id in VALID_MESSAGE_IDS:
+                return cls(cls.Id(message_id), payload)
+        return None
+
+STATE_MESSAGE_IDS = frozenset([PeerMessage.Id.CHOKE, PeerMessage.Id.UNCHOKE,
+    PeerMessage.Id.INTERESTED, PeerMessage.Id.NOT_INTERESTED])
+VALID_MESSAGE_IDS = frozenset(message_id.value for message_id in PeerMessage.Id)
+
+# Plain int ids for the hot path, comparing enum members costs more than parsing a frame
+HAVE_ID: int = PeerMessage.Id.HAVE.value
+PIECE_ID: int = PeerMessage.Id.PIECE.value
+REQUEST_ID: int = PeerMessage.Id.REQUEST.value
+KEEP_ALIVE_ID: int = PeerMessage.Id.KEEP_ALIVE.value
+LENGTH_PREFIX = struct.Struct('>I')
+PIECE_INDEX = struct.Struct('>I')
+HAVE_MESSAGE_LENGTH: int = 5
+# A whole REQUEST: length prefix, id, piece index, begin, length
+REQUEST_MESSAGE = struct.Struct('>IBIII')
+REQUEST_MESSAGE_LENGTH: int = 13
+
+def decode_frames(buf) -> List[Tuple[int, object]]:
+    """Parses every complete message in a RingBuffer in one pass and removes them from it.
+
+    Returns (message id, payload) pairs with int ids, including ids we don't know, for the caller
+    to skip. A HAVE's payload is its piece index (and malformed HAVEs are dropped). A PIECE's is a
+    memoryview into the buffer, good until the next write to it. Every other payload is bytes,
+    and a keep-alive's is None.
+    """
+    view = buf.contiguous()
+    end = len(view)
+    offset = 0
+    frames = []
+    append = frames.append
+    unpack_length = LENGTH_PREFIX.unpack_from
+    while end - offset >= 4:
+        length = unpack_length(view, offset)[0]
+        if length == 0:
+            append((KEEP_ALIVE_ID, None))
+            offset += 4
+            continue
+        frame_end = offset + 4 + length
+        if frame_end > end:
+            break
+        message_id = view[offset + 4]
+        if message_id == PIECE_ID:
+            append((PIECE_ID, view[offset + 5:frame_end]))
+        elif message_id == HAVE_ID:
+            # A HAVE of the wrong size is dropped
+            if length == HAVE_MESSAGE_LENGTH:
+                append((HAVE_ID, PIECE_INDEX.unpack_from(view, offset + 5)[0]))
+        else:
+            append((message_id, bytes(view[offset + 5:frame_end])))
+        offset = frame_end
+    buf.remove(offset)
+    return frames
 
-        payload_length = message_length - 1
-        assert(len(buf) >= payload_length)
+# Label values for counting each message type, built once
+MESSAGE_TYPE_LABELS: Dict = {message_id.value: (message_id.name.lower(),)
+        for message_id in PeerMessage.Id}
+UNKNOWN_MESSAGE_LABELS: Tuple = ('unknown',)
 
-        payload = buf.read(payload_length)
-        return cls(message_id, payload)
-    
-    
 class Bitfield:
     def __init__(self, bitfield_bytes):
         assert(bitfield_bytes is not None)
         self.bitfield_bytes = bitfield_bytes
 
+    @classmethod
+    def empty(cls, num_pieces):
+        return cls(bytearray((num_pieces + 7) // 8))
+
+    @classmethod
+    def full(cls, num_pieces):
+        bitfield = cls(bytearray(b'\xff' * ((num_pieces + 7) // 8)))
+        # Spare bits at the end stay zero
+        for i in range(num_pieces, len(bitfield.bitfield_bytes) * 8):
+            bitfield.clear(i)
+        return bitfield
+
     @staticmethod
     def get_idx_and_offset(bitfield_index) -> Tuple[int, int]:
         byte_index = bitfield_index // 8
@@ -218,9 +334,23 @@ class Bitfield:
         index, offset = self.get_idx_and_offset(index)
         self.bitfield_bytes[index] &= ~(1 << offset)
 
+    def set_many(self, indices) -> List[int]:
+        """Sets every index in range, returns the ones that weren't set already"""
+        bitfield_bytes = self.bitfield_bytes
+        num_bits = len(bitfield_bytes) * 8
+        new = []
+        for index in indices:
+            if index >= num_bits:
+                continue
+            mask = 0x80 >> (index & 7)
+            if not bitfield_bytes[index >> 3] & mask:
+                bitfield_bytes[index >> 3] |= mask
+                new.append(index)
+        return new
+
 class PieceDownload:
     BLOCK_SIZE_BYTES: int = 16384
-    def __init__(self, piece_index, piece_size_bytes):
+    def __init__(self, piece_index, piece_size_bytes, leaf_bytes=None):
         # TODO handle next requested byte better. A set maybe?
         self.piece_index = piece_index
         self.piece_bytes = bytearray(piece_size_bytes)
@@ -231,9 +361,24 @@ class PieceDownload:
         
         self.total_num_blocks = num_blocks
         self.blocks_to_request = set(range(num_blocks))
+        # Requested but not received, rejected or dropped by a choke yet
+        self.blocks_requested = set()
         self.blocks_received = set()
+        # SHA-1 of the piece so far, fed each block once every block before it has arrived
+        self.hasher = hashlib.sha1()
+        self.hashed_bytes = 0
+        # For pieces of v2 torrents, the bytes of the piece covered by Merkle leaves (the rest is
+        # padding). Each block's leaf hash and the (ip, port) it came from are kept instead of
+        # the SHA-1, so a bad block can be found and blamed on its own.
+        self.leaf_bytes = leaf_bytes
+        self.leaf_hashes: Dict[int, bytes] = {}
+        self.block_sources: Dict[int, Tuple[str, int]] = {}
 
     def get_next_block_request(self) -> PeerMessage: 
+        return PeerMessage.new_request(self.piece_index, *self.take_next_block())
+
+    def take_next_block(self) -> Tuple[int, int]:
+        """Marks the next block to request as requested, returns its (begin, length)"""
         next_block = next(iter(self.blocks_to_request))
 
         start_byte = next_block * self.BLOCK_SIZE_BYTES
@@ -242,11 +387,11 @@ class PieceDownload:
         else:
             length = self.BLOCK_SIZE_BYTES
 
-        ret = PeerMessage.new_request(self.piece_index, start_byte, length)
         self.blocks_to_request.remove(next_block)
-        return ret 
+        self.blocks_requested.add(next_block)
+        return start_byte, length
 
-    def handle_block_response(self, payload):
+    def handle_block_response(self, payload, source=None):
         piece_index = int.from_bytes(payload[0:4], byteorder='big')
         if piece_index != self.piece_index:
             return
@@ -259,10 +404,91 @@ class PieceDownload:
             raise ValueError('End byte too large: got {}, max: {}'.format(end_byte,
                 len(self.piece_bytes)))
 
-        self.piece_bytes[start_byte:end_byte] = payload[8:]
-
         received_block = start_byte // self.BLOCK_SIZE_BYTES
+        self.blocks_requested.discard(received_block)
+        # It may have been requeued after a choke and still arrived
+        self.blocks_to_request.discard(received_block)
+        if received_block in self.blocks_received:
+            # A duplicate. Keep the copy that may already be hashed.
+            return
+
+        self.piece_bytes[start_byte:end_byte] = payload[8:]
         self.blocks_received.add(received_block)
+        if self.leaf_bytes is None:
+            self.hash_received_prefix()
+            return
+        self.block_sources[received_block] = source
+        if start_byte < self.leaf_bytes:
+            with memoryview(self.piece_bytes) as view:
+                self.leaf_hashes[received_block] = merkle.block_hash(
+                        view[start_byte:min(end_byte, self.leaf_bytes)])
+
+    def hash_received_prefix(self):
+        """Hashes the blocks after the hashed prefix that have arrived. A block that arrives
+        out of order waits here until the gap before it fills, then goes in with the rest."""
+        next_block = self.hashed_bytes // self.BLOCK_SIZE_BYTES
+        end_block = next_block
+        while end_block in self.blocks_received:
+            end_block += 1
+        if end_block == next_block:
+            return
+        end_byte = min(end_block * self.BLOCK_SIZE_BYTES, len(self.piece_bytes))
+        with memoryview(self.piece_bytes) as view:
+            self.hasher.update(view[self.hashed_bytes:end_byte])
+        self.hashed_bytes = end_byte
+
+    def leaves(self) -> List[bytes]:
+        """The leaf hashes of the piece's blocks, in order"""
+        num_leaves = (self.leaf_bytes + self.BLOCK_SIZE_BYTES - 1) // self.BLOCK_SIZE_BYTES
+        return [self.leaf_hashes[block] for block in range(num_leaves)]
+
+    def padding_is_zero(self, block=None) -> bool:
+        """Whether the padding after the leaves, or the part of it in block, is all zeros"""
+        start, end = self.leaf_bytes, len(self.piece_bytes)
+        if block is not None:
+            start = max(start, block * self.BLOCK_SIZE_BYTES)
+            end = min(end, (block + 1) * self.BLOCK_SIZE_BYTES)
+        with memoryview(self.piece_bytes) as view:
+            return start >= end or not any(view[start:end])
+
+    def bad_blocks(self, leaf_hashes: List[bytes]) -> List[int]:
+        """The blocks that don't match the piece's verified leaf hashes, or that carry nonzero
+        padding"""
+        ret = []
+        for block in range(self.total_num_blocks):
+            expected = leaf_hashes[block] if block < len(leaf_hashes) else None
+            if self.leaf_hashes.get(block) != expected or not self.padding_is_zero(block):
+                ret.append(block)
+        return ret
+
+    def discard_blocks(self, blocks):
+        """Puts blocks back to be requested again"""
+        for block in blocks:
+            self.blocks_received.discard(block)
+            self.leaf_hashes.pop(block, None)
+            self.block_sources.pop(block, None)
+            self.blocks_to_request.add(block)
+
+    def digest(self) -> bytes:
+        """SHA-1 of the piece. Once every block has arrived the running hash already covers it,
+        otherwise this hashes whatever is in the piece buffer from scratch."""
+        if self.hashed_bytes == len(self.piece_bytes):
+            return self.hasher.digest()
+        return hashlib.sha1(self.piece_bytes).digest()
+
+    def reject_block(self, begin) -> bool:
+        """Puts a rejected block back to be requested again. Returns False if it wasn't pending."""
+        block = begin // self.BLOCK_SIZE_BYTES
+        if block not in self.blocks_requested:
+            return False
+        self.blocks_requested.remove(block)
+        self.blocks_to_request.add(block)
+        return True
+
+    def requeue_requested(self):
+        """Puts every outstanding request back, for when a choke has dropped them"""
+        self.blocks_to_request |= self.blocks_requested
+        self.blocks_requested = set()
 
     def all_blocks_received(self):
         return len(self.blocks_received) == self.total_num_blocks
@@ -277,6 +503,8 @@ class PeerConnection:
     CONNECTION_TIMEOUT_S: int = 5
     MAX_QUEUED_REQUESTS: int = 10
     BUFFER_PADDING: int = 1024 
+    # Most recent SUGGEST messages kept per peer
+    MAX_SUGGESTED_PIECES: int = 16
 
     class State(enum.Enum):
         INIT_HANDSHAKE = 0
@@ -285,26 +513,92 @@ class PeerConnection:
         IDLE = 3
         CANCEL = 4
         DISCONNECTED = 5
+        # Non-blocking connect in progress, see start_connection
+        CONNECTING = 6
 
-    def __init__(self, peer_info: Dict, info_hash: bytearray):
+    def __init__(self, peer_info: Dict, info_hash: bytearray, picker=None, engine_metrics=None,
+                 fast_extension=True, extension_protocol=True, peer_transport=None, v2=False):
         self.peer_info = peer_info
         self.info_hash = info_hash
-
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # PiecePicker that tracks piece availability across peers, if any
+        self.picker = picker
+        self.engine_metrics = engine_metrics or metrics.DISABLED_ENGINE_METRICS
+
+        # Whether we offer the fast extension (BEP 6), and whether the peer took us up on it
+        self.offer_fast_extension = fast_extension
+        self.fast_extension = False
+        # Pieces the peer lets us request while it's choking us
+        self.allowed_fast = set()
+        # Pieces the peer suggested, most recent last
+        self.suggested_pieces = deque(maxlen=self.MAX_SUGGESTED_PIECES)
+        # Pieces the peer rejected requests for while we were allowed to ask, so we stop asking
+        self.rejected_pieces = set()
+        # Piece given up on because of a REJECT, for the download to hand to someone else
+        self.abandoned_piece = None
+
+        # Whether we offer the extension protocol (BEP 10), whether the peer took it, and the
+        # peer's ids for the extensions it supports
+        self.offer_extension_protocol = extension_protocol
+        self.extension_protocol = False
+        self.extension_ids: Dict[str, int] = {}
+        # Peer exchange: what we've told the peer, and addresses it told us about that the
+        # download hasn't collected yet
+        self.pex_state = pex.PexState()
+        self.pex_peers = []
+        self.connect_started = None
+
+        # Whether we set the v2 bit (BEP 52), for hybrid torrents, and whether the peer did too,
+        # so we can ask it for Merkle hashes. Its answers wait here for the download to collect,
+        # see take_hash_replies.
+        self.offer_v2 = v2
+        self.v2 = False
+        self.hash_replies = []
+
+        # TCP unless the download runs its peers over uTP, see transport.py. IPv6 peers get an
+        # IPv6 socket.
+        self.transport = peer_transport or transport.TCP
+        self.socket = self.transport.create_socket(addresses.family_of(peer_info['ip']))
         self.choked = True
 
         self.peer_id = None
 
         self.num_queued_requests = 0
+        # Total bytes read off / written to the socket, for rate reporting
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.download_rate_bps = 0
+        self.rate_bytes_mark = 0
+        # Messages waiting to go out. Everything queued while handling one batch of reads is
+        # written with one send, see flush.
+        self.outbox = bytearray()
         self.buffer = ring_buffer.RingBuffer(PieceDownload.BLOCK_SIZE_BYTES + self.BUFFER_PADDING)
 
         self.available_pieces = None
+        # Message id -> handler(payload), see build_message_handlers
+        self.message_handlers = self.build_message_handlers()
         self.state: self.State = self.State.DISCONNECTED 
         self.download_state = None
 
     def __str__(self):
-        return "PeerConnection on IP = {}:{} for hash {}".format(self.peer_info['ip'],
-                self.peer_info['port'], self.info_hash)
+        return "PeerConnection on IP = {} for hash {}".format(
+                addresses.format_address(*self.address()), self.info_hash)
+
+    def update_rate(self, elapsed_s):
+        """Recomputes download_rate_bps from the bytes received in the last elapsed_s"""
+        self.download_rate_bps = int((self.bytes_received - self.rate_bytes_mark) / elapsed_s)
+        self.rate_bytes_mark = self.bytes_received
+
+    def stats(self) -> Dict:
+        return {
+            'address': addresses.format_address(*self.address()),
+            'state': self.state.name.lower(),
+            'transport': self.transport.NAME,
+            'choked': self.choked,
+            'download_rate_bps': self.download_rate_bps,
+            'bytes_received': self.bytes_received,
+            'queued_requests': self.num_queued_requests,
+            'current_piece': self.get_current_piece_index() if self.is_downloading() else None,
+        }
 
     def initialize_connection(self):
         """
@@ -318,11 +612,75 @@ class PeerConnection:
 
         # Get to initializing state once connection succeeds
         self.state = self.State.INIT_HANDSHAKE
+        self.send_handshake()
 
-        handshake = PeerHandshake(consts.PEER_ID, self.info_hash)
-        self.socket.send(handshake.serialize())
+    def start_connection(self):
+        """
+        Like initialize_connection, but returns right away. Once the socket polls writable,
+        call finish_connection.
+        """
+        assert(self.state == self.State.DISCONNECTED)
+
+        self.socket.setblocking(False)
+        error = self.socket.connect_ex((self.peer_info['ip'], self.peer_info['port']))
+        if error not in (0, errno.EINPROGRESS):
+            raise OSError(error, os.strerror(error))
+        self.state = self.State.CONNECTING
+        self.connect_started = time.monotonic()
+
+    def finish_connection(self):
+        assert(self.state == self.State.CONNECTING)
+        error = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            raise OSError(error, os.strerror(error))
+
+        self.socket.settimeout(self.CONNECTION_TIMEOUT_S)
+        self.state = self.State.INIT_HANDSHAKE
+        self.send_handshake()
+
+    def is_connecting(self):
+        return self.state == self.State.CONNECTING
+
+    def connect_timed_out(self) -> bool:
+        return self.is_connecting() and\
+                time.monotonic() - self.connect_started > self.CONNECTION_TIMEOUT_S
+
+    def send_handshake(self):
+        bits = [PeerHandshake.FAST_EXTENSION_BIT] if self.offer_fast_extension else []
+        if self.offer_extension_protocol:
+            bits.append(PeerHandshake.EXTENSION_PROTOCOL_BIT)
+        if self.offer_v2:
+            bits.append(PeerHandshake.V2_BIT)
+        handshake = PeerHandshake(consts.PEER_ID, self.info_hash,
+                PeerHandshake.reserved_with(*bits))
+        self.send_bytes(handshake.serialize())
 
    
+    def send_bytes(self, data):
+        """Queues data to go out with the next flush"""
+        self.outbox += data
+
+    def flush(self) -> bool:
+        """Sends as much of the outbox as the socket takes without blocking, in one send call.
+        Returns whether anything is still waiting, in which case flush again once the socket
+        polls writable."""
+        if self.outbox:
+            try:
+                sent = self.socket.send(self.outbox, socket.MSG_DONTWAIT)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            self.engine_metrics.socket_sends.inc()
+            if sent == len(self.outbox):
+                # Keeps the allocation for the next batch
+                self.outbox.clear()
+            else:
+                del self.outbox[:sent]
+            self.bytes_sent += sent
+        return len(self.outbox) > 0
+
+    def has_pending_writes(self) -> bool:
+        return len(self.outbox) > 0
+
     def validate_handshake(self) -> bool:
         if len(self.buffer) < PeerHandshake.HANDSHAKE_SIZE:
             return
@@ -335,54 +693,232 @@ class PeerConnection:
         
         self.peer_id = handshake.peer_id
         self.state = self.State.INIT_BITFIELD
+        self.fast_extension = self.offer_fast_extension and\
+                handshake.has_reserved_bit(PeerHandshake.FAST_EXTENSION_BIT)
+        if self.fast_extension:
+            # The first message has to say what we have. We never upload, so: nothing.
+            self.send_bytes(PeerMessage(PeerMessage.Id.HAVE_NONE).serialize())
+        self.extension_protocol = self.offer_extension_protocol and\
+                handshake.has_reserved_bit(PeerHandshake.EXTENSION_PROTOCOL_BIT)
+        self.v2 = self.offer_v2 and handshake.has_reserved_bit(PeerHandshake.V2_BIT)
+        self.message_handlers = self.build_message_handlers()
+        if self.extension_protocol:
+            self.send_bytes(extension.handshake_message([pex.EXTENSION_NAME]).serialize())
 
     def peer_has_piece(self, index):
         if not self.available_pieces:
             raise ValueError('Bitfield not initialized')
         return self.available_pieces.contains(index)
 
-    def handle_state_message(self, message_id):
-        if message_id == PeerMessage.Id.CHOKE:
-            self.choked = True
-        elif message_id == PeerMessage.Id.UNCHOKE:
-            self.choked = False
-        elif message_id == PeerMessage.Id.INTERESTED:
-            pass
-        elif message_id == PeerMessage.Id.NOT_INTERESTED:
-            pass
+    def build_message_handlers(self) -> Dict:
+        """Handlers for the messages we act on, given which extensions the peer took. HAVEs and
+        PIECEs are handled in handle_messages_from_buffer, anything not here is ignored."""
+        handlers = {
+            PeerMessage.Id.CHOKE.value: self.handle_choke,
+            PeerMessage.Id.UNCHOKE.value: self.handle_unchoke,
+            PeerMessage.Id.BITFIELD.value: self.handle_bitfield,
+            PeerMessage.Id.REQUEST.value: self.handle_request,
+        }
+        if self.extension_protocol:
+            handlers[PeerMessage.Id.EXTENDED.value] = self.handle_extended
+        if self.fast_extension:
+            handlers[PeerMessage.Id.REJECT.value] = self.handle_reject
+            handlers[PeerMessage.Id.ALLOWED_FAST.value] = self.handle_allowed_fast
+            handlers[PeerMessage.Id.SUGGEST.value] = self.handle_suggest
+        if self.v2:
+            handlers[PeerMessage.Id.HASH_REQUEST.value] = self.handle_hash_request
+            handlers[PeerMessage.Id.HASHES.value] = self.handle_hashes
+            handlers[PeerMessage.Id.HASH_REJECT.value] = self.handle_hash_reject
+        return handlers
+
+    def handle_choke(self, payload=None):
+        self.choked = True
+        if not self.fast_extension and self.download_state is not None:
+            # Choking silently drops our requests. With the fast extension the peer sends
+            # a REJECT for each one instead (and may still serve allowed fast pieces).
+            self.download_state.requeue_requested()
+            self.num_queued_requests = 0
+
+    def handle_unchoke(self, payload=None):
+        self.choked = False
 
     def handle_bitfield(self, payload):
         if self.available_pieces is not None:
             raise ValueError('Error: erroneous bitfield message?')
+        if self.picker:
+            # Checked here so a malformed bitfield drops the peer instead of failing deep inside
+            # the picker
+            num_pieces = self.picker.num_pieces
+            if len(payload) != (num_pieces + 7) // 8:
+                raise ValueError('Bitfield of {} bytes for {} pieces'.format(len(payload),
+                    num_pieces))
+            spare_bits = -num_pieces % 8
+            if spare_bits and payload[-1] & ((1 << spare_bits) - 1):
+                raise ValueError('Bitfield has bits set past the last piece')
         self.available_pieces = Bitfield(payload)
+        if self.picker:
+            self.picker.peer_bitfield(self.available_pieces)
+
+    def num_pieces(self) -> int:
+        if self.picker is None:
+            raise ValueError('Number of pieces unknown without a picker')
+        return self.picker.num_pieces
+
+    def handle_have_all(self):
+        self.handle_bitfield(Bitfield.full(self.num_pieces()).bitfield_bytes)
+
+    def handle_have_none(self):
+        self.handle_bitfield(Bitfield.empty(self.num_pieces()).bitfield_bytes)
 
     def handle_have(self, payload):
         assert(len(payload) == 4)
+        self.handle_haves([int.from_bytes(payload, byteorder='big')])
+
+    def handle_haves(self, piece_indices):
         assert(self.available_pieces is not None)
-        new_piece_index = int.from_bytes(payload, byteorder='big')
-        self.available_pieces.set(new_piece_index)
+        new_pieces = self.available_pieces.set_many(piece_indices)
+        if self.picker and new_pieces:
+            self.picker.peer_haves(new_pieces)
 
     def handle_piece(self, payload, download_state):
-        download_state.handle_block_response(payload)
+        download_state.handle_block_response(payload, self.address())
+        self.num_queued_requests -= 1
+
+    def handle_reject(self, payload):
+        piece_index = int.from_bytes(payload[0:4], byteorder='big')
+        begin = int.from_bytes(payload[4:8], byteorder='big')
+        if not self.is_downloading() or piece_index != self.download_state.piece_index:
+            return
+        if not self.download_state.reject_block(begin):
+            return
         self.num_queued_requests -= 1
+
+        if self.can_request_piece(piece_index):
+            # Not a choke flushing our requests: the peer won't give us this piece
+            self.rejected_pieces.add(piece_index)
+            self.allowed_fast.discard(piece_index)
+            self.abandon_piece()
+
+    def handle_allowed_fast(self, payload):
+        piece_index = int.from_bytes(payload, byteorder='big')
+        if self.picker is None or piece_index < self.picker.num_pieces:
+            self.allowed_fast.add(piece_index)
+
+    def handle_suggest(self, payload):
+        piece_index = int.from_bytes(payload, byteorder='big')
+        if piece_index not in self.suggested_pieces:
+            self.suggested_pieces.append(piece_index)
+
+    def handle_request(self, payload):
+        # We never unchoke anyone, so with the fast extension every request gets a REJECT
+        if self.fast_extension:
+            self.send_bytes(PeerMessage(PeerMessage.Id.REJECT, payload).serialize())
+
+    def handle_hash_request(self, payload):
+        # We don't upload, so we don't hand out hashes either
+        self.send_bytes(PeerMessage(PeerMessage.Id.HASH_REJECT, payload).serialize())
+
+    def handle_hashes(self, payload):
+        try:
+            self.hash_replies.append(merkle.parse_hashes(payload))
+        except ValueError as e:
+            print('{}: bad hashes message: {}'.format(str(self), e))
+
+    def handle_hash_reject(self, payload):
+        try:
+            self.hash_replies.append(merkle.parse_hash_request(payload) + (None,))
+        except ValueError as e:
+            print('{}: bad hash reject: {}'.format(str(self), e))
+
+    def request_hashes(self, pieces_root, index, length, proof_layers):
+        """Asks for length leaf hashes of the file with pieces_root, from index on, plus
+        proof_layers uncles to check them against a node further up"""
+        self.send_bytes(PeerMessage(PeerMessage.Id.HASH_REQUEST, merkle.hash_request_payload(
+            pieces_root, index, length, proof_layers)).serialize())
+
+    def take_hash_replies(self):
+        """Returns the (pieces root, base layer, index, length, proof layers, hashes) answers
+        since the last call. hashes is None if the peer rejected the request."""
+        replies = self.hash_replies
+        self.hash_replies = []
+        return replies
+
+    def handle_extended(self, payload):
+        try:
+            extension_id, body = extension.parse(payload)
+            if extension_id == extension.HANDSHAKE_ID:
+                self.extension_ids = extension.peer_ids(extension.decode_handshake(body))
+            elif extension_id == extension.LOCAL_IDS[pex.EXTENSION_NAME]:
+                if self.pex_state.accept_message():
+                    added, _ = pex.parse_message(body)
+                    self.pex_peers.extend(added)
+        except ValueError as e:
+            # Extensions are optional, a peer getting one wrong isn't worth disconnecting over
+            print('{}: bad extended message: {}'.format(str(self), e))
+
+    def supports_pex(self) -> bool:
+        return pex.EXTENSION_NAME in self.extension_ids
+
+    def send_pex(self, connected):
+        """Tells the peer about changes to the addresses we're connected to, if it's time"""
+        update = self.pex_state.next_update(connected)
+        if update is not None:
+            self.send_bytes(pex.pex_message(self.extension_ids[pex.EXTENSION_NAME],
+                *update).serialize())
+
+    def take_pex_peers(self):
+        """Returns the (ip, port) pairs learned through PEX since the last call"""
+        learned = self.pex_peers
+        self.pex_peers = []
+        return learned
+
+    def address(self):
+        return (self.peer_info['ip'], self.peer_info['port'])
+
+    def family(self) -> str:
+        """'ipv4' or 'ipv6', the label connect times are recorded under"""
+        return addresses.family_label(self.peer_info['ip'])
+
+    def can_request_piece(self, piece_index) -> bool:
+        return not self.choked or (self.fast_extension and piece_index in self.allowed_fast)
+
+    def can_download(self) -> bool:
+        """Whether there's any piece we could request from the peer right now"""
+        return not self.choked or (self.fast_extension and len(self.allowed_fast) > 0)
+
+    def abandon_piece(self):
+        self.abandoned_piece = self.download_state.piece_index
+        self.cancel_piece_download()
+
+    def take_abandoned_piece(self):
+        """Returns the piece given up on since the last call, or None"""
+        piece_index = self.abandoned_piece
+        self.abandoned_piece = None
+        return piece_index
     
     def send_block_requests(self, download_state):
         while self.num_queued_requests < self.MAX_QUEUED_REQUESTS:
             if not download_state.has_more_blocks_to_request():
                 break
-            next_request = download_state.get_next_block_request()
-            self.socket.send(next_request.serialize())
+            begin, length = download_state.take_next_block()
+            self.outbox += REQUEST_MESSAGE.pack(REQUEST_MESSAGE_LENGTH, REQUEST_ID,
+                    download_state.piece_index, begin, length)
             self.num_queued_requests += 1
 
-    def start_piece_download(self, piece_index, piece_length):
+    def start_piece_download(self, piece_index, piece_length, download_state=None):
+        """Starts downloading a piece. download_state carries on a PieceDownload, like one with
+        some of its blocks already known good, instead of starting from scratch."""
         assert(self.state == self.State.IDLE)
 
         if not self.peer_has_piece(piece_index):
             return
         
         self.state = self.State.DOWNLOADING
-        self.download_state = PieceDownload(piece_index, piece_length)
-        if not self.choked:
+        if download_state is None:
+            download_state = PieceDownload(piece_index, piece_length)
+        download_state.requeue_requested()
+        self.download_state = download_state
+        if self.can_request_piece(piece_index):
             self.send_block_requests(self.download_state)
     
     def is_idle(self):
@@ -396,6 +932,12 @@ class PeerConnection:
             print('Error: can\'t get piece bytes if download not complete')
             return None
         return self.download_state.piece_bytes
+
+    def get_piece_hash(self):
+        if not self.is_download_completed():
+            print('Error: can\'t get piece hash if download not complete')
+            return None
+        return self.download_state.digest()
     
     def get_current_piece_index(self):
         if not self.download_state:
@@ -408,8 +950,13 @@ class PeerConnection:
         # TODO close socket here?
         self.socket.close()
         self.buffer.clear()
+        self.outbox.clear()
         self.state = self.State.DISCONNECTED
 
+        if self.picker and self.available_pieces is not None:
+            self.picker.peer_lost(self.available_pieces)
+            self.available_pieces = None
+
     def is_download_completed(self):
         if not self.download_state:
             #print('Err: no initialized download')
@@ -433,44 +980,66 @@ class PeerConnection:
             self.validate_handshake()
         elif self.state == self.State.INIT_BITFIELD:
             message = PeerMessage.from_ring_buffer(self.buffer)
+            # Some clients send their extended handshake before the bitfield
+            while message and message.id == PeerMessage.Id.EXTENDED and self.extension_protocol:
+                self.handle_extended(message.payload)
+                message = PeerMessage.from_ring_buffer(self.buffer)
             if not message:
                 return
 
-            if message.id != PeerMessage.Id.BITFIELD:
+            if message.id == PeerMessage.Id.BITFIELD:
+                self.handle_bitfield(message.payload)
+            elif message.id == PeerMessage.Id.HAVE_ALL and self.fast_extension:
+                self.handle_have_all()
+            elif message.id == PeerMessage.Id.HAVE_NONE and self.fast_extension:
+                self.handle_have_none()
+            else:
                 print('Error! {} expected bitfield msg but got {}'.format(str(self), message.id))
                 self.set_disconnected()
                 return
-            
-            self.handle_bitfield(message.payload)
+
             self.state = self.State.IDLE
             self.socket.settimeout(None)
-            self.socket.send(PeerMessage(PeerMessage.Id.INTERESTED, None).serialize())
+            self.send_bytes(PeerMessage(PeerMessage.Id.INTERESTED, None).serialize())
 
     def handle_messages_from_buffer(self, handle_piece_message):
         if self.state == self.State.DISCONNECTED:
             return
 
-        # Parse all messages from buffer regardless of state
-        # Except Piece messages, which are only handled in downloading state
-        # and should be thrown away otherwise
-        while len(self.buffer) > 0:
-            message = PeerMessage.from_ring_buffer(self.buffer)
-            if message is None:
-                break
-
-            if PeerMessage.is_state_message(message.id):
-                self.handle_state_message(message.id)
-            elif message.id == PeerMessage.Id.BITFIELD:
-                self.handle_bitfield(message.payload)
-            elif message.id == PeerMessage.Id.HAVE:
-                self.handle_have(message.payload)
-            elif message.id == PeerMessage.Id.PIECE and handle_piece_message:
-                self.handle_piece(message.payload, self.download_state)
+        # Every complete message in the buffer at once, regardless of state. Except PIECEs,
+        # which are only handled in downloading state and thrown away otherwise. A run of HAVEs
+        # is one bitfield update.
+        frames = decode_frames(self.buffer)
+        handlers = self.message_handlers
+        haves = []
+        for message_id, payload in frames:
+            if message_id == HAVE_ID:
+                haves.append(payload)
+                continue
+            if haves:
+                self.handle_haves(haves)
+                haves = []
+            if message_id == PIECE_ID:
+                if handle_piece_message and self.download_state is not None:
+                    self.handle_piece(payload, self.download_state)
+                continue
+            handler = handlers.get(message_id)
+            if handler is not None:
+                handler(payload)
+        if haves:
+            self.handle_haves(haves)
+
+        for message_id, count in Counter(map(itemgetter(0), frames)).items():
+            self.engine_metrics.messages_received.inc(count,
+                    MESSAGE_TYPE_LABELS.get(message_id, UNKNOWN_MESSAGE_LABELS))
 
     def run_download_state(self):
         assert(self.state == self.State.DOWNLOADING)
         self.handle_messages_from_buffer(True)
-        if not self.choked:
+        if not self.is_downloading():
+            # Abandoned after a REJECT
+            return
+        if self.can_request_piece(self.download_state.piece_index):
             self.send_block_requests(self.download_state)
 
         if self.download_state.all_blocks_received():
@@ -493,12 +1062,19 @@ class PeerConnection:
             self.set_disconnected()
             return
 
+        self.bytes_received += len(recv)
         self.append_to_buffer(recv)
 
     def run_state_machine(self):
-        if self.state == self.State.INIT_HANDSHAKE or self.state == self.State.INIT_BITFIELD:
+        # The handshake and bitfield often arrive in the same read, so keep going until the init
+        # states stop making progress instead of waiting for another poll event
+        while self.state == self.State.INIT_HANDSHAKE or self.state == self.State.INIT_BITFIELD:
+            previous_state = self.state
             self.run_init_states()
-        elif self.state == self.State.IDLE:
+            if self.state == previous_state:
+                return
+
+        if self.state == self.State.IDLE:
             self.run_idle_state()
         elif self.state == self.State.DOWNLOADING:
             self.run_download_state()
@@ -511,13 +1087,15 @@ if __name__ == '__main__':
     tracker_response = tracker.send_ths_request(metainfo['announce'], info_hash,
             metainfo['info']['length'])
 
-    peer_info: Dict = tracker_response['peers'][random.randint(0, len(tracker_response['peers']))]
+    ip, port = random.choice(tracker.response_peers(tracker_response))
+    peer_info: Dict = {'ip': ip, 'port': port}
 
     print('piece length: {}'.format(metainfo['info']['piece length']))
     connection = PeerConnection(peer_info, info_hash, metainfo['info']['piece length'])
     connection.initialize_connection()
 
     while True:
+        connection.flush()
         read_len = connection.buffer.empty_space()
         recv = connection.socket.recv(4096)
         if len(recv) == 0:
@@ -537,6 +1115,7 @@ if __name__ == '__main__':
     connection.start_piece_download(42)
 
     while not connection.is_download_completed():
+        connection.flush()
         connection.read_from_socket()
         connection.run_download_state()
 
@@ -0,0 +1,100 @@
+"""
+Peer exchange (ut_pex, BEP 11), an extension protocol message (see extension.py).
+
+Connected peers tell each other which peers they've connected to ('added') and lost ('dropped')
+since their last PEX message, as compact addresses: IPv4 ones in 'added' and 'dropped', IPv6 ones
+in 'added6' and 'dropped6'. Per the spec a message goes out at most
+once a minute per connection and lists at most 50 added and 50 dropped peers. PexState keeps that
+bookkeeping for one connection.
+"""
+from typing import List, Optional, Set, Tuple
+import socket
+import time
+
+if __package__ is None or __package__ == '':
+    import addresses
+    import bencode
+    import extension
+    import peer
+else:
+    from . import addresses
+    from . import bencode
+    from . import extension
+    from . import peer
+
+EXTENSION_NAME: str = 'ut_pex'
+MIN_INTERVAL_S: float = 60.0
+MAX_PEERS_PER_MESSAGE: int = 50
+COMPACT_PEER_SIZE: int = 6
+# 'added.f' flag: we connected to this peer, so it accepts incoming connections
+FLAG_REACHABLE: int = 0x10
+
+def encode_peers(peers) -> bytes:
+    """Compact form of IPv4 (ip, port) pairs: 4 address bytes and 2 port bytes each"""
+    return addresses.encode_compact(peers)
+
+def decode_peers(data) -> List[Tuple[str, int]]:
+    return addresses.decode_compact(data)
+
+def pex_message(peer_extension_id, added, dropped) -> 'peer.PeerMessage':
+    added4, added6 = addresses.split_by_family(added)
+    dropped4, dropped6 = addresses.split_by_family(dropped)
+    body = {
+        'added': encode_peers(added4),
+        'added.f': bytes([FLAG_REACHABLE] * len(added4)),
+        'dropped': encode_peers(dropped4),
+    }
+    if added6 or dropped6:
+        body['added6'] = addresses.encode_compact(added6, socket.AF_INET6)
+        body['added6.f'] = bytes([FLAG_REACHABLE] * len(added6))
+        body['dropped6'] = addresses.encode_compact(dropped6, socket.AF_INET6)
+    return extension.message(peer_extension_id, bencode.encode(body))
+
+def parse_message(body) -> Tuple[List[Tuple[str, int]], List[Tuple[str, int]]]:
+    """Returns the (added, dropped) addresses of a ut_pex message, at most 50 of each"""
+    message = bencode.decode(body)
+    if not isinstance(message, dict):
+        raise ValueError('Malformed ut_pex message')
+    added = decode_peers(message.get('added', b'')) +\
+            addresses.decode_compact(message.get('added6', b''), socket.AF_INET6)
+    dropped = decode_peers(message.get('dropped', b'')) +\
+            addresses.decode_compact(message.get('dropped6', b''), socket.AF_INET6)
+    return added[:MAX_PEERS_PER_MESSAGE], dropped[:MAX_PEERS_PER_MESSAGE]
+
+class PexState:
+    """What we've told one peer so far, and when"""
+
+    def __init__(self):
+        # Addresses the peer has been told we're connected to
+        self.advertised: Set[Tuple[str, int]] = set()
+        self.last_sent: Optional[float] = None
+        self.last_received: Optional[float] = None
+
+    def is_due(self, now=None) -> bool:
+        now = time.monotonic() if now is None else now
+        return self.last_sent is None or now - self.last_sent >= MIN_INTERVAL_S
+
+    def next_update(self, connected, now=None) -> Optional[Tuple[List, List]]:
+        """(added, dropped) to send given the addresses we're connected to now, or None if
+        nothing changed or it's too soon"""
+        if not self.is_due(now):
+            return None
+        connected = set(connected)
+        added = sorted(connected - self.advertised)[:MAX_PEERS_PER_MESSAGE]
+        dropped = sorted(self.advertised - connected)[:MAX_PEERS_PER_MESSAGE]
+        if not added and not dropped:
+            return None
+        self.advertised.update(added)
+        self.advertised.difference_update(dropped)
+        self.last_sent = time.monotonic() if now is None else now
+        return added, dropped
+
+    def accept_message(self, now=None) -> bool:
+        """Whether to act on a message received now. Peers that send more often than the spec
+        allows only get one message per interval looked at."""
+        now = time.monotonic() if now is None else now
+        # Some slack, peers' timers aren't exact
+        if self.last_received is not None and now - self.last_received < MIN_INTERVAL_S / 2:
+            return False
+        self.last_received = now
+        return True
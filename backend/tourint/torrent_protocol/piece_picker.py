@@ -0,0 +1,163 @@
+"""
+Chooses which piece an idle peer should download next.
+
+Pieces with a deadline (the streaming window ahead of the read cursor, or ranges a reader is
+blocked on) always go first, earliest deadline first. Everything else is picked by priority and
+then rarest-first based on the bitfields and HAVEs received from connected peers. Pieces with
+priority SKIP are never picked.
+"""
+from typing import Dict, List, Optional
+import enum
+import random
+import threading
+import time
+
+class Priority(enum.IntEnum):
+    SKIP = 0
+    LOW = 1
+    NORMAL = 2
+    HIGH = 3
+
+    @classmethod
+    def from_name(cls, name):
+        try:
+            return cls[str(name).upper()]
+        except KeyError:
+            raise ValueError('Unknown priority {}, expected one of {}'
+                    .format(name, [p.name.lower() for p in cls]))
+
+class PiecePicker:
+    # Number of pieces ahead of the read cursor that get deadlines in streaming mode
+    DEFAULT_STREAMING_WINDOW: int = 16
+    # Deadline spacing between consecutive pieces in the streaming window
+    DEADLINE_STEP_S: float = 0.5
+
+    def __init__(self, num_pieces: int, streaming=False,
+                 streaming_window=DEFAULT_STREAMING_WINDOW):
+        self.num_pieces = num_pieces
+        # Number of connected peers that have each piece
+        self.availability: List[int] = [0] * num_pieces
+        self.priorities: List[Priority] = [Priority.NORMAL] * num_pieces
+        # piece index -> time.monotonic() deadline
+        self.deadlines: Dict[int, float] = {}
+
+        self.streaming = streaming
+        self.streaming_window = streaming_window
+        self.read_cursor = 0
+
+        self.lock = threading.Lock()
+        if streaming:
+            self.set_read_cursor(0)
+
+    def peer_bitfield(self, bitfield):
+        with self.lock:
+            for i in range(self.num_pieces):
+                if bitfield.contains(i):
+                    self.availability[i] += 1
+
+    def peer_have(self, piece_index):
+        with self.lock:
+            if 0 <= piece_index < self.num_pieces:
+                self.availability[piece_index] += 1
+
+    def peer_haves(self, piece_indices):
+        """peer_have for a run of HAVEs, under one lock"""
+        with self.lock:
+            for piece_index in piece_indices:
+                if 0 <= piece_index < self.num_pieces:
+                    self.availability[piece_index] += 1
+
+    def peer_lost(self, bitfield):
+        with self.lock:
+            for i in range(self.num_pieces):
+                if bitfield.contains(i) and self.availability[i] > 0:
+                    self.availability[i] -= 1
+
+    def set_priorities(self, priorities):
+        assert(len(priorities) == self.num_pieces)
+        with self.lock:
+            self.priorities = list(priorities)
+
+    def wanted(self, piece_index) -> bool:
+        return self.priorities[piece_index] != Priority.SKIP
+
+    def set_deadline(self, piece_index, deadline):
+        with self.lock:
+            current = self.deadlines.get(piece_index)
+            if current is None or deadline < current:
+                self.deadlines[piece_index] = deadline
+
+    def set_read_cursor(self, piece_index):
+        """Moves the streaming window so it starts at piece_index"""
+        now = time.monotonic()
+        with self.lock:
+            self.read_cursor = piece_index
+            if not self.streaming:
+                return
+            # Pieces behind the cursor are no longer urgent
+            self.deadlines = {i: d for i, d in self.deadlines.items() if i >= piece_index}
+            window_end = min(self.num_pieces, piece_index + self.streaming_window)
+            for i in range(piece_index, window_end):
+                if not self.wanted(i):
+                    continue
+                deadline = now + (i - piece_index) * self.DEADLINE_STEP_S
+                if i not in self.deadlines or deadline < self.deadlines[i]:
+                    self.deadlines[i] = deadline
+
+    def piece_completed(self, piece_index):
+        with self.lock:
+            self.deadlines.pop(piece_index, None)
+            advance = self.streaming and piece_index == self.read_cursor
+        if advance:
+            self.set_read_cursor(piece_index + 1)
+
+    def pick(self, candidates, peer_pieces, suggested=()) -> Optional[int]:
+        """Returns the best piece in candidates that the peer has, or None.
+
+        candidates is the set of pieces that still need to be assigned to a peer. suggested are
+        pieces the peer asked us to prefer (BEP 6 SUGGEST, e.g. because they're in its cache).
+        They win over rarer pieces of the same priority, but not over deadlines.
+        """
+        if peer_pieces is None:
+            return None
+
+        with self.lock:
+            urgent = sorted((d, i) for i, d in self.deadlines.items()
+                    if i in candidates and self.wanted(i))
+            for _, piece_index in urgent:
+                if peer_pieces.contains(piece_index):
+                    return piece_index
+
+            best = None
+            best_rank = None
+            num_ties = 0
+            for piece_index in candidates:
+                priority = self.priorities[piece_index]
+                if priority == Priority.SKIP or not peer_pieces.contains(piece_index):
+                    continue
+                rank = (-priority, self.availability[piece_index])
+                if best is None or rank < best_rank:
+                    best, best_rank, num_ties = piece_index, rank, 1
+                elif rank == best_rank:
+                    # Reservoir sample among equally rare pieces so peers don't all pile onto
+                    # the same one
+                    num_ties += 1
+                    if random.randrange(num_ties) == 0:
+                        best = piece_index
+
+            for piece_index in reversed(suggested):
+                if piece_index in candidates and peer_pieces.contains(piece_index) and\
+                        self.wanted(piece_index) and\
+                        (best is None or self.priorities[piece_index] >= self.priorities[best]):
+                    return piece_index
+            return best
+
+    def overdue_pieces(self, in_progress) -> List[int]:
+        """Pieces being downloaded whose deadline has passed, earliest first.
+
+        These are worth requesting from additional peers to cut the tail latency.
+        """
+        now = time.monotonic()
+        with self.lock:
+            return [i for d, i in sorted((d, i) for i, d in self.deadlines.items())
+                    if d < now and i in in_progress]
@@ -0,0 +1,143 @@
+"""
+Opt-in profiling of a running download.
+
+PhaseTimer adds up wall and CPU time per phase of the download (tracker, connect, parse, schedule,
+verify, write) while it's enabled. CPU time is per thread, so it's the time the phase itself used,
+not whatever else the process did meanwhile. Disabled, timing a phase costs an attribute check
+and a shared no-op context manager.
+
+Profiler runs the phase timers and, optionally, cProfile for a bounded window and then writes both
+out, one pair of files per window: <info hash>-<time>.prof (load it with pstats or snakeviz) and
+<info hash>-<time>.json with the phase totals. A window is opened by TorrentDownload(profile=True)
+for the whole download, or at runtime with control.Command.PROFILE.
+"""
+from typing import Dict, Optional, Sequence
+import cProfile
+import json
+import os
+import pathlib
+import time
+
+# Telemetry queue messages are (kind, info hash hex, payload)
+MESSAGE_KIND: str = 'profile'
+
+PHASES = ('tracker', 'connect', 'parse', 'send', 'schedule', 'verify', 'write')
+
+class Phase:
+    def __init__(self, totals):
+        # [wall seconds, cpu seconds, count] for this phase, updated in place
+        self.totals = totals
+
+    def __enter__(self):
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.thread_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.totals[0] += time.perf_counter() - self.wall_start
+        self.totals[1] += time.thread_time() - self.cpu_start
+        self.totals[2] += 1
+        return False
+
+class NullPhase:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_PHASE = NullPhase()
+
+class PhaseTimer:
+    def __init__(self, phases: Sequence[str] = PHASES):
+        self.phases = tuple(phases)
+        self.enabled = False
+        self.started_at = None
+        self.totals: Dict[str, list] = {}
+        self.reset()
+
+    def reset(self):
+        # Every phase exists up front, so threads timing different phases never resize the dict
+        self.totals = {name: [0.0, 0.0, 0] for name in self.phases}
+        self.started_at = time.perf_counter()
+
+    def start(self):
+        self.reset()
+        self.enabled = True
+
+    def stop(self) -> Dict:
+        self.enabled = False
+        return self.summary()
+
+    def phase(self, name):
+        """Context manager timing one pass through the phase, e.g. with timer.phase('verify'):"""
+        if not self.enabled:
+            return NULL_PHASE
+        return Phase(self.totals[name])
+
+    def summary(self) -> Dict:
+        return {
+            'window_s': time.perf_counter() - self.started_at,
+            'phases': {name: {'wall_s': wall_s, 'cpu_s': cpu_s, 'count': count}
+                for name, (wall_s, cpu_s, count) in self.totals.items()},
+        }
+
+class Profiler:
+    # Longest window a PROFILE command can ask for
+    MAX_DURATION_S: float = 600.0
+
+    def __init__(self, phase_timer: PhaseTimer, directory, name):
+        self.phase_timer = phase_timer
+        self.directory = pathlib.Path(directory)
+        # File name prefix, the info hash in hex
+        self.name = name
+        self.profile = None
+        self.active = False
+        # perf_counter time the window ends at, None to run until stop()
+        self.deadline = None
+
+    def start(self, duration_s: Optional[float] = None, use_cprofile=True) -> bool:
+        """Opens a profiling window. Returns False if one is already open."""
+        if self.active:
+            return False
+        if duration_s is not None:
+            duration_s = min(max(0.0, duration_s), self.MAX_DURATION_S)
+            self.deadline = time.perf_counter() + duration_s
+        else:
+            self.deadline = None
+
+        self.profile = None
+        if use_cprofile:
+            profile = cProfile.Profile()
+            try:
+                # Profiles the calling thread, i.e. the download loop
+                profile.enable()
+                self.profile = profile
+            except ValueError as e:
+                # Another profiler is already attached to this process
+                print('Not starting cProfile: {}'.format(e))
+        self.phase_timer.start()
+        self.active = True
+        return True
+
+    def expired(self) -> bool:
+        return self.active and self.deadline is not None and time.perf_counter() >= self.deadline
+
+    def stop(self) -> Dict:
+        """Closes the window, writes its files and returns the phase summary with their paths"""
+        assert(self.active)
+        self.active = False
+        summary = self.phase_timer.stop()
+        if self.profile is not None:
+            self.profile.disable()
+
+        os.makedirs(self.directory.as_posix(), exist_ok=True)
+        prefix = self.directory/'{}-{}'.format(self.name, time.strftime('%Y%m%d-%H%M%S'))
+        if self.profile is not None:
+            summary['profile_path'] = str(prefix) + '.prof'
+            self.profile.dump_stats(summary['profile_path'])
+            self.profile = None
+        summary['phases_path'] = str(prefix) + '.json'
+        with open(summary['phases_path'], 'w') as f:
+            json.dump(summary, f, indent=2)
+        return summary
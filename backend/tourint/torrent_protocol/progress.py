@@ -0,0 +1,96 @@
+"""
+Throttled progress reporting for downloads.
+
+The download loop records its counters with ProgressReporter.update(), which only touches an
+in-memory dict. A background thread hands the fields that changed since the last flush to a sink
+(e.g. a database writer) once enough time has passed or enough bytes have been downloaded, so
+slow sinks never stall the network loop.
+"""
+from typing import Any, Callable, Dict
+import threading
+import time
+
+class ProgressReporter(threading.Thread):
+    DEFAULT_INTERVAL_S: float = 2.0
+    # Flush early once this many more bytes are downloaded, even if interval_s hasn't passed
+    DEFAULT_MIN_BYTES_DELTA: int = 64 * 1024 * 1024
+    # Never flush more often than this, whatever the byte delta
+    MIN_FLUSH_SPACING_S: float = 0.25
+
+    def __init__(self, sink: Callable[[Dict[str, Any]], None], interval_s=DEFAULT_INTERVAL_S,
+                 min_bytes_delta=DEFAULT_MIN_BYTES_DELTA):
+        threading.Thread.__init__(self, name='ProgressReporter', daemon=True)
+        self.sink = sink
+        self.interval_s = interval_s
+        self.min_bytes_delta = min_bytes_delta
+
+        self.current: Dict[str, Any] = {}
+        self.flushed: Dict[str, Any] = {}
+        self.last_flush_time = 0.0
+
+        self.closing = False
+        self.condition = threading.Condition()
+
+    def update(self, **fields):
+        """Records new values for some fields. Cheap enough to call from the download loop."""
+        with self.condition:
+            self.current.update(fields)
+            downloaded = self.current.get('downloaded_bytes', 0)
+            if downloaded - self.flushed.get('downloaded_bytes', 0) >= self.min_bytes_delta:
+                self.condition.notify()
+
+    def changed_fields(self) -> Dict[str, Any]:
+        return {k: v for k, v in self.current.items()
+                if k not in self.flushed or self.flushed[k] != v}
+
+    def flush(self):
+        with self.condition:
+            changed = self.changed_fields()
+            self.flushed.update(changed)
+            self.last_flush_time = time.monotonic()
+        if changed:
+            self.sink(changed)
+
+    def close(self):
+        """Stops the reporter thread and flushes whatever hasn't been reported yet"""
+        with self.condition:
+            self.closing = True
+            self.condition.notify()
+        if self.is_alive():
+            self.join()
+        self.flush()
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait(self.interval_s)
+                if self.closing:
+                    return
+                if time.monotonic() - self.last_flush_time < self.MIN_FLUSH_SPACING_S:
+                    continue
+            try:
+                self.flush()
+            except Exception as e:
+                # The next flush retries with everything that's still different
+                print('Progress flush failed: {}'.format(e))
+                with self.condition:
+                    self.flushed = {}
+
+class QueueSink:
+    """Sink that forwards progress to another process as (kind, key, changed fields) tuples.
+
+    kind lets one queue carry other messages too, e.g. engine snapshots. With a run_id, every
+    update also carries it as RUN_ID_FIELD, so the receiver can tell runs of the same key apart.
+    """
+    KIND: str = 'progress'
+    RUN_ID_FIELD: str = 'run_id'
+
+    def __init__(self, queue, key, run_id=None):
+        self.queue = queue
+        self.key = key
+        self.run_id = run_id
+
+    def __call__(self, changed):
+        if self.run_id is not None:
+            changed = dict(changed, **{self.RUN_ID_FIELD: self.run_id})
+        self.queue.put((self.KIND, self.key, changed))
@@ -27,6 +27,14 @@ class RingBuffer:
 
         return ret
 
+    def contiguous(self) -> memoryview:
+        """All the buffered bytes as one memoryview. If they wrap around the end of the buffer
+        they're moved to the start first."""
+        if self.read_index + self.count > self.capacity:
+            self.buffer[:self.count] = self.peek(self.count)
+            self.read_index = 0
+        return memoryview(self.buffer)[self.read_index:self.read_index + self.count]
+
     def remove(self, num_bytes):
         self.read_index = (self.read_index + num_bytes) % self.capacity 
         self.count -= num_bytes
@@ -0,0 +1,263 @@
+"""
+A bottleneck link on 127.0.0.1, for comparing how TCP and uTP behave behind a slow uplink.
+
+Loopback has no queue to fill, so this puts one in: a relay that forwards the sender's data at
+rate_bps through a buffer of buffer_bytes, like a home router. It records how long everything
+waited in that buffer. TCP keeps the buffer full, so a bulk transfer adds buffer/rate of delay
+to everything sharing the link. uTP's LEDBAT backs off once it sees itself adding about
+utp.CCONTROL_TARGET_US. Data goes through the link, ACKs come back directly.
+
+    python -m simulator.bottleneck --rate-mbps 32 --buffer-kb 1024 --size-mb 8
+"""
+from typing import Dict, List
+import argparse
+import json
+import socket
+import statistics
+import threading
+import time
+
+import utp
+
+class Link:
+    """A FIFO drained at rate_bps. Packets that don't fit in the buffer are dropped."""
+
+    def __init__(self, rate_bps, buffer_bytes, forward):
+        self.rate_bps = rate_bps
+        self.buffer_bytes = buffer_bytes
+        # Called with each packet as it leaves the link
+        self.forward = forward
+        self.busy_until = 0.0
+        self.queue = []
+        self.queue_delays: List[float] = []
+        self.dropped = 0
+        self.condition = threading.Condition()
+        self.closed = False
+        self.thread = threading.Thread(target=self.drain, name='Link', daemon=True)
+        self.thread.start()
+
+    def queued_bytes(self, now) -> float:
+        return max(0.0, self.busy_until - now) * self.rate_bps
+
+    def has_room(self, size) -> bool:
+        return self.queued_bytes(time.monotonic()) + size <= self.buffer_bytes
+
+    def enqueue(self, packet) -> bool:
+        now = time.monotonic()
+        with self.condition:
+            if self.queued_bytes(now) + len(packet) > self.buffer_bytes:
+                self.dropped += 1
+                return False
+            start = max(now, self.busy_until)
+            self.queue_delays.append(start - now)
+            self.busy_until = start + len(packet) / self.rate_bps
+            self.queue.append((self.busy_until, packet))
+            self.condition.notify()
+        return True
+
+    def drain(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                departure, packet = self.queue[0]
+            wait_s = departure - time.monotonic()
+            if wait_s > 0:
+                time.sleep(wait_s)
+            with self.condition:
+                self.queue.pop(0)
+            self.forward(packet)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+
+class UdpBottleneck:
+    """Relays datagrams to server_address. Whoever isn't the server is the sender."""
+
+    def __init__(self, server_address, rate_bps, buffer_bytes):
+        self.server_address = server_address
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(('127.0.0.1', 0))
+        self.socket.settimeout(0.1)
+        self.port = self.socket.getsockname()[1]
+        self.client_address = None
+        self.link = Link(rate_bps, buffer_bytes,
+                lambda packet: self.socket.sendto(packet, self.server_address))
+        self.closed = False
+        self.thread = threading.Thread(target=self.relay, name='UdpBottleneck', daemon=True)
+        self.thread.start()
+
+    def relay(self):
+        while not self.closed:
+            try:
+                packet, address = self.socket.recvfrom(65536)
+            except socket.timeout:
+                continue
+            if address == self.server_address:
+                if self.client_address is not None:
+                    self.socket.sendto(packet, self.client_address)
+            else:
+                self.client_address = address
+                self.link.enqueue(packet)
+
+    def close(self):
+        self.closed = True
+        self.thread.join()
+        self.link.close()
+        self.socket.close()
+
+class TcpBottleneck:
+    """Accepts one connection and relays it to server_address. TCP doesn't drop, so the relay
+    stops reading while the buffer is full and the sender's own buffers fill up behind it."""
+
+    CHUNK_SIZE: int = utp.MAX_PAYLOAD
+
+    def __init__(self, server_address, rate_bps, buffer_bytes):
+        self.server_address = server_address
+        self.listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listen_socket.bind(('127.0.0.1', 0))
+        self.listen_socket.listen(1)
+        self.port = self.listen_socket.getsockname()[1]
+        self.link = None
+        self.server = None
+        self.thread = threading.Thread(target=self.relay, name='TcpBottleneck', daemon=True)
+        self.rate_bps = rate_bps
+        self.buffer_bytes = buffer_bytes
+        self.thread.start()
+
+    def relay(self):
+        client, _ = self.listen_socket.accept()
+        self.server = socket.create_connection(self.server_address)
+        for s in (client, self.server):
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.link = Link(self.rate_bps, self.buffer_bytes, self.forward)
+        threading.Thread(target=self.pump_back, args=(client,), daemon=True).start()
+        while True:
+            while not self.link.has_room(self.CHUNK_SIZE):
+                time.sleep(self.CHUNK_SIZE / self.rate_bps)
+            data = client.recv(self.CHUNK_SIZE)
+            if not data:
+                break
+            self.link.enqueue(data)
+        # Everything queued goes out before the server sees EOF
+        self.link.enqueue(b'')
+
+    def forward(self, data):
+        if data:
+            self.server.sendall(data)
+        else:
+            self.server.shutdown(socket.SHUT_WR)
+
+    def pump_back(self, client):
+        while True:
+            data = self.server.recv(65536)
+            if not data:
+                client.close()
+                return
+            client.sendall(data)
+
+    def close(self):
+        self.thread.join()
+        if self.link is not None:
+            self.link.close()
+        self.listen_socket.close()
+
+def receive_all(sock, result):
+    received = 0
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            break
+        received += len(data)
+    result['received'] = received
+    result['finished'] = time.perf_counter()
+    sock.sendall(b'done')
+    sock.close()
+
+def send_all(sock, size_bytes):
+    chunk = bytes(64 * 1024)
+    remaining = size_bytes
+    while remaining:
+        sent = sock.send(chunk[:remaining])
+        remaining -= sent
+    sock.shutdown(socket.SHUT_WR)
+    sock.recv(16)
+    sock.close()
+
+def run_transfer(transport, size_bytes, rate_bps, buffer_bytes) -> Dict:
+    """Sends size_bytes through a bottleneck over transport ('tcp' or 'utp')"""
+    result = {}
+    if transport == 'tcp':
+        listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listen_socket.bind(('127.0.0.1', 0))
+        listen_socket.listen(1)
+        bottleneck = TcpBottleneck(listen_socket.getsockname(), rate_bps, buffer_bytes)
+        sender = socket.create_connection(('127.0.0.1', bottleneck.port))
+        receiver, _ = listen_socket.accept()
+        listen_socket.close()
+    else:
+        server = utp.UtpMultiplexer('127.0.0.1', 0, listen=True)
+        client = utp.UtpMultiplexer('127.0.0.1', 0)
+        bottleneck = UdpBottleneck(('127.0.0.1', server.port), rate_bps, buffer_bytes)
+        sender = client.create_stream()
+        sender.connect(('127.0.0.1', bottleneck.port))
+        receiver, _ = server.accept(timeout=utp.CONNECT_TIMEOUT_S)
+
+    receiver_thread = threading.Thread(target=receive_all, args=(receiver, result))
+    receiver_thread.start()
+    start = time.perf_counter()
+    send_all(sender, size_bytes)
+    receiver_thread.join()
+    elapsed = result['finished'] - start
+
+    if transport == 'utp':
+        client.close()
+        server.close()
+    bottleneck.close()
+
+    delays = bottleneck.link.queue_delays
+    return {
+        'transport': transport,
+        'received_bytes': result['received'],
+        'seconds': elapsed,
+        'throughput_bps': result['received'] / elapsed,
+        'link_utilization': result['received'] / elapsed / rate_bps,
+        'queue_delay_median_s': statistics.median(delays),
+        'queue_delay_p95_s': statistics.quantiles(delays, n=20)[-1],
+        'dropped_packets': bottleneck.link.dropped,
+    }
+
+def compare_transports(size_bytes=8 * 1024 * 1024, rate_bps=4 * 1024 * 1024,
+                       buffer_bytes=1024 * 1024) -> Dict:
+    return {transport: run_transfer(transport, size_bytes, rate_bps, buffer_bytes)
+            for transport in ('tcp', 'utp')}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare TCP and uTP behind a bottleneck link')
+    parser.add_argument('--rate-mbps', type=float, default=32)
+    parser.add_argument('--buffer-kb', type=int, default=1024)
+    parser.add_argument('--size-mb', type=float, default=8)
+    parser.add_argument('--output', help='write the report to this JSON file')
+    args = parser.parse_args(argv)
+
+    report = compare_transports(int(args.size_mb * 1024 * 1024), args.rate_mbps * 1e6 / 8,
+            args.buffer_kb * 1024)
+    for result in report.values():
+        print('{}: {:.1f} MB/s ({:.0%} of the link), queuing delay median {:.0f} ms, '
+                'p95 {:.0f} ms, {} dropped'.format(result['transport'],
+                result['throughput_bps'] / 1e6, result['link_utilization'],
+                result['queue_delay_median_s'] * 1000, result['queue_delay_p95_s'] * 1000,
+                result['dropped_packets']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    return 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
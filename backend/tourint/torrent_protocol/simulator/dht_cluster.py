@@ -0,0 +1,56 @@
+"""
+A cluster of DHT nodes on 127.0.0.1 for the loopback simulator.
+
+Every node runs on one event loop in a background thread. Each one bootstraps off the first and
+then refreshes all its buckets, so after start() they know each other well enough for lookups to
+find what another node announced.
+"""
+from typing import List, Tuple
+import asyncio
+import threading
+
+import dht
+
+class DhtCluster:
+    TIMEOUT_S: float = 30.0
+
+    def __init__(self, num_nodes):
+        self.num_nodes = num_nodes
+        self.nodes: List[dht.DhtNode] = []
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='DhtCluster',
+                daemon=True)
+
+    @property
+    def addresses(self) -> List[Tuple[str, int]]:
+        return [('127.0.0.1', node.port) for node in self.nodes]
+
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(self.TIMEOUT_S)
+
+    def start(self):
+        self.thread.start()
+        self.run(self.start_nodes())
+
+    async def start_nodes(self):
+        for _ in range(self.num_nodes):
+            node = dht.DhtNode()
+            await node.start('127.0.0.1')
+            self.nodes.append(node)
+        await asyncio.gather(*(node.bootstrap(self.addresses[:1]) for node in self.nodes[1:]))
+        # Nodes that bootstrapped early only saw part of the cluster. Refreshing every bucket
+        # fills in their routing tables, like the periodic refreshes of a long running node.
+        await asyncio.gather(*(node.refresh(0) for node in self.nodes))
+
+    def announce(self, info_hash, port, node_index=0) -> int:
+        """Announces a peer on 127.0.0.1:port from one of the nodes, the way a seeder would"""
+        return self.run(self.nodes[node_index].announce_peer(info_hash, port))
+
+    def lookup(self, info_hash, node_index=-1) -> dht.LookupResult:
+        return self.run(self.nodes[node_index].get_peers(info_hash))
+
+    def stop(self):
+        for node in self.nodes:
+            self.loop.call_soon_threadsafe(node.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(self.TIMEOUT_S)
@@ -0,0 +1,258 @@
+"""
+End-to-end throughput test of TorrentDownload against a local swarm, no internet needed.
+
+Run from the torrent_protocol directory:
+
+    python -m simulator.harness --peers 4 --size-mb 32 --latency-ms 10 --output result.json
+
+A synthetic torrent is generated, N seeders and a tracker are started on 127.0.0.1, and a
+TorrentDownload runs in its own process exactly as it would when started from the web app. The
+report covers throughput, time to complete and CPU seconds per MB spent by the download process,
+and the downloaded files are checked against the generated content.
+
+With --magnet the download starts from a magnet link instead: the info dict is fetched from the
+seeders over ut_metadata first, and the report adds how long that took.
+
+With --dht-nodes N, a cluster of N DHT nodes runs on 127.0.0.1 as well, the seeders are announced
+in it, and the download uses it. Add --tracker-down to make the DHT the only way to find them.
+
+With --hybrid the torrent is a hybrid v1/v2 one (BEP 52), so the download checks blocks against
+Merkle trees. Combined with --corrupt and --corrupt-seeders it shows bad blocks being fetched
+again one by one and the seeders that sent them being dropped.
+
+With --ipv6 the seeders listen on ::1 as well and the tracker hands out both of their addresses,
+so the download races IPv6 and IPv4 connections to each seeder and keeps whichever handshakes
+first.
+"""
+from typing import Dict
+import argparse
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+
+import dht
+import disk_io
+import magnet
+import metadata
+import torrent_download
+from simulator.dht_cluster import DhtCluster
+from simulator.local_tracker import LocalTracker
+from simulator.seeder import Seeder, SeederConfig
+from simulator.torrent_gen import generate_torrent
+
+class Swarm:
+    """A local tracker plus seeders for one synthetic torrent.
+
+    Only the first num_announced seeders are on the tracker, the rest can only be found through
+    PEX (see SeederConfig.pex).
+    """
+
+    def __init__(self, torrent, num_peers, config: SeederConfig, tracker: LocalTracker,
+                 num_announced=None):
+        self.torrent = torrent
+        self.tracker = tracker
+        self.seeders = [Seeder(torrent, config, index=i) for i in range(num_peers)]
+        for seeder in self.seeders[:num_announced]:
+            tracker.add_peer(torrent.info_hash, seeder.peer_id, seeder.port)
+            if config.ipv6:
+                tracker.add_peer(torrent.info_hash, seeder.peer_id, seeder.port, ip='::1')
+        for seeder in self.seeders:
+            seeder.pex_ports = [s.port for s in self.seeders if s is not seeder]
+
+    def start(self):
+        for seeder in self.seeders:
+            seeder.start()
+
+    def stop(self):
+        for seeder in self.seeders:
+            seeder.stop()
+
+    def stats(self) -> Dict:
+        totals: Dict = {}
+        for seeder in self.seeders:
+            for name, count in seeder.stats.as_dict().items():
+                totals[name] = totals.get(name, 0) + count
+        return totals
+
+def verify_output(torrent, output_directory) -> bool:
+    layout = disk_io.FileLayout(torrent.info, output_directory)
+    for path, length, offset in layout.files:
+        if not os.path.exists(path):
+            return False
+        with open(path, 'rb') as f:
+            if f.read() != torrent.content[offset:offset+length]:
+                return False
+    return True
+
+def child_cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def run_simulation(num_peers=4, size_bytes=32 * 1024 * 1024, piece_length=262144, num_files=1,
+                   config=None, timeout_s=300, seed=0, work_directory=None, use_magnet=False,
+                   num_announced=None, dht_nodes=0, tracker_down=False, peer_transport='tcp',
+                   hybrid=False, trackerless=False, **download_kwargs) -> Dict:
+    """Runs one download against a fresh local swarm and returns the report.
+
+    With use_magnet and trackerless, the magnet link has no trackers, so its metadata and peers
+    are found through the DHT, and so is the .torrent file made from it. Needs dht_nodes.
+    """
+    config = config or SeederConfig(seed=seed, extension_protocol=use_magnet,
+            utp=peer_transport == 'utp')
+    with tempfile.TemporaryDirectory(dir=work_directory) as directory:
+        tracker = LocalTracker()
+        tracker.start()
+        # Nothing listens on port 1
+        announce_url = 'http://127.0.0.1:1/announce' if tracker_down else tracker.announce_url
+        torrent = generate_torrent(directory, announce_url, size_bytes, piece_length,
+                num_files=num_files, seed=seed, hybrid=hybrid)
+        swarm = Swarm(torrent, num_peers, config, tracker, num_announced)
+        swarm.start()
+
+        cluster = None
+        if dht_nodes:
+            cluster = DhtCluster(dht_nodes)
+            cluster.start()
+            for index, seeder in enumerate(swarm.seeders):
+                cluster.announce(torrent.info_hash, seeder.port, index % dht_nodes)
+            download_kwargs.update(dht_enabled=True, dht_bootstrap=cluster.addresses[:1])
+
+        torrent_file = torrent.torrent_file
+        metadata_seconds = None
+        if use_magnet:
+            start = time.perf_counter()
+            link = magnet.parse(torrent.magnet_uri([] if trackerless else [tracker.announce_url]))
+            if trackerless:
+                link.peers.extend({'ip': ip, 'port': port} for ip, port
+                        in dht.lookup_peers(torrent.info_hash, cluster.addresses[:1]))
+            info_bytes = metadata.fetch_metadata(link, timeout_s)
+            metadata_seconds = time.perf_counter() - start
+            torrent_file = os.path.join(directory, 'magnet.torrent')
+            with open(torrent_file, 'wb') as f:
+                f.write(magnet.torrent_file_bytes(info_bytes, link.trackers))
+
+        output_directory = os.path.join(directory, 'output')
+        download = torrent_download.TorrentDownload(torrent_file,
+                output_directory=output_directory, peer_transport=peer_transport,
+                **download_kwargs)
+
+        cpu_before = child_cpu_seconds()
+        start = time.perf_counter()
+        download.start()
+        download.join(timeout_s)
+        elapsed = time.perf_counter() - start
+        timed_out = download.is_alive()
+        if timed_out:
+            download.terminate()
+            download.join()
+        cpu_seconds = child_cpu_seconds() - cpu_before
+
+        swarm.stop()
+        tracker.stop()
+        if cluster is not None:
+            cluster.stop()
+
+        completed = not timed_out and download.exitcode == 0
+        size_mb = size_bytes / 1e6
+        return {
+            'completed': completed,
+            'verified': completed and verify_output(torrent, output_directory),
+            'timed_out': timed_out,
+            'exitcode': download.exitcode,
+            'peers': num_peers,
+            'seeders_connected': sum(1 for s in swarm.seeders if s.stats.connections > 0),
+            'size_bytes': size_bytes,
+            'piece_length': piece_length,
+            'num_files': num_files,
+            'seconds': elapsed,
+            'metadata_seconds': metadata_seconds,
+            'throughput_mb_per_s': size_mb / elapsed if completed else 0.0,
+            'cpu_seconds': cpu_seconds,
+            'cpu_seconds_per_mb': cpu_seconds / size_mb,
+            'announces': tracker.num_announces,
+            'dht_nodes': dht_nodes,
+            'peer_transport': peer_transport,
+            'hybrid': hybrid,
+            'seeders': swarm.stats(),
+            'config': vars(config),
+        }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--peers', type=int, default=4)
+    parser.add_argument('--size-mb', type=float, default=32)
+    parser.add_argument('--piece-kb', type=int, default=256)
+    parser.add_argument('--files', type=int, default=1)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--bandwidth-mbps', type=float, default=0,
+            help='upload limit per seeder connection in megabits/s, 0 for unlimited')
+    parser.add_argument('--choke-interval-s', type=float, default=0)
+    parser.add_argument('--choke-duration-s', type=float, default=1)
+    parser.add_argument('--corrupt', type=float, default=0,
+            help='probability that a block is sent corrupted')
+    parser.add_argument('--corrupt-seeders', type=int, default=None,
+            help='how many of the seeders send corrupted blocks, all of them by default')
+    parser.add_argument('--hybrid', action='store_true',
+            help='generate a hybrid v1/v2 torrent (BEP 52) with Merkle trees')
+    parser.add_argument('--fast-extension', action='store_true',
+            help='seeders offer the fast extension (BEP 6)')
+    parser.add_argument('--allowed-fast', type=int, default=0,
+            help='pieces each seeder lets the downloader have while choked')
+    parser.add_argument('--unchoke-delay-ms', type=float, default=0)
+    parser.add_argument('--magnet', action='store_true',
+            help='start from a magnet link, fetching the metadata from the seeders')
+    parser.add_argument('--pex', action='store_true',
+            help='seeders tell the downloader about each other over ut_pex (BEP 11)')
+    parser.add_argument('--announced', type=int, default=None,
+            help='seeders the tracker knows about, the rest are only found through PEX')
+    parser.add_argument('--dht-nodes', type=int, default=0,
+            help='run a local DHT of this many nodes and announce the seeders in it')
+    parser.add_argument('--tracker-down', action='store_true',
+            help='point the torrent at a tracker that does not exist')
+    parser.add_argument('--transport', choices=['tcp', 'utp'], default='tcp',
+            help='what the download connects to the seeders over')
+    parser.add_argument('--ipv6', action='store_true',
+            help='seeders listen on ::1 as well as 127.0.0.1 and are announced at both')
+    parser.add_argument('--streaming', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--timeout-s', type=float, default=300)
+    parser.add_argument('--output', help='write the report to this JSON file')
+    args = parser.parse_args(argv)
+
+    config = SeederConfig(latency_s=args.latency_ms / 1000,
+            bandwidth_bps=args.bandwidth_mbps * 1e6 / 8, choke_interval_s=args.choke_interval_s,
+            choke_duration_s=args.choke_duration_s, corrupt_probability=args.corrupt,
+            seed=args.seed, fast_extension=args.fast_extension, allowed_fast=args.allowed_fast,
+            unchoke_delay_s=args.unchoke_delay_ms / 1000, extension_protocol=args.magnet,
+            pex=args.pex, utp=args.transport == 'utp', corrupt_seeders=args.corrupt_seeders,
+            ipv6=args.ipv6)
+
+    report = run_simulation(num_peers=args.peers, size_bytes=int(args.size_mb * 1024 * 1024),
+            piece_length=args.piece_kb * 1024, num_files=args.files, config=config,
+            timeout_s=args.timeout_s, seed=args.seed, use_magnet=args.magnet,
+            num_announced=args.announced, dht_nodes=args.dht_nodes,
+            tracker_down=args.tracker_down, peer_transport=args.transport,
+            hybrid=args.hybrid, streaming=args.streaming)
+
+    print()
+    print('completed:        {} (verified: {})'.format(report['completed'], report['verified']))
+    if report['metadata_seconds'] is not None:
+        print('metadata fetch:   {:.2f} s'.format(report['metadata_seconds']))
+    print('time to complete: {:.2f} s'.format(report['seconds']))
+    print('throughput:       {:.1f} MB/s'.format(report['throughput_mb_per_s']))
+    print('cpu per MB:       {:.2f} ms'.format(report['cpu_seconds_per_mb'] * 1000))
+    print('seeders used:     {} / {}'.format(report['seeders_connected'], report['peers']))
+    print('seeders:          {}'.format(report['seeders']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    return 0 if report['verified'] else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
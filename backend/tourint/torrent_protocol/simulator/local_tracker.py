@@ -0,0 +1,89 @@
+"""
+A minimal HTTP tracker that hands out the simulator's seeders, as compact 'peers' and 'peers6'
+strings when the announce asks for compact=1 and as a list of dicts otherwise.
+"""
+from typing import Dict, List
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import socket
+import threading
+
+import addresses
+import bencode
+
+class LocalTracker:
+    """Serves announce requests on 127.0.0.1 with a fixed list of peers per info hash"""
+
+    def __init__(self, interval_s=1800):
+        self.interval_s = interval_s
+        # info hash -> list of peer dicts in the non-compact format
+        self.swarms: Dict[bytes, List[Dict]] = {}
+        self.num_announces = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.make_handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name='LocalTracker',
+                daemon=True)
+
+    @property
+    def announce_url(self) -> str:
+        return 'http://127.0.0.1:{}/announce'.format(self.server.server_address[1])
+
+    def add_peer(self, info_hash, peer_id, port, ip='127.0.0.1'):
+        with self.lock:
+            self.swarms.setdefault(bytes(info_hash), []).append({
+                'peer id': peer_id,
+                'ip': ip,
+                'port': port,
+            })
+
+    def announce(self, info_hash, compact=False) -> bytes:
+        with self.lock:
+            self.num_announces += 1
+            if info_hash not in self.swarms:
+                return bencode.encode({'failure reason': 'unknown info hash'})
+            peers = list(self.swarms[info_hash])
+            response = {
+                'interval': self.interval_s,
+                'complete': len(peers),
+                'incomplete': 0,
+                'peers': peers,
+            }
+            if compact:
+                ipv4, ipv6 = addresses.split_by_family([(p['ip'], p['port']) for p in peers])
+                response['peers'] = addresses.encode_compact(ipv4)
+                response['peers6'] = addresses.encode_compact(ipv6, socket.AF_INET6)
+            return bencode.encode(response)
+
+    def make_handler(self):
+        local_tracker = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path != '/announce':
+                    self.send_error(404)
+                    return
+
+                # info_hash is raw bytes, percent-encoded. latin-1 maps each byte to one char.
+                query = parse_qs(url.query, encoding='latin-1')
+                info_hash = query.get('info_hash', [''])[0].encode('latin-1')
+                body = local_tracker.announce(info_hash, query.get('compact', [''])[0] == '1')
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
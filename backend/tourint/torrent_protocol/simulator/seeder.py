@@ -0,0 +1,427 @@
+"""
+Seeder peers for the loopback simulator.
+
+Each Seeder listens on 127.0.0.1 and serves every piece of a SyntheticTorrent. Per connection, a
+reader thread parses requests and a writer thread sends the blocks back, which is where latency,
+bandwidth limits, periodic choking and corrupted data are injected. Seeders can also speak the fast
+extension (BEP 6): HAVE_ALL, Allowed Fast pieces served while choked, and REJECTs, and serve the
+info dict over ut_metadata (BEP 9) so magnet links can be tested, and tell downloaders about the
+other seeders over ut_pex (BEP 11). With SeederConfig.utp they also accept uTP connections (BEP 29)
+on the same port number. For hybrid torrents they set the v2 bit and answer hash requests (BEP 52).
+With SeederConfig.ipv6 they listen on ::1 too, so downloads can reach them over either family.
+"""
+from collections import deque
+import queue
+import random
+import socket
+import threading
+import time
+
+import bencode
+import extension
+import merkle
+import metadata
+import peer
+import pex
+import utp
+
+# Our ids for ut_metadata and ut_pex. Deliberately not the downloader's, ids are per direction.
+METADATA_EXTENSION_ID: int = 3
+PEX_EXTENSION_ID: int = 4
+
+class SeederConfig:
+    def __init__(self, latency_s=0.0, bandwidth_bps=0, choke_interval_s=0.0,
+                 choke_duration_s=1.0, corrupt_probability=0.0, seed=0, fast_extension=False,
+                 allowed_fast=0, unchoke_delay_s=0.0, extension_protocol=False, pex=False,
+                 utp=False, corrupt_seeders=None, ipv6=False):
+        # One-way delay added before answering each request
+        self.latency_s = latency_s
+        # Upload limit per connection in bytes/s, 0 for unlimited
+        self.bandwidth_bps = bandwidth_bps
+        # Every choke_interval_s the seeder chokes for choke_duration_s, dropping queued
+        # requests like a real peer would. 0 disables choking.
+        self.choke_interval_s = choke_interval_s
+        self.choke_duration_s = choke_duration_s
+        # Chance that any given block is sent with a flipped byte, by the first corrupt_seeders
+        # seeders or by all of them if None
+        self.corrupt_probability = corrupt_probability
+        self.corrupt_seeders = corrupt_seeders
+        self.seed = seed
+        # Offer the fast extension. If the downloader takes it, send HAVE_ALL instead of a
+        # bitfield, REJECT requests instead of dropping them, and offer allowed_fast pieces.
+        self.fast_extension = fast_extension
+        self.allowed_fast = allowed_fast
+        # Time between INTERESTED and UNCHOKE
+        self.unchoke_delay_s = unchoke_delay_s
+        # Offer the extension protocol (BEP 10) and serve the info dict over ut_metadata
+        self.extension_protocol = extension_protocol
+        # Send each downloader one PEX message listing the swarm's other seeders. Also offers
+        # the extension protocol, without ut_metadata unless extension_protocol is set.
+        self.pex = pex
+        # Accept uTP connections as well as TCP ones
+        self.utp = utp
+        # Accept connections on ::1 as well, on the same port number
+        self.ipv6 = ipv6
+
+class SeederStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.ipv6_connections = 0
+        self.blocks_sent = 0
+        self.bytes_sent = 0
+        self.corrupt_blocks = 0
+        self.dropped_requests = 0
+        self.rejected_requests = 0
+        self.metadata_pieces_sent = 0
+        self.pex_messages_received = 0
+        self.hash_requests = 0
+
+    def add(self, **counts):
+        with self.lock:
+            for name, count in counts.items():
+                setattr(self, name, getattr(self, name) + count)
+
+    def as_dict(self):
+        with self.lock:
+            return {name: getattr(self, name) for name in ('connections', 'ipv6_connections',
+                'blocks_sent',
+                'bytes_sent', 'corrupt_blocks', 'dropped_requests', 'rejected_requests',
+                'metadata_pieces_sent', 'pex_messages_received', 'hash_requests')}
+
+class SeederConnection:
+    def __init__(self, seeder, sock, rng):
+        self.seeder = seeder
+        self.torrent = seeder.torrent
+        self.config = seeder.config
+        self.socket = sock
+        self.rng = rng
+
+        self.choked = True
+        self.closed = False
+        self.fast_extension = False
+        self.extension_protocol = False
+        # The downloader's id for ut_metadata, once its extended handshake arrives
+        self.metadata_extension_id = None
+        # Pieces served even while choked
+        self.allowed_fast = set()
+        # (due time, serialized message, REQUEST payload it answers or None)
+        self.outbox = deque()
+        self.condition = threading.Condition()
+        self.next_send_time = time.monotonic()
+
+    def start(self):
+        threading.Thread(target=self.read_loop, daemon=True).start()
+        threading.Thread(target=self.write_loop, daemon=True).start()
+        if self.config.choke_interval_s > 0:
+            threading.Thread(target=self.choke_loop, daemon=True).start()
+
+    def close(self):
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.condition.notify_all()
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+
+    def queue_message(self, message_bytes, delay=0.0, request=None):
+        with self.condition:
+            self.outbox.append((time.monotonic() + delay, message_bytes, request))
+            self.condition.notify_all()
+
+    def is_allowed_fast(self, request) -> bool:
+        return int.from_bytes(request[0:4], byteorder='big') in self.allowed_fast
+
+    def reject(self, request):
+        self.seeder.stats.add(rejected_requests=1)
+        self.queue_message(peer.PeerMessage(peer.PeerMessage.Id.REJECT,
+            bytes(request)).serialize())
+
+    def set_choked(self, choked):
+        dropped = []
+        with self.condition:
+            if choked == self.choked:
+                return
+            self.choked = choked
+            if choked:
+                # Choking discards every request that hasn't been answered yet, except for
+                # allowed fast pieces. Other messages (metadata, rejects) still go out.
+                kept = deque(entry for entry in self.outbox
+                        if entry[2] is None or self.is_allowed_fast(entry[2]))
+                dropped = [entry[2] for entry in self.outbox
+                        if entry[2] is not None and not self.is_allowed_fast(entry[2])]
+                self.outbox = kept
+        message_id = peer.PeerMessage.Id.CHOKE if choked else peer.PeerMessage.Id.UNCHOKE
+        self.queue_message(peer.PeerMessage(message_id).serialize())
+        for request in dropped:
+            if self.fast_extension:
+                self.reject(request)
+            else:
+                self.seeder.stats.add(dropped_requests=1)
+
+    def unchoke_later(self):
+        if self.config.unchoke_delay_s > 0:
+            timer = threading.Timer(self.config.unchoke_delay_s, self.set_choked, (False,))
+            timer.daemon = True
+            timer.start()
+        else:
+            self.set_choked(False)
+
+    def make_block(self, payload) -> bytes:
+        piece_index = int.from_bytes(payload[0:4], byteorder='big')
+        begin = int.from_bytes(payload[4:8], byteorder='big')
+        length = int.from_bytes(payload[8:12], byteorder='big')
+
+        block = bytearray(self.torrent.piece(piece_index)[begin:begin+length])
+        if self.seeder.corrupts and self.rng.random() < self.config.corrupt_probability:
+            block[self.rng.randrange(len(block))] ^= 0xff
+            self.seeder.stats.add(corrupt_blocks=1)
+
+        response = bytearray(payload[0:8])
+        response.extend(block)
+        return peer.PeerMessage(peer.PeerMessage.Id.PIECE, response).serialize()
+
+    def handle_extended(self, payload):
+        extension_id, body = extension.parse(payload)
+        if extension_id == extension.HANDSHAKE_ID:
+            ids = extension.peer_ids(extension.decode_handshake(body))
+            self.metadata_extension_id = ids.get(metadata.EXTENSION_NAME)
+            if self.config.pex and pex.EXTENSION_NAME in ids:
+                addresses = [('127.0.0.1', port) for port in self.seeder.pex_ports]
+                self.queue_message(pex.pex_message(ids[pex.EXTENSION_NAME], addresses,
+                    []).serialize())
+        elif extension_id == PEX_EXTENSION_ID and self.config.pex:
+            pex.parse_message(body)
+            self.seeder.stats.add(pex_messages_received=1)
+        elif extension_id == METADATA_EXTENSION_ID and self.config.extension_protocol and\
+                self.metadata_extension_id is not None:
+            message_type, piece, _, _ = metadata.parse_message(body)
+            if message_type != metadata.MessageType.REQUEST:
+                return
+            info_bytes = self.torrent.info_bytes
+            if not 0 <= piece < metadata.num_pieces(len(info_bytes)):
+                message = metadata.reject_message(self.metadata_extension_id, piece)
+            else:
+                start = piece * metadata.METADATA_PIECE_SIZE
+                message = metadata.data_message(self.metadata_extension_id, piece,
+                        len(info_bytes), info_bytes[start:start+metadata.METADATA_PIECE_SIZE])
+                self.seeder.stats.add(metadata_pieces_sent=1)
+            self.queue_message(message.serialize(), self.config.latency_s)
+
+    def handle_hash_request(self, payload):
+        pieces_root, base_layer, index, length, proof_layers = merkle.parse_hash_request(payload)
+        self.seeder.stats.add(hash_requests=1)
+        tree = self.torrent.merkle_trees.get(pieces_root)
+        try:
+            if tree is None:
+                raise ValueError('no file with that root')
+            hashes = tree.hashes(base_layer, index, length, proof_layers)
+            message = peer.PeerMessage(peer.PeerMessage.Id.HASHES,
+                    bytes(payload) + b''.join(hashes))
+        except ValueError:
+            message = peer.PeerMessage(peer.PeerMessage.Id.HASH_REJECT, payload)
+        self.queue_message(message.serialize(), self.config.latency_s)
+
+    def read_loop(self):
+        try:
+            handshake = peer.PeerHandshake.deserialize(bytes(peer.read_from_socket_checked(
+                self.socket, peer.PeerHandshake.HANDSHAKE_SIZE)))
+            if handshake.info_hash != self.torrent.info_hash:
+                return
+
+            fast_bit = peer.PeerHandshake.FAST_EXTENSION_BIT
+            extension_bit = peer.PeerHandshake.EXTENSION_PROTOCOL_BIT
+            bits = [fast_bit] if self.config.fast_extension else []
+            if self.config.extension_protocol or self.config.pex:
+                bits.append(extension_bit)
+            if self.torrent.merkle_trees:
+                bits.append(peer.PeerHandshake.V2_BIT)
+            self.socket.sendall(peer.PeerHandshake(self.seeder.peer_id,
+                self.torrent.info_hash, peer.PeerHandshake.reserved_with(*bits)).serialize())
+            self.fast_extension = self.config.fast_extension and\
+                    handshake.has_reserved_bit(fast_bit)
+            self.extension_protocol = (self.config.extension_protocol or self.config.pex) and\
+                    handshake.has_reserved_bit(extension_bit)
+
+            if self.fast_extension:
+                self.socket.sendall(peer.PeerMessage(peer.PeerMessage.Id.HAVE_ALL).serialize())
+                num_allowed = min(self.config.allowed_fast, self.torrent.num_pieces)
+                self.allowed_fast = set(self.rng.sample(range(self.torrent.num_pieces),
+                    num_allowed))
+                for piece_index in sorted(self.allowed_fast):
+                    self.socket.sendall(peer.PeerMessage(peer.PeerMessage.Id.ALLOWED_FAST,
+                        piece_index.to_bytes(4, byteorder='big')).serialize())
+            else:
+                bitfield = peer.Bitfield.full(self.torrent.num_pieces).bitfield_bytes
+                self.socket.sendall(peer.PeerMessage(peer.PeerMessage.Id.BITFIELD,
+                    bitfield).serialize())
+
+            if self.extension_protocol:
+                handshake = {'m': {}}
+                if self.config.extension_protocol:
+                    handshake['m'][metadata.EXTENSION_NAME] = METADATA_EXTENSION_ID
+                    handshake['metadata_size'] = len(self.torrent.info_bytes)
+                if self.config.pex:
+                    handshake['m'][pex.EXTENSION_NAME] = PEX_EXTENSION_ID
+                handshake_body = bencode.encode(handshake)
+                self.socket.sendall(extension.message(extension.HANDSHAKE_ID,
+                    handshake_body).serialize())
+
+            while True:
+                length = int.from_bytes(peer.read_from_socket_checked(self.socket, 4),
+                        byteorder='big')
+                if length == 0:
+                    continue
+                message = peer.read_from_socket_checked(self.socket, length)
+                message_id, payload = message[0], message[1:]
+
+                if message_id == peer.PeerMessage.Id.INTERESTED.value:
+                    self.unchoke_later()
+                elif message_id == peer.PeerMessage.Id.REQUEST.value:
+                    if self.choked and not self.is_allowed_fast(payload):
+                        if self.fast_extension:
+                            self.reject(payload)
+                        else:
+                            self.seeder.stats.add(dropped_requests=1)
+                        continue
+                    self.queue_message(self.make_block(payload), self.config.latency_s,
+                            payload)
+                elif message_id == peer.PeerMessage.Id.EXTENDED.value and\
+                        self.extension_protocol:
+                    self.handle_extended(payload)
+                elif message_id == peer.PeerMessage.Id.HASH_REQUEST.value and\
+                        self.torrent.merkle_trees:
+                    self.handle_hash_request(payload)
+        except (OSError, ValueError):
+            pass
+        finally:
+            self.close()
+
+    def write_loop(self):
+        try:
+            while True:
+                with self.condition:
+                    while not self.outbox and not self.closed:
+                        self.condition.wait()
+                    if self.closed:
+                        return
+                    due, message_bytes, request = self.outbox[0]
+                    now = time.monotonic()
+                    if due > now:
+                        self.condition.wait(due - now)
+                        continue
+                    self.outbox.popleft()
+
+                if self.config.bandwidth_bps:
+                    # Token bucket with no burst allowance: each message pushes the next send out
+                    self.next_send_time = max(self.next_send_time, time.monotonic())
+                    delay = self.next_send_time - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                    self.next_send_time += len(message_bytes) / self.config.bandwidth_bps
+
+                self.socket.sendall(message_bytes)
+                if request is not None:
+                    self.seeder.stats.add(blocks_sent=1, bytes_sent=len(message_bytes) - 13)
+        except OSError:
+            pass
+        finally:
+            self.close()
+
+    def choke_loop(self):
+        while not self.closed:
+            time.sleep(self.config.choke_interval_s)
+            if self.closed:
+                return
+            self.set_choked(True)
+            time.sleep(self.config.choke_duration_s)
+            self.set_choked(False)
+
+class Seeder:
+    """A peer on 127.0.0.1 that has the whole torrent"""
+
+    def __init__(self, torrent, config: SeederConfig, index=0):
+        self.torrent = torrent
+        self.config = config
+        self.peer_id = '-SIM{:03d}-'.format(index % 1000).encode('ascii') +\
+                random.Random(config.seed + index).randbytes(12)
+        self.rng = random.Random(config.seed * 1000 + index)
+        self.corrupts = config.corrupt_probability > 0 and\
+                (config.corrupt_seeders is None or index < config.corrupt_seeders)
+        self.stats = SeederStats()
+        self.connections = []
+        # Ports of the other seeders, for PEX
+        self.pex_ports = []
+
+        self.listen_socket = self.listen(socket.AF_INET, '127.0.0.1', 0)
+        self.port = self.listen_socket.getsockname()[1]
+        self.listen_sockets = [self.listen_socket]
+        if config.ipv6:
+            self.listen_sockets.append(self.listen(socket.AF_INET6, '::1', self.port))
+        self.threads = [threading.Thread(target=self.accept_loop, args=(listen_socket,),
+                name='Seeder{}-{}'.format(index, listen_socket.family.name), daemon=True)
+                for listen_socket in self.listen_sockets]
+
+        self.stopped = threading.Event()
+        self.utp_multiplexers = []
+        if config.utp:
+            hosts = ['127.0.0.1', '::1'] if config.ipv6 else ['127.0.0.1']
+            self.utp_multiplexers = [utp.UtpMultiplexer(host, self.port, listen=True)
+                    for host in hosts]
+        self.utp_threads = [threading.Thread(target=self.utp_accept_loop, args=(multiplexer,),
+                name='Seeder{}-uTP-{}'.format(index, multiplexer.family.name), daemon=True)
+                for multiplexer in self.utp_multiplexers]
+
+    @staticmethod
+    def listen(family, host, port) -> socket.socket:
+        listen_socket = socket.socket(family, socket.SOCK_STREAM)
+        listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listen_socket.bind((host, port))
+        listen_socket.listen(16)
+        return listen_socket
+
+    def start(self):
+        for thread in self.threads + self.utp_threads:
+            thread.start()
+
+    def accept_loop(self, listen_socket):
+        while True:
+            try:
+                sock, _ = listen_socket.accept()
+            except OSError:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.add_connection(sock, listen_socket.family)
+
+    def utp_accept_loop(self, multiplexer):
+        while not self.stopped.is_set():
+            try:
+                stream, _ = multiplexer.accept(timeout=0.1)
+            except queue.Empty:
+                continue
+            self.add_connection(stream, multiplexer.family)
+
+    def add_connection(self, sock, family=socket.AF_INET):
+        connection = SeederConnection(self, sock, random.Random(self.rng.random()))
+        self.connections.append(connection)
+        self.stats.add(connections=1, ipv6_connections=int(family == socket.AF_INET6))
+        connection.start()
+
+    def stop(self):
+        self.stopped.set()
+        for listen_socket in self.listen_sockets:
+            try:
+                # Wakes up the accept() in accept_loop
+                listen_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            listen_socket.close()
+        for connection in self.connections:
+            connection.close()
+        for thread, multiplexer in zip(self.utp_threads, self.utp_multiplexers):
+            thread.join()
+            multiplexer.close()
@@ -0,0 +1,120 @@
+"""
+Generates synthetic torrents with deterministic content for the loopback simulator, v1 or hybrid
+v1/v2 (BEP 52).
+"""
+from typing import Dict, List
+import hashlib
+import os
+import random
+import urllib.parse
+
+import bencode
+import magnet
+import merkle
+import tracker
+
+class SyntheticTorrent:
+    """The content of a generated torrent, kept in memory so seeders can serve it"""
+
+    def __init__(self, metainfo: Dict, content: bytes, torrent_file: str, merkle_trees=None):
+        self.metainfo = metainfo
+        self.info = metainfo['info']
+        self.content = content
+        self.torrent_file = torrent_file
+        self.info_hash = tracker.get_info_hash(metainfo)
+        # The info dict as peers send it over ut_metadata
+        self.info_bytes = bencode.encode(self.info)
+        self.piece_length = self.info['piece length']
+        self.num_pieces = len(self.info['pieces']) // 20
+        # Hybrid torrents only: each file's MerkleTree by pieces root, for answering hash requests
+        self.merkle_trees: Dict[bytes, merkle.MerkleTree] = merkle_trees or {}
+
+    def magnet_uri(self, trackers=(), peers=()) -> str:
+        params = [('xt', magnet.INFO_HASH_PREFIX + self.info_hash.hex()), ('dn', self.info['name'])]
+        params.extend(('tr', url) for url in trackers)
+        params.extend(('x.pe', '{}:{}'.format(ip, port)) for ip, port in peers)
+        return magnet.SCHEME + '?' + urllib.parse.urlencode(params)
+
+    def piece(self, piece_index) -> bytes:
+        start = piece_index * self.piece_length
+        return self.content[start:start+self.piece_length]
+
+def split_lengths(rng, total_size, num_files) -> List[int]:
+    if num_files == 1:
+        return [total_size]
+    cuts = sorted(rng.randrange(total_size + 1) for _ in range(num_files - 1))
+    return [b - a for a, b in zip([0] + cuts, cuts + [total_size])]
+
+def generate_torrent(directory, announce_url, total_size, piece_length=262144, num_files=1,
+                     seed=0, name='synthetic', hybrid=False) -> SyntheticTorrent:
+    """Creates random content and a matching .torrent file in directory.
+
+    A hybrid torrent also gets a 'file tree' and 'piece layers', and its v1 file list pads every
+    file out to a piece boundary, so content includes those zeros.
+    """
+    rng = random.Random(seed)
+    file_data = rng.randbytes(total_size)
+    lengths = split_lengths(rng, total_size, num_files)
+    paths = [[name]] if num_files == 1 else [['file_{}.bin'.format(i)] for i in range(num_files)]
+
+    entries = list(zip(paths, lengths))
+    if hybrid:
+        # The v1 file list has to be in the file tree's order
+        entries.sort()
+
+    files = []
+    merkle_trees = {}
+    piece_layers = {}
+    file_tree: Dict = {}
+    content = bytearray()
+    offset = 0
+    for i, (path, length) in enumerate(entries):
+        data = file_data[offset:offset+length]
+        offset += length
+        content.extend(data)
+        files.append({'length': length, 'path': path})
+        if not hybrid:
+            continue
+
+        node = {'length': length}
+        if length > 0:
+            tree = merkle.MerkleTree.from_data(data)
+            node['pieces root'] = tree.root()
+            merkle_trees[tree.root()] = tree
+            if length > piece_length:
+                piece_layers[tree.root()] = tree.piece_layer(piece_length, length)
+        directory_node = file_tree
+        for component in path:
+            directory_node = directory_node.setdefault(component, {})
+        directory_node[''] = node
+
+        padding = -len(content) % piece_length
+        if padding and i < num_files - 1:
+            content.extend(bytes(padding))
+            files.append({'attr': 'p', 'length': padding, 'path': ['.pad', str(padding)]})
+
+    pieces = bytearray()
+    for start in range(0, len(content), piece_length):
+        pieces.extend(hashlib.sha1(content[start:start+piece_length]).digest())
+
+    info: Dict = {
+        'name': name,
+        'piece length': piece_length,
+        'pieces': bytes(pieces),
+    }
+    if num_files == 1:
+        info['length'] = total_size
+    else:
+        info['files'] = files
+    if hybrid:
+        info['meta version'] = merkle.META_VERSION
+        info['file tree'] = file_tree
+
+    metainfo = {'announce': announce_url, 'info': info}
+    if piece_layers:
+        metainfo['piece layers'] = piece_layers
+    torrent_file = os.path.join(str(directory), name + '.torrent')
+    with open(torrent_file, 'wb') as f:
+        f.write(bencode.encode(metainfo))
+
+    return SyntheticTorrent(metainfo, bytes(content), torrent_file, merkle_trees)
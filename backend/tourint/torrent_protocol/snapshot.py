@@ -0,0 +1,35 @@
+"""
+Live engine snapshots.
+
+A running TorrentDownload periodically builds a plain dict describing its state (per-peer rates
+and choke state, disk queue, ETA and which pieces are done) and sends it over its telemetry
+queue, so the web app can answer detail requests from memory without touching the engine or the
+database. The piece map is sent as a bitfield, zlib compressed and base64 encoded: long runs of
+done or missing pieces compress to almost nothing.
+"""
+from typing import Iterable, Set
+import base64
+import zlib
+
+# Telemetry queue messages are (kind, info hash hex, payload)
+MESSAGE_KIND: str = 'snapshot'
+PIECE_MAP_ENCODING: str = 'bitfield+zlib+base64'
+
+def encode_piece_map(pieces: Iterable[int], num_pieces: int) -> str:
+    """Encodes a set of piece indices as a compressed bitfield, high bit first like BITFIELD"""
+    bitfield = bytearray((num_pieces + 7) // 8)
+    for index in pieces:
+        bitfield[index // 8] |= 1 << (7 - (index % 8))
+    return base64.b64encode(zlib.compress(bytes(bitfield))).decode('ascii')
+
+def decode_piece_map(encoded: str, num_pieces: int) -> Set[int]:
+    bitfield = zlib.decompress(base64.b64decode(encoded))
+    return set(i for i in range(num_pieces) if bitfield[i // 8] & (1 << (7 - (i % 8))))
+
+def estimate_eta_s(bytes_left, rate_bps):
+    """Seconds left at the current rate, or None if nothing is coming in"""
+    if bytes_left <= 0:
+        return 0
+    if rate_bps <= 0:
+        return None
+    return bytes_left / rate_bps
@@ -0,0 +1,31 @@
+import socket
+import unittest
+
+import addresses
+import bencode
+import tracker
+
+class CompactTests(unittest.TestCase):
+    def test_round_trip(self):
+        ipv4 = [('10.0.0.1', 6881), ('192.168.1.20', 51413)]
+        ipv6 = [('2001:db8::1', 6881), ('::ffff:10.0.0.1', 1)]
+        self.assertEqual(addresses.decode_compact(addresses.encode_compact(ipv4)), ipv4)
+        data = addresses.encode_compact(ipv6, socket.AF_INET6)
+        self.assertEqual(len(data), 36)
+        self.assertEqual(addresses.decode_compact(data, socket.AF_INET6), ipv6)
+
+    def test_format(self):
+        self.assertEqual(addresses.format_address('10.0.0.1', 80), '10.0.0.1:80')
+        self.assertEqual(addresses.format_address('::1', 80), '[::1]:80')
+        self.assertEqual(addresses.family_label('example.com'), 'ipv4')
+
+class ResponsePeersTests(unittest.TestCase):
+    def test_compact_and_dict_peers(self):
+        compact = bencode.decode(bencode.encode({
+            'peers': addresses.encode_compact([('65.66.67.68', 0x4142)]),
+            'peers6': addresses.encode_compact([('2001:db8::7', 6881)], socket.AF_INET6),
+        }))
+        self.assertEqual(tracker.response_peers(compact),
+                [('65.66.67.68', 0x4142), ('2001:db8::7', 6881)])
+        listed = {'peers': [{'ip': '10.0.0.1', 'port': 1}, {'ip': '::1', 'port': 2}]}
+        self.assertEqual(tracker.response_peers(listed), [('10.0.0.1', 1), ('::1', 2)])
@@ -0,0 +1,192 @@
+import unittest
+import multiprocessing
+import os
+import queue
+import tempfile
+import time
+from control import *
+import disk_io
+import piece_picker
+import snapshot
+import torrent_download
+from simulator.harness import Swarm
+from simulator.local_tracker import LocalTracker
+from simulator.seeder import SeederConfig
+from simulator.torrent_gen import generate_torrent
+
+class TokenBucketTests(unittest.TestCase):
+    def test_unlimited_never_waits(self):
+        bucket = TokenBucket()
+        bucket.consume(10 ** 9)
+        self.assertEqual(bucket.wait_s(), 0)
+
+    def test_debt_is_paid_back_at_the_rate(self):
+        bucket = TokenBucket(1000)
+        bucket.tokens = 0
+        bucket.consume(500)
+        self.assertAlmostEqual(bucket.wait_s(), 0.5, delta=0.05)
+
+    def test_burst_is_capped(self):
+        bucket = TokenBucket(1000)
+        bucket.last_refill -= 60
+        bucket.refill()
+        self.assertEqual(bucket.tokens, bucket.capacity())
+
+class ControlChannelTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.tracker = LocalTracker()
+        self.tracker.start()
+        self.torrent = generate_torrent(self.directory.name, self.tracker.announce_url,
+                8 * 1024 * 1024, 65536, num_files=2)
+        # Slow enough that the download is still running while commands are sent
+        self.swarm = Swarm(self.torrent, 2, SeederConfig(bandwidth_bps=1024 * 1024),
+                self.tracker)
+        self.swarm.start()
+        self.telemetry = multiprocessing.Queue()
+        self.output_directory = os.path.join(self.directory.name, 'output')
+
+    def tearDown(self):
+        self.swarm.stop()
+        self.tracker.stop()
+        self.directory.cleanup()
+
+    def wait_for_snapshot(self, predicate, timeout_s=10):
+        deadline = time.monotonic() + timeout_s
+        while time.monotonic() < deadline:
+            try:
+                kind, _, payload = self.telemetry.get(timeout=deadline - time.monotonic())
+            except queue.Empty:
+                break
+            if kind == snapshot.MESSAGE_KIND and predicate(payload):
+                return payload
+        self.fail('No matching snapshot within {}s'.format(timeout_s))
+
+    def start_download(self):
+        parent, child = multiprocessing.Pipe()
+        self.replies, reply_writer = multiprocessing.Pipe(duplex=False)
+        download = torrent_download.TorrentDownload(self.torrent.torrent_file,
+                output_directory=self.output_directory, telemetry_queue=self.telemetry,
+                control_connection=child, reply_connection=reply_writer)
+        download.start()
+        child.close()
+        reply_writer.close()
+        return download, parent
+
+    def test_pause_exits_and_resume_continues(self):
+        download, connection = self.start_download()
+        self.wait_for_snapshot(lambda s: s['downloaded_bytes'] > 0)
+        send_command(connection, Command.PAUSE)
+        paused = self.wait_for_snapshot(lambda s: s['state'] == 'paused')
+        download.join(10)
+        self.assertEqual(download.exitcode, 0)
+        self.assertTrue(os.path.exists(os.path.join(self.output_directory, '.resume')))
+
+        # A new process picks up where the paused one stopped
+        download, connection = self.start_download()
+        send_command(connection, Command.SNAPSHOT)
+        resumed = self.wait_for_snapshot(lambda s: s['state'] == 'downloading')
+        self.assertGreaterEqual(resumed['downloaded_bytes'], paused['downloaded_bytes'])
+        self.assertGreater(paused['downloaded_bytes'], 0)
+
+        send_command(connection, Command.CANCEL, delete_data=True)
+        self.wait_for_snapshot(lambda s: s['state'] == 'cancelled')
+        download.join(10)
+        self.assertEqual(download.exitcode, 0)
+        self.assertFalse(os.path.exists(self.output_directory))
+
+    def test_rate_limit(self):
+        download, connection = self.start_download()
+        send_command(connection, Command.SET_RATE_LIMIT, bytes_per_second=256 * 1024)
+        limited = self.wait_for_snapshot(lambda s: s['rate_limit_bps'] and
+                s['download_rate_bps'] > 0)
+        self.assertLess(limited['download_rate_bps'], 2 * 256 * 1024)
+        send_command(connection, Command.CANCEL)
+        download.join(10)
+        self.assertFalse(download.is_alive())
+
+    def test_read_while_downloading(self):
+        download, connection = self.start_download()
+        # Spans a piece boundary near the end, so it can't have been downloaded yet
+        offset, length = len(self.torrent.content) - 100000, 70000
+        replies = ReadReplies(self.replies)
+        deadline = time.time() + 20
+        send_command(connection, Command.READ, request_id='tail', offset=offset, length=length,
+                deadline=deadline)
+        replies.wait('tail', deadline)
+        layout = disk_io.FileLayout(self.torrent.metainfo['info'], self.output_directory)
+        self.assertEqual(disk_io.read_range(layout, offset, length),
+                self.torrent.content[offset:offset + length])
+
+        deadline = time.time() + 5
+        send_command(connection, Command.READ, request_id='bad', offset=0,
+                length=len(self.torrent.content) + 1, deadline=deadline)
+        with self.assertRaises(ValueError):
+            replies.wait('bad', deadline)
+
+        send_command(connection, Command.CANCEL)
+        download.join(10)
+        self.assertFalse(download.is_alive())
+
+    def test_unread_replies_dont_stall_commands(self):
+        download, connection = self.start_download()
+        # Nobody drains the replies. One read has already been given up on, the rest fill the
+        # pipe once the pieces come in.
+        send_command(connection, Command.READ, request_id='late', offset=0, length=1,
+                deadline=time.time() - 1)
+        for i in range(2000):
+            send_command(connection, Command.READ, request_id='{:064d}'.format(i), offset=0,
+                    length=len(self.torrent.content), deadline=time.time() + 60)
+        send_command(connection, Command.SET_RATE_LIMIT, bytes_per_second=512 * 1024)
+        self.wait_for_snapshot(lambda s: s['rate_limit_bps'] == 512 * 1024)
+        self.wait_for_snapshot(lambda s: s['state'] == 'completed', timeout_s=30)
+        download.join(10)
+        self.assertEqual(download.exitcode, 0)
+
+    def test_file_priorities_reach_running_download(self):
+        download, connection = self.start_download()
+        # Wrong number of files, ignored
+        send_command(connection, Command.SET_FILE_PRIORITIES, priorities=['skip'])
+        send_command(connection, Command.SET_FILE_PRIORITIES, priorities=['normal', 'skip'])
+        skipping = self.wait_for_snapshot(lambda s: s['pieces']['wanted'] <
+                s['pieces']['count'])
+        self.assertLess(skipping['wanted_bytes'], len(self.torrent.content))
+        self.wait_for_snapshot(lambda s: s['state'] == 'completed')
+        download.join(10)
+        self.assertEqual(download.exitcode, 0)
+
+class FilePriorityChangeTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.torrent = generate_torrent(self.directory.name, 'http://127.0.0.1:1/announce',
+                10 * 1024, 1024, num_files=2)
+        self.download = torrent_download.TorrentDownload(self.torrent.torrent_file,
+                output_directory=os.path.join(self.directory.name, 'output'))
+        self.download.setup_output_directory()
+
+    def tearDown(self):
+        self.download.disk_writer.close()
+        self.directory.cleanup()
+
+    def write_piece(self, piece_index):
+        self.download.on_piece_verified(piece_index, self.torrent.piece(piece_index))
+        self.download.disk_writer.flush()
+
+    def test_rewritten_piece_survives_the_next_change(self):
+        Priority = piece_picker.Priority
+        first_length = self.torrent.info['files'][0]['length']
+        # The piece both files share
+        straddling = first_length // 1024
+        self.download.set_file_priorities([Priority.NORMAL, Priority.SKIP])
+        self.write_piece(straddling)
+        self.assertIn(straddling, self.download.disk_writer.partial_pieces)
+
+        # Un-skipping the file needs the piece again. Once it's rewritten whole, it's done.
+        self.download.set_file_priorities([Priority.NORMAL, Priority.NORMAL])
+        self.assertIn(straddling, self.download.pieces_to_download)
+        self.write_piece(straddling)
+        self.assertNotIn(straddling, self.download.disk_writer.partial_pieces)
+
+        self.download.set_file_priorities([Priority.HIGH, Priority.NORMAL])
+        self.assertIn(straddling, self.download.completed_pieces)
+        self.assertNotIn(straddling, self.download.pieces_to_download)
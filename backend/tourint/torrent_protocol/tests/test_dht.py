@@ -0,0 +1,107 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+import dht
+import metrics
+from simulator.dht_cluster import DhtCluster
+from simulator.harness import run_simulation
+
+def node_id(value) -> bytes:
+    return value.to_bytes(dht.NODE_ID_SIZE, byteorder='big')
+
+class RoutingTableTests(unittest.TestCase):
+    def test_buckets_hold_k_good_nodes(self):
+        table = dht.RoutingTable(node_id(0))
+        # All in the farthest bucket
+        nodes = [dht.Node(node_id((1 << 159) + i), '10.0.0.1', 1000 + i) for i in range(10)]
+        added = [table.add(node) for node in nodes]
+        self.assertEqual(added, [True] * dht.K + [False] * 2)
+
+        # A bad node makes room
+        for _ in range(dht.BAD_NODE_FAILURES):
+            table.mark_failed(nodes[0].node_id)
+        self.assertTrue(table.add(nodes[-1]))
+        self.assertIsNone(table.get(nodes[0].node_id))
+
+    def test_closest(self):
+        table = dht.RoutingTable(node_id(0))
+        for i in range(1, 40):
+            table.add(dht.Node(node_id(i), '10.0.0.1', 1000 + i))
+        closest = table.closest(node_id(16), 3)
+        self.assertEqual([n.node_id for n in closest], [node_id(16), node_id(17), node_id(18)])
+
+    def test_state_round_trip(self):
+        table = dht.RoutingTable(node_id(0))
+        table.add(dht.Node(node_id(5), '10.0.0.5', 6881))
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'dht.json')
+            dht.save_state(path, node_id(0), table)
+            loaded_id, nodes = dht.load_state(path)
+            self.assertEqual(dht.load_state(os.path.join(directory, 'missing.json')),
+                    (None, []))
+        self.assertEqual(loaded_id, node_id(0))
+        self.assertEqual([(n.node_id, n.address) for n in nodes],
+                [(node_id(5), ('10.0.0.5', 6881))])
+
+class DhtClusterTests(unittest.TestCase):
+    def setUp(self):
+        self.cluster = DhtCluster(30)
+        self.cluster.start()
+
+    def tearDown(self):
+        self.cluster.stop()
+
+    def test_lookup_finds_announced_peer(self):
+        info_hash = os.urandom(dht.NODE_ID_SIZE)
+        self.assertGreater(self.cluster.announce(info_hash, 5555, node_index=3), 0)
+        result = self.cluster.lookup(info_hash, node_index=20)
+        self.assertEqual(result.peers, [('127.0.0.1', 5555)])
+        self.assertGreaterEqual(result.queries, dht.K)
+        self.assertEqual(result.timeouts, 0)
+        self.assertEqual(len(result.nodes), dht.K)
+
+    def test_announce_needs_valid_token(self):
+        node = self.cluster.nodes[0]
+        target = self.cluster.nodes[1]
+        arguments = {'info_hash': os.urandom(dht.NODE_ID_SIZE), 'port': 5555,
+                'token': b'made up', 'implied_port': 0}
+        with self.assertRaises(dht.KrpcError) as raised:
+            self.cluster.run(node.query(target.transport.get_extra_info('sockname'),
+                'announce_peer', arguments))
+        self.assertEqual(raised.exception.code, dht.ErrorCode.PROTOCOL)
+
+    def test_lookup_metrics(self):
+        engine_metrics = metrics.EngineMetrics(metrics.Registry())
+
+        async def lookup():
+            node = dht.DhtNode(engine_metrics=engine_metrics)
+            await node.start('127.0.0.1')
+            try:
+                await node.bootstrap(self.cluster.addresses[:1])
+                return await node.get_peers(os.urandom(dht.NODE_ID_SIZE))
+            finally:
+                node.close()
+
+        result = self.cluster.run(lookup())
+        collected = engine_metrics.registry.collect()
+        sent = dict(collected['tourint_dht_messages_total']['samples'])
+        self.assertEqual(sent[('sent', 'get_peers')], result.queries)
+        lookups = {labels: counts for labels, counts, _
+                in collected['tourint_dht_lookup_seconds']['samples']}
+        self.assertEqual(sum(lookups[('get_peers',)]), 1)
+
+class DhtDownloadTests(unittest.TestCase):
+    def test_download_without_tracker(self):
+        report = run_simulation(num_peers=3, size_bytes=1024 * 1024, piece_length=32768,
+                timeout_s=60, dht_nodes=20, tracker_down=True)
+        self.assertTrue(report['verified'], report)
+        self.assertEqual(report['announces'], 0)
+
+    def test_download_from_trackerless_magnet(self):
+        # The .torrent made from the magnet link has neither 'announce' nor 'announce-list'
+        report = run_simulation(num_peers=3, size_bytes=1024 * 1024, piece_length=32768,
+                timeout_s=60, dht_nodes=20, use_magnet=True, trackerless=True)
+        self.assertTrue(report['verified'], report)
+        self.assertEqual(report['announces'], 0)
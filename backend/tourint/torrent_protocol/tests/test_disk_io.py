@@ -0,0 +1,138 @@
+import unittest
+import os
+import tempfile
+from disk_io import *
+
+class FileLayoutTests(unittest.TestCase):
+    def test_single_file(self):
+        layout = FileLayout({'name': 'a.iso', 'length': 100}, '/tmp/x')
+        self.assertEqual(layout.total_length, 100)
+        self.assertEqual(layout.segments(10, 20), [(0, 10, 20)])
+        self.assertRaises(ValueError, layout.segments, 90, 20)
+
+    def test_multi_file(self):
+        info = {'name': 'dir', 'files': [
+            {'path': ['a'], 'length': 10},
+            {'path': ['sub', 'b'], 'length': 0},
+            {'path': ['c'], 'length': 30},
+        ]}
+        layout = FileLayout(info, '/tmp/x')
+        self.assertEqual(layout.total_length, 40)
+        self.assertEqual(layout.files[1][0], os.path.join('/tmp/x', 'dir', 'sub', 'b'))
+        self.assertEqual(layout.segments(5, 10), [(0, 5, 5), (2, 0, 5)])
+        self.assertEqual(layout.segments(10, 30), [(2, 0, 30)])
+
+    def test_piece_priorities(self):
+        info = {'name': 'dir', 'files': [
+            {'path': ['a'], 'length': 10},
+            {'path': ['b'], 'length': 0},
+            {'path': ['c'], 'length': 30},
+        ]}
+        layout = FileLayout(info, '/tmp/x')
+        self.assertEqual(list(layout.file_pieces(0, 8)), [0, 1])
+        self.assertEqual(list(layout.file_pieces(1, 8)), [])
+        self.assertEqual(list(layout.file_pieces(2, 8)), [1, 2, 3, 4])
+        self.assertEqual(layout.piece_priorities([0, 3, 2], 8, 5), [0, 2, 2, 2, 2])
+        self.assertEqual(layout.piece_priorities([2, 1, 0], 8, 5), [2, 2, 0, 0, 0])
+
+    def test_sanitizes_paths(self):
+        layout = FileLayout({'name': '..', 'files': [{'path': ['..', 'x'], 'length': 1}]}, '/d')
+        self.assertEqual(layout.files[0][0], os.path.join('/d', '_', '_', 'x'))
+
+class DiskWriterTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.info = {'name': 'dir', 'files': [
+            {'path': ['a'], 'length': 10},
+            {'path': ['b'], 'length': 25},
+        ]}
+        self.data = bytes(range(35))
+        self.piece_length = 8
+        self.num_pieces = 5
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def make_writer(self, **kwargs):
+        layout = FileLayout(self.info, self.directory.name)
+        writer = DiskWriter(layout, self.piece_length, self.num_pieces, self.directory.name,
+                **kwargs)
+        writer.start()
+        return writer
+
+    def piece(self, i):
+        return self.data[i*self.piece_length:(i+1)*self.piece_length]
+
+    def test_writes_pieces_across_files(self):
+        writer = self.make_writer(fsync_policy=FsyncPolicy.EVERY_BATCH)
+        for i in [3, 0, 1, 4, 2]:
+            writer.submit(i, self.piece(i))
+        writer.close()
+
+        with open(os.path.join(self.directory.name, 'dir', 'a'), 'rb') as f:
+            self.assertEqual(f.read(), self.data[:10])
+        with open(os.path.join(self.directory.name, 'dir', 'b'), 'rb') as f:
+            self.assertEqual(f.read(), self.data[10:])
+
+        self.assertEqual(load_resume_state(self.directory.name, self.num_pieces), set(range(5)))
+
+    def test_skipped_files_are_not_created(self):
+        writer = self.make_writer()
+        writer.set_skipped_files({0})
+        for i in range(5):
+            writer.submit(i, self.piece(i))
+        writer.close()
+
+        self.assertFalse(os.path.exists(os.path.join(self.directory.name, 'dir', 'a')))
+        with open(os.path.join(self.directory.name, 'dir', 'b'), 'rb') as f:
+            self.assertEqual(f.read(), self.data[10:])
+        self.assertEqual(writer.partial_pieces, {0, 1})
+        self.assertEqual(load_resume_state(self.directory.name, self.num_pieces), {2, 3, 4})
+
+    def test_resume_state_waits_for_fsync(self):
+        synced = []
+        writer = self.make_writer()
+        real_sync_files = writer.sync_files
+        def sync_files():
+            synced.append(set(writer.written_pieces))
+            real_sync_files()
+        writer.sync_files = sync_files
+
+        writer.submit(0, self.piece(0))
+        writer.flush()
+        # Not synced yet under ON_CLOSE, so not resumable yet either
+        self.assertEqual(load_resume_state(self.directory.name, self.num_pieces), set())
+        writer.close()
+        self.assertEqual(synced, [{0}])
+        self.assertEqual(load_resume_state(self.directory.name, self.num_pieces), {0})
+
+        writer = self.make_writer(fsync_policy=FsyncPolicy.NEVER, written_pieces={0})
+        writer.submit(1, self.piece(1))
+        writer.close()
+        self.assertEqual(load_resume_state(self.directory.name, self.num_pieces), {0})
+
+    def test_read_from_cache_and_disk(self):
+        writer = self.make_writer()
+        writer.submit(1, self.piece(1))
+        writer.flush()
+        writer.submit(2, self.piece(2))
+        self.assertEqual(writer.read(9, 10), self.data[9:19])
+        writer.close()
+
+    def test_coalesce(self):
+        self.assertEqual(DiskWriter.coalesce([5, 1, 2, 3, 7, 6]), [[1, 2, 3], [5, 6, 7]])
+
+    def test_backpressure(self):
+        writer = DiskWriter(FileLayout(self.info, self.directory.name), self.piece_length,
+                self.num_pieces, self.directory.name, max_cache_bytes=self.piece_length)
+        writer.submit(0, self.piece(0))
+        self.assertTrue(writer.is_full())
+        writer.start()
+        writer.submit(1, self.piece(1))
+        writer.close()
+        self.assertEqual(writer.cached_bytes, 0)
+
+    def test_resume_state_size_mismatch(self):
+        save_resume_state(self.directory.name, 16, {0, 9})
+        self.assertEqual(load_resume_state(self.directory.name, 16), {0, 9})
+        self.assertEqual(load_resume_state(self.directory.name, 30), set())
@@ -0,0 +1,81 @@
+import base64
+import hashlib
+import tempfile
+import unittest
+
+import bencode
+import magnet
+import metadata
+import tracker
+from simulator.harness import Swarm, run_simulation
+from simulator.local_tracker import LocalTracker
+from simulator.seeder import SeederConfig
+from simulator.torrent_gen import generate_torrent
+
+INFO_HASH = bytes(range(20))
+
+class MagnetParseTests(unittest.TestCase):
+    def test_parse_hex(self):
+        link = magnet.parse('magnet:?xt=urn:btih:{}&dn=some+name&tr=http%3A%2F%2Ft%2Fannounce'
+                '&tr=http%3A%2F%2Fu%2Fannounce&x.pe=10.0.0.1:6881'.format(INFO_HASH.hex()))
+        self.assertEqual(link.info_hash, INFO_HASH)
+        self.assertEqual(link.name, 'some name')
+        self.assertEqual(link.trackers, ['http://t/announce', 'http://u/announce'])
+        self.assertEqual(link.peers, [{'ip': '10.0.0.1', 'port': 6881}])
+
+    def test_parse_base32(self):
+        encoded = base64.b32encode(INFO_HASH).decode('ascii')
+        self.assertEqual(magnet.parse('magnet:?xt=urn:btih:' + encoded).info_hash, INFO_HASH)
+
+    def test_rejects_links_without_info_hash(self):
+        with self.assertRaises(ValueError):
+            magnet.parse('magnet:?dn=nothing')
+        with self.assertRaises(ValueError):
+            magnet.parse('magnet:?xt=urn:btih:1234')
+        with self.assertRaises(ValueError):
+            magnet.parse('http://example.com/a.torrent')
+
+    def test_torrent_file_keeps_info_hash(self):
+        info_bytes = bencode.encode({'name': 'x', 'piece length': 16384, 'pieces': bytes(20),
+            'length': 100})
+        data = magnet.torrent_file_bytes(info_bytes, ['http://t/announce'])
+        metainfo = bencode.decode(data)
+        self.assertEqual(metainfo['announce'], 'http://t/announce')
+        self.assertEqual(tracker.get_info_hash(metainfo), hashlib.sha1(info_bytes).digest())
+
+class MetadataFetchTests(unittest.TestCase):
+    def fetch_from_swarm(self, num_peers, config):
+        with tempfile.TemporaryDirectory() as directory:
+            local_tracker = LocalTracker()
+            local_tracker.start()
+            # 2048 pieces, so the info dict is 3 metadata pieces long
+            torrent = generate_torrent(directory, local_tracker.announce_url, 16 * 1024 * 1024,
+                    piece_length=8192)
+            swarm = Swarm(torrent, num_peers, config, local_tracker)
+            swarm.start()
+            try:
+                link = magnet.parse(torrent.magnet_uri([local_tracker.announce_url]))
+                info_bytes = metadata.fetch_metadata(link, timeout_s=30)
+            finally:
+                swarm.stop()
+                local_tracker.stop()
+            return torrent, swarm, info_bytes
+
+    def test_fetch_spreads_pieces_over_peers(self):
+        torrent, swarm, info_bytes = self.fetch_from_swarm(3, SeederConfig(
+            extension_protocol=True))
+        self.assertEqual(info_bytes, torrent.info_bytes)
+        self.assertEqual(metadata.num_pieces(len(info_bytes)), 3)
+        sent = [seeder.stats.metadata_pieces_sent for seeder in swarm.seeders]
+        self.assertEqual(sum(sent), 3)
+        self.assertGreater(sum(1 for count in sent if count > 0), 1)
+
+    def test_fetch_fails_without_extension_protocol(self):
+        with self.assertRaises((ValueError, TimeoutError)):
+            self.fetch_from_swarm(2, SeederConfig())
+
+    def test_download_from_magnet(self):
+        report = run_simulation(num_peers=3, size_bytes=1024 * 1024, piece_length=32768,
+                timeout_s=60, use_magnet=True)
+        self.assertTrue(report['verified'], report)
+        self.assertGreater(report['seeders']['metadata_pieces_sent'], 0)
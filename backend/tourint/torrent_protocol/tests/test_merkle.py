@@ -0,0 +1,113 @@
+import os
+import tempfile
+import unittest
+
+import merkle
+import peer
+import tracker
+from simulator.harness import run_simulation
+from simulator.seeder import SeederConfig
+from simulator.torrent_gen import generate_torrent
+
+BLOCK = merkle.BLOCK_SIZE
+
+class MerkleTreeTests(unittest.TestCase):
+    def test_root_pads_with_zero_hashes(self):
+        leaves = [merkle.block_hash(bytes([i])) for i in range(3)]
+        zero = merkle.ZERO_HASH
+        expected = merkle.parent(merkle.parent(leaves[0], leaves[1]),
+                merkle.parent(leaves[2], zero))
+        self.assertEqual(merkle.root(leaves), expected)
+        self.assertEqual(merkle.MerkleTree(leaves).root(), expected)
+        # A layer one above the leaves pads with the hash of two zero leaves
+        self.assertEqual(merkle.root(leaves[:1], 2, height=1),
+                merkle.parent(leaves[0], merkle.parent(zero, zero)))
+
+    def test_hashes_with_proof_add_up_to_the_root(self):
+        tree = merkle.MerkleTree([merkle.block_hash(bytes([i])) for i in range(13)])
+        for index in (0, 4, 12):
+            hashes = tree.hashes(0, index, 4, 2)
+            self.assertEqual(len(hashes), 6)
+            self.assertEqual(merkle.root_from_proof(merkle.root(hashes[:4]), index // 4,
+                hashes[4:]), tree.root())
+        self.assertRaises(ValueError, tree.hashes, 0, 2, 4, 0)
+        self.assertRaises(ValueError, tree.hashes, 0, 0, 4, 3)
+
+    def test_hashes_message_round_trip(self):
+        request = merkle.hash_request_payload(bytes(range(32)), 16, 2, 1)
+        self.assertEqual(merkle.parse_hash_request(request), (bytes(range(32)), 0, 16, 2, 1))
+        hashes = [bytes([i]) * 32 for i in range(3)]
+        self.assertEqual(merkle.parse_hashes(request + b''.join(hashes))[-1], hashes)
+        self.assertRaises(ValueError, merkle.parse_hashes, request + b''.join(hashes[:2]))
+
+class PieceTreesTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.torrent = generate_torrent(self.directory.name, 'http://127.0.0.1:1/announce',
+                1024 * 1024 + 1000, piece_length=4 * BLOCK, num_files=3, seed=2, hybrid=True)
+        self.metainfo = tracker.decode_torrent_file(self.torrent.torrent_file)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_every_piece_checks_against_its_tree(self):
+        info = self.metainfo['info']
+        trees = merkle.PieceTrees(info, self.metainfo['piece layers'], self.torrent.num_pieces)
+        self.assertTrue(merkle.is_hybrid(info))
+        self.assertEqual(len(trees), self.torrent.num_pieces)
+        for piece_index in range(self.torrent.num_pieces):
+            tree = trees.get(piece_index)
+            piece = self.torrent.piece(piece_index)
+            download = peer.PieceDownload(piece_index, len(piece), leaf_bytes=tree.data_length)
+            for begin in range(0, len(piece), BLOCK):
+                payload = piece_index.to_bytes(4, 'big') + begin.to_bytes(4, 'big') +\
+                        piece[begin:begin + BLOCK]
+                download.handle_block_response(payload, ('127.0.0.1', 1))
+            self.assertTrue(tree.check(download.leaves()), piece_index)
+            self.assertTrue(download.padding_is_zero())
+
+    def test_piece_layer_has_to_match_the_root(self):
+        layers = dict(self.metainfo['piece layers'])
+        root, layer = next(iter(layers.items()))
+        layers[root] = bytes(len(layer))
+        self.assertRaises(ValueError, merkle.PieceTrees, self.metainfo['info'], layers,
+                self.torrent.num_pieces)
+
+class BadBlockTests(unittest.TestCase):
+    def test_bad_block_is_found_and_blamed(self):
+        data = os.urandom(3 * BLOCK + 100)
+        tree = merkle.MerkleTree.from_data(data)
+        download = peer.PieceDownload(0, 4 * BLOCK, leaf_bytes=len(data))
+        for block, source in enumerate(['a', 'b', 'c', 'd']):
+            chunk = bytearray(data[block * BLOCK:(block + 1) * BLOCK])
+            if block == 3:
+                chunk.extend(bytes(BLOCK - len(chunk)))
+            if block == 1:
+                chunk[5] ^= 0xff
+            payload = bytes(4) + (block * BLOCK).to_bytes(4, 'big') + chunk
+            download.handle_block_response(payload, source)
+
+        leaves = tree.layers[0][:4]
+        self.assertNotEqual(merkle.root(download.leaves()), tree.root())
+        self.assertEqual(download.bad_blocks(leaves), [1])
+        self.assertEqual(download.block_sources[1], 'b')
+        download.discard_blocks([1])
+        self.assertFalse(download.all_blocks_received())
+        self.assertEqual(download.take_next_block(), (BLOCK, BLOCK))
+
+class HybridDownloadTests(unittest.TestCase):
+    def test_bad_blocks_are_fetched_again_on_their_own(self):
+        config = SeederConfig(corrupt_probability=0.1, corrupt_seeders=1, seed=1)
+        report = run_simulation(num_peers=2, size_bytes=1024 * 1024 + 1000, piece_length=65536,
+                num_files=2, config=config, timeout_s=60, hybrid=True)
+        self.assertTrue(report['verified'], report)
+        self.assertGreater(report['seeders']['corrupt_blocks'], 0)
+        self.assertGreater(report['seeders']['hash_requests'], 0)
+
+    def test_lightly_corrupt_seeders_are_kept(self):
+        # Every seeder sends the odd bad block. Banning on the first one would leave nobody.
+        config = SeederConfig(corrupt_probability=0.02, seed=2)
+        report = run_simulation(num_peers=3, size_bytes=16 * 1024 * 1024, piece_length=65536,
+                config=config, timeout_s=60, hybrid=True)
+        self.assertTrue(report['verified'], report)
+        self.assertGreaterEqual(report['seeders']['corrupt_blocks'], 10)
@@ -0,0 +1,79 @@
+import unittest
+import multiprocessing
+import threading
+from metrics import *
+from simulator.harness import run_simulation
+
+class RenderTests(unittest.TestCase):
+    def test_counter_and_gauge(self):
+        registry = Registry()
+        messages = registry.counter('messages_total', 'Messages', ('type',))
+        peers = registry.gauge('peers', 'Peers')
+        messages.inc(labels=('piece',))
+        messages.inc(2, labels=('piece',))
+        peers.set(3)
+
+        text = render([({'torrent': 'ab'}, registry.collect())])
+        self.assertIn('# TYPE messages_total counter', text)
+        self.assertIn('messages_total{torrent="ab",type="piece"} 3', text)
+        self.assertIn('peers{torrent="ab"} 3', text)
+
+    def test_histogram_buckets_are_cumulative(self):
+        registry = Registry()
+        latency = registry.histogram('latency_seconds', 'Latency', buckets=(0.1, 1.0))
+        for value in (0.05, 0.5, 5.0):
+            latency.observe(value)
+
+        text = render([({}, registry.collect())])
+        self.assertIn('latency_seconds_bucket{le="0.1"} 1', text)
+        self.assertIn('latency_seconds_bucket{le="1.0"} 2', text)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 3', text)
+        self.assertIn('latency_seconds_count 3', text)
+        self.assertIn('latency_seconds_sum 5.55', text)
+
+    def test_disabled_records_nothing(self):
+        engine_metrics = EngineMetrics(DISABLED)
+        engine_metrics.bytes_received.inc(100)
+        engine_metrics.poll_loop_seconds.observe(0.1)
+        self.assertEqual(DISABLED.collect(), {})
+
+class EngineMetricsTests(unittest.TestCase):
+    def run_download(self, **download_kwargs):
+        telemetry_queue = multiprocessing.Queue()
+        messages = []
+
+        def drain():
+            while True:
+                message = telemetry_queue.get()
+                if message is None:
+                    return
+                messages.append(message)
+        drainer = threading.Thread(target=drain)
+        drainer.start()
+
+        report = run_simulation(num_peers=2, size_bytes=1024 * 1024, piece_length=32768,
+                timeout_s=60, telemetry_queue=telemetry_queue, **download_kwargs)
+        telemetry_queue.put(None)
+        drainer.join()
+        self.assertTrue(report['verified'], report)
+        return [payload for kind, _, payload in messages if kind == MESSAGE_KIND]
+
+    def test_download_sends_metrics(self):
+        collected = self.run_download(metrics_enabled=True)
+        self.assertTrue(collected)
+        final = collected[-1]
+        self.assertEqual(final['tourint_pieces_verified_total']['samples'], [((), 32)])
+        bytes_received = final['tourint_bytes_received_total']['samples'][0][1]
+        self.assertGreaterEqual(bytes_received, 1024 * 1024)
+        piece_messages = dict(final['tourint_messages_received_total']['samples'])[('piece',)]
+        self.assertGreaterEqual(piece_messages, 1024 * 1024 // 16384)
+        # Every block is requested, but requests queued together go out in one send
+        socket_sends = final['tourint_socket_sends_total']['samples'][0][1]
+        self.assertLess(socket_sends, piece_messages)
+        connects = final['tourint_peer_connect_seconds']['samples']
+        self.assertEqual([labels for labels, _, _ in connects], [('ipv4',)])
+        self.assertIn('tourint_pieces_verified_total{torrent="ab"} 32',
+                render([({'torrent': 'ab'}, final)]))
+
+    def test_disabled_by_default(self):
+        self.assertEqual(self.run_download(), [])
@@ -0,0 +1,125 @@
+import hashlib
+import os
+import unittest
+
+import peer
+import piece_picker
+import ring_buffer
+
+Id = peer.PeerMessage.Id
+
+def have(piece_index) -> bytes:
+    return peer.PeerMessage(Id.HAVE, piece_index.to_bytes(4, byteorder='big')).serialize()
+
+def unknown_message() -> bytes:
+    # Message id 99 with a 3 byte payload
+    return (4).to_bytes(4, byteorder='big') + bytes([99]) + b'abc'
+
+class DecodeFramesTests(unittest.TestCase):
+    def test_decodes_every_complete_frame(self):
+        buf = ring_buffer.RingBuffer(64)
+        request = peer.PeerMessage.new_request(1, 0, 16384).serialize()
+        buf.write(have(7) + peer.PeerMessage(Id.KEEP_ALIVE).serialize() + unknown_message() +
+                request + have(8)[:5])
+        frames = peer.decode_frames(buf)
+        self.assertEqual(frames, [(Id.HAVE.value, 7), (Id.KEEP_ALIVE.value, None), (99, b'abc'),
+            (Id.REQUEST.value, request[5:])])
+        # The partial HAVE waits for the rest of it
+        self.assertEqual(len(buf), 5)
+        buf.write(have(8)[5:])
+        self.assertEqual(peer.decode_frames(buf), [(Id.HAVE.value, 8)])
+
+    def test_frames_wrapping_around_the_buffer(self):
+        buf = ring_buffer.RingBuffer(16)
+        buf.write(bytes(12))
+        buf.remove(12)
+        buf.write(have(3) + have(4)[:3])
+        self.assertEqual(peer.decode_frames(buf), [(Id.HAVE.value, 3)])
+        self.assertEqual(len(buf), 3)
+
+    def test_from_ring_buffer_skips_unknown_ids(self):
+        buf = ring_buffer.RingBuffer(64)
+        buf.write(unknown_message() + have(5))
+        message = peer.PeerMessage.from_ring_buffer(buf)
+        self.assertEqual((message.id, bytes(message.payload)), (Id.HAVE, (5).to_bytes(4, 'big')))
+
+class HandleMessagesTests(unittest.TestCase):
+    def setUp(self):
+        self.picker = piece_picker.PiecePicker(16)
+        self.connection = peer.PeerConnection({'ip': '127.0.0.1', 'port': 1}, bytes(20),
+                self.picker)
+        self.connection.socket.close()
+        self.connection.state = peer.PeerConnection.State.IDLE
+        self.connection.available_pieces = peer.Bitfield.empty(16)
+
+    def test_haves_and_state_messages(self):
+        self.connection.append_to_buffer(have(1) + have(2) + have(1) + unknown_message() +
+                peer.PeerMessage(Id.UNCHOKE).serialize() + have(40) + have(3))
+        self.connection.handle_messages_from_buffer(False)
+        self.assertEqual([i for i in range(16) if self.connection.peer_has_piece(i)], [1, 2, 3])
+        # Repeated HAVEs only count once, out of range ones not at all
+        self.assertEqual(self.picker.availability[:5], [0, 1, 1, 1, 0])
+        self.assertFalse(self.connection.choked)
+
+    def test_malformed_bitfields_are_rejected(self):
+        picker = piece_picker.PiecePicker(12)
+        connection = peer.PeerConnection({'ip': '127.0.0.1', 'port': 1}, bytes(20), picker)
+        connection.socket.close()
+        connection.state = peer.PeerConnection.State.IDLE
+        # Too short, too long, and a bit set for piece 12 of 12
+        for payload in (bytes(1), bytes(3), b'\x00\x08'):
+            connection.append_to_buffer(peer.PeerMessage(Id.BITFIELD, payload).serialize())
+            with self.assertRaises(ValueError):
+                connection.handle_messages_from_buffer(False)
+            self.assertIsNone(connection.available_pieces)
+            self.assertEqual(picker.availability, [0] * 12)
+
+        connection.append_to_buffer(peer.PeerMessage(Id.BITFIELD, b'\x80\x10').serialize())
+        connection.handle_messages_from_buffer(False)
+        self.assertEqual([i for i in range(12) if connection.peer_has_piece(i)], [0, 11])
+
+    def test_fast_extension_messages_need_the_extension(self):
+        allowed_fast = peer.PeerMessage(Id.ALLOWED_FAST, (4).to_bytes(4, 'big')).serialize()
+        self.connection.append_to_buffer(allowed_fast)
+        self.connection.handle_messages_from_buffer(False)
+        self.assertEqual(self.connection.allowed_fast, set())
+
+        self.connection.fast_extension = True
+        self.connection.message_handlers = self.connection.build_message_handlers()
+        self.connection.append_to_buffer(allowed_fast)
+        self.connection.handle_messages_from_buffer(False)
+        self.assertEqual(self.connection.allowed_fast, {4})
+
+class PieceHashTests(unittest.TestCase):
+    BLOCK: int = peer.PieceDownload.BLOCK_SIZE_BYTES
+
+    def setUp(self):
+        # Three and a half blocks, so the last one is short
+        self.data = os.urandom(self.BLOCK * 3 + self.BLOCK // 2)
+        self.download = peer.PieceDownload(7, len(self.data))
+
+    def receive(self, block, data=None):
+        begin = block * self.BLOCK
+        if data is None:
+            data = self.data[begin:begin + self.BLOCK]
+        payload = (7).to_bytes(4, 'big') + begin.to_bytes(4, 'big') + data
+        self.download.handle_block_response(memoryview(payload))
+
+    def test_hashes_blocks_as_the_prefix_grows(self):
+        self.receive(0)
+        self.assertEqual(self.download.hashed_bytes, self.BLOCK)
+        self.receive(2)
+        self.assertEqual(self.download.hashed_bytes, self.BLOCK)
+        self.receive(1)
+        self.assertEqual(self.download.hashed_bytes, self.BLOCK * 3)
+        self.receive(3)
+        self.assertTrue(self.download.all_blocks_received())
+        self.assertEqual(self.download.hashed_bytes, len(self.data))
+        self.assertEqual(self.download.digest(), hashlib.sha1(self.data).digest())
+
+    def test_duplicate_blocks_keep_the_first_copy(self):
+        for block in (3, 2, 1, 0):
+            self.receive(block)
+        self.receive(1, bytes(self.BLOCK))
+        self.assertEqual(bytes(self.download.piece_bytes), self.data)
+        self.assertEqual(self.download.digest(), hashlib.sha1(self.data).digest())
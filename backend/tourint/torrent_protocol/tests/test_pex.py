@@ -0,0 +1,59 @@
+import unittest
+
+import bencode
+import pex
+from simulator.harness import run_simulation
+from simulator.seeder import SeederConfig
+
+class PexMessageTests(unittest.TestCase):
+    def test_round_trip(self):
+        added = [('10.0.0.1', 6881), ('192.168.1.20', 51413)]
+        dropped = [('10.0.0.2', 6882)]
+        message = pex.pex_message(2, added, dropped)
+        self.assertEqual(message.payload[0], 2)
+        self.assertEqual(pex.parse_message(message.payload[1:]), (added, dropped))
+
+    def test_ipv6_peers_go_in_added6(self):
+        added = [('10.0.0.1', 6881), ('2001:db8::1', 51413)]
+        dropped = [('fe80::2', 6882)]
+        message = pex.pex_message(2, added, dropped)
+        body = bencode.decode(message.payload[1:])
+        self.assertEqual(len(body['added']), 6)
+        self.assertEqual(len(body['added6']), 18)
+        self.assertEqual(pex.parse_message(message.payload[1:]), (added, dropped))
+
+    def test_ascii_compact_peers(self):
+        # Compact addresses that happen to be ascii come out of bencode.decode as str
+        body = bencode.encode({'added': pex.encode_peers([('65.66.67.68', 0x4142)])})
+        self.assertEqual(pex.parse_message(body)[0], [('65.66.67.68', 0x4142)])
+
+    def test_caps_peers_per_message(self):
+        added = [('10.0.{}.{}'.format(i // 256, i % 256), 6881) for i in range(80)]
+        received, _ = pex.parse_message(pex.pex_message(2, added, []).payload[1:])
+        self.assertEqual(len(received), pex.MAX_PEERS_PER_MESSAGE)
+
+class PexStateTests(unittest.TestCase):
+    def test_sends_changes_at_most_once_per_interval(self):
+        state = pex.PexState()
+        a, b, c = ('10.0.0.1', 1), ('10.0.0.2', 2), ('10.0.0.3', 3)
+        self.assertEqual(state.next_update([a, b], now=0), ([a, b], []))
+        self.assertIsNone(state.next_update([b, c], now=30))
+        self.assertEqual(state.next_update([b, c], now=60), ([c], [a]))
+        self.assertIsNone(state.next_update([b, c], now=200))
+
+    def test_ignores_flooding(self):
+        state = pex.PexState()
+        self.assertTrue(state.accept_message(now=0))
+        self.assertFalse(state.accept_message(now=5))
+        self.assertTrue(state.accept_message(now=60))
+
+class PexSwarmTests(unittest.TestCase):
+    def test_finds_unannounced_seeders(self):
+        config = SeederConfig(pex=True, bandwidth_bps=512 * 1024)
+        report = run_simulation(num_peers=4, size_bytes=8 * 1024 * 1024, piece_length=65536,
+                config=config, timeout_s=60, num_announced=1)
+        self.assertTrue(report['verified'], report)
+        self.assertEqual(report['seeders_connected'], 4)
+        # Each seeder connected to exactly once, even though each one lists all the others
+        self.assertEqual(report['seeders']['connections'], 4)
+        self.assertGreater(report['seeders']['pex_messages_received'], 0)
@@ -0,0 +1,85 @@
+import unittest
+import time
+from piece_picker import *
+from peer import Bitfield
+
+def bitfield_with(num_pieces, pieces):
+    bitfield = Bitfield(bytearray((num_pieces + 7) // 8))
+    for i in pieces:
+        bitfield.set(i)
+    return bitfield
+
+class PiecePickerTests(unittest.TestCase):
+    def test_rarest_first(self):
+        picker = PiecePicker(4)
+        picker.peer_bitfield(bitfield_with(4, [0, 1, 2, 3]))
+        picker.peer_bitfield(bitfield_with(4, [0, 1, 3]))
+        picker.peer_have(0)
+
+        everything = bitfield_with(4, [0, 1, 2, 3])
+        self.assertEqual(picker.pick({0, 1, 2, 3}, everything), 2)
+        self.assertEqual(picker.pick({0, 1, 3}, bitfield_with(4, [0, 1])), 1)
+        self.assertIsNone(picker.pick({2}, bitfield_with(4, [0, 1])))
+        self.assertIsNone(picker.pick({0}, None))
+
+    def test_peer_lost(self):
+        picker = PiecePicker(2)
+        bitfield = bitfield_with(2, [1])
+        picker.peer_bitfield(bitfield)
+        picker.peer_lost(bitfield)
+        self.assertEqual(picker.availability, [0, 0])
+
+    def test_streaming_window_is_sequential(self):
+        picker = PiecePicker(10, streaming=True, streaming_window=3)
+        everything = bitfield_with(10, range(10))
+        picker.peer_bitfield(bitfield_with(10, [0, 1, 2]))
+
+        candidates = set(range(10))
+        order = []
+        for _ in range(3):
+            piece_index = picker.pick(candidates, everything)
+            candidates.remove(piece_index)
+            order.append(piece_index)
+        self.assertEqual(order, [0, 1, 2])
+
+        picker.piece_completed(0)
+        self.assertEqual(picker.read_cursor, 1)
+        self.assertEqual(picker.pick(candidates, everything), 3)
+
+    def test_deadline_beats_rarity(self):
+        picker = PiecePicker(4)
+        picker.peer_bitfield(bitfield_with(4, [0, 1, 2]))
+        picker.set_deadline(2, time.monotonic())
+        self.assertEqual(picker.pick({0, 2, 3}, bitfield_with(4, range(4))), 2)
+
+    def test_overdue_pieces(self):
+        picker = PiecePicker(4)
+        picker.set_deadline(1, time.monotonic() - 1)
+        picker.set_deadline(2, time.monotonic() + 100)
+        self.assertEqual(picker.overdue_pieces({1, 2}), [1])
+        self.assertEqual(picker.overdue_pieces({2}), [])
+
+    def test_priorities(self):
+        picker = PiecePicker(3)
+        picker.peer_bitfield(bitfield_with(3, [0]))
+        picker.set_priorities([Priority.HIGH, Priority.SKIP, Priority.LOW])
+        everything = bitfield_with(3, range(3))
+        self.assertEqual(picker.pick({0, 1, 2}, everything), 0)
+        self.assertEqual(picker.pick({1, 2}, everything), 2)
+        self.assertIsNone(picker.pick({1}, everything))
+
+        picker.set_deadline(1, time.monotonic())
+        self.assertIsNone(picker.pick({1}, everything))
+        self.assertEqual(Priority.from_name('High'), Priority.HIGH)
+        self.assertRaises(ValueError, Priority.from_name, 'urgent')
+
+    def test_suggested_beats_rarity_not_priority(self):
+        picker = PiecePicker(3)
+        picker.peer_bitfield(bitfield_with(3, [0, 1]))
+        everything = bitfield_with(3, range(3))
+        self.assertEqual(picker.pick({0, 1, 2}, everything), 2)
+        self.assertEqual(picker.pick({0, 1, 2}, everything, [7, 1]), 1)
+
+        picker.set_priorities([Priority.NORMAL, Priority.LOW, Priority.NORMAL])
+        self.assertEqual(picker.pick({0, 1, 2}, everything, [1]), 2)
+        self.assertEqual(picker.pick({0, 1, 2}, everything, [1, 0]), 0)
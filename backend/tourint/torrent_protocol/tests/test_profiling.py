@@ -0,0 +1,106 @@
+import unittest
+import json
+import multiprocessing
+import os
+import pstats
+import queue
+import tempfile
+import time
+from profiling import *
+import control
+import torrent_download
+from simulator.harness import Swarm, run_simulation
+from simulator.local_tracker import LocalTracker
+from simulator.seeder import SeederConfig
+from simulator.torrent_gen import generate_torrent
+
+class PhaseTimerTests(unittest.TestCase):
+    def test_disabled_records_nothing(self):
+        timer = PhaseTimer()
+        with timer.phase('verify'):
+            pass
+        self.assertEqual(timer.summary()['phases']['verify']['count'], 0)
+
+    def test_wall_and_cpu(self):
+        timer = PhaseTimer()
+        timer.start()
+        with timer.phase('verify'):
+            sum(range(200000))
+        with timer.phase('write'):
+            time.sleep(0.05)
+        phases = timer.stop()['phases']
+        self.assertEqual(phases['verify']['count'], 1)
+        self.assertGreater(phases['verify']['cpu_s'], 0)
+        # Sleeping takes wall time but no CPU
+        self.assertGreaterEqual(phases['write']['wall_s'], 0.05)
+        self.assertLess(phases['write']['cpu_s'], 0.02)
+
+class ProfilerTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_window_writes_files(self):
+        profiler = Profiler(PhaseTimer(), self.directory.name, 'abcd')
+        self.assertTrue(profiler.start(0.01))
+        self.assertFalse(profiler.start(0.01))
+        time.sleep(0.02)
+        self.assertTrue(profiler.expired())
+        summary = profiler.stop()
+        self.assertFalse(profiler.active)
+        pstats.Stats(summary['profile_path'])
+        with open(summary['phases_path']) as f:
+            self.assertEqual(set(json.load(f)['phases']), set(PHASES))
+
+    def test_whole_download(self):
+        report = run_simulation(num_peers=2, size_bytes=1024 * 1024, piece_length=32768,
+                timeout_s=60, profile=True, profile_directory=self.directory.name)
+        self.assertTrue(report['verified'], report)
+        phases_files = [f for f in os.listdir(self.directory.name) if f.endswith('.json')]
+        self.assertEqual(len(phases_files), 1)
+        with open(os.path.join(self.directory.name, phases_files[0])) as f:
+            phases = json.load(f)['phases']
+        self.assertEqual(phases['verify']['count'], 32)
+        self.assertEqual(phases['tracker']['count'], 1)
+        self.assertGreater(phases['parse']['count'], 0)
+        self.assertGreater(phases['write']['count'], 0)
+
+class ProfileCommandTests(unittest.TestCase):
+    def test_profile_window_on_running_download(self):
+        with tempfile.TemporaryDirectory() as directory:
+            tracker = LocalTracker()
+            tracker.start()
+            torrent = generate_torrent(directory, tracker.announce_url, 4 * 1024 * 1024, 65536)
+            swarm = Swarm(torrent, 2, SeederConfig(bandwidth_bps=1024 * 1024), tracker)
+            swarm.start()
+            telemetry = multiprocessing.Queue()
+            parent, child = multiprocessing.Pipe()
+            profile_directory = os.path.join(directory, 'profiles')
+            download = torrent_download.TorrentDownload(torrent.torrent_file,
+                    output_directory=os.path.join(directory, 'output'),
+                    telemetry_queue=telemetry, control_connection=child,
+                    profile_directory=profile_directory)
+            download.start()
+            child.close()
+            try:
+                control.send_command(parent, control.Command.PROFILE, duration_s=0.5)
+                deadline = time.monotonic() + 10
+                summary = None
+                while summary is None and time.monotonic() < deadline:
+                    try:
+                        kind, _, payload = telemetry.get(timeout=deadline - time.monotonic())
+                    except queue.Empty:
+                        break
+                    if kind == MESSAGE_KIND:
+                        summary = payload
+                self.assertIsNotNone(summary)
+                self.assertLess(summary['window_s'], 2)
+                self.assertTrue(os.path.exists(summary['profile_path']))
+                self.assertGreater(summary['phases']['parse']['count'], 0)
+            finally:
+                control.send_command(parent, control.Command.CANCEL)
+                download.join(10)
+                swarm.stop()
+                tracker.stop()
@@ -0,0 +1,55 @@
+import unittest
+import queue
+import threading
+from progress import *
+
+class ProgressReporterTests(unittest.TestCase):
+    def setUp(self):
+        self.flushes = []
+        self.flushed = threading.Event()
+
+    def sink(self, changed):
+        self.flushes.append(changed)
+        self.flushed.set()
+
+    def test_only_changed_fields_are_flushed(self):
+        reporter = ProgressReporter(self.sink)
+        reporter.update(downloaded_bytes=10, number_of_peers_connected=3)
+        reporter.flush()
+        reporter.update(downloaded_bytes=20, number_of_peers_connected=3)
+        reporter.flush()
+        reporter.flush()
+        self.assertEqual(self.flushes, [
+            {'downloaded_bytes': 10, 'number_of_peers_connected': 3},
+            {'downloaded_bytes': 20},
+        ])
+
+    def test_byte_delta_triggers_early_flush(self):
+        reporter = ProgressReporter(self.sink, interval_s=60, min_bytes_delta=100)
+        reporter.start()
+        reporter.update(downloaded_bytes=50)
+        self.assertFalse(self.flushed.wait(0.5))
+        reporter.update(downloaded_bytes=150)
+        self.assertTrue(self.flushed.wait(5))
+        reporter.close()
+        self.assertEqual(self.flushes, [{'downloaded_bytes': 150}])
+
+    def test_close_flushes(self):
+        reporter = ProgressReporter(self.sink, interval_s=60)
+        reporter.start()
+        reporter.update(completed=True)
+        reporter.close()
+        self.assertEqual(self.flushes, [{'completed': True}])
+
+class QueueSinkTests(unittest.TestCase):
+    def test_tags_updates_with_key(self):
+        q = queue.Queue()
+        reporter = ProgressReporter(QueueSink(q, 'abc'))
+        reporter.update(downloaded_bytes=10)
+        reporter.flush()
+        self.assertEqual(q.get_nowait(), ('progress', 'abc', {'downloaded_bytes': 10}))
+
+    def test_tags_updates_with_run_id(self):
+        q = queue.Queue()
+        QueueSink(q, 'abc', 'run1')({'paused': True})
+        self.assertEqual(q.get_nowait(), ('progress', 'abc', {'paused': True, 'run_id': 'run1'}))
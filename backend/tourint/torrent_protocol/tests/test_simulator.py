@@ -0,0 +1,53 @@
+import unittest
+from simulator.harness import run_simulation
+from simulator.seeder import SeederConfig
+
+class LoopbackSwarmTests(unittest.TestCase):
+    def test_download_completes(self):
+        report = run_simulation(num_peers=3, size_bytes=2 * 1024 * 1024 + 1000,
+                piece_length=65536, num_files=3, timeout_s=60)
+        self.assertTrue(report['verified'], report)
+
+    def test_download_recovers_from_bad_data(self):
+        config = SeederConfig(corrupt_probability=0.05, seed=1)
+        report = run_simulation(num_peers=2, size_bytes=1024 * 1024, piece_length=32768,
+                config=config, timeout_s=60)
+        self.assertTrue(report['verified'], report)
+        self.assertGreater(report['seeders']['corrupt_blocks'], 0)
+
+    def test_download_recovers_from_chokes(self):
+        # Slow enough that requests are still queued when the seeder chokes and drops them
+        config = SeederConfig(bandwidth_bps=4 * 1024 * 1024, choke_interval_s=0.2,
+                choke_duration_s=0.2)
+        report = run_simulation(num_peers=2, size_bytes=4 * 1024 * 1024, piece_length=65536,
+                config=config, timeout_s=60)
+        self.assertTrue(report['verified'], report)
+        self.assertGreater(report['seeders']['dropped_requests'], 0)
+
+class FastExtensionTests(unittest.TestCase):
+    def test_rejected_requests_are_requeued(self):
+        config = SeederConfig(bandwidth_bps=4 * 1024 * 1024, choke_interval_s=0.2,
+                choke_duration_s=0.2, fast_extension=True)
+        report = run_simulation(num_peers=2, size_bytes=4 * 1024 * 1024, piece_length=65536,
+                config=config, timeout_s=60)
+        self.assertTrue(report['verified'], report)
+        self.assertGreater(report['seeders']['rejected_requests'], 0)
+        self.assertEqual(report['seeders']['dropped_requests'], 0)
+
+    def test_allowed_fast_pieces_download_while_choked(self):
+        # The seeders never unchoke in time, so only allowed fast pieces can be downloaded
+        config = SeederConfig(fast_extension=True, allowed_fast=16, unchoke_delay_s=300)
+        report = run_simulation(num_peers=2, size_bytes=512 * 1024, piece_length=32768,
+                config=config, timeout_s=30)
+        self.assertTrue(report['verified'], report)
+
+class DualStackTests(unittest.TestCase):
+    def test_one_connection_per_seeder_over_either_family(self):
+        # Every seeder is announced at 127.0.0.1 and ::1. Both addresses get tried, and the
+        # connection that handshakes second is dropped.
+        config = SeederConfig(ipv6=True)
+        report = run_simulation(num_peers=3, size_bytes=1024 * 1024, piece_length=65536,
+                config=config, timeout_s=60)
+        self.assertTrue(report['verified'], report)
+        self.assertEqual(report['seeders_connected'], 3)
+        self.assertGreater(report['seeders']['ipv6_connections'], 0)
@@ -0,0 +1,47 @@
+import unittest
+import multiprocessing
+import threading
+from snapshot import *
+from simulator.harness import run_simulation
+
+class PieceMapTests(unittest.TestCase):
+    def test_round_trip(self):
+        pieces = {0, 7, 8, 1000, 1001, 4095}
+        encoded = encode_piece_map(pieces, 4097)
+        self.assertEqual(decode_piece_map(encoded, 4097), pieces)
+
+    def test_runs_compress(self):
+        encoded = encode_piece_map(range(50000), 100000)
+        self.assertLess(len(encoded), 200)
+
+    def test_eta(self):
+        self.assertEqual(estimate_eta_s(1000, 100), 10)
+        self.assertIsNone(estimate_eta_s(1000, 0))
+        self.assertEqual(estimate_eta_s(0, 0), 0)
+
+class EngineSnapshotTests(unittest.TestCase):
+    def test_download_sends_snapshots(self):
+        telemetry_queue = multiprocessing.Queue()
+        messages = []
+
+        def drain():
+            while True:
+                message = telemetry_queue.get()
+                if message is None:
+                    return
+                messages.append(message)
+        drainer = threading.Thread(target=drain)
+        drainer.start()
+
+        report = run_simulation(num_peers=2, size_bytes=1024 * 1024, piece_length=32768,
+                timeout_s=60, telemetry_queue=telemetry_queue)
+        telemetry_queue.put(None)
+        drainer.join()
+
+        self.assertTrue(report['verified'], report)
+        snapshots = [payload for kind, _, payload in messages if kind == MESSAGE_KIND]
+        self.assertTrue(snapshots)
+        final = snapshots[-1]
+        self.assertEqual(final['state'], 'completed')
+        self.assertEqual(final['bytes_left'], 0)
+        self.assertEqual(decode_piece_map(final['pieces']['completed_map'], 32), set(range(32)))
@@ -0,0 +1,99 @@
+import os
+import threading
+import time
+import unittest
+
+import utp
+from simulator.bottleneck import UdpBottleneck, compare_transports
+from simulator.harness import run_simulation
+
+class PacketTests(unittest.TestCase):
+    def test_round_trip(self):
+        packet = utp.Packet(utp.PacketType.DATA, 1234, 65535, 7, timestamp=99,
+                timestamp_difference=5, wnd_size=4096, payload=b'block',
+                selective_ack=utp.encode_selective_ack(7, [9, 12]))
+        parsed = utp.Packet.deserialize(packet.serialize())
+        self.assertEqual((parsed.type, parsed.connection_id, parsed.seq_nr, parsed.ack_nr,
+            parsed.timestamp, parsed.timestamp_difference, parsed.wnd_size, parsed.payload),
+            (utp.PacketType.DATA, 1234, 65535, 7, 99, 5, 4096, b'block'))
+        self.assertEqual(utp.decode_selective_ack(7, parsed.selective_ack), [9, 12])
+
+    def test_rejects_garbage(self):
+        with self.assertRaises(ValueError):
+            utp.Packet.deserialize(b'd1:ad2:id20:')
+
+    def test_sequence_numbers_wrap(self):
+        self.assertEqual(utp.seq_diff(2, 65534), 4)
+        self.assertEqual(utp.seq_diff(65534, 2), -4)
+        self.assertEqual(utp.decode_selective_ack(65534, utp.encode_selective_ack(65534, [1])),
+                [1])
+
+class UtpStreamTests(unittest.TestCase):
+    def setUp(self):
+        self.server = utp.UtpMultiplexer('127.0.0.1', 0, listen=True)
+        self.client = utp.UtpMultiplexer('127.0.0.1', 0)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+
+    def transfer(self, port, data) -> bytes:
+        stream = self.client.create_stream()
+        stream.settimeout(utp.CONNECT_TIMEOUT_S)
+        stream.connect(('127.0.0.1', port))
+        received = bytearray()
+        server_stream, _ = self.server.accept(timeout=utp.CONNECT_TIMEOUT_S)
+
+        def receive():
+            while True:
+                chunk = server_stream.recv(65536)
+                if not chunk:
+                    break
+                received.extend(chunk)
+            server_stream.close()
+
+        receiver = threading.Thread(target=receive)
+        receiver.start()
+        stream.sendall(data)
+        stream.close()
+        receiver.join(30)
+        return bytes(received)
+
+    def test_transfer(self):
+        data = os.urandom(4 * 1024 * 1024)
+        self.assertEqual(self.transfer(self.server.port, data), data)
+
+    def test_transfer_with_losses(self):
+        # A 16 KiB queue drops hundreds of packets, found again from the selective ACKs
+        link = UdpBottleneck(('127.0.0.1', self.server.port), 4 * 1024 * 1024, 16 * 1024)
+        data = os.urandom(2 * 1024 * 1024)
+        start = time.monotonic()
+        try:
+            self.assertEqual(self.transfer(link.port, data), data)
+        finally:
+            link.close()
+        self.assertGreater(link.link.dropped, 0)
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_connection_refused(self):
+        stream = self.server.create_stream()
+        with self.assertRaises(ConnectionRefusedError):
+            stream.connect(('127.0.0.1', self.client.port))
+        stream.close()
+
+class BottleneckTests(unittest.TestCase):
+    def test_ledbat_keeps_queue_short(self):
+        report = compare_transports(size_bytes=4 * 1024 * 1024, rate_bps=4 * 1024 * 1024,
+                buffer_bytes=1024 * 1024)
+        tcp, utp_result = report['tcp'], report['utp']
+        # TCP fills the 250 ms buffer, uTP stays around its 100 ms target
+        self.assertGreater(tcp['queue_delay_median_s'], 0.2)
+        self.assertLess(utp_result['queue_delay_median_s'], utp.CCONTROL_TARGET_US / 1e6)
+        self.assertGreater(utp_result['link_utilization'], 0.8)
+
+class UtpDownloadTests(unittest.TestCase):
+    def test_download_over_utp(self):
+        report = run_simulation(num_peers=3, size_bytes=4 * 1024 * 1024, piece_length=65536,
+                timeout_s=60, peer_transport='utp')
+        self.assertTrue(report['verified'], report)
+        self.assertEqual(report['seeders']['connections'], 3)
@@ -0,0 +1,41 @@
+import unittest
+import os
+import tempfile
+import snapshot
+from worker import *
+from simulator.harness import Swarm, verify_output
+from simulator.local_tracker import LocalTracker
+from simulator.seeder import SeederConfig
+from simulator.torrent_gen import generate_torrent
+from benchmarks.bench_startup import heavy_modules_after_import
+
+class WorkerTests(unittest.TestCase):
+    def test_engine_import_is_light(self):
+        self.assertEqual(heavy_modules_after_import('torrent_download'), [])
+
+    def test_worker_downloads_from_plain_options(self):
+        with tempfile.TemporaryDirectory() as directory:
+            tracker = LocalTracker()
+            tracker.start()
+            torrent = generate_torrent(directory, tracker.announce_url, 1024 * 1024, 32768,
+                    num_files=2)
+            swarm = Swarm(torrent, 2, SeederConfig(), tracker)
+            swarm.start()
+            try:
+                telemetry = get_context().Queue()
+                output_directory = os.path.join(directory, 'output')
+                process = start_worker(torrent.torrent_file, {
+                    'output_directory': output_directory,
+                    'file_priorities': ['normal', 'high'],
+                }, telemetry_queue=telemetry)
+
+                while True:
+                    kind, _, payload = telemetry.get(timeout=30)
+                    if kind == snapshot.MESSAGE_KIND and payload['state'] == 'completed':
+                        break
+                process.join(10)
+                self.assertEqual(process.exitcode, 0)
+                self.assertTrue(verify_output(torrent, output_directory))
+            finally:
+                swarm.stop()
+                tracker.stop()
@@ -1,38 +1,55 @@
 import hashlib
-import threading
 import os
 import pathlib
 import queue
 import select
-import random
+import socket
+import sys
+import time
 from multiprocessing import Process
-from collections import deque
-from typing import Dict, List
+from collections import Counter, deque
+from typing import Dict, List, NamedTuple, Set
 
 # TODO python imports suck
 if __package__ is None or __package__ == '':
     # This means I'm running the script directly which means I can't use relative imports
+    import addresses
     import bencode
     import tracker
     import peer
+    import disk_io
+    import piece_picker
+    import progress
+    import snapshot
+    import control
+    import metrics
+    import profiling
+    import dht
+    import consts
+    import transport
+    import merkle
 else:
+    from . import addresses
     from . import bencode
     from . import tracker
     from . import peer
+    from . import disk_io
+    from . import piece_picker
+    from . import progress
+    from . import snapshot
+    from . import control
+    from . import metrics
+    from . import profiling
+    from . import dht
+    from . import consts
+    from . import transport
+    from . import merkle
 
 TORRENT_OUTPUT_DIRECTORY: str = pathlib.Path(__file__).absolute().parent
-TORRENT_PIECE_ENDING: str = 'torrent_piece'
+PROFILE_DIRECTORY: str = TORRENT_OUTPUT_DIRECTORY/'profiles'
 
-def write_piece_to_file(info_hash, piece_idx, piece_bytes, output_directory):
-    piece_file_name = '{}_piece_{}.{}'.format(info_hash.hex(), piece_idx, TORRENT_PIECE_ENDING)
-    piece_file_path = os.path.join(output_directory, piece_file_name)
-
-    if os.path.exists(piece_file_path):
-        print('Failed to write file {} because it already exists'.format(piece_file_path))
-        return
-
-    with open(piece_file_path, 'wb+') as f:
-        f.write(piece_bytes)
+def default_output_directory(info_hash_hex) -> pathlib.Path:
+    return TORRENT_OUTPUT_DIRECTORY/("torrent_" + info_hash_hex)
 
 class PieceHashes:
     HASH_LENGTH: int = 20
@@ -50,6 +67,31 @@ class PieceHashes:
                 len(self.piece_hashes)))
         return self.piece_hashes[start_byte:end_byte]
 
+class PendingRead(NamedTuple):
+    """A control.Command.READ waiting for the pieces it covers"""
+    request_id: str
+    offset: int
+    length: int
+    pieces: Set[int]
+    # time.time() after which the reader has given up, as sent by the reader
+    deadline: float
+
+class BlockCheck:
+    """A piece of a hybrid torrent that failed its Merkle check, waiting on a peer for the leaf
+    hashes that tell which of its blocks were bad"""
+
+    def __init__(self, piece_index, download_state, tree: merkle.PieceTree, peer_connection):
+        self.piece_index = piece_index
+        self.download_state = download_state
+        self.tree = tree
+        # Who the hashes were asked of, and when
+        self.peer_connection = peer_connection
+        self.started = time.monotonic()
+        self.leaves = [None] * tree.width
+
+    def is_complete(self) -> bool:
+        return all(leaf is not None for leaf in self.leaves)
+
 class TorrentDownload(Process):
     """Class that handles downloading a single torrent file.
 
@@ -59,94 +101,684 @@ class TorrentDownload(Process):
     """
 
     MAX_NUM_CONNECTED_PEERS: int = 5 
-    def __init__(self, torrent_file: str, db_entry):
+    # Addresses learned through PEX that haven't been tried yet, per address family
+    MAX_PEER_CANDIDATES: int = 1000
+    # Happy eyeballs (RFC 8305): how long an attempt gets before the next candidate is tried
+    # alongside it, and how many attempts race at once
+    CONNECTION_ATTEMPT_DELAY_S: float = 0.25
+    MAX_CONNECTION_ATTEMPTS: int = 4
+    # How often to collect DHT peers, time out connection attempts and send PEX updates
+    PEER_MAINTENANCE_INTERVAL_S: float = 1.0
+    POLL_READ_FLAGS: int = select.POLLIN | select.POLLPRI | select.POLLHUP | select.POLLERR
+    # How often to look the torrent up in the DHT again, and how soon when no peer is connected
+    DHT_LOOKUP_INTERVAL_S: float = 15 * 60
+    DHT_RETRY_S: float = 30.0
+    # Poll timeout, so periodic work like rate reporting still happens when peers go quiet
+    POLL_TIMEOUT_MS: int = 1000
+    # How often pending reads are checked against the disk writer while any are waiting
+    READ_CHECK_INTERVAL_S: float = 0.05
+    RATE_INTERVAL_S: float = 1.0
+    # How often live progress is pushed to telemetry_queue
+    TELEMETRY_INTERVAL_S: float = 0.5
+    # How long a peer gets to answer a hash request before the whole piece is fetched again
+    HASH_REQUEST_TIMEOUT_S: float = 10.0
+    # A peer is banned once at least this many of its blocks were bad, and they make up at least
+    # BAN_BAD_BLOCK_FRACTION of the blocks it sent, so peers that only now and then send a bad
+    # block (a flaky link, say) are kept
+    BAN_MIN_BAD_BLOCKS: int = 4
+    BAN_BAD_BLOCK_FRACTION: float = 0.25
+
+    def __init__(self, torrent_file: str, progress_sink=None, output_directory=None,
+                 telemetry_queue=None,
+                 fsync_policy=disk_io.FsyncPolicy.ON_CLOSE,
+                 disk_cache_bytes=disk_io.DiskWriter.DEFAULT_MAX_CACHE_BYTES, streaming=False,
+                 streaming_window=piece_picker.PiecePicker.DEFAULT_STREAMING_WINDOW,
+                 file_priorities=None, control_connection=None, metrics_enabled=False,
+                 profile=False, profile_directory=PROFILE_DIRECTORY, dht_enabled=False,
+                 dht_bootstrap=None, dht_state_file=None, dht_port=0, peer_transport='tcp',
+                 run_id=None, reply_connection=None):
         Process.__init__(self)
         self.metainfo: Dict = tracker.decode_torrent_file(torrent_file)
-        self.announce_url = self.metainfo['announce']
+        # None for trackerless torrents, which find their peers through the DHT only
+        self.announce_url = tracker.get_announce_url(self.metainfo)
         self.info = self.metainfo['info']
 
+        if 'pieces' not in self.info:
+            raise ValueError('v2-only torrents are not supported, only v1 and hybrid ones')
         self.hashes = PieceHashes(self.info['pieces'])
+        # Hybrid torrents (BEP 52) are checked block by block against their Merkle trees. A
+        # hybrid from a magnet link has no piece layers, so it makes do with the SHA-1s.
+        self.piece_trees = None
+        if merkle.is_hybrid(self.info):
+            try:
+                self.piece_trees = merkle.PieceTrees(self.info,
+                        self.metainfo.get('piece layers', {}), len(self.hashes))
+            except ValueError as e:
+                print('Checking pieces with SHA-1 only: {}'.format(e))
 
         self.info_hash = hashlib.sha1(bencode.encode(self.info)).digest() 
 
-        self.output_directory = TORRENT_OUTPUT_DIRECTORY/("torrent_" + self.info_hash.hex())
+        if output_directory is None:
+            output_directory = default_output_directory(self.info_hash.hex())
+        self.output_directory = pathlib.Path(output_directory)
+        self.layout = disk_io.FileLayout(self.info, self.output_directory)
+        self.fsync_policy = fsync_policy
+        self.disk_cache_bytes = disk_cache_bytes
+        self.disk_writer = None
 
         self.poll_object = None
+        # Peer fds registered for POLLOUT, because their outbox didn't fit in the socket buffer
+        self.waiting_to_write = set()
+
+        # Sent over telemetry_queue with the snapshots. Disabled metrics are no-ops.
+        if metrics_enabled:
+            self.engine_metrics = metrics.EngineMetrics(metrics.Registry())
+        else:
+            self.engine_metrics = metrics.DISABLED_ENGINE_METRICS
+
+        # Phase timers and cProfile, for the whole run if profile is set, otherwise only while a
+        # PROFILE command's window is open
+        self.profile_whole_run = profile
+        self.phase_timer = profiling.PhaseTimer()
+        self.profiler = profiling.Profiler(self.phase_timer, profile_directory,
+                self.info_hash.hex())
 
         # maps from socket fd to peer connection object
         self.peer_connections = {}
+        # (ip, port) pairs to connect to when there's room, by address family, and every
+        # address seen so far so each is only tried once
+        self.peer_candidates = {family: deque(maxlen=self.MAX_PEER_CANDIDATES)
+                for family in (socket.AF_INET, socket.AF_INET6)}
+        self.known_addresses = set()
+        # Family and start time of the last connection attempt, see start_connection_attempts
+        self.last_attempt_family = socket.AF_INET
+        self.last_attempt_time = None
+        # Connections that finished their handshake first, see settle_race
+        self.handshaken = set()
+        self.last_maintenance_time = None
+
+        # Peers from the DHT as well as the tracker. The DhtService (and its thread) is only
+        # created in run, in the download process.
+        self.dht_enabled = dht_enabled
+        self.dht_bootstrap = dht.DEFAULT_BOOTSTRAP if dht_bootstrap is None else dht_bootstrap
+        self.dht_state_file = dht_state_file
+        self.dht_port = dht_port
+        self.dht = None
+        self.last_dht_lookup = None
+        # What peer connections run over, see transport.py. Like the DHT, a uTP transport owns
+        # a thread, so it's created in run.
+        self.peer_transport_name = peer_transport
+        self.peer_transport = None
+        # Byte counts of connections that were replaced in peer_connections
+        self.retired_bytes_received = 0
+        self.retired_bytes_sent = 0
 
         self.pieces_to_download = set([i for i in range(len(self.hashes))])
+        # Hybrid torrents only: hash requests waiting for an answer, by (pieces root, index),
+        # pieces whose good blocks are kept while the bad ones are fetched again, the peers that
+        # sent those bad blocks by piece, the good and bad blocks each peer sent, and peers that
+        # sent too many bad ones
+        self.block_checks: Dict = {}
+        self.partial_pieces: Dict[int, peer.PieceDownload] = {}
+        self.bad_block_sources: Dict[int, Set] = {}
+        self.good_block_counts = Counter()
+        self.bad_block_counts = Counter()
+        self.banned_addresses = set()
         self.completed_pieces = set()
+        # Pieces that belong to at least one file that isn't skipped
+        self.wanted_pieces = set(self.pieces_to_download)
+        self.skipped_files = set()
         self.num_dc = 0
 
-        self.db_entry = db_entry
-        self.db_entry.save()
+        self.picker = piece_picker.PiecePicker(len(self.hashes), streaming=streaming,
+                streaming_window=streaming_window)
+        if file_priorities:
+            self.set_file_priorities(file_priorities)
+        # READs from the control channel, answered as the pieces they cover reach the disk
+        self.pending_reads: List[PendingRead] = []
+
+        # Called from the reporter thread with the progress fields that changed, e.g. to write
+        # them to the database. Keeps slow sinks out of the download loop.
+        self.progress_sink = progress_sink
+        # multiprocessing queue that live progress (including rates) is streamed to, keyed by
+        # the info hash in hex, and tagged with run_id so a resumed download's progress isn't
+        # mixed up with the late updates of the run it replaced
+        self.telemetry_queue = telemetry_queue
+        self.run_id = run_id
+        self.reporters = []
+        self.downloaded_bytes = 0
+        self.download_rate_bps = 0
+
+        self.last_rate_time = None
+        self.last_bytes_received = 0
+        # Byte counts as of the last send_metrics
+        self.metrics_bytes_received = 0
+        self.metrics_bytes_sent = 0
+
+        # Our end of a multiprocessing Pipe the parent sends control.Command tuples over
+        self.control_connection = control_connection
+        # Our end of a one-way Pipe that READs are answered on, made non-blocking so a reader
+        # that stopped draining it can't stall the loop (see control.send_read_reply)
+        self.reply_connection = reply_connection
+        self.paused = False
+        self.cancelled = False
+        self.delete_data = False
+        self.rate_limiter = control.TokenBucket()
+        # bytes_received total already charged to rate_limiter
+        self.bytes_charged = 0
+
+    def report_progress(self, **fields):
+        for reporter in self.reporters:
+            reporter.update(**fields)
+
+    def start_reporters(self):
+        if self.progress_sink is not None:
+            self.reporters.append(progress.ProgressReporter(self.progress_sink))
+        if self.telemetry_queue is not None:
+            sink = progress.QueueSink(self.telemetry_queue, self.info_hash.hex(), self.run_id)
+            self.reporters.append(progress.ProgressReporter(sink,
+                interval_s=self.TELEMETRY_INTERVAL_S, min_bytes_delta=0))
+        for reporter in self.reporters:
+            reporter.start()
+
+    def report_rates(self):
+        now = time.monotonic()
+        if self.last_rate_time is None:
+            self.last_rate_time = now
+            return
+        elapsed = now - self.last_rate_time
+        if elapsed < self.RATE_INTERVAL_S:
+            return
+
+        bytes_received = self.total_bytes_received()
+        connected = sum(1 for p in self.peer_connections.values() if not p.is_disconnected())
+        for peer_connection in self.peer_connections.values():
+            peer_connection.update_rate(elapsed)
+        self.download_rate_bps = int((bytes_received - self.last_bytes_received) / elapsed)
+        self.report_progress(
+            download_rate_bps=self.download_rate_bps,
+            number_of_peers_connected=connected,
+        )
+        self.last_rate_time = now
+        self.last_bytes_received = bytes_received
+        self.send_snapshot()
+        self.send_metrics()
+
+    def total_bytes_received(self) -> int:
+        return self.retired_bytes_received + sum(p.bytes_received
+                for p in self.peer_connections.values())
+
+    def total_bytes_sent(self) -> int:
+        return self.retired_bytes_sent + sum(p.bytes_sent for p in self.peer_connections.values())
+
+    def snapshot(self) -> Dict:
+        """Returns the live state of the download as plain data, see snapshot.py"""
+        wanted_bytes = sum(self.get_piece_size(i) for i in self.wanted_pieces)
+        done_bytes = sum(self.get_piece_size(i) for i in self.completed_pieces & self.wanted_pieces)
+        bytes_left = wanted_bytes - done_bytes
+        in_progress = sorted(p.get_current_piece_index() for p in self.peer_connections.values()
+                if p.is_downloading())
+
+        return {
+            'file_hash': self.info_hash.hex(),
+            'state': self.state_name(),
+            'profiling': self.profiler.active,
+            'timestamp': time.time(),
+            'downloaded_bytes': self.downloaded_bytes,
+            'wanted_bytes': wanted_bytes,
+            'bytes_left': bytes_left,
+            'download_rate_bps': self.download_rate_bps,
+            'rate_limit_bps': self.rate_limiter.rate_bps,
+            'eta_s': snapshot.estimate_eta_s(bytes_left, self.download_rate_bps),
+            'pieces': {
+                'count': len(self.hashes),
+                'completed': len(self.completed_pieces),
+                'wanted': len(self.wanted_pieces),
+                'in_progress': in_progress,
+                'encoding': snapshot.PIECE_MAP_ENCODING,
+                'completed_map': snapshot.encode_piece_map(self.completed_pieces,
+                    len(self.hashes)),
+            },
+            'disk': {
+                'queue_depth': self.disk_writer.queue_depth() if self.disk_writer else 0,
+                'cached_bytes': self.disk_writer.cached_bytes if self.disk_writer else 0,
+                'full': self.disk_writer.is_full() if self.disk_writer else False,
+            },
+            'peers': [p.stats() for p in self.peer_connections.values()
+                if not p.is_disconnected()],
+        }
+
+    def send_metrics(self):
+        if self.telemetry_queue is not None and self.engine_metrics.registry.enabled:
+            # Byte counts and gauges are taken here rather than on every read
+            bytes_received = self.total_bytes_received()
+            bytes_sent = self.total_bytes_sent()
+            self.engine_metrics.bytes_received.inc(bytes_received - self.metrics_bytes_received)
+            self.engine_metrics.bytes_sent.inc(bytes_sent - self.metrics_bytes_sent)
+            self.metrics_bytes_received = bytes_received
+            self.metrics_bytes_sent = bytes_sent
+            self.engine_metrics.peers_active.set(sum(1 for p in self.peer_connections.values()
+                if not p.is_disconnected()))
+            self.engine_metrics.disk_queue_depth.set(self.disk_writer.queue_depth())
+            self.telemetry_queue.put((metrics.MESSAGE_KIND, self.info_hash.hex(),
+                self.engine_metrics.registry.collect()))
+
+    def state_name(self) -> str:
+        if self.is_complete():
+            return 'completed'
+        elif self.cancelled:
+            return 'cancelled'
+        elif self.paused:
+            return 'paused'
+        return 'downloading'
+
+    def send_snapshot(self):
+        if self.telemetry_queue is not None:
+            self.telemetry_queue.put((snapshot.MESSAGE_KIND, self.info_hash.hex(),
+                self.snapshot()))
 
     def contact_tracker(self):
-        return tracker.send_ths_request(self.announce_url, self.info_hash, self.info['length'])
+        return tracker.send_ths_request(self.announce_url, self.info_hash, self.bytes_left())
+
+    def bytes_left(self):
+        return self.layout.total_length - sum(self.get_piece_size(i) for i in self.completed_pieces)
 
     def setup_output_directory(self):
         print('Starting download in directory {}'.format(self.output_directory.as_posix()))
 
         if os.path.exists(self.output_directory):
-            print('Directory already exists, collecting all downloaded pieces...')
-            existing_piece_files = [f for f in os.listdir(self.output_directory) if
-                    f.endswith(TORRENT_PIECE_ENDING)]
-            for piece_file in existing_piece_files:
-                name = piece_file.split('.')[0]
-                split_name = name.split('_')
-                piece_index = int(split_name[2])
-                self.pieces_to_download.remove(piece_index)
+            print('Directory already exists, loading resume state...')
+            for piece_index in disk_io.load_resume_state(self.output_directory, len(self.hashes)):
+                self.pieces_to_download.discard(piece_index)
                 self.completed_pieces.add(piece_index)
+                self.picker.piece_completed(piece_index)
+                self.downloaded_bytes += self.get_piece_size(piece_index)
         else:
             print('Starting new download')
             os.makedirs(self.output_directory.as_posix())
-    
-    def combine_piece_files(self):
-        pass
+
+        self.disk_writer = disk_io.DiskWriter(self.layout, self.info['piece length'],
+                len(self.hashes), self.output_directory, written_pieces=self.completed_pieces,
+                max_cache_bytes=self.disk_cache_bytes, fsync_policy=self.fsync_policy,
+                engine_metrics=self.engine_metrics, phase_timer=self.phase_timer)
+        self.disk_writer.set_skipped_files(self.skipped_files)
+        self.disk_writer.start()
+        self.pieces_to_download &= self.wanted_pieces
+
+    def set_file_priorities(self, file_priorities):
+        """Sets the piece_picker.Priority of every file in the torrent.
+
+        Pieces that only cover skipped files are never requested, and skipped files are never
+        created on disk.
+        """
+        if len(file_priorities) != len(self.layout):
+            raise ValueError('Expected {} file priorities, got {}'
+                    .format(len(self.layout), len(file_priorities)))
+
+        piece_priorities = self.layout.piece_priorities(file_priorities, self.info['piece length'],
+                len(self.hashes))
+        self.picker.set_priorities(piece_priorities)
+        self.wanted_pieces = set(i for i, p in enumerate(piece_priorities)
+                if p != piece_picker.Priority.SKIP)
+        self.skipped_files = set(i for i, p in enumerate(file_priorities)
+                if p == piece_picker.Priority.SKIP)
+
+        if self.disk_writer is not None:
+            self.disk_writer.set_skipped_files(self.skipped_files)
+            # Pieces written while part of them belonged to a skipped file are missing data for
+            # any file that has since been un-skipped
+            for piece_index in self.disk_writer.partial_pieces & self.completed_pieces:
+                offset = piece_index * self.info['piece length']
+                files = set(f for f, _, _ in self.layout.segments(offset,
+                        self.get_piece_size(piece_index)))
+                if not files <= self.skipped_files:
+                    self.completed_pieces.discard(piece_index)
+                    self.downloaded_bytes -= self.get_piece_size(piece_index)
+
+        in_progress = set(p.get_current_piece_index() for p in self.peer_connections.values())
+        self.pieces_to_download = self.wanted_pieces - self.completed_pieces - in_progress
+
+    def is_complete(self):
+        return self.wanted_pieces <= self.completed_pieces
 
     def run(self):
+        if self.profile_whole_run:
+            self.profiler.start()
+        self.start_reporters()
         self.setup_output_directory()
-        self.initialize()
-        self.run_download()
+        self.report_progress(downloaded_bytes=self.downloaded_bytes)
+        try:
+            self.initialize()
+            self.run_download()
+            self.download_rate_bps = 0
+            if self.cancelled:
+                self.report_progress(cancelled=True, download_rate_bps=0,
+                        number_of_peers_connected=0)
+            elif self.paused:
+                self.report_progress(paused=True, download_rate_bps=0,
+                        number_of_peers_connected=0)
+            else:
+                self.report_progress(completed=True, download_rate_bps=0)
+            self.send_snapshot()
+            self.send_metrics()
+        finally:
+            # Writes out whatever is still cached, so the resume state covers every verified
+            # piece. Paused and cancelled downloads exit here, releasing their sockets and memory.
+            self.disk_writer.close()
+            if self.cancelled and self.delete_data:
+                disk_io.delete_download(self.layout, self.output_directory)
+            if self.profiler.active:
+                self.finish_profiling()
+            if self.dht is not None:
+                self.dht.stop()
+            if self.peer_transport is not None:
+                self.peer_transport.close()
+            for reporter in self.reporters:
+                reporter.close()
 
     def initialize(self):
-        tracker_response = self.contact_tracker()
-        peer_info_list = tracker_response['peers']
-        self.db_entry.number_of_seeders = len(peer_info_list)
+        self.peer_transport = transport.create(self.peer_transport_name)
+        if self.dht_enabled:
+            self.start_dht()
+
+        if self.announce_url is None and self.dht is None:
+            raise ValueError('Torrent has no tracker and the DHT is off, no way to find peers')
+        try:
+            tracker_peers = []
+            if self.announce_url is not None:
+                with self.phase_timer.phase('tracker'):
+                    tracker_response = self.contact_tracker()
+                tracker_peers = tracker.response_peers(tracker_response)
+        except Exception as e:
+            if self.dht is None:
+                raise
+            # The DHT lookup is already running, its peers get connected to as they come in
+            print('Tracker announce failed, relying on the DHT: {}'.format(e))
+            tracker_peers = []
+        self.report_progress(number_of_seeders=len(tracker_peers))
 
-        read_only_flags = select.POLLIN | select.POLLPRI | select.POLLHUP | select.POLLERR
         self.poll_object = select.poll()
-        for peer_info in peer_info_list:
-            peer_connection = peer.PeerConnection(peer_info, self.info_hash)
+        if self.control_connection is not None:
+            self.poll_object.register(self.control_connection.fileno(), self.POLL_READ_FLAGS)
+        if self.reply_connection is not None:
+            os.set_blocking(self.reply_connection.fileno(), False)
+
+        # Connected to from the download loop like any other candidates, IPv4 and IPv6 ones
+        # racing each other
+        self.add_peer_candidates(tracker_peers)
+        print('{} peers from the tracker'.format(len(tracker_peers)))
+        self.report_progress(number_of_peers_connected=0)
+
+    def start_dht(self):
+        self.dht = dht.DhtService(self.dht_bootstrap, self.dht_state_file, self.dht_port,
+                self.engine_metrics)
+        try:
+            self.dht.start()
+        except Exception as e:
+            print('Could not start the DHT: {}'.format(e))
+            self.dht.stop()
+            self.dht = None
+            return
+        self.lookup_dht()
+
+    def lookup_dht(self):
+        self.last_dht_lookup = time.monotonic()
+        # Announced on the same port as to the tracker
+        self.dht.find_peers(self.info_hash, consts.DEFAULT_PORT)
+
+    def add_peer_connection(self, peer_connection):
+        fd = peer_connection.socket.fileno()
+        replaced = self.peer_connections.get(fd)
+        if replaced is not None:
+            # A disconnected peer whose fd got reused. Keep its bytes in the totals.
+            self.retired_bytes_received += replaced.bytes_received
+            self.retired_bytes_sent += replaced.bytes_sent
+        self.peer_connections[fd] = peer_connection
+
+    def add_peer_candidates(self, peer_addresses):
+        for address in peer_addresses:
+            if address not in self.known_addresses:
+                self.known_addresses.add(address)
+                self.peer_candidates[addresses.family_of(address[0])].append(address)
+
+    def has_candidates(self) -> bool:
+        return any(self.peer_candidates.values())
+
+    def next_candidate(self):
+        """Alternates address families, IPv6 first, so a family that doesn't work from here only
+        holds up every other attempt"""
+        family = socket.AF_INET6 if self.last_attempt_family == socket.AF_INET else socket.AF_INET
+        if not self.peer_candidates[family]:
+            family = socket.AF_INET if family == socket.AF_INET6 else socket.AF_INET6
+        self.last_attempt_family = family
+        return self.peer_candidates[family].popleft()
+
+    def start_connection_attempts(self):
+        """Connects to candidates while below MAX_NUM_CONNECTED_PEERS, happy eyeballs style
+        (RFC 8305). The next attempt starts once none is pending, or CONNECTION_ATTEMPT_DELAY_S
+        after the last one started, without waiting for it, so a slow or unreachable address
+        (often a whole family) doesn't hold the others up. The attempts race each other, see
+        settle_race."""
+        now = time.monotonic()
+        while self.has_candidates():
+            live = [p for p in self.peer_connections.values() if not p.is_disconnected()]
+            connecting = sum(1 for p in live if p.is_connecting())
+            if len(live) - connecting >= self.MAX_NUM_CONNECTED_PEERS or\
+                    connecting >= self.MAX_CONNECTION_ATTEMPTS:
+                return
+            if connecting and now - self.last_attempt_time < self.CONNECTION_ATTEMPT_DELAY_S:
+                return
+            if self.connect_to_candidate(self.next_candidate()):
+                self.last_attempt_time = now
+
+    def settle_race(self, peer_connection):
+        """Called once a connection finishes its handshake. The first connections to get there
+        are kept; one to a peer we already have (e.g. over the other address family), or past
+        MAX_NUM_CONNECTED_PEERS, is dropped."""
+        self.handshaken = {p for p in self.handshaken if not p.is_disconnected()}
+        duplicate = any(p.peer_id == peer_connection.peer_id for p in self.handshaken)
+        if not duplicate and len(self.handshaken) < self.MAX_NUM_CONNECTED_PEERS:
+            self.handshaken.add(peer_connection)
+            return
+        print('Dropping {}: {}'.format(str(peer_connection),
+            'already connected to that peer' if duplicate else 'enough peers connected'))
+        self.engine_metrics.connect_races_lost.inc()
+        peer_connection.set_disconnected()
+        if not duplicate:
+            # Nothing wrong with the peer, so it's tried again once there's room
+            address = peer_connection.address()
+            self.peer_candidates[addresses.family_of(address[0])].append(address)
+
+    def poll_timeout_ms(self) -> int:
+        """Short enough to start the next connection attempt on time while some are pending, and
+        to notice pending reads reaching the disk"""
+        if self.pending_reads:
+            return int(self.READ_CHECK_INTERVAL_S * 1000)
+        if self.has_candidates() and\
+                any(p.is_connecting() for p in self.peer_connections.values()):
+            return int(self.CONNECTION_ATTEMPT_DELAY_S * 1000)
+        return self.POLL_TIMEOUT_MS
+
+    def maintain_peers(self):
+        """Collects DHT peers, times out connection attempts and sends PEX updates"""
+        now = time.monotonic()
+        if self.last_maintenance_time is not None and\
+                now - self.last_maintenance_time < self.PEER_MAINTENANCE_INTERVAL_S:
+            return
+        self.last_maintenance_time = now
+
+        if self.dht is not None:
+            self.add_peer_candidates(self.dht.take_peers())
+            num_connected = sum(1 for p in self.peer_connections.values()
+                    if not p.is_disconnected())
+            since_lookup = now - self.last_dht_lookup
+            if since_lookup >= self.DHT_LOOKUP_INTERVAL_S or\
+                    (num_connected == 0 and since_lookup >= self.DHT_RETRY_S):
+                self.lookup_dht()
+
+        for fd, peer_connection in list(self.peer_connections.items()):
+            if peer_connection.connect_timed_out():
+                print('Could not connect: {} timed out'.format(str(peer_connection)))
+                self.engine_metrics.connect_failures.inc(1, (peer_connection.family(),))
+                peer_connection.set_disconnected()
+                self.poll_object.unregister(fd)
+            elif peer_connection.address() in self.banned_addresses and\
+                    not peer_connection.is_disconnected():
+                print('Dropping {}, it sent bad blocks'.format(str(peer_connection)))
+                peer_connection.set_disconnected()
+                self.replace_disconnected_piece_index(peer_connection)
+                self.waiting_to_write.discard(fd)
+                self.poll_object.unregister(fd)
+
+        for check in set(self.block_checks.values()):
+            if check.peer_connection.is_disconnected() or\
+                    now - check.started >= self.HASH_REQUEST_TIMEOUT_S:
+                self.abandon_block_check(check, 'no answer from {}'.format(
+                    str(check.peer_connection)))
+
+        connected = [p for p in self.peer_connections.values() if p.is_idle() or p.is_downloading()]
+        candidates = [p.address() for p in connected]
+        for peer_connection in connected:
+            if peer_connection.supports_pex():
+                peer_connection.send_pex([a for a in candidates if a != peer_connection.address()])
+
+    def connect_to_candidate(self, address) -> bool:
+        if address in self.banned_addresses:
+            return False
+        ip, port = address
+        peer_connection = peer.PeerConnection({'ip': ip, 'port': port}, self.info_hash,
+                self.picker, self.engine_metrics, peer_transport=self.peer_transport,
+                v2=self.piece_trees is not None)
+        try:
+            peer_connection.start_connection()
+        except OSError as e:
+            print('Could not connect: {}'.format(e))
+            self.engine_metrics.connect_failures.inc(1, (peer_connection.family(),))
+            peer_connection.socket.close()
+            return False
+        self.add_peer_connection(peer_connection)
+        self.poll_object.register(peer_connection.socket, select.POLLOUT)
+        return True
+
+    def handle_connect_event(self, fd, peer_connection):
+        try:
+            with self.phase_timer.phase('connect'):
+                peer_connection.finish_connection()
+        except OSError as e:
+            print('Could not connect: {}'.format(e))
+            self.engine_metrics.connect_failures.inc(1, (peer_connection.family(),))
+            peer_connection.set_disconnected()
+            self.poll_object.unregister(fd)
+            return
+        self.engine_metrics.peer_connect_seconds.observe(
+                time.monotonic() - peer_connection.connect_started, (peer_connection.family(),))
+        self.poll_object.modify(fd, self.POLL_READ_FLAGS)
+
+    def is_control_fd(self, fd):
+        return self.control_connection is not None and fd == self.control_connection.fileno()
+
+    def handle_control_event(self, event):
+        if not event & select.POLLIN:
+            # Parent went away. Keep downloading, there's just nobody to take orders from.
+            self.poll_object.unregister(self.control_connection.fileno())
+            self.control_connection = None
+            return
+        try:
+            while self.control_connection.poll():
+                self.handle_command(*control.receive_command(self.control_connection))
+        except (EOFError, OSError):
+            self.poll_object.unregister(self.control_connection.fileno())
+            self.control_connection = None
+
+    def handle_command(self, command, arguments):
+        print('Got command {} {}'.format(command.value, arguments))
+        if command == control.Command.PAUSE:
+            self.paused = True
+        elif command == control.Command.CANCEL:
+            self.cancelled = True
+            self.delete_data = bool(arguments.get('delete_data', False))
+        elif command == control.Command.SET_RATE_LIMIT:
+            self.rate_limiter.set_rate(int(arguments.get('bytes_per_second', 0)))
+        elif command == control.Command.PROFILE:
+            duration_s = float(arguments.get('duration_s', control.DEFAULT_PROFILE_S))
+            if not self.profiler.start(duration_s, bool(arguments.get('cprofile', True))):
+                print('Already profiling')
+        elif command == control.Command.SET_FILE_PRIORITIES:
             try:
-                peer_connection.initialize_connection()
-            except Exception as e:
-                print('Could not connect: {}'.format(e))
-                continue
-            self.peer_connections[peer_connection.socket.fileno()] = peer_connection
-            self.poll_object.register(peer_connection.socket, read_only_flags)
+                self.set_file_priorities([piece_picker.Priority.from_name(p)
+                        for p in arguments['priorities']])
+            except (KeyError, TypeError, ValueError) as e:
+                print('Bad file priorities: {}'.format(e))
+        elif command == control.Command.READ:
+            # Answered over the pipe, no snapshot needed
+            self.start_read(arguments)
+            return
+        self.send_snapshot()
 
-        print('initialized {} connections'.format(len(self.peer_connections)))
-        self.db_entry.number_of_peers_connected = len(self.peer_connections)
-        self.db_entry.save()
+    def finish_profiling(self):
+        summary = self.profiler.stop()
+        print('Profile written to {}'.format(summary.get('profile_path', summary['phases_path'])))
+        if self.telemetry_queue is not None:
+            self.telemetry_queue.put((profiling.MESSAGE_KIND, self.info_hash.hex(), summary))
 
-    def handle_poll_event_for_peer(self, peer_connection, event):
-        if event == select.POLLHUP or event == select.POLLRDHUP:
+    def io_wait_s(self) -> float:
+        """How long to leave the peer sockets alone for to stay under the rate limit.
+
+        Not reading makes the peers' TCP windows fill up, which slows them down for us.
+        """
+        bytes_received = self.total_bytes_received()
+        self.rate_limiter.consume(bytes_received - self.bytes_charged)
+        self.bytes_charged = bytes_received
+        return self.rate_limiter.wait_s()
+
+    def wait_for_commands(self, timeout_s):
+        if self.control_connection is None:
+            time.sleep(timeout_s)
+        elif self.control_connection.poll(timeout_s):
+            self.handle_control_event(select.POLLIN)
+
+    def handle_poll_event_for_peer(self, fd, peer_connection, event):
+        if event & select.POLLOUT:
+            self.flush_peer(fd, peer_connection)
+            if peer_connection.is_disconnected():
+                return
+        if event & select.POLLIN:
+            peer_connection.read_from_socket()
+            peer_connection.run_state_machine()
+        elif event & select.POLLHUP:
             self.num_dc += 1
             print('{} disconnected: {}'.format(str(peer_connection), self.num_dc))
             peer_connection.set_disconnected()
             self.replace_disconnected_piece_index(peer_connection)
-            self.poll_object.unregister(peer_connection.socket.fileno())
-        elif event == select.POLLIN:
-            peer_connection.read_from_socket()
-            peer_connection.run_state_machine()
-        elif event == select.POLLERR:
+        elif event & select.POLLERR:
             print('peer had error??')
-        elif event == select.POLLNVAL:
-            #print('peer {} invalid??'.format(peer_connection))
-            pass
+
+    def flush_writes(self):
+        """Writes out what every connection queued since the last poll, one send each"""
+        for fd, peer_connection in self.peer_connections.items():
+            if peer_connection.is_connecting() or not peer_connection.has_pending_writes():
+                continue
+            self.flush_peer(fd, peer_connection)
+            if peer_connection.is_disconnected():
+                self.replace_disconnected_piece_index(peer_connection)
+                self.poll_object.unregister(fd)
+
+    def flush_peer(self, fd, peer_connection):
+        """Flushes one connection's outbox, polling for POLLOUT only while some of it is left"""
+        try:
+            with self.phase_timer.phase('send'):
+                pending = peer_connection.flush()
+        except OSError as e:
+            print('{}: send failed: {}'.format(str(peer_connection), e))
+            peer_connection.set_disconnected()
+            self.waiting_to_write.discard(fd)
+            return
+        if pending and fd not in self.waiting_to_write:
+            self.waiting_to_write.add(fd)
+            self.poll_object.modify(fd, self.POLL_READ_FLAGS | select.POLLOUT)
+        elif not pending and fd in self.waiting_to_write:
+            self.waiting_to_write.discard(fd)
+            self.poll_object.modify(fd, self.POLL_READ_FLAGS)
 
     def in_end_game(self):
         idle_peers = [p for p in self.peer_connections.values() if p.is_idle()]
@@ -155,7 +787,7 @@ class TorrentDownload(Process):
     
     def stop_download(self, cancelled_piece_index=None):
         for p in self.peer_connections.values():
-            if not cancelled_piece_index or cancelled_piece_index == p.get_current_piece_index():
+            if cancelled_piece_index is None or cancelled_piece_index == p.get_current_piece_index():
                 p.cancel_piece_download()
 
     def replace_disconnected_piece_index(self, peer):
@@ -164,87 +796,352 @@ class TorrentDownload(Process):
         if unfinished_piece >= 0:
             self.pieces_to_download.add(unfinished_piece)
 
+    def start_read(self, arguments):
+        """Handles a control.Command.READ of a byte range of the torrent. It's answered once every
+        piece the range covers is verified and written to its files, which the reader then reads
+        itself. In streaming mode the read also moves the picker's read cursor, so sequential
+        readers pull the download along behind them."""
+        request_id = arguments.get('request_id')
+        if self.reply_connection is None or not isinstance(request_id, str) or\
+                len(request_id) > control.MAX_REQUEST_ID_CHARS:
+            print('Dropping unanswerable read {}'.format(arguments))
+            return
+        try:
+            offset, length = int(arguments['offset']), int(arguments['length'])
+            deadline = float(arguments['deadline'])
+            if offset < 0 or length < 0 or offset + length > self.layout.total_length:
+                raise ValueError('range {}+{} outside of torrent of size {}'.format(offset,
+                    length, self.layout.total_length))
+            if length > control.MAX_READ_BYTES:
+                raise ValueError('reads are limited to {} bytes'.format(control.MAX_READ_BYTES))
+            piece_length = self.info['piece length']
+            first_piece = offset // piece_length
+            last_piece = (offset + max(length, 1) - 1) // piece_length
+            needed = set(range(first_piece, last_piece + 1))
+            if not needed <= self.wanted_pieces:
+                raise ValueError('range {}+{} covers skipped files'.format(offset, length))
+        except (KeyError, TypeError, ValueError) as e:
+            self.send_read_reply(request_id, 'Bad read: {}'.format(e))
+            return
+
+        self.picker.set_read_cursor(first_piece)
+        now = time.monotonic()
+        for piece_index in needed - self.completed_pieces:
+            self.picker.set_deadline(piece_index, now)
+        self.pending_reads.append(PendingRead(request_id, offset, length, needed, deadline))
+        self.answer_reads()
+
+    def answer_reads(self):
+        """Answers the pending reads whose pieces are all on disk, and forgets the ones the
+        reader has stopped waiting for"""
+        now = time.time()
+        waiting = []
+        for pending in self.pending_reads:
+            if now >= pending.deadline:
+                continue
+            if pending.pieces <= self.completed_pieces and\
+                    self.disk_writer.on_disk(pending.pieces):
+                self.send_read_reply(pending.request_id)
+            else:
+                waiting.append(pending)
+        self.pending_reads = waiting
+
+    def send_read_reply(self, request_id, error=None):
+        if not control.send_read_reply(self.reply_connection, request_id, error):
+            print('Dropped the reply to read {}, nobody is reading them'.format(request_id))
+
+    def on_piece_verified(self, piece_index, piece_bytes):
+        # Backpressure: blocks only while the write-back cache is full. No new pieces are assigned
+        # while it is (see run_download), so at worst this waits on pieces that were already
+        # being downloaded when it filled up.
+        self.disk_writer.submit(piece_index, piece_bytes)
+        self.picker.piece_completed(piece_index)
+        if piece_index not in self.completed_pieces:
+            self.completed_pieces.add(piece_index)
+            self.downloaded_bytes += self.get_piece_size(piece_index)
+
     def get_piece_size(self, piece_index):
         if piece_index == len(self.hashes) - 1:
             # This is the last piece, so might be smaller than the piece length
-            return self.info['length'] % self.info['piece length']
+            return self.layout.total_length - piece_index * self.info['piece length']
         return self.info['piece length']
     
     def run_download(self):
         print('Download starting...')
-        while len(self.completed_pieces) < len(self.hashes):
-            for fd, event in self.poll_object.poll():
+        while not self.is_complete() and not self.cancelled and not self.paused:
+            self.report_rates()
+            self.maintain_peers()
+            if self.pending_reads:
+                self.answer_reads()
+            self.start_connection_attempts()
+            if self.profiler.expired():
+                self.finish_profiling()
+            wait_s = self.io_wait_s()
+            if wait_s > 0:
+                self.wait_for_commands(wait_s)
+                continue
+
+            self.flush_writes()
+            events = self.poll_object.poll(self.poll_timeout_ms())
+            batch_start = time.perf_counter()
+            for fd, event in events:
+                if self.is_control_fd(fd):
+                    self.handle_control_event(event)
+                    continue
+                if self.paused or self.cancelled:
+                    break
+
                 peer_connection = self.peer_connections[fd]
-                self.handle_poll_event_for_peer(peer_connection, event)
+                if peer_connection.is_connecting():
+                    self.handle_connect_event(fd, peer_connection)
+                    continue
+                with self.phase_timer.phase('parse'):
+                    self.handle_poll_event_for_peer(fd, peer_connection, event)
+                if peer_connection.peer_id is not None and\
+                        peer_connection not in self.handshaken and\
+                        not peer_connection.is_disconnected():
+                    self.settle_race(peer_connection)
+                self.add_peer_candidates(peer_connection.take_pex_peers())
+                for reply in peer_connection.take_hash_replies():
+                    self.handle_hash_reply(peer_connection, *reply)
+                abandoned_piece = peer_connection.take_abandoned_piece()
+                if abandoned_piece is not None:
+                    self.pieces_to_download.add(abandoned_piece)
 
                 if peer_connection.is_disconnected():
                     peer_connection.set_disconnected()
                     self.replace_disconnected_piece_index(peer_connection)
+                    self.waiting_to_write.discard(fd)
                     self.poll_object.unregister(fd)
                 elif peer_connection.is_download_completed():
                     completed_piece_index = peer_connection.get_current_piece_index()
                     piece_bytes = peer_connection.get_piece_bytes()
-                    piece_hash = self.hashes[completed_piece_index]
-                    calculated_hash = hashlib.sha1(piece_bytes).digest()
-                    if piece_hash != calculated_hash:
-                        print('Bad hash! c: {} vs r: {}'.format(calculated_hash, piece_hash))
-                        self.pieces_to_download.add(completed_piece_index)
+                    hash_start = time.perf_counter()
+                    with self.phase_timer.phase('verify'):
+                        verified = self.check_piece(peer_connection, completed_piece_index)
+                    self.engine_metrics.piece_hash_seconds.observe(
+                            time.perf_counter() - hash_start)
+                    if not verified:
+                        self.engine_metrics.hash_failures.inc()
+                        self.handle_bad_piece(peer_connection, completed_piece_index)
                     else:
-                        self.completed_pieces.add(completed_piece_index)
-                        write_piece_to_file(self.info_hash, completed_piece_index, piece_bytes,
-                                self.output_directory)
+                        self.engine_metrics.pieces_verified.inc()
+                        if self.piece_trees:
+                            self.credit_blocks(completed_piece_index,
+                                    peer_connection.download_state)
+                        self.on_piece_verified(completed_piece_index, piece_bytes)
 
                         if self.in_end_game():
                             self.stop_download(completed_piece_index)
                             if completed_piece_index in self.pieces_to_download:
                                 self.pieces_to_download.remove(completed_piece_index)
 
-                        pct_complete = len(self.completed_pieces) / len(self.hashes) * 100
+                        num_completed = len(self.completed_pieces & self.wanted_pieces)
+                        pct_complete = num_completed / len(self.wanted_pieces) * 100
                         print('Got {} / {} pieces. {}% complete'
-                               .format(len(self.completed_pieces), len(self.hashes), pct_complete),
+                               .format(num_completed, len(self.wanted_pieces), pct_complete),
                                end='\r')
-                        self.db_entry.downloaded_bytes = len(self.completed_pieces) * self.info['piece length']
-                        self.db_entry.save()
+                        self.report_progress(downloaded_bytes=self.downloaded_bytes)
 
                 if self.in_end_game():
-                    # This might not be exactly the situation that the spec says is the 'end game'
-                    # but whatever
+                    with self.phase_timer.phase('schedule'):
+                        self.schedule_end_game()
+                elif peer_connection.is_idle() and peer_connection.can_download() and\
+                        not self.disk_writer.is_full():
+                    with self.phase_timer.phase('schedule'):
+                        self.assign_piece(peer_connection)
 
-                    # blast all idle peers with the next not downloaded piece 
-                    if len(self.pieces_to_download) > 0:
-                        next_piece = next(iter(self.pieces_to_download))
-                    else:
-                        # In case any peers are still connected but have been choked for a long
-                        # time, if we run out of pieces in pieces_to_download, start downloading
-                        # pieces that are being actively downloaded and let all the connections
-                        # race.
-                        try:
-                            next_piece = next(p.get_current_piece_index() for p in\
-                                self.peer_connections.values() if p.is_downloading())
-                        except StopIteration:
-                            # This means we're done, I think
-                            continue
+            if events:
+                self.engine_metrics.poll_loop_seconds.observe(time.perf_counter() - batch_start)
 
-                    idle_peers = [p for p in self.peer_connections.values() if p.is_idle() and\
-                            not p.choked]
+        print('\n')
+        if self.paused or self.cancelled:
+            print('Stopped: {}'.format(self.state_name()))
+        else:
+            print('Done!')
+        for p in self.peer_connections.values():
+            p.set_disconnected()
+        self.disk_writer.flush()
+        if self.pending_reads:
+            self.answer_reads()
 
-                    for p in idle_peers:
-                        p.start_piece_download(next_piece, self.get_piece_size(next_piece))
+    def schedule_end_game(self):
+        # This might not be exactly the situation that the spec says is the 'end game'
+        # but whatever
 
-                elif peer_connection.is_idle() and len(self.pieces_to_download) > 0:
-                    next_piece = random.sample(self.pieces_to_download, 1)[0]
-                    self.pieces_to_download.remove(next_piece)
-                    peer_connection.start_piece_download(next_piece, self.get_piece_size(next_piece))
+        # blast all idle peers with the next not downloaded piece 
+        if len(self.pieces_to_download) > 0:
+            next_piece = next(iter(self.pieces_to_download))
+        else:
+            # In case any peers are still connected but have been choked for a long
+            # time, if we run out of pieces in pieces_to_download, start downloading
+            # pieces that are being actively downloaded and let all the connections
+            # race.
+            try:
+                next_piece = next(p.get_current_piece_index() for p in\
+                    self.peer_connections.values() if p.is_downloading())
+            except StopIteration:
+                # This means we're done, I think
+                return
 
+        idle_peers = [p for p in self.peer_connections.values() if p.is_idle() and\
+                p.can_request_piece(next_piece)]
 
-        print('\n')
-        print('Done!')
-        for p in self.peer_connections.values():
-            p.set_disconnected()
+        for p in idle_peers:
+            self.start_piece_download(p, next_piece)
+
+    def assign_piece(self, peer_connection):
+        if peer_connection.address() in self.banned_addresses:
+            # Dropped at the next maintain_peers
+            return
+        candidates = self.pieces_to_download
+        if peer_connection.choked:
+            # Only allowed fast pieces can be downloaded while choked
+            candidates = set(i for i in peer_connection.allowed_fast if i in candidates)
+        elif peer_connection.rejected_pieces:
+            candidates = candidates - peer_connection.rejected_pieces
+        if self.bad_block_sources:
+            candidates = candidates - self.pieces_to_fetch_elsewhere(peer_connection)
+        next_piece = self.picker.pick(candidates, peer_connection.available_pieces,
+                peer_connection.suggested_pieces)
+        if next_piece is not None:
+            self.pieces_to_download.remove(next_piece)
+        else:
+            # Nothing left to hand out, but help out with a piece that's holding up a reader
+            in_progress = set(p.get_current_piece_index() for p in self.peer_connections.values()
+                    if p.is_downloading())
+            overdue = [i for i in self.picker.overdue_pieces(in_progress)
+                    if peer_connection.peer_has_piece(i) and peer_connection.can_request_piece(i)]
+            if not overdue:
+                return
+            next_piece = overdue[0]
+
+        self.start_piece_download(peer_connection, next_piece)
+
+    def start_piece_download(self, peer_connection, piece_index):
+        """Has peer_connection download a piece, picking up where a piece with bad blocks left
+        off if there is one"""
+        download_state = None
+        if peer_connection.peer_has_piece(piece_index):
+            download_state = self.partial_pieces.pop(piece_index, None)
+        tree = self.piece_trees.get(piece_index) if self.piece_trees else None
+        if download_state is None and tree is not None:
+            download_state = peer.PieceDownload(piece_index, self.get_piece_size(piece_index),
+                    leaf_bytes=tree.data_length)
+        peer_connection.start_piece_download(piece_index, self.get_piece_size(piece_index),
+                download_state)
+
+    def pieces_to_fetch_elsewhere(self, peer_connection) -> Set[int]:
+        """Pieces peer_connection sent bad blocks of, which another connected peer that has
+        them is asked for instead"""
+        address = peer_connection.address()
+        others = [p for p in self.peer_connections.values() if p is not peer_connection and
+                (p.is_idle() or p.is_downloading()) and p.address() not in self.banned_addresses]
+        return set(i for i, sources in self.bad_block_sources.items() if address in sources and
+                any(p.peer_has_piece(i) and p.address() not in sources for p in others))
+
+    def credit_blocks(self, piece_index, download_state):
+        """Counts the blocks of a verified piece as good for the peers they came from"""
+        self.bad_block_sources.pop(piece_index, None)
+        self.good_block_counts.update(source for source in download_state.block_sources.values()
+                if source is not None)
+
+    def check_piece(self, peer_connection, piece_index) -> bool:
+        tree = self.piece_trees.get(piece_index) if self.piece_trees else None
+        if tree is None:
+            # Blocks were hashed as they arrived, this only finishes it off
+            return peer_connection.get_piece_hash() == self.hashes[piece_index]
+        download_state = peer_connection.download_state
+        return tree.check(download_state.leaves()) and download_state.padding_is_zero()
+
+    def handle_bad_piece(self, peer_connection, piece_index):
+        """Fetches a piece that failed its check again. For a hybrid torrent, only its bad
+        blocks, once a peer has sent the leaf hashes that say which those are."""
+        tree = self.piece_trees.get(piece_index) if self.piece_trees else None
+        if tree is None:
+            print('Bad hash! piece {} from {}'.format(piece_index, str(peer_connection)))
+            self.pieces_to_download.add(piece_index)
+            return
+
+        check = BlockCheck(piece_index, peer_connection.download_state, tree, peer_connection)
+        peer_connection.cancel_piece_download()
+        if tree.width == 1:
+            # The piece is one block and its node in the tree is that block's hash
+            check.leaves = [tree.root]
+            self.finish_block_check(check)
+            return
+
+        if not peer_connection.v2:
+            check.peer_connection = next((p for p in self.peer_connections.values()
+                if p.v2 and (p.is_idle() or p.is_downloading())), None)
+            if check.peer_connection is None:
+                print('Bad piece {}, but no peer to ask for its hashes'.format(piece_index))
+                self.pieces_to_download.add(piece_index)
+                return
+        for index, length, proof_layers in tree.hash_requests():
+            check.peer_connection.request_hashes(tree.pieces_root, index, length, proof_layers)
+            self.block_checks[(tree.pieces_root, index)] = check
+
+    def handle_hash_reply(self, peer_connection, pieces_root, base_layer, index, length,
+                          proof_layers, hashes):
+        check = self.block_checks.pop((pieces_root, index), None)
+        if check is None:
+            return
+        if hashes is None:
+            self.abandon_block_check(check, '{} rejected the hash request'.format(
+                str(peer_connection)))
+            return
+        # Whoever sent them, the hashes have to add up to the piece's node in the piece layer
+        subtree_root = merkle.root(hashes[:length])
+        if base_layer != 0 or merkle.root_from_proof(subtree_root, index // length,
+                hashes[length:]) != check.tree.root:
+            self.abandon_block_check(check, 'hashes from {} do not check out'.format(
+                str(peer_connection)))
+            return
+        offset = index - check.tree.first_leaf
+        check.leaves[offset:offset + length] = hashes[:length]
+        if check.is_complete():
+            self.finish_block_check(check)
+
+    def finish_block_check(self, check):
+        """Blames each bad block on the peer it came from and fetches only those again, from
+        another peer if there is one. Peers are banned once too many of their blocks were bad,
+        see BAN_MIN_BAD_BLOCKS."""
+        if check.piece_index in self.completed_pieces:
+            return
+        bad_blocks = check.download_state.bad_blocks(check.leaves[:check.tree.num_blocks()])
+        if not bad_blocks:
+            self.abandon_block_check(check, 'no bad blocks in it')
+            return
+        for block in bad_blocks:
+            source = check.download_state.block_sources.get(block)
+            print('Block {} of piece {} from {} is bad'.format(block, check.piece_index, source))
+            self.engine_metrics.bad_blocks.inc()
+            if source is None:
+                continue
+            self.bad_block_counts[source] += 1
+            self.bad_block_sources.setdefault(check.piece_index, set()).add(source)
+            num_bad = self.bad_block_counts[source]
+            if num_bad >= self.BAN_MIN_BAD_BLOCKS and num_bad >=\
+                    self.BAN_BAD_BLOCK_FRACTION * (num_bad + self.good_block_counts[source]):
+                print('Banning {}, {} of its blocks were bad'.format(source, num_bad))
+                self.banned_addresses.add(source)
+        check.download_state.discard_blocks(bad_blocks)
+        self.partial_pieces[check.piece_index] = check.download_state
+        self.pieces_to_download.add(check.piece_index)
+
+    def abandon_block_check(self, check, reason):
+        """Gives up on finding the bad blocks and fetches the whole piece again"""
+        for key in [k for k, c in self.block_checks.items() if c is check]:
+            del self.block_checks[key]
+        if check.piece_index in self.completed_pieces:
+            return
+        print('Fetching all of piece {} again: {}'.format(check.piece_index, reason))
+        self.pieces_to_download.add(check.piece_index)
            
 
 if __name__ == '__main__':
-    download = TorrentDownload('torrent-files/ubuntu.iso.torrent')
-    download.setup_output_directory()
-    download.initialize()
-    download.run_download()
+    # For an offline run against local peers, see simulator/harness.py
+    torrent_file = sys.argv[1] if len(sys.argv) > 1 else 'torrent-files/ubuntu.iso.torrent'
+    download = TorrentDownload(torrent_file)
+    download.run()
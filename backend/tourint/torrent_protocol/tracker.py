@@ -1,11 +1,13 @@
-from typing import Dict
-import requests
+from typing import Dict, List, Optional, Tuple
 import hashlib
+import socket
 
 if __package__ is None or __package__ == '':
+    import addresses
     import consts
     import bencode
 else:
+    from . import addresses
     from . import consts
     from . import bencode
 
@@ -22,6 +24,16 @@ def decode_torrent_file(filename: str) -> Dict:
 
     return metainfo
 
+def get_announce_url(metainfo: Dict) -> Optional[str]:
+    """'announce', or the first tracker of 'announce-list' (BEP 12). None for trackerless torrents,
+    e.g. ones made from a magnet link without trackers."""
+    if metainfo.get('announce'):
+        return metainfo['announce']
+    for tier in metainfo.get('announce-list', []):
+        if tier:
+            return tier[0]
+    return None
+
 def send_ths_request(announce_url, info_hash, left, peer_id=consts.PEER_ID,
                      port=consts.DEFAULT_PORT, up=0, down=0) -> Dict:
     """Peers should send this request regularly, based on the 'interval' field that is sent in the
@@ -34,20 +46,40 @@ def send_ths_request(announce_url, info_hash, left, peer_id=consts.PEER_ID,
         'uploaded': up,
         'downloaded': down,
         'left': left,
+        # Peers as compact strings, 'peers' for IPv4 and 'peers6' for IPv6 (BEP 23, BEP 7)
+        'compact': 1,
     }
 
+    # requests is most of this package's import time, and only the announce needs it
+    import requests
     r = requests.get(announce_url, params=params)
     return bencode.decode(r.content)
 
+def response_peers(response: Dict) -> List[Tuple[str, int]]:
+    """(ip, port) of every peer in an announce response. Trackers that ignore 'compact' send
+    'peers' as a list of dicts instead."""
+    peers = response.get('peers', [])
+    if isinstance(peers, list):
+        ret = [(p['ip'], p['port']) for p in peers if isinstance(p, dict)]
+    else:
+        ret = addresses.decode_compact(peers)
+    return ret + addresses.decode_compact(response.get('peers6', b''), socket.AF_INET6)
+
 def get_info_hash(metainfo: Dict) -> bytearray:
     return hashlib.sha1(bencode.encode(metainfo['info'])).digest()
 
+def get_total_length(info: Dict) -> int:
+    """Total size of the torrent's content, for both single and multi-file torrents"""
+    if 'files' in info:
+        return sum(f['length'] for f in info['files'])
+    return info['length']
+
 if __name__ == '__main__':
     torrent_file: str = 'torrent-files/ubuntu.iso.torrent'
     metainfo = decode_torrent_file(torrent_file)
 
     info_hash = get_info_hash(metainfo)
 
-    response = send_ths_request(metainfo['announce'], info_hash, metainfo['info']['length'])
+    response = send_ths_request(metainfo['announce'], info_hash, get_total_length(metainfo['info']))
     print(response)
 
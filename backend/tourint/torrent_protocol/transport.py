@@ -0,0 +1,55 @@
+"""
+What a PeerConnection's socket runs over.
+
+A transport makes the sockets connections talk through. Every one supports what PeerConnection
+and the download's poll loop use: connect, connect_ex, send, recv, settimeout, setblocking,
+getsockopt(SO_ERROR), fileno and close. TCP's sockets are plain ones. uTP's are UtpStreams (see
+utp.py), carried over one UDP socket per address family shared by every connection.
+"""
+import socket
+
+if __package__ is None or __package__ == '':
+    import utp
+else:
+    from . import utp
+
+class TcpTransport:
+    NAME: str = 'tcp'
+
+    def create_socket(self, family=socket.AF_INET) -> socket.socket:
+        return socket.socket(family, socket.SOCK_STREAM)
+
+    def close(self):
+        pass
+
+class UtpTransport:
+    NAME: str = 'utp'
+
+    def __init__(self, host='0.0.0.0', port=0, host6='::'):
+        self.multiplexer = utp.UtpMultiplexer(host, port)
+        # The IPv6 one is only started once there's an IPv6 peer
+        self.host6 = host6
+        self.multiplexer6 = None
+
+    def create_socket(self, family=socket.AF_INET) -> utp.UtpStream:
+        if family != socket.AF_INET6:
+            return self.multiplexer.create_stream()
+        if self.multiplexer6 is None:
+            self.multiplexer6 = utp.UtpMultiplexer(self.host6, 0)
+        return self.multiplexer6.create_stream()
+
+    def close(self):
+        """Resets any connections still open and stops the multiplexers' threads"""
+        self.multiplexer.close()
+        if self.multiplexer6 is not None:
+            self.multiplexer6.close()
+
+TRANSPORTS = {transport.NAME: transport for transport in (TcpTransport, UtpTransport)}
+# Shared by every connection that isn't given a transport. It holds no state.
+TCP = TcpTransport()
+
+def create(name):
+    if name not in TRANSPORTS:
+        raise ValueError('Unknown transport {}, expected one of {}'.format(name,
+            ', '.join(TRANSPORTS)))
+    return TCP if name == TcpTransport.NAME else TRANSPORTS[name]()
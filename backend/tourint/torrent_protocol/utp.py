@@ -0,0 +1,761 @@
+"""
+uTP, the micro transport protocol (BEP 29): reliable, ordered byte streams over UDP.
+
+uTP exists for its congestion control. LEDBAT measures one-way delay from the timestamps every
+packet carries, and grows the send window only while the delay it adds on top of the lowest it
+has seen (the base delay) stays under CCONTROL_TARGET_US. Once the bottleneck queue starts
+filling it backs off, so a bulk download leaves room for interactive traffic where TCP would fill
+the queue. Lost packets are found from selective ACKs and duplicate ACKs, or by timeout.
+
+One UtpMultiplexer owns a single UDP socket and a thread that runs every connection over it,
+telling connections apart by (address, connection id). Each connection is handed to its user as
+a UtpStream: one end of a socketpair whose other end the multiplexer thread reads from and writes
+to. A stream is a real socket, so it blocks, times out and polls like a TCP socket. Data written
+to a stream that's still connecting waits in the socketpair until the SYN is answered, and a
+connection that fails closes its end, which the stream's user sees as EOF.
+"""
+from typing import Dict, List, Optional, Tuple
+from collections import OrderedDict, deque
+import bisect
+import enum
+import errno
+import os
+import queue
+import selectors
+import socket
+import struct
+import threading
+import time
+
+VERSION: int = 1
+
+class PacketType(enum.IntEnum):
+    DATA = 0
+    FIN = 1
+    STATE = 2
+    RESET = 3
+    SYN = 4
+
+HEADER = struct.Struct('>BBHIIIHH')
+EXTENSION_SELECTIVE_ACK: int = 1
+# Payload bytes per packet, small enough that packets aren't fragmented on most paths
+MAX_PAYLOAD: int = 1400
+SEQ_MASK: int = 0xffff
+TIMESTAMP_MASK: int = 0xffffffff
+
+# LEDBAT
+CCONTROL_TARGET_US: int = 100000
+MAX_CWND_INCREASE_BYTES_PER_RTT: int = 3000
+MIN_WINDOW: int = 2 * MAX_PAYLOAD
+INITIAL_WINDOW: int = 4 * MAX_PAYLOAD
+# The base delay is the lowest delay seen in the last two minutes, kept as per minute minimums
+BASE_DELAY_HISTORY: int = 2
+# Packets acked past a missing one before it's taken as lost
+DUPLICATE_ACKS_BEFORE_RESEND: int = 3
+# Bits in the selective ACK we send, i.e. how far past ack_nr it reaches
+MAX_SELECTIVE_ACK_BITS: int = 256
+RECEIVE_WINDOW: int = 1024 * 1024
+# Out of order packets we hold on to, past what the selective ACK can say we have
+MAX_REORDER_PACKETS: int = 2 * RECEIVE_WINDOW // MAX_PAYLOAD
+
+INITIAL_RTO_S: float = 1.0
+MIN_RTO_S: float = 0.5
+MAX_RTO_S: float = 10.0
+# Consecutive timeouts before a connection is given up on
+MAX_TIMEOUTS: int = 5
+CONNECT_TIMEOUT_S: float = 5.0
+# How long a connection we've closed waits for the peer to close its side
+FIN_LINGER_S: float = 30.0
+UDP_BUFFER_BYTES: int = 4 * 1024 * 1024
+
+def now_us() -> int:
+    return int(time.monotonic() * 1000000) & TIMESTAMP_MASK
+
+def seq_diff(a, b) -> int:
+    """a - b for 16 bit sequence numbers that wrap around"""
+    return ((a - b + 0x8000) & SEQ_MASK) - 0x8000
+
+class Packet:
+    def __init__(self, packet_type, connection_id, seq_nr, ack_nr, timestamp=0,
+                 timestamp_difference=0, wnd_size=0, payload=b'', selective_ack=None):
+        self.type = packet_type
+        self.connection_id = connection_id
+        self.seq_nr = seq_nr
+        self.ack_nr = ack_nr
+        self.timestamp = timestamp
+        self.timestamp_difference = timestamp_difference
+        self.wnd_size = wnd_size
+        self.payload = payload
+        # Bitmask bytes, bit i set if ack_nr + 2 + i was received
+        self.selective_ack = selective_ack
+
+    def serialize(self) -> bytes:
+        extension = EXTENSION_SELECTIVE_ACK if self.selective_ack else 0
+        header = HEADER.pack((self.type << 4) | VERSION, extension, self.connection_id,
+                self.timestamp, self.timestamp_difference, self.wnd_size, self.seq_nr,
+                self.ack_nr)
+        if self.selective_ack:
+            header += bytes([0, len(self.selective_ack)]) + self.selective_ack
+        return header + self.payload
+
+    @classmethod
+    def deserialize(cls, data: bytes):
+        if len(data) < HEADER.size:
+            raise ValueError('uTP packet too short')
+        (type_version, extension, connection_id, timestamp, timestamp_difference, wnd_size,
+                seq_nr, ack_nr) = HEADER.unpack_from(data)
+        if type_version & 0x0f != VERSION or type_version >> 4 > PacketType.SYN:
+            raise ValueError('Not a uTP packet')
+
+        selective_ack = None
+        offset = HEADER.size
+        while extension != 0:
+            if offset + 2 > len(data):
+                raise ValueError('Truncated uTP extension')
+            next_extension, length = data[offset], data[offset+1]
+            body = data[offset+2:offset+2+length]
+            if len(body) != length:
+                raise ValueError('Truncated uTP extension')
+            if extension == EXTENSION_SELECTIVE_ACK:
+                selective_ack = body
+            extension = next_extension
+            offset += 2 + length
+
+        return cls(type_version >> 4, connection_id, seq_nr, ack_nr, timestamp,
+                timestamp_difference, wnd_size, data[offset:], selective_ack)
+
+def encode_selective_ack(ack_nr, received) -> Optional[bytes]:
+    """Bitmask for the out of order sequence numbers in received, or None if there are none"""
+    offsets = [seq_diff(seq, ack_nr) - 2 for seq in received]
+    offsets = [o for o in offsets if 0 <= o < MAX_SELECTIVE_ACK_BITS]
+    if not offsets:
+        return None
+    mask = bytearray((max(offsets) // 32 + 1) * 4)
+    for offset in offsets:
+        mask[offset // 8] |= 1 << (offset % 8)
+    return bytes(mask)
+
+def decode_selective_ack(ack_nr, mask) -> List[int]:
+    return [(ack_nr + 2 + i * 8 + bit) & SEQ_MASK for i, byte in enumerate(mask)
+            for bit in range(8) if byte & (1 << bit)]
+
+class OutgoingPacket:
+    def __init__(self, packet: Packet):
+        self.packet = packet
+        self.size = len(packet.payload)
+        self.sent_time = 0.0
+        self.transmissions = 0
+
+class UtpConnection:
+    """One connection's state. Only ever touched from the multiplexer thread."""
+
+    class State(enum.Enum):
+        SYN_SENT = 0
+        CONNECTED = 1
+        CLOSED = 2
+
+    def __init__(self, multiplexer, address, stream_socket, recv_id, send_id, seq_nr):
+        self.multiplexer = multiplexer
+        self.address = address
+        # Our end of the socketpair, non-blocking
+        self.stream_socket = stream_socket
+        self.recv_id = recv_id
+        self.send_id = send_id
+        self.state = self.State.SYN_SENT
+        self.error: Optional[OSError] = None
+        # Set once connected or failed, for blocking connects
+        self.settled = threading.Event()
+
+        # Sending
+        self.seq_nr = seq_nr
+        self.initial_seq_nr = seq_nr
+        self.outgoing: Dict[int, OutgoingPacket] = OrderedDict()
+        self.bytes_in_flight = 0
+        self.max_window = float(INITIAL_WINDOW)
+        self.peer_window = RECEIVE_WINDOW
+        self.slow_start = True
+        # No more window cuts for losses of packets sent before this one
+        self.loss_recovery_seq: Optional[int] = None
+        self.duplicate_acks = 0
+        self.last_ack_nr: Optional[int] = None
+        self.stream_eof = False
+        self.fin_sent = False
+        self.fin_acked = False
+        self.fin_acked_time = None
+
+        # Round trip time and retransmission timeout
+        self.rtt: Optional[float] = None
+        self.rtt_var = 0.0
+        self.rto = INITIAL_RTO_S
+        self.timeouts = 0
+        self.connect_deadline = time.monotonic() + CONNECT_TIMEOUT_S
+
+        # Delay-based congestion control
+        self.base_delays = deque(maxlen=BASE_DELAY_HISTORY)
+        self.base_delay_minute = None
+        self.our_delay_us = 0
+        # Our measurement of the peer's one-way delay to us, sent back in every packet
+        self.reply_micro = 0
+
+        # Receiving
+        self.ack_nr = 0
+        self.reorder: Dict[int, bytes] = {}
+        self.reorder_bytes = 0
+        self.delivery = bytearray()
+        self.fin_seq: Optional[int] = None
+        self.eof_delivered = False
+        self.need_ack = False
+
+        self.stats = {'packets_sent': 0, 'packets_received': 0, 'retransmits': 0,
+                'timeouts': 0, 'losses': 0}
+
+    # Sending
+
+    def receive_window(self) -> int:
+        return max(0, RECEIVE_WINDOW - len(self.delivery) - self.reorder_bytes)
+
+    def make_packet(self, packet_type, payload=b'') -> Packet:
+        selective_ack = encode_selective_ack(self.ack_nr, self.reorder) if self.reorder else None
+        return Packet(packet_type, self.send_id, self.seq_nr, self.ack_nr,
+                timestamp_difference=self.reply_micro, wnd_size=self.receive_window(),
+                payload=payload, selective_ack=selective_ack)
+
+    def transmit(self, packet: Packet):
+        packet.timestamp = now_us()
+        packet.ack_nr = self.ack_nr
+        packet.timestamp_difference = self.reply_micro
+        packet.wnd_size = self.receive_window()
+        self.multiplexer.send_packet(packet, self.address)
+        self.stats['packets_sent'] += 1
+        self.need_ack = False
+
+    def send_sequenced(self, packet_type, payload=b'', connection_id=None):
+        packet = self.make_packet(packet_type, payload)
+        if connection_id is not None:
+            packet.connection_id = connection_id
+        outgoing = OutgoingPacket(packet)
+        self.outgoing[self.seq_nr] = outgoing
+        self.bytes_in_flight += outgoing.size
+        self.seq_nr = (self.seq_nr + 1) & SEQ_MASK
+        self.send_outgoing(outgoing)
+
+    def send_outgoing(self, outgoing: OutgoingPacket):
+        if outgoing.transmissions > 0:
+            self.stats['retransmits'] += 1
+        outgoing.transmissions += 1
+        outgoing.sent_time = time.monotonic()
+        self.transmit(outgoing.packet)
+
+    def send_syn(self):
+        # The SYN carries the id we receive on, everything after it the one we send on
+        self.send_sequenced(PacketType.SYN, connection_id=self.recv_id)
+
+    def send_state(self):
+        self.transmit(self.make_packet(PacketType.STATE))
+
+    def send_reset(self):
+        self.transmit(self.make_packet(PacketType.RESET))
+
+    def window_open(self) -> bool:
+        # With nothing in flight one packet always goes, which also probes a closed peer window
+        window = min(self.max_window, self.peer_window)
+        return self.bytes_in_flight == 0 or self.bytes_in_flight + MAX_PAYLOAD <= window
+
+    def wants_stream_data(self) -> bool:
+        return self.state == self.State.CONNECTED and not self.stream_eof and self.window_open()
+
+    def read_stream(self):
+        """Sends what the stream's user wrote, as far as the window allows"""
+        while self.wants_stream_data():
+            try:
+                data = self.stream_socket.recv(MAX_PAYLOAD)
+            except BlockingIOError:
+                break
+            except OSError:
+                data = b''
+            if not data:
+                self.stream_eof = True
+                break
+            self.send_sequenced(PacketType.DATA, data)
+        if self.stream_eof and not self.fin_sent and self.state == self.State.CONNECTED:
+            self.fin_sent = True
+            self.send_sequenced(PacketType.FIN)
+
+    # Receiving
+
+    def handle_packet(self, packet: Packet):
+        self.stats['packets_received'] += 1
+        now = now_us()
+        self.reply_micro = (now - packet.timestamp) & TIMESTAMP_MASK
+        self.peer_window = packet.wnd_size
+
+        if packet.type == PacketType.RESET:
+            if self.state == self.State.SYN_SENT:
+                self.close(ConnectionRefusedError(errno.ECONNREFUSED, 'uTP connection refused'))
+            else:
+                self.close(ConnectionResetError(errno.ECONNRESET, 'uTP connection reset'))
+            return
+        if self.state == self.State.SYN_SENT:
+            if packet.type != PacketType.STATE:
+                return
+            self.state = self.State.CONNECTED
+            self.ack_nr = (packet.seq_nr - 1) & SEQ_MASK
+            self.settled.set()
+
+        self.handle_ack(packet)
+        if packet.type in (PacketType.DATA, PacketType.FIN):
+            self.handle_data(packet)
+
+    def handle_ack(self, packet: Packet):
+        now = time.monotonic()
+        acked = [seq for seq in self.outgoing if seq_diff(seq, packet.ack_nr) <= 0]
+        selectively_acked = []
+        if packet.selective_ack:
+            selectively_acked = [seq for seq in
+                    decode_selective_ack(packet.ack_nr, packet.selective_ack)
+                    if seq in self.outgoing]
+
+        bytes_acked = 0
+        for seq in acked + selectively_acked:
+            outgoing = self.outgoing.pop(seq, None)
+            if outgoing is None:
+                continue
+            bytes_acked += outgoing.size
+            self.bytes_in_flight -= outgoing.size
+            if outgoing.transmissions == 1:
+                self.update_rtt(now - outgoing.sent_time)
+            if outgoing.packet.type == PacketType.FIN:
+                self.fin_acked = True
+                self.fin_acked_time = now
+
+        if acked or selectively_acked:
+            self.timeouts = 0
+            self.duplicate_acks = 0
+        elif packet.type == PacketType.STATE and self.outgoing and\
+                packet.ack_nr == self.last_ack_nr:
+            self.duplicate_acks += 1
+            if self.duplicate_acks == DUPLICATE_ACKS_BEFORE_RESEND:
+                self.packet_lost(next(iter(self.outgoing)))
+        self.last_ack_nr = packet.ack_nr
+
+        if packet.selective_ack:
+            self.detect_losses(packet.ack_nr, packet.selective_ack)
+        if bytes_acked:
+            self.update_window(packet.timestamp_difference, bytes_acked)
+
+    def detect_losses(self, ack_nr, selective_ack):
+        """Packets with at least DUPLICATE_ACKS_BEFORE_RESEND later ones selectively acked are
+        taken as lost, and resent at most once a round trip"""
+        offsets = [seq_diff(seq, ack_nr) for seq in decode_selective_ack(ack_nr, selective_ack)]
+        now = time.monotonic()
+        resend_after = self.rtt if self.rtt is not None else self.rto
+        for seq, outgoing in list(self.outgoing.items()):
+            later = len(offsets) - bisect.bisect_right(offsets, seq_diff(seq, ack_nr))
+            if later < DUPLICATE_ACKS_BEFORE_RESEND:
+                break
+            if now - outgoing.sent_time >= resend_after:
+                self.packet_lost(seq)
+
+    def packet_lost(self, seq):
+        self.stats['losses'] += 1
+        if self.loss_recovery_seq is None or seq_diff(seq, self.loss_recovery_seq) >= 0:
+            # One cut per window's worth of losses
+            self.max_window = max(self.max_window / 2, MIN_WINDOW)
+            self.slow_start = False
+            self.loss_recovery_seq = self.seq_nr
+        self.send_outgoing(self.outgoing[seq])
+
+    def update_rtt(self, sample_s):
+        if self.rtt is None:
+            self.rtt = sample_s
+            self.rtt_var = sample_s / 2
+        else:
+            self.rtt_var += (abs(self.rtt - sample_s) - self.rtt_var) / 4
+            self.rtt += (sample_s - self.rtt) / 8
+        self.rto = min(max(self.rtt + 4 * self.rtt_var, MIN_RTO_S), MAX_RTO_S)
+
+    def update_window(self, delay_sample_us, bytes_acked):
+        """LEDBAT: grow the window while we add less than the target delay, shrink it when we
+        add more. Doubles every round trip until the delay gets near the target."""
+        minute = int(time.monotonic() // 60)
+        if self.base_delay_minute != minute or not self.base_delays:
+            self.base_delays.append(delay_sample_us)
+            self.base_delay_minute = minute
+        else:
+            self.base_delays[-1] = min(self.base_delays[-1], delay_sample_us)
+        base_delay = min(self.base_delays)
+        self.our_delay_us = delay_sample_us - base_delay
+
+        if self.our_delay_us > CCONTROL_TARGET_US * 0.9:
+            self.slow_start = False
+        if self.our_delay_us <= CCONTROL_TARGET_US:
+            off_target = (CCONTROL_TARGET_US - self.our_delay_us) / CCONTROL_TARGET_US
+            window_factor = min(bytes_acked, self.max_window) / max(self.max_window, bytes_acked)
+            gain = MAX_CWND_INCREASE_BYTES_PER_RTT * off_target * window_factor
+            if self.slow_start:
+                gain = max(gain, bytes_acked)
+        else:
+            # Over target the window shrinks in proportion to how far over, at most by half per
+            # round trip, like LEDBAT++. BEP 29's additive decrease of at most
+            # MAX_CWND_INCREASE_BYTES_PER_RTT takes minutes to drain a queue slow start overfilled.
+            gain = -min(bytes_acked * (self.our_delay_us / CCONTROL_TARGET_US - 1),
+                    bytes_acked / 2)
+        self.max_window = max(self.max_window + gain, MIN_WINDOW)
+
+    def handle_data(self, packet: Packet):
+        self.need_ack = True
+        offset = seq_diff(packet.seq_nr, (self.ack_nr + 1) & SEQ_MASK)
+        if offset < 0 or packet.seq_nr in self.reorder:
+            # Already have it, the ACK we send will say so
+            return
+        if offset >= MAX_REORDER_PACKETS:
+            return
+
+        if packet.type == PacketType.FIN:
+            self.fin_seq = packet.seq_nr
+        if offset > 0:
+            self.reorder[packet.seq_nr] = packet.payload
+            self.reorder_bytes += len(packet.payload)
+            return
+
+        self.accept_in_order(packet.seq_nr, packet.payload)
+        next_seq = (self.ack_nr + 1) & SEQ_MASK
+        while next_seq in self.reorder:
+            payload = self.reorder.pop(next_seq)
+            self.reorder_bytes -= len(payload)
+            self.accept_in_order(next_seq, payload)
+            next_seq = (self.ack_nr + 1) & SEQ_MASK
+        self.write_stream()
+
+    def accept_in_order(self, seq, payload):
+        self.ack_nr = seq
+        self.delivery.extend(payload)
+
+    def write_stream(self):
+        """Hands received data to the stream's user, as much as the socketpair takes"""
+        if self.delivery:
+            window_was_closed = self.receive_window() < MAX_PAYLOAD
+            try:
+                sent = self.stream_socket.send(self.delivery)
+            except BlockingIOError:
+                sent = 0
+            except OSError:
+                # The user closed the stream while the peer was still sending
+                self.send_reset()
+                self.close()
+                return
+            del self.delivery[:sent]
+            if window_was_closed and self.receive_window() >= MAX_PAYLOAD:
+                # The peer stopped sending when our window closed, tell it that it's open
+                self.need_ack = True
+        if not self.delivery and self.fin_seq is not None and self.ack_nr == self.fin_seq and\
+                not self.eof_delivered:
+            self.eof_delivered = True
+            try:
+                self.stream_socket.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+
+    # Timers
+
+    def next_deadline(self) -> Optional[float]:
+        if self.state == self.State.SYN_SENT:
+            return min(self.connect_deadline, self.oldest_sent_time() + self.rto)
+        if self.outgoing:
+            return self.oldest_sent_time() + self.rto
+        if self.fin_acked:
+            return self.fin_acked_time + FIN_LINGER_S
+        return None
+
+    def oldest_sent_time(self) -> float:
+        """When the oldest unacked packet was last sent, which the retransmission timer runs off"""
+        return next(iter(self.outgoing.values())).sent_time if self.outgoing else\
+                time.monotonic()
+
+    def check_timers(self, now):
+        if self.state == self.State.SYN_SENT and now >= self.connect_deadline:
+            self.close(TimeoutError(errno.ETIMEDOUT, 'uTP connect timed out'))
+            return
+        if self.fin_acked and now >= self.fin_acked_time + FIN_LINGER_S:
+            # The peer never closed its side
+            self.close()
+            return
+        if not self.outgoing or now < self.oldest_sent_time() + self.rto:
+            return
+
+        self.timeouts += 1
+        self.stats['timeouts'] += 1
+        if self.timeouts > MAX_TIMEOUTS:
+            self.close(TimeoutError(errno.ETIMEDOUT, 'uTP connection timed out'))
+            return
+        # Like TCP: back off, start again from a small window and resend the oldest packet
+        self.rto = min(self.rto * 2, MAX_RTO_S)
+        self.max_window = MIN_WINDOW
+        self.slow_start = False
+        self.loss_recovery_seq = self.seq_nr
+        self.send_outgoing(next(iter(self.outgoing.values())))
+
+    def is_finished(self) -> bool:
+        """Both directions closed and everything we sent acked"""
+        return self.fin_acked and self.eof_delivered
+
+    def close(self, error=None):
+        if self.state == self.State.CLOSED:
+            return
+        self.state = self.State.CLOSED
+        self.error = error
+        self.settled.set()
+        self.multiplexer.forget(self)
+        try:
+            self.stream_socket.close()
+        except OSError:
+            pass
+
+class UtpStream:
+    """The user's side of a uTP connection: a socket like object, see the module docstring.
+
+    Everything but connecting is the socketpair end's own socket methods.
+    """
+
+    def __init__(self, multiplexer):
+        self.multiplexer = multiplexer
+        self.socket, self.multiplexer_end = socket.socketpair()
+        self.multiplexer_end.setblocking(False)
+        self.connection: Optional[UtpConnection] = None
+
+    def __getattr__(self, name):
+        return getattr(self.socket, name)
+
+    def connect_ex(self, address) -> int:
+        """Starts connecting and returns EINPROGRESS. The stream can be written to right away."""
+        self.connection = self.multiplexer.open(self, address)
+        return errno.EINPROGRESS
+
+    def connect(self, address):
+        self.connect_ex(address)
+        timeout = self.socket.gettimeout()
+        if not self.connection.settled.wait(CONNECT_TIMEOUT_S if timeout is None else timeout):
+            raise socket.timeout('uTP connect to {}:{} timed out'.format(*address))
+        if self.connection.error is not None:
+            raise self.connection.error
+
+class UtpMultiplexer:
+    """Runs every uTP connection of this process over one UDP socket"""
+
+    # Longest the thread sleeps when no timer is due sooner
+    MAX_WAIT_S: float = 0.05
+    ACCEPT_BACKLOG: int = 64
+
+    def __init__(self, host='0.0.0.0', port=0, listen=False):
+        self.family = socket.AF_INET6 if ':' in host else socket.AF_INET
+        self.socket = socket.socket(self.family, socket.SOCK_DGRAM)
+        for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+            self.socket.setsockopt(socket.SOL_SOCKET, option, UDP_BUFFER_BYTES)
+        self.socket.bind((host, port))
+        self.socket.setblocking(False)
+        self.port = self.socket.getsockname()[1]
+
+        self.listening = listen
+        self.accepted = queue.Queue(self.ACCEPT_BACKLOG)
+        # (address, our receive connection id) -> connection
+        self.connections: Dict[Tuple[Tuple[str, int], int], UtpConnection] = {}
+
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.socket, selectors.EVENT_READ, None)
+        # Other threads queue functions to run on the multiplexer thread, and wake it up
+        self.calls = deque()
+        self.wake_reader, self.wake_writer = socket.socketpair()
+        self.wake_reader.setblocking(False)
+        self.selector.register(self.wake_reader, selectors.EVENT_READ, self.wake_reader)
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name='uTP-{}'.format(self.port),
+                daemon=True)
+        self.thread.start()
+
+    def call_soon(self, function, *args):
+        self.calls.append((function, args))
+        try:
+            self.wake_writer.send(b'\0')
+        except BlockingIOError:
+            # Already plenty of wakeups queued
+            pass
+
+    def create_stream(self) -> UtpStream:
+        return UtpStream(self)
+
+    def open(self, stream: UtpStream, address) -> UtpConnection:
+        """Called from the stream's thread. The connection's SYN goes out from ours."""
+        recv_id = int.from_bytes(os.urandom(2), byteorder='big')
+        if self.family == socket.AF_INET6:
+            # The form recvfrom gives back, so the connection's replies are matched to it
+            ip = socket.inet_ntop(socket.AF_INET6, socket.inet_pton(socket.AF_INET6, address[0]))
+        else:
+            ip = socket.gethostbyname(address[0])
+        connection = UtpConnection(self, (ip, address[1]),
+                stream.multiplexer_end, recv_id, (recv_id + 1) & SEQ_MASK, seq_nr=1)
+        self.call_soon(self.start_connection, connection)
+        return connection
+
+    def start_connection(self, connection):
+        self.connections[(connection.address, connection.recv_id)] = connection
+        connection.send_syn()
+        self.update_interest(connection)
+
+    def accept(self, timeout=None) -> Tuple[UtpStream, Tuple[str, int]]:
+        """Next incoming connection, for multiplexers created with listen=True"""
+        stream = self.accepted.get(timeout=timeout)
+        return stream, stream.connection.address
+
+    def send_packet(self, packet: Packet, address):
+        try:
+            self.socket.sendto(packet.serialize(), address)
+        except (BlockingIOError, OSError):
+            # Full buffers look like loss, which uTP recovers from
+            pass
+
+    def forget(self, connection):
+        self.connections.pop((connection.address, connection.recv_id), None)
+        try:
+            self.selector.unregister(connection.stream_socket)
+        except (KeyError, ValueError, OSError):
+            pass
+
+    def update_interest(self, connection):
+        if connection.state == UtpConnection.State.CLOSED:
+            return
+        events = 0
+        if connection.wants_stream_data():
+            events |= selectors.EVENT_READ
+        if connection.delivery:
+            events |= selectors.EVENT_WRITE
+        try:
+            key = self.selector.get_key(connection.stream_socket)
+        except KeyError:
+            key = None
+        if events == 0:
+            if key is not None:
+                self.selector.unregister(connection.stream_socket)
+        elif key is None:
+            self.selector.register(connection.stream_socket, events, connection)
+        elif key.events != events:
+            self.selector.modify(connection.stream_socket, events, connection)
+
+    def handle_datagram(self, data, address, touched):
+        try:
+            packet = Packet.deserialize(data)
+        except ValueError:
+            return
+
+        if packet.type == PacketType.SYN:
+            key = (address, (packet.connection_id + 1) & SEQ_MASK)
+            connection = self.connections.get(key)
+            if connection is None:
+                if not self.listening or self.accepted.full():
+                    self.send_packet(Packet(PacketType.RESET, packet.connection_id, 0,
+                        packet.seq_nr, now_us()), address)
+                    return
+                stream = self.create_stream()
+                connection = UtpConnection(self, address, stream.multiplexer_end, key[1],
+                        packet.connection_id, int.from_bytes(os.urandom(2), byteorder='big'))
+                connection.state = UtpConnection.State.CONNECTED
+                connection.ack_nr = packet.seq_nr
+                connection.settled.set()
+                stream.connection = connection
+                self.connections[key] = connection
+                self.accepted.put(stream)
+            if connection.seq_nr == connection.initial_seq_nr:
+                # Answered again if our STATE was lost and the SYN resent
+                connection.reply_micro = (now_us() - packet.timestamp) & TIMESTAMP_MASK
+                connection.send_state()
+                touched.add(connection)
+            return
+
+        connection = self.connections.get((address, packet.connection_id))
+        if connection is None and packet.type == PacketType.RESET:
+            # Some implementations reset with the id the other side sends on
+            connection = next((c for (a, _), c in self.connections.items()
+                if a == address and c.send_id == packet.connection_id), None)
+        if connection is None:
+            if packet.type != PacketType.RESET:
+                self.send_packet(Packet(PacketType.RESET, packet.connection_id, 0,
+                    packet.seq_nr, now_us()), address)
+            return
+        connection.handle_packet(packet)
+        touched.add(connection)
+
+    def run(self):
+        while not self.closed:
+            deadlines = [d for d in (c.next_deadline() for c in self.connections.values())
+                    if d is not None]
+            wait_s = self.MAX_WAIT_S
+            if deadlines:
+                wait_s = max(0.0, min(wait_s, min(deadlines) - time.monotonic()))
+
+            touched = set()
+            for key, mask in self.selector.select(wait_s):
+                if key.fileobj is self.socket:
+                    self.read_datagrams(touched)
+                elif key.fileobj is self.wake_reader:
+                    self.run_calls()
+                    if self.closed:
+                        return
+                else:
+                    connection = key.data
+                    if mask & selectors.EVENT_WRITE:
+                        connection.write_stream()
+                    if mask & selectors.EVENT_READ:
+                        connection.read_stream()
+                    touched.add(connection)
+
+            now = time.monotonic()
+            for connection in list(self.connections.values()):
+                connection.check_timers(now)
+            for connection in touched:
+                if connection.state == UtpConnection.State.CLOSED:
+                    continue
+                connection.read_stream()
+                if connection.need_ack:
+                    connection.send_state()
+                if connection.is_finished():
+                    connection.close()
+                else:
+                    self.update_interest(connection)
+
+    def read_datagrams(self, touched):
+        while True:
+            try:
+                data, address = self.socket.recvfrom(65536)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                # e.g. ICMP port unreachable reported on the next read
+                continue
+            # IPv6 sockets give (host, port, flowinfo, scope id)
+            self.handle_datagram(data, address[:2], touched)
+
+    def run_calls(self):
+        try:
+            while self.wake_reader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self.calls:
+            function, args = self.calls.popleft()
+            function(*args)
+
+    def close(self):
+        """Resets every connection and stops the thread"""
+        if self.closed:
+            return
+        self.call_soon(self.shutdown)
+        self.thread.join(CONNECT_TIMEOUT_S)
+
+    def shutdown(self):
+        for connection in list(self.connections.values()):
+            connection.send_reset()
+            connection.close()
+        self.closed = True
+        self.selector.close()
+        self.socket.close()
+        self.wake_reader.close()
+        self.wake_writer.close()
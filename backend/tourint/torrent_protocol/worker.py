@@ -0,0 +1,70 @@
+"""
+Entry point for download worker processes.
+
+The web app doesn't fork itself to run a download: a forked child would start with a copy of
+Django, DRF and everything else the server has loaded, none of which the protocol code needs.
+Workers are started from a forkserver instead. The forkserver preloads only this package, so a
+new worker is a fork of a small, already warm process. A worker receives plain data (the torrent
+file path and download options) and reports back only over its telemetry queue and control pipe.
+"""
+from typing import Dict, Optional
+import multiprocessing
+import threading
+
+if __package__ is None or __package__ == '':
+    import torrent_download
+    import piece_picker
+else:
+    from . import torrent_download
+    from . import piece_picker
+
+# Module the forkserver imports once, so workers don't each pay for it
+PRELOAD_MODULE: str = torrent_download.__name__
+
+context = None
+context_lock = threading.Lock()
+
+def get_context():
+    """Returns the multiprocessing context workers are started with.
+
+    forkserver where the platform has it, otherwise the default.
+    """
+    global context
+    with context_lock:
+        if context is None:
+            if 'forkserver' in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context('forkserver')
+                context.set_forkserver_preload([PRELOAD_MODULE])
+            else:
+                context = multiprocessing.get_context()
+        return context
+
+def prewarm():
+    """Starts the forkserver now, so the first download doesn't wait for it"""
+    if get_context().get_start_method() == 'forkserver':
+        from multiprocessing import forkserver
+        forkserver.ensure_running()
+
+def run_worker(torrent_file: str, options: Dict, control_connection=None, telemetry_queue=None,
+               reply_connection=None):
+    """Runs one download to completion (or until paused or cancelled) in this process.
+
+    options are TorrentDownload keyword arguments as plain data. file_priorities is given as
+    priority names.
+    """
+    options = dict(options)
+    if options.get('file_priorities'):
+        options['file_priorities'] = [piece_picker.Priority.from_name(p)
+                for p in options['file_priorities']]
+
+    download = torrent_download.TorrentDownload(torrent_file, telemetry_queue=telemetry_queue,
+            control_connection=control_connection, reply_connection=reply_connection, **options)
+    download.run()
+
+def start_worker(torrent_file: str, options: Dict, control_connection=None,
+                 telemetry_queue=None, name: Optional[str] = None, reply_connection=None):
+    """Starts run_worker in a new process and returns the Process"""
+    process = get_context().Process(target=run_worker, name=name,
+            args=(torrent_file, options, control_connection, telemetry_queue, reply_connection))
+    process.start()
+    return process
@@ -3,5 +3,9 @@ from . import views
 
 urlpatterns = [
     path('', views.handle_request_to_base_directory, name='torrents-all'),
-    path('<str:file_hash>/', views.handle_request_to_hash)
+    path('jobs/<str:job_id>/', views.handle_request_to_job, name='torrents-job'),
+    path('events/', views.handle_progress_stream, name='torrents-events'),
+    path('<str:file_hash>/', views.handle_request_to_hash),
+    path('<str:file_hash>/priorities/', views.handle_request_to_priorities),
+    path('<str:file_hash>/data/', views.handle_request_to_data),
 ]
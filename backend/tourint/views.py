@@ -1,71 +1,358 @@
 from django.shortcuts import render
+from django.conf import settings
 from rest_framework import generics
-from django.http import HttpRequest, HttpResponse
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
+from django.db.models import Count, Max
+from django.utils import timezone
+from django.utils.http import parse_etags
+from django.http import HttpRequest, HttpResponse, JsonResponse, StreamingHttpResponse
 from .models import Torrents
 from .serializers import TorrentsSerializer
+from .pagination import TorrentsCursorPagination
+from .progress import TorrentProgressSink
+from . import events
+from . import jobs
+from . import engines
 
 from .torrent_protocol import tracker
-from .torrent_protocol import bencode
-from .torrent_protocol.torrent_download import TorrentDownload
+from .torrent_protocol import disk_io
+from .torrent_protocol import metrics
+from .torrent_protocol.piece_picker import Priority
+from .torrent_protocol.control import Command, DEFAULT_PROFILE_S, MAX_READ_BYTES
+from .torrent_protocol.profiling import Profiler
+from .torrent_protocol.torrent_download import default_output_directory
 
-import os
-import urllib
+from typing import Dict
 import json
+import hashlib
+import time
 
 DOWNLOAD_FOLDER: str = './downloads/'
-TORRENT_FILE_ENDING: str = '.torrent'
-
-GLOBAL_DOWNLOAD_PROCESS: TorrentDownload = None
+# Comment line sent on idle progress streams so proxies don't time the connection out
+STREAM_KEEP_ALIVE_S: float = 15.0
+METRICS_CONTENT_TYPE: str = 'text/plain; version=0.0.4; charset=utf-8'
 
 # Create your views here.
 class ListTorrentsView(generics.ListAPIView):
-    queryset = Torrents.objects.all()
+    """Lists torrents a page at a time, newest first.
+
+    Query parameters:
+        status     comma separated download statuses, e.g. "In Progress,Paused"
+        name       case-insensitive substring of the name
+        file_hash  exact info hash
+        fields     comma separated subset of the serializer's fields
+        cursor, page_size  see TorrentsCursorPagination
+
+    Responses carry an ETag derived from the row count and latest updated_at of the filtered
+    rows, so an unchanged list is answered with 304 using one aggregate query.
+    """
     serializer_class = TorrentsSerializer
+    pagination_class = TorrentsCursorPagination
+
+    def requested_fields(self):
+        fields = self.request.query_params.get('fields')
+        if not fields:
+            return None
+        requested = [f for f in fields.split(',') if f]
+        unknown = set(requested) - set(TorrentsSerializer.Meta.fields)
+        if unknown:
+            raise ValidationError({'fields': 'Unknown fields: {}'
+                    .format(', '.join(sorted(unknown)))})
+        return requested
+
+    def get_queryset(self):
+        queryset = Torrents.objects.all()
+        params = self.request.query_params
+        if params.get('status'):
+            queryset = queryset.filter(download_status__in=params['status'].split(','))
+        if params.get('name'):
+            queryset = queryset.filter(name__icontains=params['name'])
+        if params.get('file_hash'):
+            queryset = queryset.filter(file_hash=params['file_hash'].lower())
+
+        fields = self.requested_fields()
+        if fields is not None:
+            # id is what the cursor seeks on
+            queryset = queryset.only('id', *fields)
+        return queryset
+
+    def get_serializer(self, *args, **kwargs):
+        kwargs['fields'] = self.requested_fields()
+        return super().get_serializer(*args, **kwargs)
+
+    def list_etag(self, queryset):
+        state = queryset.order_by().aggregate(count=Count('id'), updated=Max('updated_at'))
+        key = '{}|{}|{}'.format(self.request.get_full_path(), state['count'], state['updated'])
+        return '"{}"'.format(hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def list(self, request, *args, **kwargs):
+        etag = self.list_etag(self.get_queryset())
+        if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+            return Response(status=304, headers={'ETag': etag})
+        response = super().list(request, *args, **kwargs)
+        response['ETag'] = etag
+        return response
 
 def handle_request_to_base_directory(request):
     if request.method == 'GET':
         return ListTorrentsView.as_view()(request)
     elif request.method == 'POST':
-        if not os.path.exists(DOWNLOAD_FOLDER):
-            os.makedirs(DOWNLOAD_FOLDER)
-
-        request_body_string = request.body.decode('utf-8')
-        request_json = json.loads(request_body_string)
-        url = request_json['torrent']['url']
-        with urllib.request.urlopen(url) as f:
-            data_from_url = f.read()
-            metainfo = bencode.decode(data_from_url)
-            info_hash = tracker.get_info_hash(metainfo)
-
-            torrent_file_name = metainfo['info']['name']\
-                + '_' + info_hash.hex() + TORRENT_FILE_ENDING
-
-            torrent_file_path = os.path.join(DOWNLOAD_FOLDER, torrent_file_name)
-            with open(torrent_file_path, 'wb+') as torrent_file:
-                torrent_file.write(data_from_url)
-
-        t = Torrents(name = metainfo['info']['name'],
-                     file_hash = info_hash.hex(),
-                     torrent_file_path = torrent_file_path,
-                     total_size_bytes = metainfo['info']['length'],
-                     downloaded_bytes = 0,
-                     download_status = Torrents.DownloadStatus.IN_PROGRESS,
-                     number_of_seeders = 0,
-                     number_of_peers_connected = 0,
-                     download_directory = DOWNLOAD_FOLDER)
-
-        print('STARTING DOWNLOAD')
-        GLOBAL_DOWNLOAD_PROCESS = TorrentDownload(torrent_file_path, t)
-        GLOBAL_DOWNLOAD_PROCESS.start()
-        print('DOWNLOAD STARTED')
-        return HttpResponse(status=200)
+        try:
+            request_json = json.loads(request.body.decode('utf-8'))
+            # A single {"torrent": {...}} or a bulk {"torrents": [{...}, ...]}
+            requested = request_json['torrents'] if 'torrents' in request_json\
+                    else [request_json['torrent']]
+            urls = [t['url'] for t in requested]
+        except (ValueError, KeyError, TypeError) as e:
+            return JsonResponse({'error': 'Bad request: {}'.format(e)}, status=400)
+
+        pipeline = jobs.get_pipeline(start_download, DOWNLOAD_FOLDER)
+        submitted = [pipeline.submit(url).as_dict() for url in urls]
+        if 'torrents' in request_json:
+            return JsonResponse({'jobs': submitted}, status=202)
+        return JsonResponse(submitted[0], status=202)
+    return HttpResponse(status=405)
+
+def start_download(torrent):
+    print('STARTING DOWNLOAD')
+    def track_progress(run_id):
+        events.track_progress(torrent.file_hash, run_id, TorrentProgressSink(torrent.pk))
+
+    engines.start(torrent.file_hash, torrent.torrent_file_path,
+            {'file_priorities': list(torrent.file_priorities),
+             'metrics_enabled': getattr(settings, 'TOURINT_METRICS_ENABLED', True),
+             'dht_enabled': getattr(settings, 'TOURINT_DHT_ENABLED', True),
+             'dht_state_file': getattr(settings, 'TOURINT_DHT_STATE_FILE', None),
+             'peer_transport': getattr(settings, 'TOURINT_PEER_TRANSPORT', 'tcp'),
+             'streaming': getattr(settings, 'TOURINT_STREAMING', False)},
+            events.get_telemetry_queue(), on_start=track_progress)
+    print('DOWNLOAD STARTED')
+
+def handle_request_to_job(request, job_id):
+    if request.method != 'GET':
+        return HttpResponse(status=405)
+    job = jobs.pipeline.get(job_id) if jobs.pipeline is not None else None
+    if job is None:
+        return HttpResponse(status=404)
+    return JsonResponse(job.as_dict())
 
 def handle_request_to_hash(request, file_hash):
     if request.method == 'GET':
-        print('Got GET request for file hash {}'.format(file_hash))
-        metainfo = tracker.decode_torrent_file('/home/john/dev/tour-int/backend/tourint/torrent_protocol/torrent-files/ubuntu.iso.torrent')
-        print('test: {}'.format(metainfo['announce']))
-        return HttpResponse(status=200)
+        # Served from the engine's latest snapshot while there is one, so polling this every
+        # second doesn't touch the database. Otherwise falls back to the stored row.
+        live = events.get_snapshot(file_hash.lower())
+        if live is not None:
+            return JsonResponse(dict(live, live=True,
+                last_profile=events.get_profile(file_hash.lower())))
+        try:
+            torrent = Torrents.objects.get(file_hash=file_hash.lower())
+        except Torrents.DoesNotExist:
+            return HttpResponse(status=404)
+        return JsonResponse(dict(TorrentsSerializer(torrent).data, live=False))
     elif request.method == 'POST':
-        print('Got POST request for file hash {}'.format(file_hash))
-        return HttpResponse(status=200)
+        # {"command": "pause" | "resume" | "cancel" | "set_rate_limit" | "snapshot" | "profile",
+        #  ...}
+        try:
+            request_json = json.loads(request.body.decode('utf-8'))
+            command = request_json.pop('command')
+            if command not in STATUS_ACTIONS:
+                command = Command(command)
+            if command == Command.READ:
+                raise ValueError('use GET /torrents/<file_hash>/data/ to read')
+            if command == Command.SET_RATE_LIMIT:
+                request_json['bytes_per_second'] = int(request_json.get('bytes_per_second', 0))
+            elif command == Command.PROFILE:
+                request_json['duration_s'] = float(request_json.get('duration_s',
+                    DEFAULT_PROFILE_S))
+                if not 0 < request_json['duration_s'] <= Profiler.MAX_DURATION_S:
+                    raise ValueError('duration_s must be between 0 and {}'.format(
+                        Profiler.MAX_DURATION_S))
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            return JsonResponse({'error': 'Bad request: {}'.format(e)}, status=400)
+
+        if command in STATUS_ACTIONS:
+            return change_download_status(file_hash, STATUS_ACTIONS[command],
+                    bool(request_json.get('delete_data', False)))
+        if not engines.send(file_hash.lower(), command, **request_json):
+            return JsonResponse({'error': 'No running download for {}'.format(file_hash)},
+                    status=404)
+        return HttpResponse(status=202)
+    elif request.method == 'PATCH':
+        # {"torrent": {"download_status": "pause" | "resume" | "Paused" | "In Progress" | ...}}
+        try:
+            request_json = json.loads(request.body.decode('utf-8'))
+            action = STATUS_ACTIONS[request_json['torrent']['download_status']]
+        except (ValueError, KeyError, TypeError) as e:
+            return JsonResponse({'error': 'Bad request: {}'.format(e)}, status=400)
+        return change_download_status(file_hash, action)
+    elif request.method == 'DELETE':
+        # Cancels the download. The row is kept; ?delete_data=true also removes the files.
+        delete_data = request.GET.get('delete_data', '').lower() in ('1', 'true', 'yes')
+        return change_download_status(file_hash, 'cancel', delete_data)
+    return HttpResponse(status=405)
+
+def handle_request_to_data(request, file_hash):
+    """GET ?offset=&length= reads that byte range of a running download, waiting for the pieces
+    it covers if they aren't in yet"""
+    if request.method != 'GET':
+        return HttpResponse(status=405)
+    try:
+        offset = int(request.GET.get('offset', 0))
+        length = int(request.GET['length'])
+        if not 0 < length <= MAX_READ_BYTES:
+            raise ValueError('length must be between 1 and {}'.format(MAX_READ_BYTES))
+    except (ValueError, KeyError) as e:
+        return JsonResponse({'error': 'Bad request: {}'.format(e)}, status=400)
+    try:
+        data = engines.read(file_hash.lower(), offset, length)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    except TimeoutError as e:
+        return JsonResponse({'error': str(e)}, status=504)
+    if data is None:
+        return JsonResponse({'error': 'No running download for {}'.format(file_hash)},
+                status=404)
+    return HttpResponse(data, content_type='application/octet-stream')
+
+# Accepted spellings of a status change, to the action taken
+STATUS_ACTIONS: Dict[str, str] = {
+    'pause': 'pause',
+    Torrents.DownloadStatus.PAUSED.value: 'pause',
+    'resume': 'resume',
+    Torrents.DownloadStatus.IN_PROGRESS.value: 'resume',
+    'cancel': 'cancel',
+    Torrents.DownloadStatus.CANCELLED.value: 'cancel',
+}
+
+def change_download_status(file_hash, action, delete_data=False):
+    """Pauses, resumes or cancels a torrent whether or not its download is running.
+
+    Pausing and cancelling make the download process save its state and exit. Resuming starts a
+    new one, which picks up from the saved state.
+    """
+    try:
+        torrent = Torrents.objects.get(file_hash=file_hash.lower())
+    except Torrents.DoesNotExist:
+        return HttpResponse(status=404)
+
+    if action == 'pause':
+        if not engines.send(torrent.file_hash, Command.PAUSE):
+            # Nothing running, e.g. after a server restart. Just record it.
+            Torrents.objects.filter(pk=torrent.pk,
+                    download_status=Torrents.DownloadStatus.IN_PROGRESS)\
+                .update(download_status=Torrents.DownloadStatus.PAUSED, updated_at=timezone.now())
+    elif action == 'resume':
+        if torrent.download_status in (Torrents.DownloadStatus.COMPLETED,
+                                       Torrents.DownloadStatus.CANCELLED):
+            return JsonResponse({'error': 'Torrent is {}'.format(torrent.download_status)},
+                    status=409)
+        torrent.download_status = Torrents.DownloadStatus.IN_PROGRESS
+        torrent.save(update_fields=['download_status'])
+        start_download(torrent)
+    elif action == 'cancel':
+        if not engines.send(torrent.file_hash, Command.CANCEL, delete_data=delete_data):
+            torrent.download_status = Torrents.DownloadStatus.CANCELLED
+            torrent.save(update_fields=['download_status'])
+            if delete_data:
+                metainfo = tracker.decode_torrent_file(torrent.torrent_file_path)
+                output_directory = default_output_directory(torrent.file_hash)
+                disk_io.delete_download(disk_io.FileLayout(metainfo['info'], output_directory),
+                        output_directory)
+    return HttpResponse(status=202)
+
+def parse_file_priorities(request_json, current_priorities):
+    """Accepts either a full list of priority names, or a dict of file index -> priority name"""
+    priorities = request_json['priorities']
+    if isinstance(priorities, list):
+        if len(priorities) != len(current_priorities):
+            raise ValueError('Expected {} priorities, got {}'
+                    .format(len(current_priorities), len(priorities)))
+        updated = priorities
+    elif isinstance(priorities, dict):
+        updated = list(current_priorities)
+        for index, priority in priorities.items():
+            index = int(index)
+            if index < 0 or index >= len(updated):
+                raise ValueError('No file with index {}'.format(index))
+            updated[index] = priority
+    else:
+        raise ValueError('priorities must be a list or an object')
+
+    return [Priority.from_name(p).name.lower() for p in updated]
+
+def handle_request_to_priorities(request, file_hash):
+    try:
+        torrent = Torrents.objects.get(file_hash=file_hash.lower())
+    except Torrents.DoesNotExist:
+        return HttpResponse(status=404)
+
+    metainfo = tracker.decode_torrent_file(torrent.torrent_file_path)
+    layout = disk_io.FileLayout(metainfo['info'], '')
+    priorities = torrent.file_priorities or [Priority.NORMAL.name.lower()] * len(layout)
+
+    if request.method == 'POST':
+        try:
+            request_json = json.loads(request.body.decode('utf-8'))
+            priorities = parse_file_priorities(request_json, priorities)
+        except (ValueError, KeyError) as e:
+            return JsonResponse({'error': str(e)}, status=400)
+
+        torrent.file_priorities = priorities
+        torrent.save(update_fields=['file_priorities'])
+        # A running download picks them up right away, a stopped one when it's next started
+        engines.send(torrent.file_hash, Command.SET_FILE_PRIORITIES, priorities=priorities)
+    elif request.method != 'GET':
+        return HttpResponse(status=405)
+
+    files = [{'index': i, 'path': path, 'length': length, 'priority': priority}
+            for i, ((path, length, _), priority) in enumerate(zip(layout.files, priorities))]
+    return JsonResponse({'files': files})
+
+def handle_progress_stream(request):
+    """Streams live progress as server-sent events.
+
+    Each event carries only the fields that changed for one torrent, plus its file_hash. Updates
+    are coalesced so a client gets at most one batch every TOURINT_PROGRESS_STREAM_INTERVAL_S.
+    Pass ?file_hash=... to follow a single torrent.
+
+    A plain generator, so it streams under WSGI (runserver) as well as ASGI. Under WSGI every
+    connected client holds one server thread for as long as it stays connected.
+    """
+    if request.method != 'GET':
+        return HttpResponse(status=405)
+
+    interval = getattr(settings, 'TOURINT_PROGRESS_STREAM_INTERVAL_S', 0.5)
+    file_hash = request.GET.get('file_hash')
+
+    def event_stream():
+        subscription = events.broker.subscribe(file_hash)
+        try:
+            yield 'retry: 2000\n\n'
+            while True:
+                batch = subscription.next_batch(STREAM_KEEP_ALIVE_S)
+                if not batch:
+                    yield ': keep-alive\n\n'
+                    continue
+
+                for torrent_hash, changed in batch.items():
+                    data = json.dumps(dict(changed, file_hash=torrent_hash))
+                    yield 'event: progress\ndata: {}\n\n'.format(data)
+                # Let the next batch accumulate for the rest of the interval
+                time.sleep(interval)
+        finally:
+            events.broker.unsubscribe(subscription)
+
+    response = StreamingHttpResponse(event_stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+def handle_metrics(request):
+    """Serves the engine metrics of every download started since the server started, in the
+    Prometheus text format, labelled by torrent. A stopped download keeps its last values."""
+    if request.method != 'GET':
+        return HttpResponse(status=405)
+    collections = [({'torrent': file_hash}, collected)
+            for file_hash, collected in sorted(events.get_engine_metrics().items())]
+    return HttpResponse(metrics.render(collections), content_type=METRICS_CONTENT_TYPE)
@@ -9,6 +9,17 @@ export const getTorrents = () => {
   });
 };
 
+// Calls onProgress with the changed fields of one torrent (always including file_hash) every
+// time the server pushes an update. Returns the EventSource so the caller can close it.
+export const subscribeToProgress = (onProgress, onError) => {
+  const source = new EventSource(`${apiUrl}events/`);
+  source.addEventListener("progress", (event) =>
+    onProgress(JSON.parse(event.data))
+  );
+  if (onError) source.onerror = onError;
+  return source;
+};
+
 export const createTorrent = (formData) => {
   return axios({
     url: apiUrl,
@@ -24,7 +35,7 @@ export const createTorrent = (formData) => {
 
 export const updateStatus = (file_hash, statusRequest) => {
   return axios({
-    url: `${apiUrl}/${file_hash}`,
+    url: `${apiUrl}${file_hash}/`,
     method: "PATCH",
     data: {
       torrent: {
@@ -36,7 +47,7 @@ export const updateStatus = (file_hash, statusRequest) => {
 
 export const deleteTorrent = (torrent_hash) => {
   return axios({
-    url: `${apiUrl}/${torrent_hash}`,
+    url: `${apiUrl}${torrent_hash}/`,
     method: "DELETE",
   });
 };
@@ -1,14 +1,63 @@
 import React, { useEffect, useState } from "react";
 import TorrentCard from "./TorrentCard";
 import { TableContainer } from "../styles/TorrentTableStyles";
-import { getTorrents } from "../api/torrent";
+import { getTorrents, subscribeToProgress } from "../api/torrent";
+
+// Polling interval while no progress stream is delivering updates
+const FALLBACK_POLL_MS = 2000;
+// Refresh interval for the list itself while the stream is live
+const LIST_REFRESH_MS = 30000;
+
+// Merges a pushed progress update into the matching torrent
+const applyProgress = (torrentData, update) => {
+  if (!torrentData || !torrentData.data) return torrentData;
+  const { file_hash, download_rate_bps, ...fields } = update;
+  return {
+    ...torrentData,
+    data: torrentData.data.map((torrent) =>
+      torrent.file_hash === file_hash
+        ? {
+            ...torrent,
+            ...fields,
+            ...(download_rate_bps !== undefined && {
+              speed: `${(download_rate_bps / 1e6).toFixed(1)} MB/s`,
+            }),
+          }
+        : torrent
+    ),
+  };
+};
 
 function TorrentTable() {
   useEffect(() => {
-    const interval = setInterval(() => {
-      getTorrents().then((data) => setTorrentData(data));
-    }, 2000);
-    return () => clearInterval(interval);
+    // Shows the newest page of the paginated list, polled every 2s until the progress stream
+    // delivers its first update. From then on the stream keeps the numbers current and the page
+    // is only refetched every 30s to pick up new torrents. Losing the stream goes back to 2s.
+    const refresh = () =>
+      getTorrents().then((response) =>
+        setTorrentData({ data: response.data.results })
+      );
+    let streaming = false;
+    let interval = setInterval(refresh, FALLBACK_POLL_MS);
+    const setPolling = (live) => {
+      if (live === streaming) return;
+      streaming = live;
+      clearInterval(interval);
+      interval = setInterval(refresh, live ? LIST_REFRESH_MS : FALLBACK_POLL_MS);
+    };
+    refresh();
+    const source = subscribeToProgress(
+      (update) => {
+        setPolling(true);
+        if (!update.file_hash) return;
+        setTorrentData((current) => applyProgress(current, update));
+      },
+      () => setPolling(false)
+    );
+    return () => {
+      clearInterval(interval);
+      source.close();
+    };
   }, []);
 
   const [torrentData, setTorrentData] = useState([]);